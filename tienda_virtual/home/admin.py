@@ -1,16 +1,22 @@
 from django.contrib import admin
+from django.core.paginator import EmptyPage, Paginator
+from django.utils.functional import cached_property
 from django.utils.html import format_html
 from django.db.models import Sum
-from django.db import models
+from django.db import connections, models
 from django.forms import NumberInput
 
 from .models import (
+    AlertaStock,
     Articulo,
     Cliente,
     Escaparate,
+    HistorialEstadoPedido,
     ItemPedido,
     Pedido,
     Producto,
+    RankingProducto,
+    RecomendacionProducto,
     ImagenProducto,
     Marca,
     Categoria,
@@ -18,7 +24,84 @@ from .models import (
     Carrito, 
     ItemCarrito,
     MensajeContacto,
+    Promocion,
+    ReservaStock,
 )
+from .miniaturas import miniatura_url
+
+
+class PaginadorEstimado(Paginator):
+    """
+    Paginador que evita el COUNT(*) exacto en tablas grandes.
+
+    Sin filtros y en PostgreSQL usa la estimación del planificador
+    (`pg_class.reltuples`). En el resto de casos cuenta como mucho
+    `LIMITE_CONTEO` filas, así que el coste no crece con la tabla.
+
+    La estimación solo se usa para el total que se muestra: al pedir la
+    última página estimada o una posterior se cuenta de verdad, para que las
+    filas de más allá del límite (los pedidos antiguos) sigan accesibles.
+    """
+    LIMITE_CONTEO = 10000
+
+    estimado = False
+
+    @cached_property
+    def count(self):
+        qs = self.object_list
+        query = getattr(qs, "query", None)
+        if query is None:
+            return super().count
+
+        connection = connections[qs.db]
+        if connection.vendor == "postgresql" and not query.where:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT reltuples::bigint FROM pg_class WHERE relname = %s",
+                    [qs.model._meta.db_table],
+                )
+                fila = cursor.fetchone()
+            if fila and fila[0] >= self.LIMITE_CONTEO:
+                self.estimado = True
+                return int(fila[0])
+
+        contadas = qs.order_by()[:self.LIMITE_CONTEO + 1].count()
+        if contadas > self.LIMITE_CONTEO:
+            self.estimado = True
+            return self.LIMITE_CONTEO
+        return contadas
+
+    def _contar_exacto(self):
+        self.__dict__["count"] = self.object_list.order_by().count()
+        self.__dict__.pop("num_pages", None)
+        self.estimado = False
+
+    def validate_number(self, number):
+        try:
+            numero = super().validate_number(number)
+        except EmptyPage:
+            if not self.estimado:
+                raise
+            self._contar_exacto()
+            return super().validate_number(number)
+        if self.estimado and numero >= self.num_pages:
+            self._contar_exacto()
+            numero = super().validate_number(number)
+        return numero
+
+
+class AdminEscalable(admin.ModelAdmin):
+    """Base para los admins de tablas que pueden crecer mucho."""
+    paginator = PaginadorEstimado
+    show_full_result_count = False
+    list_per_page = 50
+
+
+def miniatura_preview(imagen):
+    url = miniatura_url(imagen)
+    if url:
+        return format_html('<img src="{}" style="max-height:50px;" loading="lazy"/>', url)
+    return "-"
 
 #Inlines
 class ImagenProductoInline(admin.TabularInline):
@@ -28,25 +111,24 @@ class ImagenProductoInline(admin.TabularInline):
     readonly_fields = ("imagen_preview",)
 
     def imagen_preview(self, obj):
-        if obj.imagen:
-            return format_html('<img src="{}" style="max-height:50px;"/>', obj.imagen.url)
-        return "-"
+        return miniatura_preview(obj.imagen)
 
 class TallaProductoInline(admin.TabularInline):
     model = TallaProducto
     extra = 1
-    fields = ("talla", "stock")
+    fields = ("talla", "stock", "umbral_stock_bajo")
 
 
 
 
 @admin.register(Producto)
-class ProductoAdmin(admin.ModelAdmin):
+class ProductoAdmin(AdminEscalable):
     list_display = (
         "nombre",
         "precio",
         "precio_oferta",
         "stock",
+        "umbral_stock_bajo",
         "esta_disponible",
         "es_destacado",
         "marca",
@@ -55,6 +137,8 @@ class ProductoAdmin(admin.ModelAdmin):
     readonly_fields = ()
     list_filter = ("esta_disponible", "es_destacado", "marca", "categoria")
     search_fields = ("nombre", "descripcion", "color", "material", "genero")
+    list_select_related = ("marca", "categoria")
+    autocomplete_fields = ("marca", "categoria")
     inlines = [ImagenProductoInline, TallaProductoInline]
 
    
@@ -64,26 +148,37 @@ class ProductoAdmin(admin.ModelAdmin):
     }
 
     def imagen_preview(self, obj):
-        if obj.imagen:
-            return format_html('<img src="{}" style="max-height:50px;"/>', obj.imagen.url)
-        return "-"
+        return miniatura_preview(obj.imagen)
 
 @admin.register(TallaProducto)
-class TallaProductoAdmin(admin.ModelAdmin):
-    list_display = ("producto", "talla", "stock")
+class TallaProductoAdmin(AdminEscalable):
+    list_display = ("producto", "talla", "stock", "umbral_stock_bajo")
     list_filter = ("talla",)
     search_fields = ("producto__nombre",)
+    list_select_related = ("producto",)
+    autocomplete_fields = ("producto",)
+
+@admin.register(AlertaStock)
+class AlertaStockAdmin(AdminEscalable):
+    list_display = ("producto", "talla", "stock", "umbral", "fecha_creacion", "fecha_notificacion")
+    list_select_related = ("producto", "talla__producto")
+    search_fields = ("producto__nombre",)
+    readonly_fields = ("producto", "talla", "stock", "umbral", "fecha_creacion", "fecha_notificacion")
+
+    def has_add_permission(self, request):
+        # Las alertas se generan solas al cambiar el stock
+        return False
 
 @admin.register(ImagenProducto)
-class ImagenProductoAdmin(admin.ModelAdmin):
+class ImagenProductoAdmin(AdminEscalable):
     list_display = ("producto", "es_principal", "imagen_preview")
     list_filter = ("es_principal",)
     search_fields = ("producto__nombre",)
+    list_select_related = ("producto",)
+    autocomplete_fields = ("producto",)
 
     def imagen_preview(self, obj):
-        if obj.imagen:
-            return format_html('<img src="{}" style="max-height:50px;"/>', obj.imagen.url)
-        return "-"
+        return miniatura_preview(obj.imagen)
 
     imagen_preview.short_description = "Imagen"
 
@@ -93,9 +188,7 @@ class MarcaAdmin(admin.ModelAdmin):
     search_fields = ("nombre",)
 
     def imagen_preview(self, obj):
-        if obj.imagen:
-            return format_html('<img src="{}" style="max-height:50px;"/>', obj.imagen.url)
-        return "-"
+        return miniatura_preview(obj.imagen)
 
     imagen_preview.short_description = "Imagen"
 
@@ -105,15 +198,28 @@ class CategoriaAdmin(admin.ModelAdmin):
     search_fields = ("nombre",)
 
     def imagen_preview(self, obj):
-        if obj.imagen:
-            return format_html('<img src="{}" style="max-height:50px;"/>', obj.imagen.url)
-        return "-"
+        return miniatura_preview(obj.imagen)
 
     imagen_preview.short_description = "Imagen"
 
 
+class HistorialEstadoPedidoInline(admin.TabularInline):
+    model = HistorialEstadoPedido
+    extra = 0
+    fields = ("fecha", "estado_anterior", "estado_nuevo", "usuario", "nota")
+    readonly_fields = fields
+    can_delete = False
+
+    def get_queryset(self, request):
+        # evita una consulta por fila al mostrar el usuario
+        return super().get_queryset(request).select_related("usuario")
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
 @admin.register(Pedido)
-class PedidoAdmin(admin.ModelAdmin):
+class PedidoAdmin(AdminEscalable):
     list_display = (
         "numero_pedido",
         "cliente",
@@ -123,11 +229,18 @@ class PedidoAdmin(admin.ModelAdmin):
     )
     list_filter = ("estado", "fecha_creacion")
     search_fields = ("numero_pedido", "cliente__nombre", "cliente__email")
-    readonly_fields = ("subtotal", "total", "fecha_creacion")
+    list_select_related = ("cliente",)
+    autocomplete_fields = ("cliente",)
+    # El estado solo cambia a través de Pedido.cambiar_estado (panel de administración)
+    readonly_fields = (
+        "estado", "stock_descontado", "en_recomendaciones", "subtotal", "total", "fecha_creacion",
+        "clave_idempotencia", "sesion_stripe_id", "sesion_stripe_url",
+    )
+    inlines = [HistorialEstadoPedidoInline]
 
 
 @admin.register(ItemPedido)
-class ItemPedidoAdmin(admin.ModelAdmin):
+class ItemPedidoAdmin(AdminEscalable):
     list_display = (
         "pedido",
         "producto",
@@ -138,12 +251,41 @@ class ItemPedidoAdmin(admin.ModelAdmin):
     )
     list_filter = ("pedido__estado",)
     search_fields = ("pedido__numero_pedido", "producto__nombre")
+    list_select_related = ("pedido", "producto")
+    autocomplete_fields = ("pedido", "producto")
+
+
+@admin.register(RankingProducto)
+class RankingProductoAdmin(AdminEscalable):
+    list_display = ("producto", "genero", "categoria", "unidades_vendidas", "tendencia", "fecha_calculo")
+    list_filter = ("genero", "categoria")
+    list_select_related = ("producto", "categoria")
+    search_fields = ("producto__nombre",)
+    readonly_fields = ("producto", "genero", "categoria", "unidades_vendidas", "tendencia", "fecha_calculo")
+
+    def has_add_permission(self, request):
+        # Se calculan con el comando calcular_rankings
+        return False
+
+
+@admin.register(RecomendacionProducto)
+class RecomendacionProductoAdmin(AdminEscalable):
+    list_display = ("producto", "posicion", "recomendado", "puntuacion")
+    list_select_related = ("producto", "recomendado")
+    search_fields = ("producto__nombre",)
+    readonly_fields = ("producto", "recomendado", "posicion", "puntuacion")
+
+    def has_add_permission(self, request):
+        # Se calculan con el comando actualizar_recomendaciones
+        return False
 
 
 @admin.register(Cliente)
-class ClienteAdmin(admin.ModelAdmin):
+class ClienteAdmin(AdminEscalable):
     list_display = ("nombre", "apellidos", "email", "telefono", "user", "fecha_creacion")
     search_fields = ("nombre", "apellidos", "email", "user__username")
+    list_select_related = ("user",)
+    autocomplete_fields = ("user",)
     readonly_fields = ("fecha_creacion",)
 
 
@@ -152,15 +294,18 @@ class ItemCarritoInline(admin.TabularInline):
     extra = 0
     fields = ("producto", "talla", "cantidad")
     readonly_fields = ()
+    autocomplete_fields = ("producto",)
 
 
 @admin.register(Carrito)
-class CarritoAdmin(admin.ModelAdmin):
+class CarritoAdmin(AdminEscalable):
     list_display = ("id", "cliente", "fecha_creacion", "fecha_actualizacion", "total_items")
     search_fields = ("cliente__nombre", "cliente__email")
     list_filter = ("fecha_creacion",)
     readonly_fields = ("fecha_creacion", "fecha_actualizacion")
     inlines = [ItemCarritoInline]
+    list_select_related = ("cliente",)
+    autocomplete_fields = ("cliente",)
 
     def get_queryset(self, request):
         qs = super().get_queryset(request)
@@ -178,12 +323,36 @@ class CarritoAdmin(admin.ModelAdmin):
 
 
 @admin.register(ItemCarrito)
-class ItemCarritoAdmin(admin.ModelAdmin):
+class ItemCarritoAdmin(AdminEscalable):
     list_display = ("carrito", "producto", "talla", "cantidad")
     search_fields = ("producto__nombre", "carrito__cliente__nombre")
+    list_select_related = ("carrito__cliente", "producto")
+    autocomplete_fields = ("carrito", "producto")
+
+
+@admin.register(ReservaStock)
+class ReservaStockAdmin(AdminEscalable):
+    list_display = ("producto", "talla", "cantidad", "carrito", "expira")
+    list_select_related = ("producto", "carrito")
+    search_fields = ("producto__nombre",)
+    readonly_fields = ("carrito", "producto", "talla", "cantidad", "expira")
+
+    def has_add_permission(self, request):
+        # Se crean desde el carrito (ver home/reservas.py)
+        return False
+
+
+@admin.register(Promocion)
+class PromocionAdmin(AdminEscalable):
+    list_display = ("nombre", "codigo", "tipo", "valor", "activa", "fecha_inicio", "fecha_fin")
+    list_filter = ("activa", "tipo")
+    search_fields = ("nombre", "codigo")
+    autocomplete_fields = ("producto", "categoria", "marca")
+    readonly_fields = ("fecha_actualizacion",)
+
 
 @admin.register(MensajeContacto)
-class MensajeContactoAdmin(admin.ModelAdmin):
+class MensajeContactoAdmin(AdminEscalable):
     list_display = ("nombre", "email", "fecha")
     search_fields = ("nombre", "email", "mensaje")
 
@@ -15,6 +15,7 @@ urlpatterns = [
     path('clientes/crear/', admin_views.admin_cliente_crear, name='cliente_crear'),
     path('clientes/editar/<int:cliente_id>/', admin_views.admin_cliente_editar, name='cliente_editar'),
     path('clientes/eliminar/<int:cliente_id>/', admin_views.admin_cliente_eliminar, name='cliente_eliminar'),
+    path('stock-bajo/', admin_views.admin_stock_bajo, name='stock_bajo'),
     path('mensajes/', admin_views.admin_mensajes, name='mensajes'),
 ]
 
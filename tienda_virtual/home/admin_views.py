@@ -1,4 +1,5 @@
 from django.contrib import messages
+from django.core.exceptions import ValidationError
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.db.models import Count, Sum, Q
 from django.shortcuts import render, redirect, get_object_or_404
@@ -8,6 +9,7 @@ from datetime import timedelta
 from .decorators import admin_required
 from .forms import ProductoAdminForm, ClienteAdminForm
 from .models import (
+    AlertaStock,
     Cliente,
     Pedido,
     Producto,
@@ -42,8 +44,9 @@ def admin_dashboard(request):
     # Pedidos recientes
     pedidos_recientes = Pedido.objects.select_related('cliente').order_by('-fecha_creacion')[:10]
     
-    # Productos con bajo stock
-    productos_bajo_stock = Producto.objects.filter(stock__lt=10, esta_disponible=True)[:10]
+    # Alertas de stock bajo (por producto o por talla), mantenidas al cambiar el stock
+    alertas_stock = AlertaStock.objects.select_related('producto__categoria', 'talla')[:10]
+    total_alertas_stock = AlertaStock.objects.count()
     
     contexto = {
         'total_clientes': total_clientes,
@@ -54,7 +57,8 @@ def admin_dashboard(request):
         'pedidos_enviados': pedidos_enviados,
         'ventas_mes': ventas_mes,
         'pedidos_recientes': pedidos_recientes,
-        'productos_bajo_stock': productos_bajo_stock,
+        'alertas_stock': alertas_stock,
+        'total_alertas_stock': total_alertas_stock,
     }
     
     return render(request, 'admin_portal/dashboard.html', contexto)
@@ -99,10 +103,16 @@ def admin_pedido_detalle(request, pedido_id):
     
     if request.method == 'POST':
         nuevo_estado = request.POST.get('estado')
+        if nuevo_estado == pedido.estado:
+            messages.info(request, f'El pedido ya está en estado: {pedido.get_estado_display()}')
+            return redirect('admin_panel:pedido_detalle', pedido_id=pedido_id)
         if nuevo_estado in [estado[0] for estado in Pedido.Estados.choices]:
-            pedido.estado = nuevo_estado
-            pedido.save()
-            messages.success(request, f'Estado del pedido actualizado a: {pedido.get_estado_display()}')
+            try:
+                pedido.cambiar_estado(nuevo_estado, usuario=request.user)
+            except ValidationError as e:
+                messages.error(request, e.messages[0])
+            else:
+                messages.success(request, f'Estado del pedido actualizado a: {pedido.get_estado_display()}')
             return redirect('admin_panel:pedido_detalle', pedido_id=pedido_id)
     
     estados = Pedido.Estados.choices
@@ -124,12 +134,16 @@ def admin_pedido_detalle(request, pedido_id):
         else:
             estados_timeline.append({'estado': estado, 'tipo': 'pendiente'})
     
+    historial = pedido.historial_estados.select_related('usuario').order_by('-fecha', '-id')
+
     contexto = {
         'pedido': pedido,
         'items': items,
         'estados': estados,
         'estados_slider': estados_slider,
         'estados_timeline': estados_timeline,
+        'estados_siguientes': pedido.estados_siguientes(),
+        'historial': historial,
     }
     
     return render(request, 'admin_portal/pedido_detalle.html', contexto)
@@ -391,7 +405,7 @@ def admin_cliente_eliminar(request, cliente_id):
         return redirect('admin_panel:clientes')
     
     # No eliminar si es el cliente actual (el admin que está logueado)
-    if request.user.is_authenticated and request.user.cliente and request.user.cliente.id == cliente.id:
+    if request.cliente and request.cliente.pk == cliente.id:
         messages.error(request, 'No puedes eliminar tu propio perfil de cliente.')
         return redirect('admin_panel:clientes')
     
@@ -408,6 +422,34 @@ def admin_cliente_eliminar(request, cliente_id):
     return redirect('admin_panel:clientes')
 
 
+@admin_required
+def admin_stock_bajo(request):
+    """Productos y tallas que necesitan reposición"""
+    alertas_list = AlertaStock.objects.select_related('producto__categoria', 'talla')
+
+    categoria_filtro = request.GET.get('categoria', '')
+    if categoria_filtro:
+        alertas_list = alertas_list.filter(producto__categoria_id=categoria_filtro)
+
+    # Paginación
+    paginator = Paginator(alertas_list, 20)  # 20 alertas por página
+    page = request.GET.get('page')
+    try:
+        alertas = paginator.page(page)
+    except PageNotAnInteger:
+        alertas = paginator.page(1)
+    except EmptyPage:
+        alertas = paginator.page(paginator.num_pages)
+
+    contexto = {
+        'alertas': alertas,
+        'categorias': Categoria.objects.all().order_by('nombre'),
+        'categoria_filtro': categoria_filtro,
+    }
+
+    return render(request, 'admin_portal/stock_bajo.html', contexto)
+
+
 @admin_required
 def admin_mensajes(request):
     """Mensajes de contacto"""
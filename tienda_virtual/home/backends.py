@@ -0,0 +1,19 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+
+UserModel = get_user_model()
+
+
+class ClienteBackend(ModelBackend):
+    """
+    `ModelBackend` que carga el usuario de la sesión junto con su `Cliente`
+    (`select_related`): `request.user.cliente` y `request.cliente` (ver
+    `home/middleware.py`) ya no hacen otra consulta.
+    """
+
+    def get_user(self, user_id):
+        try:
+            user = UserModel._default_manager.select_related("cliente").get(pk=user_id)
+        except UserModel.DoesNotExist:
+            return None
+        return user if self.user_can_authenticate(user) else None
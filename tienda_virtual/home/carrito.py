@@ -0,0 +1,558 @@
+"""
+Carrito de la web y su sincronización por versiones con `cart.js`.
+
+El carrito se guarda en `Carrito`/`ItemCarrito`; la sesión solo guarda el id
+(`carrito_id`), que se conserva al iniciar sesión. Cada cambio pasa por
+`_cas()`: lee la versión y las líneas, calcula el carrito nuevo y lo escribe
+con `UPDATE ... WHERE version = <leída>`. Si otra petición ha cambiado el
+carrito entretanto, el UPDATE no toca ninguna fila y se vuelve a intentar con
+los datos nuevos. Así dos peticiones simultáneas (doble clic, varias pestañas)
+no se pisan, cosa que sí pasaba al reescribir el dict entero de la sesión.
+
+Cada línea guarda la versión en la que cambió (las quitadas se quedan con
+cantidad 0), lo que permite:
+
+- Que las vistas que modifican el carrito respondan solo con las líneas
+  cambiadas desde la versión que tiene el navegador (`since_version`) y los
+  totales, en lugar del carrito entero con imágenes y stock de cada línea.
+- Que `cart/status` acepte `since_version` y responda `304` si el
+  `If-None-Match` coincide (versión del carrito y fecha de sus productos).
+
+Si el navegador no manda versión, o es de otro carrito, se responde con el
+carrito completo en el formato de siempre (`cart_items`).
+
+`cart/batch` recibe varias operaciones seguidas (los clics en +/- que
+`cart.js` agrupa) y las aplica con `aplicar_operaciones()`: una sola consulta
+de stock y una sola escritura.
+
+Formato de una respuesta parcial (`cart_delta: true`):
+
+- `cart_changes`: líneas nuevas o modificadas, incluidas las demás líneas del
+  mismo producto, porque su stock restante depende de ellas.
+- `cart_removed`: claves ("<producto_id>:<talla>") que ya no están.
+- `cart_count`, `cart_total`, `cart_version` y `remaining_by_product` de los
+  productos afectados.
+
+Limpieza: `purgar()` (desde `manage.py liberar_reservas`) borra las líneas
+quitadas y los carritos sin cliente que llevan `CARRITO_ABANDONADO_DIAS` sin
+cambios. Al borrar las líneas quitadas de un carrito sube su
+`version_inicial` hasta la de la última borrada: un navegador que venga de
+antes ya no puede enterarse del borrado por el delta y recibe el carrito
+completo.
+
+Con `RESERVA_STOCK_MINUTOS` cada cambio aparta además el stock de las líneas
+cambiadas en la misma transacción (ver `home/reservas.py`), y el stock
+restante descuenta lo reservado por otros carritos.
+"""
+import datetime
+import random
+import time
+from collections import Counter
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, OperationalError, transaction
+from django.db.models import F, Max
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from . import metricas, reservas
+from .models import Carrito, ItemCarrito, Producto
+
+CLAVE_SESION = "carrito_id"
+MAX_REINTENTOS = 20
+
+OPERACIONES = ("add", "decrement", "remove", "update")
+MAX_OPERACIONES = 50
+TAMANO_LOTE = 1000
+
+
+def _clave(producto_id, talla):
+    return f"{producto_id}:{talla or ''}"
+
+
+def _crear_carrito(session):
+    if session.session_key is None:
+        session.save()
+    # La primera versión es la hora en ms: un carrito nuevo (tras cerrar
+    # sesión) no repite las versiones que el navegador conocía del anterior.
+    inicial = int(time.time() * 1000)
+    try:
+        carrito, _ = Carrito.objects.get_or_create(
+            clave_sesion=session.session_key,
+            defaults={"version": inicial, "version_inicial": inicial},
+        )
+    except IntegrityError:
+        # otra petición de la misma sesión lo ha creado a la vez
+        carrito = Carrito.objects.get(clave_sesion=session.session_key)
+    session[CLAVE_SESION] = carrito.pk
+    return carrito
+
+
+def obtener_carrito(request, crear=False):
+    """
+    Carrito de la sesión, o None si aún no tiene (salvo con `crear`). Si la
+    sesión trae un carrito antiguo (`session['cart']`), lo pasa a la base de
+    datos.
+    """
+    carrito = getattr(request, "_carrito", None)
+    session = request.session
+    if carrito is None:
+        pk = session.get(CLAVE_SESION)
+        if pk:
+            carrito = Carrito.objects.filter(pk=pk).first()
+        elif session.session_key:
+            carrito = Carrito.objects.filter(clave_sesion=session.session_key).first()
+
+    antiguo = session.pop("cart", None) if "cart" in session else None
+    if carrito is None and (crear or antiguo):
+        carrito = _crear_carrito(session)
+    if antiguo and isinstance(antiguo, dict):
+        _importar(carrito, antiguo)
+
+    request._carrito = carrito
+    return carrito
+
+
+def _importar(carrito, antiguo):
+    """Sustituye las líneas del carrito por las de un carrito de sesión antiguo."""
+    nuevo = {}
+    for clave, qty in antiguo.items():
+        try:
+            pid, talla = _partir(clave)
+            cantidad = int(qty)
+        except (TypeError, ValueError):
+            continue
+        if cantidad > 0:
+            nuevo[_clave(pid, talla)] = cantidad
+    existentes = set(
+        Producto.objects.filter(pk__in={_partir(c)[0] for c in nuevo}).values_list("id", flat=True)
+    )
+    nuevo = {clave: cantidad for clave, cantidad in nuevo.items() if _partir(clave)[0] in existentes}
+    _cas(carrito, lambda cart: (nuevo, set(cart) | set(nuevo)))
+
+
+def _leer_lineas(carrito_id):
+    filas = (
+        ItemCarrito.objects.filter(carrito_id=carrito_id, cantidad__gt=0)
+        .order_by("id")
+        .values_list("producto_id", "talla", "cantidad")
+    )
+    return {_clave(pid, talla): cantidad for pid, talla, cantidad in filas}
+
+
+def _escribir_lineas(carrito_id, nuevo, claves, version):
+    filas = []
+    for clave in claves:
+        pid, talla = _partir(clave)
+        filas.append(ItemCarrito(
+            carrito_id=carrito_id,
+            producto_id=pid,
+            talla=talla,
+            cantidad=nuevo.get(clave, 0),
+            version=version,
+        ))
+    ItemCarrito.objects.bulk_create(
+        filas,
+        update_conflicts=True,
+        unique_fields=["carrito", "producto", "talla"],
+        update_fields=["cantidad", "version"],
+    )
+
+
+def _cas(carrito, funcion):
+    """
+    Aplica `funcion(cart) -> (nuevo, claves_cambiadas)` al carrito con
+    compare-and-swap sobre `Carrito.version`, reintentando si otra petición lo
+    ha cambiado entretanto. Devuelve las claves cambiadas.
+    """
+    for intento in range(MAX_REINTENTOS):
+        try:
+            # La versión se lee antes que las líneas: si cambian en medio, el UPDATE falla
+            version = Carrito.objects.values_list("version", flat=True).get(pk=carrito.pk)
+            cart = _leer_lineas(carrito.pk)
+            nuevo, claves = funcion(cart)
+            if not claves:
+                return set()
+            with transaction.atomic():
+                actualizado = Carrito.objects.filter(pk=carrito.pk, version=version).update(
+                    version=version + 1, fecha_actualizacion=timezone.now()
+                )
+                if actualizado:
+                    _escribir_lineas(carrito.pk, nuevo, claves, version + 1)
+                    reservas.reservar(
+                        carrito,
+                        [(*_partir(clave), nuevo.get(clave, 0)) for clave in claves],
+                    )
+            if actualizado:
+                carrito.version = version + 1
+                return claves
+        except OperationalError:
+            # SQLite: la base de datos está bloqueada por otra escritura
+            pass
+        time.sleep(random.uniform(0, 0.005 * (intento + 1)))
+    raise ValidationError("El carrito está ocupado, inténtalo de nuevo")
+
+
+def _purgar_lineas_quitadas(carrito_ids):
+    borradas = 0
+    with transaction.atomic():
+        ultimas = dict(
+            ItemCarrito.objects.filter(carrito_id__in=carrito_ids, cantidad=0)
+            .values("carrito_id")
+            .annotate(ultima=Max("version"))
+            .values_list("carrito_id", "ultima")
+        )
+        for carrito_id, ultima in ultimas.items():
+            Carrito.objects.filter(pk=carrito_id).update(version_inicial=Greatest(F("version_inicial"), ultima))
+            # Las quitadas después de leer `ultima` se quedan para la siguiente pasada
+            borradas += ItemCarrito.objects.filter(
+                carrito_id=carrito_id, cantidad=0, version__lte=ultima
+            ).delete()[0]
+    return borradas
+
+
+def purgar(dias=None, ahora=None, tamano_lote=TAMANO_LOTE):
+    """
+    Borra por lotes los carritos sin cliente abandonados hace más de `dias` y
+    las líneas quitadas (cantidad 0) del resto. Devuelve (carritos, líneas).
+    """
+    if dias is None:
+        dias = getattr(settings, "CARRITO_ABANDONADO_DIAS", 30)
+    limite = (ahora or timezone.now()) - datetime.timedelta(days=dias)
+    carritos = 0
+    while True:
+        ids = list(
+            Carrito.objects.filter(cliente__isnull=True, fecha_actualizacion__lt=limite)
+            .order_by("fecha_actualizacion")
+            .values_list("id", flat=True)[:tamano_lote]
+        )
+        if not ids:
+            break
+        carritos += Carrito.objects.filter(
+            pk__in=ids, cliente__isnull=True, fecha_actualizacion__lt=limite
+        ).delete()[1].get(Carrito._meta.label, 0)
+
+    lineas = 0
+    desde = 0
+    while True:
+        ids = list(
+            ItemCarrito.objects.filter(cantidad=0, carrito_id__gt=desde)
+            .order_by("carrito_id")
+            .values_list("carrito_id", flat=True)
+            .distinct()[:tamano_lote]
+        )
+        if not ids:
+            return carritos, lineas
+        lineas += _purgar_lineas_quitadas(ids)
+        desde = ids[-1]
+
+
+def modificar(request, operaciones, stock_sin_tallas=True):
+    """
+    Aplica operaciones (ver `aplicar_operaciones`) al carrito de la sesión.
+    Lanza `ValidationError` si alguna no es válida.
+    """
+    carrito = obtener_carrito(request, crear=True)
+    try:
+        claves = _cas(carrito, lambda cart: aplicar_operaciones(cart, operaciones, stock_sin_tallas))
+    except ValidationError:
+        _contar_operaciones(operaciones, "error")
+        raise
+    _contar_operaciones(operaciones, "ok")
+    return claves
+
+
+def _contar_operaciones(operaciones, resultado):
+    for operacion in operaciones[:MAX_OPERACIONES] if isinstance(operaciones, list) else ():
+        nombre = operacion.get("op") if isinstance(operacion, dict) else None
+        metricas.carrito_operaciones.inc(
+            operacion=nombre if nombre in OPERACIONES else "otra", resultado=resultado
+        )
+
+
+def vaciar(request):
+    carrito = obtener_carrito(request)
+    if carrito is not None:
+        _cas(carrito, lambda cart: ({}, set(cart)))
+        metricas.carrito_operaciones.inc(operacion="vaciar", resultado="ok")
+
+
+def leer_carrito(request):
+    """Contenido del carrito como dict {"<producto_id>:<talla>": cantidad}."""
+    carrito = obtener_carrito(request)
+    return _leer_lineas(carrito.pk) if carrito is not None else {}
+
+
+def _estado(request):
+    """(carrito, versión, líneas), leyendo la versión antes que las líneas."""
+    carrito = obtener_carrito(request)
+    if carrito is None:
+        return None, 0, {}
+    version = Carrito.objects.values_list("version", flat=True).get(pk=carrito.pk)
+    return carrito, version, _leer_lineas(carrito.pk)
+
+
+def estado_usuario(request):
+    """Identifica el contenido del carrito para los ETag (ver `home/condicional.py`)."""
+    carrito = obtener_carrito(request)
+    if carrito is None:
+        return None
+    version = Carrito.objects.values_list("version", flat=True).get(pk=carrito.pk)
+    return (carrito.pk, version, reservas.version_reservas(carrito))
+
+
+def leer_version(valor):
+    try:
+        return int(valor)
+    except (TypeError, ValueError):
+        return None
+
+
+def version_cliente(request):
+    """Versión del carrito que tiene el navegador (`since_version`), o None."""
+    return leer_version(request.GET.get("since_version") or request.POST.get("since_version"))
+
+
+def claves_cambiadas(carrito, version, desde):
+    """Claves cambiadas después de la versión `desde`, o None si no se pueden saber."""
+    if desde is None or desde > version:
+        return None
+    if desde == version:
+        return set()
+    if carrito is None or desde < carrito.version_inicial:
+        return None
+    filas = ItemCarrito.objects.filter(carrito=carrito, version__gt=desde).values_list("producto_id", "talla")
+    return {_clave(pid, talla) for pid, talla in filas}
+
+
+def _partir(clave):
+    """Clave "<producto_id>:<talla>" (o la antigua "<producto_id>") → (id, talla)."""
+    pid, _, talla = str(clave).partition(":")
+    return int(pid), talla
+
+
+def _entradas(cart):
+    entradas = []
+    for clave, qty in cart.items():
+        try:
+            pid, talla = _partir(clave)
+            entradas.append((str(clave), pid, talla, int(qty)))
+        except (TypeError, ValueError):
+            continue
+    return entradas
+
+
+def _lineas(entradas, producto_ids, carrito=None):
+    """
+    Líneas del carrito (formato de `cart_items`) de los productos indicados y
+    el stock restante de los que no tienen tallas, más el total de esas
+    líneas. Tres consultas en total (cuatro con reservas).
+    """
+    otras = reservas.reservadas_por_otros(carrito.pk if carrito else None, producto_ids)
+    productos = Producto.objects.filter(pk__in=producto_ids).prefetch_related("tallas", "imagenes")
+    productos = {p.id: p for p in productos}
+    por_producto = Counter()
+    for _, pid, _, cantidad in entradas:
+        por_producto[pid] += cantidad
+
+    lineas = []
+    restantes = {}
+    total = Decimal("0.00")
+    for clave, pid, talla, cantidad in entradas:
+        prod = productos.get(pid)
+        if prod is None:
+            continue
+        tallas = list(prod.tallas.all())
+        if talla:
+            stock = next((t.stock for t in tallas if t.talla == talla), 0)
+            remaining = max(0, stock - otras.get((pid, talla), 0) - cantidad)
+        elif tallas:
+            reservado = sum(otras.get((pid, t.talla), 0) for t in tallas)
+            remaining = max(0, sum(t.stock for t in tallas) - reservado - por_producto[pid])
+        else:
+            remaining = max(0, prod.stock - otras.get((pid, ""), 0) - por_producto[pid])
+            restantes[pid] = remaining
+
+        imagenes = list(prod.imagenes.all())
+        precio = prod.precio_efectivo
+        total += precio * cantidad
+        lineas.append({
+            'clave': clave,
+            'producto_id': prod.id,
+            'nombre': prod.nombre,
+            'cantidad': cantidad,
+            'subtotal': float(precio * cantidad),
+            'size': talla,
+            'imagen_url': imagenes[0].imagen.url if imagenes else None,
+            'precio': float(precio),
+            'remaining': remaining,
+        })
+    return lineas, restantes, total
+
+
+def respuesta_completa(cart, carrito=None):
+    entradas = _entradas(cart)
+    lineas, restantes, total = _lineas(entradas, {pid for _, pid, _, _ in entradas}, carrito)
+    return {
+        'success': True,
+        'cart_delta': False,
+        'cart_count': sum(cantidad for _, _, _, cantidad in entradas),
+        'cart_items': lineas,
+        'cart_total': float(total),
+        'remaining_by_product': restantes,
+    }
+
+
+def respuesta_parcial(cart, claves, carrito=None):
+    entradas = _entradas(cart)
+    afectados = set()
+    for clave in claves:
+        try:
+            afectados.add(_partir(clave)[0])
+        except ValueError:
+            continue
+    lineas, restantes, _ = _lineas([e for e in entradas if e[1] in afectados], afectados, carrito)
+    presentes = {linea['clave'] for linea in lineas}
+
+    # El total necesita el precio de todas las líneas, no solo de las cambiadas
+    precios = dict(
+        Producto.objects.filter(pk__in={pid for _, pid, _, _ in entradas})
+        .values_list("id", "precio_efectivo")
+    )
+    total = sum(
+        (precios[pid] * cantidad for _, pid, _, cantidad in entradas if pid in precios),
+        Decimal("0.00"),
+    )
+    return {
+        'success': True,
+        'cart_delta': True,
+        'cart_count': sum(cantidad for _, _, _, cantidad in entradas),
+        'cart_changes': lineas,
+        'cart_removed': sorted(set(claves) - presentes),
+        'cart_total': float(total),
+        'remaining_by_product': restantes,
+    }
+
+
+def respuesta(request, extra=None, desde=None):
+    """
+    Respuesta JSON del carrito: parcial si el navegador manda una versión
+    conocida (`desde`, o `since_version` de la petición).
+    """
+    if desde is None:
+        desde = version_cliente(request)
+    carrito, version, cart = _estado(request)
+    claves = claves_cambiadas(carrito, version, desde)
+    if claves is None:
+        datos = respuesta_completa(cart, carrito)
+    else:
+        datos = respuesta_parcial(cart, claves, carrito)
+    datos['cart_version'] = version
+    if extra:
+        datos.update(extra)
+    return datos
+
+
+def version_estado(request, *args, **kwargs):
+    """Versión para el ETag de `cart/status` (ver `home/condicional.py`)."""
+    entradas = _entradas(leer_carrito(request))
+    fecha = Producto.objects.filter(pk__in={pid for _, pid, _, _ in entradas}).aggregate(
+        fecha=Max("fecha_actualizacion")
+    )["fecha"]
+    return (version_cliente(request), fecha)
+
+
+def _stock_productos(producto_ids):
+    """Disponibilidad, stock y stock por talla de los productos, en una consulta."""
+    info = {}
+    filas = Producto.objects.filter(pk__in=producto_ids).values_list(
+        "id", "nombre", "esta_disponible", "stock", "tallas__talla", "tallas__stock"
+    )
+    for pid, nombre, disponible, stock, talla, stock_talla in filas:
+        datos = info.setdefault(
+            pid, {"nombre": nombre, "disponible": disponible, "stock": stock, "tallas": {}}
+        )
+        if talla is not None:
+            datos["tallas"][talla] = stock_talla
+    return info
+
+
+def _validar_stock(info, pid, talla, cantidad, stock_sin_tallas=True):
+    datos = info.get(pid)
+    if datos is None or not datos["disponible"]:
+        raise ValidationError("El producto no está disponible")
+    tallas = datos["tallas"]
+    if not tallas and not stock_sin_tallas:
+        return
+    if tallas and not talla:
+        raise ValidationError("Por favor selecciona una talla para este producto")
+    if talla and talla not in tallas:
+        raise ValidationError(f'La talla "{talla}" no es válida para este producto')
+    stock = tallas[talla] if talla else datos["stock"]
+    if cantidad > stock:
+        if talla:
+            raise ValidationError(f'No hay suficiente stock disponible para la talla "{talla}"')
+        nombre = datos["nombre"]
+        raise ValidationError(f'No hay suficiente stock disponible de "{nombre}"')
+
+
+def _leer_operacion(op):
+    if not isinstance(op, dict) or op.get("op") not in OPERACIONES:
+        raise ValidationError("Operación no válida")
+    try:
+        pid = int(op.get("product_id"))
+        cantidad = int(op.get("quantity", 1))
+    except (TypeError, ValueError):
+        raise ValidationError("Producto o cantidad no válidos")
+    if cantidad < 0:
+        raise ValidationError("Producto o cantidad no válidos")
+    return op["op"], pid, str(op.get("size") or "").strip(), cantidad
+
+
+def aplicar_operaciones(cart, operaciones, stock_sin_tallas=True):
+    """
+    Aplica en orden una lista de operaciones sobre una copia del carrito. Cada
+    operación es un dict con `op` ("add", "decrement", "remove" o "update"),
+    `product_id`, `size` y `quantity` (unidades a sumar o restar, o la cantidad
+    final en "update").
+
+    El stock de todos los productos se lee con una sola consulta. Con
+    `stock_sin_tallas=False` los productos sin tallas no se limitan por su
+    stock (como siempre ha hecho `add_to_cart`). Si alguna operación no es
+    válida lanza `ValidationError` y no se aplica ninguna. Devuelve el carrito
+    nuevo y las claves que han cambiado.
+    """
+    if not isinstance(operaciones, list) or not operaciones:
+        raise ValidationError("No hay operaciones")
+    if len(operaciones) > MAX_OPERACIONES:
+        raise ValidationError(f"Como máximo {MAX_OPERACIONES} operaciones por petición")
+    leidas = [_leer_operacion(op) for op in operaciones]
+    info = _stock_productos({pid for _, pid, _, _ in leidas})
+
+    nuevo = dict(cart)
+    tocadas = set()
+    for tipo, pid, talla, cantidad in leidas:
+        clave = _clave(pid, talla)
+        actual = int(nuevo.get(clave, 0))
+        if tipo == "add":
+            final = actual + cantidad
+        elif tipo == "decrement":
+            final = max(0, actual - cantidad)
+        elif tipo == "remove":
+            final = 0
+        else:
+            final = cantidad
+
+        # Solo se comprueba el stock al subir: bajar siempre está permitido
+        if final > actual:
+            _validar_stock(info, pid, talla, final, stock_sin_tallas)
+        if final:
+            nuevo[clave] = final
+        else:
+            nuevo.pop(clave, None)
+        tocadas.add(clave)
+
+    cambiadas = {clave for clave in tocadas if nuevo.get(clave) != cart.get(clave)}
+    return nuevo, cambiadas
@@ -0,0 +1,109 @@
+"""
+Orden y filtro por precio de los listados del catálogo.
+
+Todo se hace sobre columnas indexadas de la base de datos:
+`Producto.precio_efectivo` (el precio que paga el cliente, columna generada)
+y las puntuaciones de `RankingProducto` (ver `home/rankings.py`).
+"""
+from decimal import Decimal, InvalidOperation
+
+from django.db.models import Count, Max, Min, Q
+
+from . import rankings
+
+ORDEN_RECIENTES = "recientes"
+ORDEN_MAS_VENDIDOS = rankings.ORDEN_MAS_VENDIDOS
+ORDEN_TENDENCIA = rankings.ORDEN_TENDENCIA
+ORDEN_PRECIO_ASC = "precio_asc"
+ORDEN_PRECIO_DESC = "precio_desc"
+
+# Valores aceptados en ?orden= por las vistas del catálogo
+ORDENES = [
+    (ORDEN_RECIENTES, "Más recientes"),
+    (ORDEN_MAS_VENDIDOS, "Más vendidos"),
+    (ORDEN_TENDENCIA, "Tendencia"),
+    (ORDEN_PRECIO_ASC, "Precio: de menor a mayor"),
+    (ORDEN_PRECIO_DESC, "Precio: de mayor a menor"),
+]
+
+# Límites de los tramos del histograma de precios (en euros)
+TRAMOS_PRECIO = [Decimal("10"), Decimal("25"), Decimal("50"), Decimal("100")]
+
+
+# Columna de `RankingProducto` por la que ordena cada orden de popularidad
+CAMPOS_RANKING = {
+    ORDEN_MAS_VENDIDOS: "unidades_vendidas",
+    ORDEN_TENDENCIA: "tendencia",
+}
+
+
+def aplicar_orden(productos, orden, especie=None, categoria=None):
+    """
+    Ordena un queryset de `Producto` según `?orden=`.
+
+    Los órdenes de popularidad se resuelven desde `RankingProducto`: `especie`
+    y `categoria` (los mismos filtros que ya aplica la vista) se repiten sobre
+    el ranking para que la consulta recorra su índice ya ordenado y cruce con
+    `Producto` por clave primaria, sin ordenar el catálogo entero.
+    """
+    campo = CAMPOS_RANKING.get(orden)
+    if campo:
+        filtros = {"ranking__isnull": False}
+        if especie:
+            filtros["ranking__genero"] = especie
+        if categoria:
+            filtros["ranking__categoria"] = categoria
+        return productos.filter(**filtros).order_by(f"-ranking__{campo}", "-ranking__producto")
+    if orden == ORDEN_PRECIO_ASC:
+        return productos.order_by("precio_efectivo", "id")
+    if orden == ORDEN_PRECIO_DESC:
+        return productos.order_by("-precio_efectivo", "-id")
+    return productos.order_by("-fecha_creacion")
+
+
+def _decimal(valor):
+    try:
+        numero = Decimal(valor)
+    except (InvalidOperation, TypeError, ValueError):
+        return None
+    if not numero.is_finite() or numero < 0:
+        return None
+    return numero
+
+
+def leer_rango_precio(params):
+    """Lee `precio_min` y `precio_max` de la query string; los valores no válidos se ignoran."""
+    return _decimal(params.get("precio_min")), _decimal(params.get("precio_max"))
+
+
+def filtrar_precio(productos, precio_min=None, precio_max=None):
+    """Filtra por precio efectivo. `precio_max` es exclusivo, como los tramos del histograma."""
+    if precio_min is not None:
+        productos = productos.filter(precio_efectivo__gte=precio_min)
+    if precio_max is not None:
+        productos = productos.filter(precio_efectivo__lt=precio_max)
+    return productos
+
+
+def histograma_precios(productos, limites=TRAMOS_PRECIO):
+    """
+    Cuenta cuántos productos caen en cada tramo de precio con una sola consulta
+    agregada (un COUNT condicional por tramo), junto con el precio mínimo y máximo.
+
+    Devuelve un dict con `min`, `max` y `tramos`: lista de dicts con `desde`,
+    `hasta` (None en el último tramo) y `total`.
+    """
+    cortes = [Decimal("0")] + list(limites) + [None]
+    agregados = {"min": Min("precio_efectivo"), "max": Max("precio_efectivo")}
+    for i, (desde, hasta) in enumerate(zip(cortes, cortes[1:])):
+        condicion = Q(precio_efectivo__gte=desde)
+        if hasta is not None:
+            condicion &= Q(precio_efectivo__lt=hasta)
+        agregados[f"tramo_{i}"] = Count("id", filter=condicion)
+
+    resultado = productos.order_by().aggregate(**agregados)
+    tramos = [
+        {"desde": desde, "hasta": hasta, "total": resultado[f"tramo_{i}"]}
+        for i, (desde, hasta) in enumerate(zip(cortes, cortes[1:]))
+    ]
+    return {"min": resultado["min"], "max": resultado["max"], "tramos": tramos}
@@ -0,0 +1,98 @@
+"""
+Peticiones condicionales (ETag) para las páginas del catálogo.
+
+El ETag de cada página combina:
+
+- La versión de los datos que muestra, sacada con una sola consulta de las
+  columnas `fecha_actualizacion` (Producto, Marca, Categoria), de
+  `RankingProducto.fecha_calculo` y de las recomendaciones. Los cambios de
+  tallas e imágenes actualizan la fecha del producto (ver `home/signals.py`).
+- Lo que cambia por usuario dentro de la misma página: el usuario autenticado
+  y la versión del carrito (contador de la cabecera, stock restante en las
+  tarjetas).
+
+Si coincide con el `If-None-Match` del navegador se responde `304` sin
+renderizar. No se envía `Last-Modified`: una fecha no refleja el carrito, y un
+navegador que solo mande `If-Modified-Since` recibiría una página equivocada.
+Las respuestas llevan `Cache-Control: private, no-cache` y `Vary: Cookie` para
+que ninguna caché compartida guarde la versión de un usuario y el navegador
+siempre revalide.
+"""
+import hashlib
+from functools import wraps
+
+from django.contrib import messages
+from django.db import connection
+from django.db.models import Count, Max
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.views.decorators.http import condition
+
+from . import carrito, metricas
+from .models import Categoria, Marca, Producto, RankingProducto, RecomendacionProducto
+
+
+def version_catalogo(request, *args, **kwargs):
+    """Última modificación de cualquier producto, marca, categoría o ranking (una consulta)."""
+    tablas = [
+        (Producto._meta.db_table, "fecha_actualizacion"),
+        (Marca._meta.db_table, "fecha_actualizacion"),
+        (Categoria._meta.db_table, "fecha_actualizacion"),
+        (RankingProducto._meta.db_table, "fecha_calculo"),
+        (RecomendacionProducto._meta.db_table, "id"),
+    ]
+    qn = connection.ops.quote_name
+    subconsultas = ", ".join(f"(SELECT MAX({qn(col)}) FROM {qn(tabla)})" for tabla, col in tablas)
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT {subconsultas}")
+        return cursor.fetchone()
+
+
+def version_producto(request, product_id, *args, **kwargs):
+    """Versión de la ficha de un producto: el producto, su marca, categoría y recomendados."""
+    return tuple(
+        Producto.objects.filter(pk=product_id).aggregate(
+            fecha_producto=Max("fecha_actualizacion"),
+            fecha_marca=Max("marca__fecha_actualizacion"),
+            fecha_categoria=Max("categoria__fecha_actualizacion"),
+            ultima_recomendacion=Max("recomendaciones__id"),
+            num_recomendaciones=Count("recomendaciones"),
+            fecha_recomendados=Max("recomendaciones__recomendado__fecha_actualizacion"),
+        ).values()
+    )
+
+
+def version_categorias(request, *args, **kwargs):
+    return tuple(Categoria.objects.aggregate(total=Count("id"), fecha=Max("fecha_actualizacion")).values())
+
+
+def _estado_usuario(request):
+    return (request.user.pk, carrito.estado_usuario(request))
+
+
+def pagina_condicional(version_func):
+    """
+    Decorador para vistas GET del catálogo: calcula el ETag con `version_func`
+    (mismos argumentos que la vista) y responde 304 si no ha cambiado.
+    """
+    def decorador(vista):
+        def etag(request, *args, **kwargs):
+            # Los mensajes pendientes se muestran una sola vez: hay que renderizar
+            if len(messages.get_messages(request)):
+                return None
+            datos = repr((version_func(request, *args, **kwargs), _estado_usuario(request)))
+            return hashlib.md5(datos.encode(), usedforsecurity=False).hexdigest()
+
+        vista_condicional = condition(etag_func=etag)(vista)
+
+        @wraps(vista)
+        def envoltorio(request, *args, **kwargs):
+            response = vista_condicional(request, *args, **kwargs)
+            if "HTTP_IF_NONE_MATCH" in request.META:
+                metricas.cache_consulta("etag", response.status_code == 304)
+            patch_cache_control(response, private=True, no_cache=True)
+            patch_vary_headers(response, ("Cookie",))
+            return response
+
+        return envoltorio
+
+    return decorador
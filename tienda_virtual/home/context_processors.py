@@ -1,3 +1,4 @@
+from . import carrito, reservas
 from .models import Producto
 
 
@@ -8,7 +9,7 @@ def cart_count(request):
     `cart_items` (list of {'producto','cantidad','subtotal','size'}) and
     `cart_total` (sum of subtotals).
     """
-    cart = request.session.get('cart', {})
+    cart = carrito.leer_carrito(request)
     items = []
     total_amount = 0
     count = 0
@@ -46,7 +47,13 @@ def cart_count(request):
                 # ignore malformed entries and keep the processor safe
                 continue
 
-        # compute remaining per cart item using talla stock when applicable
+        # compute remaining per cart item using talla stock when applicable,
+        # minus the units other carts have on hold (reservation mode)
+        actual = carrito.obtener_carrito(request)
+        otras = reservas.reservadas_por_otros(
+            actual.pk if actual else None,
+            {int(pid) for pid in qty_by_product},
+        )
         for composite_key, qty in cart.items():
             try:
                 if isinstance(composite_key, str) and ':' in composite_key:
@@ -64,14 +71,15 @@ def cart_count(request):
                 if size:
                     talla = producto.tallas.filter(talla=size).first()
                     stock = talla.stock if talla else 0
-                    taken = qty_by_item.get(key, 0)
+                    taken = qty_by_item.get(key, 0) + otras.get((int(pid_str), size), 0)
                     remaining_by_item[key] = max(0, stock - taken)
                 else:
+                    reservado = sum(v for (p, _), v in otras.items() if p == int(pid_str))
                     if producto.tallas.exists():
-                        taken = qty_by_product.get(pid_key, 0)
+                        taken = qty_by_product.get(pid_key, 0) + reservado
                         remaining_by_item[key] = max(0, producto.available_stock - taken)
                     else:
-                        taken = qty_by_product.get(pid_key, 0)
+                        taken = qty_by_product.get(pid_key, 0) + reservado
                         remaining_by_item[key] = max(0, producto.stock - taken)
             except Exception:
                 continue
@@ -15,13 +15,9 @@ def admin_required(view_func):
             return redirect(f"{reverse('login')}?next={request.path}")
 
         # Verificar si el usuario tiene un cliente asociado y si es administrador
-        try:
-            cliente = request.user.cliente
-            if not cliente or not cliente.es_admin:
-                messages.error(request, 'No tienes permisos para acceder a esta sección.')
-                return redirect('home')
-        except (AttributeError, Exception):
-            # El usuario no tiene un cliente asociado o ocurrió algún error
+        # (request.cliente llega con el usuario: ver home/middleware.py)
+        cliente = request.cliente
+        if not cliente or not cliente.es_admin:
             messages.error(request, 'No tienes permisos para acceder a esta sección.')
             return redirect('home')
 
@@ -2,7 +2,7 @@ from django import forms
 from django.contrib.auth import get_user_model
 from django.contrib.auth.forms import AuthenticationForm
 
-from .models import Cliente, Producto, Marca, Categoria
+from .models import Cliente, Producto, Marca, Categoria, normalizar_email
 
 User = get_user_model()
 
@@ -54,8 +54,8 @@ class RegistroForm(forms.ModelForm):
             self.fields[field_name].required = True
 
     def clean_email(self):
-        email = (self.cleaned_data.get("email") or "").strip().lower()
-        if Cliente.objects.filter(email__iexact=email).exists():
+        email = normalizar_email(self.cleaned_data.get("email"))
+        if Cliente.por_email(email).exists():
             raise forms.ValidationError("Ya existe un cliente con este email.")
         if User.objects.filter(email__iexact=email).exists():
             raise forms.ValidationError("Ya existe un usuario con este email.")
@@ -142,9 +142,9 @@ class GuestCheckoutForm(forms.Form):
     )
     
     def clean_email(self):
-        email = (self.cleaned_data.get("email") or "").strip().lower()
+        email = normalizar_email(self.cleaned_data.get("email"))
         # Verificar si ya existe un cliente con usuario (cuenta registrada)
-        if Cliente.objects.filter(email__iexact=email, user__isnull=False).exists():
+        if Cliente.por_email(email).filter(user__isnull=False).exists():
             raise forms.ValidationError("Ya existe una cuenta con este email. Por favor, inicia sesión para continuar.")
         return email
 
@@ -203,15 +203,13 @@ class ClienteAdminForm(forms.ModelForm):
         self.fields['email'].required = True
 
     def clean_email(self):
-        email = self.cleaned_data.get('email')
+        email = normalizar_email(self.cleaned_data.get('email'))
+        existentes = Cliente.por_email(email)
         if self.instance and self.instance.pk:
             # Si estamos editando, permitir el mismo email
-            if Cliente.objects.filter(email=email).exclude(pk=self.instance.pk).exists():
-                raise forms.ValidationError("Ya existe un cliente con este email.")
-        else:
-            # Si estamos creando, verificar que no exista
-            if Cliente.objects.filter(email=email).exists():
-                raise forms.ValidationError("Ya existe un cliente con este email.")
+            existentes = existentes.exclude(pk=self.instance.pk)
+        if existentes.exists():
+            raise forms.ValidationError("Ya existe un cliente con este email.")
         return email
 
     def save(self, commit=True):
@@ -265,6 +263,7 @@ class ProductoAdminForm(forms.ModelForm):
             'color',
             'material',
             'stock',
+            'umbral_stock_bajo',
             'esta_disponible',
             'es_destacado',
         ]
@@ -279,6 +278,7 @@ class ProductoAdminForm(forms.ModelForm):
             'color': forms.TextInput(attrs={'class': 'form-control'}),
             'material': forms.TextInput(attrs={'class': 'form-control'}),
             'stock': forms.NumberInput(attrs={'class': 'form-control', 'min': '0'}),
+            'umbral_stock_bajo': forms.NumberInput(attrs={'class': 'form-control', 'min': '0'}),
             'esta_disponible': forms.CheckboxInput(attrs={'class': 'form-check-input'}),
             'es_destacado': forms.CheckboxInput(attrs={'class': 'form-check-input'}),
         }
@@ -0,0 +1,99 @@
+"""
+Índices en memoria por proceso que se reconstruyen cuando cambian los datos.
+
+Lo usan el autocompletado (`home/search_index.py`) y las promociones
+(`home/promociones.py`). Cada `IndiceLocal` guarda el índice construido, la
+versión de la caché con la que se construyó y cuándo. Un índice está
+obsoleto si:
+
+- se ha llamado a `invalidar()` en este proceso,
+- la versión de la caché ha cambiado (`invalidar()` en otro worker; solo se
+  ve si `CACHES` es compartida). Para no ir a la caché en cada petición, la
+  versión se consulta como mucho cada `INDICES_COMPROBAR_VERSION` segundos:
+  es lo que tarda como máximo en llegar un cambio de otro worker,
+- o tiene más de `edad_maxima` segundos (para el resto de casos).
+
+Las reconstrucciones de un proceso van de una en una (`_construyendo`):
+mientras un hilo reconstruye, el resto sigue usando el índice anterior en
+lugar de construir cada uno el suyo. Solo esperan si aún no hay ninguno.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import metricas
+
+
+class IndiceLocal:
+    """Índice que devuelve `construir()`, uno por proceso, con su versión en `clave_version`."""
+
+    def __init__(self, nombre, construir, clave_version, edad_maxima=300):
+        self.nombre = nombre  # para las métricas de caché
+        self.construir = construir
+        self.clave_version = clave_version
+        self.edad_maxima = edad_maxima
+        self._lock = threading.Lock()
+        self._construyendo = threading.Lock()
+        self.estado = {
+            "indice": None, "version": None, "construido": 0.0, "comprobado": 0.0, "obsoleto": True,
+        }
+
+    def version_cache(self):
+        return cache.get_or_set(self.clave_version, 1, timeout=None)
+
+    def precargar(self):
+        """Construye el índice del proceso actual."""
+        version = self.version_cache()
+        indice = self.construir()
+        ahora = time.monotonic()
+        with self._lock:
+            self.estado.update(indice=indice, version=version, construido=ahora, comprobado=ahora, obsoleto=False)
+        return indice
+
+    def _version_cambiada(self, ahora):
+        """Compara con la versión de la caché si hace más de `INDICES_COMPROBAR_VERSION` s."""
+        if ahora - self.estado["comprobado"] < getattr(settings, "INDICES_COMPROBAR_VERSION", 1):
+            return False
+        self.estado["comprobado"] = ahora
+        if self.estado["version"] == self.version_cache():
+            return False
+        # Queda marcado hasta reconstruir: la comprobación siguiente ya no iría a la caché
+        self.estado["obsoleto"] = True
+        return True
+
+    def obsoleto(self):
+        estado = self.estado
+        ahora = time.monotonic()
+        return (
+            estado["indice"] is None
+            or estado["obsoleto"]
+            or ahora - estado["construido"] > self.edad_maxima
+            or self._version_cambiada(ahora)
+        )
+
+    def obtener(self):
+        """Devuelve el índice del proceso, reconstruyéndolo si está obsoleto."""
+        if not self.obsoleto():
+            metricas.cache_consulta(self.nombre, True)
+            return self.estado["indice"]
+        metricas.cache_consulta(self.nombre, False)
+        anterior = self.estado["indice"]
+        # Con un índice anterior no se espera: si otro hilo ya reconstruye, se usa ese
+        if not self._construyendo.acquire(blocking=anterior is None):
+            return anterior
+        try:
+            if not self.obsoleto():  # lo ha reconstruido otro hilo mientras se esperaba
+                return self.estado["indice"]
+            return self.precargar()
+        finally:
+            self._construyendo.release()
+
+    def invalidar(self):
+        """Marca el índice como obsoleto en este proceso y en el resto (vía caché)."""
+        self.estado["obsoleto"] = True
+        try:
+            cache.incr(self.clave_version)
+        except ValueError:
+            cache.set(self.clave_version, 1, timeout=None)
@@ -0,0 +1,320 @@
+"""
+Llamadas salientes a servicios externos (Stripe y SendGrid).
+
+Antes cada email creaba su propio `SendGridAPIClient` (conexión nueva, sin
+timeout) y Stripe usaba su cliente por defecto: si un proveedor iba lento,
+cada worker se quedaba esperándolo. Ahora todas las llamadas pasan por un
+`ServicioHTTP` por proveedor, compartido en el proceso, con:
+
+- Conexiones keep-alive reutilizadas (`requests.Session` con un pool de
+  `conexiones`; tras un `fork` el hijo abre las suyas).
+- Timeouts estrictos de conexión y de lectura.
+- Reintentos con espera exponencial y jitter completo. Solo se reintenta lo
+  que no puede duplicar nada: fallos al conectar y 429 siempre; 5xx, timeouts
+  de lectura y cortes solo si la petición es idempotente (GET/HEAD/PUT/DELETE
+  o lleva cabecera `Idempotency-Key`, como las de Stripe).
+- Un interruptor (circuit breaker): tras `fallos_para_abrir` llamadas
+  fallidas seguidas se abre y las siguientes fallan al momento con
+  `CircuitoAbierto`, sin tocar la red; pasados `segundos_abierto` deja pasar
+  una llamada de prueba y, si va bien, se vuelve a cerrar.
+- Métricas en memoria por servicio (`metricas()`): peticiones, errores,
+  reintentos, llamadas fallidas, rechazadas por el interruptor y un
+  histograma de latencias.
+
+Los errores de 4xx (salvo 429) son respuestas del proveedor, no fallos del
+servicio: se devuelven tal cual y no cuentan para el interruptor.
+
+Uso: `enviar_email(mensaje)` para SendGrid; Stripe usa `ClienteStripe`
+(instalado en `home/views.py` como `stripe.default_http_client`). Quien
+llama decide cómo degradar: los emails se registran y se omiten, y el pago
+con tarjeta vuelve al resumen de pago con un aviso.
+"""
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass
+
+import requests
+import stripe
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from . import tiempos
+from .metricas import email_segundos
+
+METODOS_IDEMPOTENTES = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+LIMITES_LATENCIA = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # segundos
+
+
+class IntegracionError(Exception):
+    """Un servicio externo no ha respondido bien tras los reintentos."""
+
+
+class CircuitoAbierto(IntegracionError):
+    """El interruptor del servicio está abierto: se falla sin llamar."""
+
+
+@dataclass(frozen=True)
+class Politica:
+    timeout_conexion: float = 3.0
+    timeout_lectura: float = 10.0
+    reintentos: int = 2
+    espera_base: float = 0.2
+    espera_maxima: float = 2.0
+    fallos_para_abrir: int = 5
+    segundos_abierto: float = 30.0
+    conexiones: int = 10
+
+    @classmethod
+    def desde_settings(cls):
+        return cls(
+            timeout_conexion=getattr(settings, "INTEGRACIONES_TIMEOUT_CONEXION", cls.timeout_conexion),
+            timeout_lectura=getattr(settings, "INTEGRACIONES_TIMEOUT_LECTURA", cls.timeout_lectura),
+            reintentos=getattr(settings, "INTEGRACIONES_REINTENTOS", cls.reintentos),
+            fallos_para_abrir=getattr(settings, "INTEGRACIONES_FALLOS_CIRCUITO", cls.fallos_para_abrir),
+            segundos_abierto=getattr(settings, "INTEGRACIONES_SEGUNDOS_CIRCUITO", cls.segundos_abierto),
+        )
+
+
+def _sin_conexion(error):
+    """True si no se llegó a conectar (la petición no ha salido): se puede repetir siempre."""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    causa = error.args[0] if error.args else None
+    return isinstance(getattr(causa, "reason", causa), NewConnectionError)
+
+
+class Interruptor:
+    CERRADO = "cerrado"
+    ABIERTO = "abierto"
+    SEMIABIERTO = "semiabierto"
+
+    def __init__(self, fallos_para_abrir, segundos_abierto):
+        self.fallos_para_abrir = fallos_para_abrir
+        self.segundos_abierto = segundos_abierto
+        self.estado = self.CERRADO
+        self._fallos = 0
+        self._abierto_desde = 0.0
+        self._lock = threading.Lock()
+
+    def permitir(self):
+        """True si se puede llamar; en semiabierto solo pasa una llamada de prueba."""
+        with self._lock:
+            if self.estado == self.CERRADO:
+                return True
+            if self.estado == self.ABIERTO and time.monotonic() - self._abierto_desde >= self.segundos_abierto:
+                self.estado = self.SEMIABIERTO
+                return True
+            return False
+
+    def abierto(self):
+        """True si está abierto y aún no toca la llamada de prueba."""
+        with self._lock:
+            return (
+                self.estado == self.ABIERTO
+                and time.monotonic() - self._abierto_desde < self.segundos_abierto
+            )
+
+    def exito(self):
+        with self._lock:
+            self.estado = self.CERRADO
+            self._fallos = 0
+
+    def fallo(self):
+        with self._lock:
+            self._fallos += 1
+            if self.estado == self.SEMIABIERTO or self._fallos >= self.fallos_para_abrir:
+                self.estado = self.ABIERTO
+                self._abierto_desde = time.monotonic()
+
+
+class Metricas:
+    CONTADORES = ("peticiones", "errores", "reintentos", "fallidas", "rechazadas")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._valores = dict.fromkeys(self.CONTADORES, 0)
+        self._histograma = [0] * (len(LIMITES_LATENCIA) + 1)
+        self._latencia_total = 0.0
+
+    def sumar(self, contador):
+        with self._lock:
+            self._valores[contador] += 1
+
+    def latencia(self, segundos, error):
+        with self._lock:
+            self._valores["peticiones"] += 1
+            if error:
+                self._valores["errores"] += 1
+            self._latencia_total += segundos
+            posicion = next((i for i, limite in enumerate(LIMITES_LATENCIA) if segundos <= limite), -1)
+            self._histograma[posicion] += 1
+
+    def resumen(self):
+        with self._lock:
+            datos = dict(self._valores)
+            datos["latencia_total"] = round(self._latencia_total, 6)
+            datos["latencia_media_ms"] = (
+                round(self._latencia_total * 1000 / datos["peticiones"], 1) if datos["peticiones"] else 0.0
+            )
+            datos["histograma"] = dict(zip(LIMITES_LATENCIA + (float("inf"),), self._histograma))
+        return datos
+
+
+class ServicioHTTP:
+    """Cliente HTTP de un proveedor: pool de conexiones, reintentos, interruptor y métricas."""
+
+    def __init__(self, nombre, politica=None):
+        self.nombre = nombre
+        self.politica = politica or Politica()
+        self.interruptor = Interruptor(self.politica.fallos_para_abrir, self.politica.segundos_abierto)
+        self.metricas = Metricas()
+        self._sesion = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def sesion(self):
+        with self._lock:
+            if self._sesion is None or self._pid != os.getpid():
+                sesion = requests.Session()
+                adaptador = HTTPAdapter(pool_connections=1, pool_maxsize=self.politica.conexiones, max_retries=0)
+                sesion.mount("http://", adaptador)
+                sesion.mount("https://", adaptador)
+                self._sesion, self._pid = sesion, os.getpid()
+            return self._sesion
+
+    def cerrar(self):
+        with self._lock:
+            if self._sesion is not None and self._pid == os.getpid():
+                self._sesion.close()
+            self._sesion = None
+
+    def _espera(self, intento):
+        techo = min(self.politica.espera_maxima, self.politica.espera_base * 2 ** intento)
+        return random.uniform(0, techo)
+
+    def peticion(self, metodo, url, **kwargs):
+        """
+        Hace la petición y devuelve la `requests.Response` (también las 4xx).
+        Lanza `CircuitoAbierto` sin llamar si el interruptor está abierto, o
+        `IntegracionError` si tras los reintentos sigue fallando.
+        """
+        if not self.interruptor.permitir():
+            self.metricas.sumar("rechazadas")
+            raise CircuitoAbierto(f"{self.nombre}: servicio no disponible (circuito abierto)")
+        # Tiempo de la llamada completa (con reintentos) para Server-Timing
+        with tiempos.medir(self.nombre):
+            return self._peticion(metodo, url, **kwargs)
+
+    def _peticion(self, metodo, url, **kwargs):
+        metodo = metodo.upper()
+        cabeceras = kwargs.get("headers") or {}
+        idempotente = metodo in METODOS_IDEMPOTENTES or any(
+            c.lower() == "idempotency-key" for c in cabeceras
+        )
+        timeout = (self.politica.timeout_conexion, self.politica.timeout_lectura)
+
+        for intento in range(self.politica.reintentos + 1):
+            inicio = time.perf_counter()
+            respuesta, error, sin_enviar = None, None, False
+            try:
+                respuesta = self.sesion().request(metodo, url, timeout=timeout, **kwargs)
+            except requests.exceptions.ConnectionError as e:
+                error, sin_enviar = e, _sin_conexion(e)
+            except requests.exceptions.RequestException as e:
+                error = e
+            else:
+                if respuesta.status_code == 429:
+                    error, sin_enviar = "HTTP 429", True
+                elif respuesta.status_code >= 500:
+                    error = f"HTTP {respuesta.status_code}"
+            self.metricas.latencia(time.perf_counter() - inicio, error is not None)
+
+            if error is None:
+                self.interruptor.exito()
+                return respuesta
+            if intento < self.politica.reintentos and (idempotente or sin_enviar):
+                self.metricas.sumar("reintentos")
+                time.sleep(self._espera(intento))
+                continue
+            break
+
+        self.metricas.sumar("fallidas")
+        self.interruptor.fallo()
+        raise IntegracionError(f"{self.nombre}: {error}")
+
+
+_servicios = {}
+_lock_servicios = threading.Lock()
+
+
+def servicio(nombre):
+    """`ServicioHTTP` compartido del proceso para el proveedor `nombre`."""
+    with _lock_servicios:
+        if nombre not in _servicios:
+            _servicios[nombre] = ServicioHTTP(nombre, Politica.desde_settings())
+        return _servicios[nombre]
+
+
+def disponible(nombre):
+    """False si el interruptor del servicio está abierto (para no empezar algo que va a fallar)."""
+    return not servicio(nombre).interruptor.abierto()
+
+
+def metricas():
+    """Métricas de cada servicio usado en este proceso, con el estado de su interruptor."""
+    with _lock_servicios:
+        servicios = list(_servicios.values())
+    return {s.nombre: {**s.metricas.resumen(), "circuito": s.interruptor.estado} for s in servicios}
+
+
+def reiniciar():
+    """Olvida servicios, interruptores y métricas (pruebas, cambio de configuración)."""
+    with _lock_servicios:
+        for s in _servicios.values():
+            s.cerrar()
+        _servicios.clear()
+
+
+def enviar_email(mensaje):
+    """Envía un `sendgrid.helpers.mail.Mail` por la API v3 de SendGrid."""
+    clave = getattr(settings, "SENDGRID_API_KEY", None)
+    if not clave:
+        raise IntegracionError("sendgrid: SENDGRID_API_KEY no configurada")
+    base = getattr(settings, "SENDGRID_API_URL", "https://api.sendgrid.com").rstrip("/")
+    inicio = time.perf_counter()
+    resultado = "error"
+    try:
+        respuesta = servicio("sendgrid").peticion(
+            "POST",
+            f"{base}/v3/mail/send",
+            json=mensaje.get(),
+            headers={"Authorization": f"Bearer {clave}"},
+        )
+        if respuesta.status_code >= 400:
+            raise IntegracionError(f"sendgrid: HTTP {respuesta.status_code} {respuesta.text[:200]}")
+        resultado = "ok"
+        return respuesta
+    finally:
+        email_segundos.observar(time.perf_counter() - inicio, resultado=resultado)
+
+
+class ClienteStripe(stripe.HTTPClient):
+    """
+    Cliente HTTP para la librería de Stripe sobre `servicio("stripe")`. Los
+    reintentos los hace el servicio (las peticiones de Stripe llevan
+    `Idempotency-Key`), así que `stripe.max_network_retries` debe ser 0.
+    """
+    name = "integraciones"
+
+    def request(self, method, url, headers, post_data=None, *, _usage=None):
+        try:
+            respuesta = servicio("stripe").peticion(method, url, headers=headers, data=post_data)
+        except IntegracionError as e:
+            raise stripe.APIConnectionError(str(e), should_retry=False)
+        return respuesta.content, respuesta.status_code, respuesta.headers
+
+    def close(self):
+        servicio("stripe").cerrar()
@@ -0,0 +1,157 @@
+"""
+Límite de peticiones por IP y por sesión (token bucket).
+
+Cada límite es una tasa "N/s", "N/m" o "N/h": caben N peticiones seguidas y
+el cubo se rellena a razón de N por periodo. `LimitePeticionesMiddleware`
+(`home/middleware.py`) aplica los de `settings.LIMITES_PETICIONES`, por nombre
+de URL, antes de llamar a la vista; si el cubo de la IP o el de la sesión está
+vacío responde 429 con `Retry-After`. Una petición sin sesión (un bot que no
+guarda cookies) solo tiene el de la IP, que por eso es más holgado. Con
+`por_operacion` la petición gasta un token por cada elemento de la lista
+`operaciones` de su JSON (`cart_batch`), para que agrupar no salte el límite.
+
+Los cubos (tokens que quedan y cuándo se miraron) se guardan en la caché, que
+comparten los workers si `CACHES` es compartida; con la caché en memoria por
+defecto cada worker tiene sus cubos y con N workers el límite real es N veces
+el configurado. Si la caché falla se sigue con una tabla en memoria
+del proceso, compartida por sus hilos. La lectura y la escritura del cubo no
+son atómicas: con peticiones simultáneas de la misma IP puede colarse alguna
+de más, suficiente para frenar abusos.
+
+Detrás de un proxy `REMOTE_ADDR` es la del proxy: `LIMITES_CABECERA_IP`
+indica la cabecera con la IP real (p. ej. `HTTP_X_FORWARDED_FOR`, de la que se
+toma la última entrada, la que añade el proxy).
+"""
+import json
+import math
+import threading
+import time
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.core.cache import cache
+
+PERIODOS = {"s": 1, "m": 60, "h": 3600}
+MAX_CUBOS_LOCALES = 10000
+
+
+@dataclass(frozen=True)
+class Tasa:
+    capacidad: int
+    por_segundo: float
+
+    @classmethod
+    def desde_texto(cls, texto):
+        """'30/m' -> 30 seguidas y 30 por minuto."""
+        cantidad, _, periodo = texto.partition("/")
+        return cls(int(cantidad), int(cantidad) / PERIODOS[periodo.strip() or "s"])
+
+    @property
+    def segundos_llenado(self):
+        return self.capacidad / self.por_segundo
+
+
+@dataclass(frozen=True)
+class Limite:
+    por_ip: str = ""
+    por_sesion: str = ""
+    metodos: tuple = ()  # vacío: todos
+    por_operacion: bool = False
+
+    def aplica(self, request):
+        return not self.metodos or request.method in self.metodos
+
+
+def limites():
+    """Límites configurados por nombre de URL."""
+    configurados = getattr(settings, "LIMITES_PETICIONES", {}) or {}
+    return {
+        nombre: Limite(
+            por_ip=datos.get("por_ip", ""),
+            por_sesion=datos.get("por_sesion", ""),
+            metodos=tuple(m.upper() for m in datos.get("metodos", ())),
+            por_operacion=bool(datos.get("por_operacion", False)),
+        )
+        for nombre, datos in configurados.items()
+    }
+
+
+def ip_cliente(request):
+    cabecera = getattr(settings, "LIMITES_CABECERA_IP", "")
+    if cabecera and request.META.get(cabecera):
+        return request.META[cabecera].split(",")[-1].strip()
+    return request.META.get("REMOTE_ADDR", "")
+
+
+def coste(request, limite):
+    """Tokens que gasta la petición: uno, o uno por operación con `por_operacion`."""
+    if not limite.por_operacion:
+        return 1
+    try:
+        operaciones = json.loads(request.body or b"{}").get("operaciones")
+    except (ValueError, AttributeError):
+        return 1
+    return max(1, len(operaciones)) if isinstance(operaciones, list) else 1
+
+
+def _gastar(estado, tasa, ahora, coste=1):
+    """
+    Rellena el cubo hasta `ahora` e intenta gastar `coste` tokens (como mucho
+    la capacidad, para que quepa con el cubo lleno): (estado nuevo, segundos de espera).
+    """
+    coste = min(coste, tasa.capacidad)
+    tokens, visto = estado if estado else (tasa.capacidad, ahora)
+    tokens = min(tasa.capacidad, tokens + max(0.0, ahora - visto) * tasa.por_segundo)
+    if tokens >= coste:
+        return (tokens - coste, ahora), 0.0
+    return (tokens, ahora), (coste - tokens) / tasa.por_segundo
+
+
+_cubos_locales = {}
+_lock_local = threading.Lock()
+
+
+def _gastar_local(clave, tasa, ahora, coste=1):
+    with _lock_local:
+        if len(_cubos_locales) > MAX_CUBOS_LOCALES:
+            # Un cubo que lleva un llenado entero sin usarse está lleno: se puede olvidar
+            for k, (estado, llenado) in list(_cubos_locales.items()):
+                if ahora - estado[1] > llenado:
+                    del _cubos_locales[k]
+        estado, espera = _gastar(_cubos_locales.get(clave, (None,))[0], tasa, ahora, coste)
+        _cubos_locales[clave] = (estado, tasa.segundos_llenado)
+        return espera
+
+
+def _gastar_en_cubo(clave, tasa, ahora, coste=1):
+    try:
+        estado, espera = _gastar(cache.get(clave), tasa, ahora, coste)
+        cache.set(clave, estado, timeout=math.ceil(tasa.segundos_llenado) + 1)
+        return espera
+    except Exception as e:
+        print("⚠ Límite de peticiones sin caché, se usa la memoria del proceso:", e)
+        return _gastar_local(clave, tasa, ahora, coste)
+
+
+def espera(request, nombre, limite, coste=1):
+    """
+    Cuenta la petición (`coste` tokens) en los cubos de su IP y de su sesión
+    para `nombre`. Devuelve 0 si se puede atender o los segundos hasta que se pueda.
+    """
+    ahora = time.time()
+    cubos = [(limite.por_ip, f"ip:{ip_cliente(request)}")]
+    sesion = getattr(request, "session", None)
+    if sesion is not None and sesion.session_key:
+        cubos.append((limite.por_sesion, f"sesion:{sesion.session_key}"))
+    esperas = [
+        _gastar_en_cubo(f"limite:{nombre}:{cubo}", Tasa.desde_texto(texto), ahora, coste)
+        for texto, cubo in cubos
+        if texto
+    ]
+    return max(esperas, default=0.0)
+
+
+def olvidar():
+    """Vacía los cubos en memoria del proceso (pruebas)."""
+    with _lock_local:
+        _cubos_locales.clear()
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from home import recomendaciones
+
+
+class Command(BaseCommand):
+    help = 'Actualiza las recomendaciones de productos con los pedidos confirmados nuevos y los cancelados'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--reconstruir',
+            action='store_true',
+            help='Borra las co-ocurrencias y procesa de nuevo todos los pedidos',
+        )
+        parser.add_argument('--lote', type=int, default=recomendaciones.TAMANO_LOTE,
+                            help='Pedidos procesados por transacción')
+        parser.add_argument('--top', type=int, default=recomendaciones.TOP_K,
+                            help='Recomendaciones guardadas por producto')
+
+    def handle(self, *args, **options):
+        if options.get('reconstruir'):
+            procesados = recomendaciones.reconstruir_recomendaciones(options['lote'], options['top'])
+        else:
+            procesados = recomendaciones.actualizar_recomendaciones(options['lote'], options['top'])
+
+        if procesados:
+            self.stdout.write(self.style.SUCCESS(f'Pedidos procesados: {procesados}'))
+        else:
+            self.stdout.write('No hay pedidos nuevos que procesar')
@@ -0,0 +1,71 @@
+import random
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+
+from home import promociones
+from home.models import Producto
+
+# Reparto de las reglas: casi todas son de producto o cupones; las de especie o
+# generales afectan a medio catálogo y en una tienda real hay muy pocas.
+AMBITOS = ["producto", "cupon", "marca", "categoria", "especie", "general"]
+PESOS = [50, 30, 10, 8, 1, 1]
+
+
+class Command(BaseCommand):
+    help = 'Mide el índice de promociones con reglas sintéticas (no toca la base de datos)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reglas', type=int, default=5000, help='Promociones activas')
+        parser.add_argument('--lineas', type=int, default=20, help='Líneas por carrito')
+        parser.add_argument('--carritos', type=int, default=1000, help='Carritos evaluados')
+        parser.add_argument('--productos', type=int, default=100000, help='Productos del catálogo')
+
+    def handle(self, *args, **options):
+        rnd = random.Random(1)
+        num_productos = options['productos']
+        especies = [valor for valor, _ in Producto.Especie.choices]
+        tipos = [promociones.PORCENTAJE, promociones.IMPORTE, promociones.LLEVA_X_PAGA_Y,
+                 promociones.ENVIO_GRATIS]
+
+        reglas = []
+        for i in range(options['reglas']):
+            ambito = rnd.choices(AMBITOS, PESOS)[0]
+            reglas.append(promociones.Regla(
+                id=i,
+                nombre=f"Promo {i}",
+                codigo=f"CUPON{i}" if ambito == "cupon" else "",
+                tipo=rnd.choice(tipos),
+                valor=Decimal(rnd.randint(1, 50)),
+                lleva=3,
+                paga=2,
+                producto_id=rnd.randrange(num_productos) if ambito == "producto" else None,
+                categoria_id=rnd.randrange(200) if ambito == "categoria" else None,
+                marca_id=rnd.randrange(500) if ambito == "marca" else None,
+                especie=rnd.choice(especies) if ambito == "especie" else "",
+            ))
+
+        inicio = time.perf_counter()
+        indice = promociones.IndicePromociones(reglas)
+        construir = time.perf_counter() - inicio
+
+        carritos = [
+            [
+                promociones.LineaPromocion(
+                    rnd.randrange(num_productos), rnd.randrange(200), rnd.randrange(500),
+                    rnd.choice(especies), rnd.randint(1, 4), Decimal(rnd.randint(1, 100)),
+                )
+                for _ in range(options['lineas'])
+            ]
+            for _ in range(options['carritos'])
+        ]
+        inicio = time.perf_counter()
+        for num, lineas in enumerate(carritos):
+            indice.evaluar(lineas, codigo=f"CUPON{num}")
+        evaluar = (time.perf_counter() - inicio) / len(carritos)
+
+        self.stdout.write(
+            f"{len(indice)} reglas: índice construido en {construir * 1000:.1f} ms, "
+            f"{evaluar * 1000:.3f} ms por carrito de {options['lineas']} líneas"
+        )
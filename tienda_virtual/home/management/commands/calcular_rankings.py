@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from home import rankings
+
+
+class Command(BaseCommand):
+    help = 'Recalcula los rankings de más vendidos y tendencias de los productos'
+
+    def handle(self, *args, **options):
+        total = rankings.calcular_rankings()
+        self.stdout.write(self.style.SUCCESS(f'Rankings recalculados para {total} producto(s)'))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from home import pedidos_caducados
+
+
+class Command(BaseCommand):
+    help = 'Cancela por lotes los pedidos con pago online que siguen pendientes pasado el plazo'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--horas', type=int,
+                            help='Horas pendiente tras las que se cancela (por defecto PEDIDO_PENDIENTE_HORAS)')
+        parser.add_argument('--lote', type=int, default=pedidos_caducados.TAMANO_LOTE,
+                            help='Pedidos cancelados por transacción')
+
+    def handle(self, *args, **options):
+        metricas = pedidos_caducados.cancelar_caducados(options.get('horas'), options['lote'])
+        if not metricas['pedidos']:
+            self.stdout.write('No hay pedidos pendientes caducados')
+            return
+        self.stdout.write(self.style.SUCCESS(
+            f"Pedidos cancelados: {metricas['pedidos']} ({metricas['lineas']} línea(s)) "
+            f"en {metricas['lotes']} lote(s), {metricas['segundos']} s "
+            f"({metricas['pedidos_por_segundo']} pedidos/s)"
+        ))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from home import carrito, reservas
+
+
+class Command(BaseCommand):
+    help = 'Borra por lotes las reservas de stock caducadas, los carritos abandonados y las líneas quitadas'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--lote',
+            type=int,
+            default=reservas.TAMANO_LOTE,
+            help='Reservas (o carritos) borrados por consulta',
+        )
+        parser.add_argument(
+            '--dias',
+            type=int,
+            default=None,
+            help='Días sin cambios tras los que se borra un carrito sin cliente (CARRITO_ABANDONADO_DIAS)',
+        )
+
+    def handle(self, *args, **options):
+        total = reservas.liberar_caducadas(tamano_lote=options['lote'])
+        self.stdout.write(self.style.SUCCESS(f'Reservas caducadas liberadas: {total}'))
+        carritos, lineas = carrito.purgar(dias=options['dias'], tamano_lote=options['lote'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Carritos abandonados borrados: {carritos}; líneas quitadas borradas: {lineas}'
+        ))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from home import stock_alerts
+
+
+class Command(BaseCommand):
+    help = 'Envía el resumen de alertas de stock bajo pendientes de notificar'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--reconstruir',
+            action='store_true',
+            help='Recalcula todas las alertas desde cero antes de enviar el resumen',
+        )
+        parser.add_argument('--email', help='Destinatario del resumen (por defecto EMAIL_FROM)')
+        parser.add_argument('--sin-email', action='store_true', help='No envía el resumen')
+
+    def handle(self, *args, **options):
+        if options.get('reconstruir'):
+            total = stock_alerts.reconstruir_alertas()
+            self.stdout.write(f'Alertas de stock recalculadas: {total}')
+
+        if options.get('sin_email'):
+            return
+
+        enviadas = stock_alerts.enviar_resumen(options.get('email'))
+        if enviadas:
+            self.stdout.write(self.style.SUCCESS(f'Resumen enviado con {enviadas} alerta(s)'))
+        else:
+            self.stdout.write('No hay alertas nuevas que notificar')
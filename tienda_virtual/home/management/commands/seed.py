@@ -3,12 +3,12 @@ import random
 import json
 import os
 from django.utils import timezone
-from django.utils.crypto import get_random_string
 
 from django.contrib.auth import get_user_model
 from django.core.management.base import BaseCommand
 from django.db import transaction
 
+from home import numeracion
 from home.models import (
     Carrito,
     Categoria,
@@ -25,11 +25,6 @@ from home.models import (
 User = get_user_model()
 
 
-def generar_numero_pedido():
-    """Genera un número de pedido con el formato MP-YYYYMMDDHHMMSS-XXXX"""
-    return f"MP-{timezone.now().strftime('%Y%m%d%H%M%S')}-{get_random_string(4).upper()}"
-
-
 class Command(BaseCommand):
     help = 'Seed the database with initial data for development'
 
@@ -335,7 +330,7 @@ class Command(BaseCommand):
             # Usar numero_pedido del JSON si existe, sino generar uno nuevo
             numero_pedido = item.get("numero_pedido")
             if not numero_pedido:
-                numero_pedido = generar_numero_pedido()
+                numero_pedido = numeracion.numero_pedido()
 
             pedido = Pedido.objects.create(
                 cliente=cliente_obj,
@@ -0,0 +1,235 @@
+"""
+Métricas de la tienda en el formato de texto de Prometheus (`/metrics`).
+
+Contadores e histogramas en memoria del proceso, con etiquetas fijas por
+métrica:
+
+- `tienda_peticion_segundos`: duración de cada petición por nombre de URL
+  (`MetricasMiddleware`).
+- `tienda_carrito_operaciones_total`: operaciones sobre el carrito y si se
+  aplicaron.
+- `tienda_checkouts_total`: checkouts por `metodo_pago` y resultado (pedido
+  creado, reenviado, pagado, cancelado o Stripe no disponible).
+- `tienda_stock_descuento_fallos_total`: líneas cuyo stock no se pudo restar
+  entero al confirmar un pedido.
+- `tienda_email_segundos`: duración de los envíos por SendGrid y si fueron bien.
+- `tienda_cache_consultas_total`: aciertos y fallos de las cachés
+  (seguimiento, índices de promociones y de búsqueda, revalidación por ETag).
+
+Varios workers: con `METRICAS_DIR` cada proceso vuelca sus valores a un
+fichero propio del directorio (`<pid>-<id>.json`, escrito de golpe con
+`os.replace`) como mucho una vez por `METRICAS_INTERVALO` segundos y al
+salir, y `/metrics` suma los de todos. Lo que publica otro worker puede ir
+hasta un intervalo por detrás. Los ficheros de workers que ya han terminado
+se siguen sumando (los contadores no bajan al reiniciar uno); el directorio
+se vacía al desplegar. Sin `METRICAS_DIR` solo se ve el proceso que responde.
+"""
+import atexit
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+LIMITES_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registro = {}
+_valores = {}
+_lock = threading.Lock()
+_proceso = {"pid": None, "fichero": None, "volcado": 0.0}
+
+
+class _Metrica:
+    tipo = ""
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        _registro[nombre] = self
+
+    def _clave(self, etiquetas):
+        if set(etiquetas) != set(self.etiquetas):
+            raise ValueError(f"{self.nombre}: etiquetas {sorted(etiquetas)}, se esperaban {self.etiquetas}")
+        return self.nombre, tuple(str(etiquetas[e]) for e in self.etiquetas)
+
+
+class Contador(_Metrica):
+    tipo = "counter"
+
+    def inc(self, cantidad=1, **etiquetas):
+        clave = self._clave(etiquetas)
+        with _lock:
+            _comprobar_proceso()
+            _valores[clave] = _valores.get(clave, 0) + cantidad
+        _quizas_volcar()
+
+
+class Histograma(_Metrica):
+    tipo = "histogram"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), limites=LIMITES_SEGUNDOS):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.limites = tuple(limites)
+
+    def observar(self, valor, **etiquetas):
+        clave = self._clave(etiquetas)
+        with _lock:
+            _comprobar_proceso()
+            # Cubetas sin acumular (la última es +Inf), y al final la suma
+            datos = _valores.setdefault(clave, [0] * (len(self.limites) + 1) + [0.0])
+            datos[bisect.bisect_left(self.limites, valor)] += 1
+            datos[-1] += valor
+        _quizas_volcar()
+
+
+peticiones = Histograma(
+    "tienda_peticion_segundos", "Duración de las peticiones por nombre de URL", ("url", "metodo")
+)
+carrito_operaciones = Contador(
+    "tienda_carrito_operaciones_total", "Operaciones sobre el carrito", ("operacion", "resultado")
+)
+checkouts = Contador(
+    "tienda_checkouts_total", "Checkouts por método de pago y resultado", ("metodo_pago", "resultado")
+)
+stock_fallos = Contador(
+    "tienda_stock_descuento_fallos_total",
+    "Líneas de pedido cuyo stock no se pudo descontar entero",
+    ("motivo",),
+)
+email_segundos = Histograma(
+    "tienda_email_segundos", "Duración de los envíos de email por SendGrid", ("resultado",)
+)
+cache_consultas = Contador(
+    "tienda_cache_consultas_total", "Consultas a las cachés de la tienda", ("cache", "resultado")
+)
+
+
+def cache_consulta(nombre, acierto):
+    cache_consultas.inc(cache=nombre, resultado="acierto" if acierto else "fallo")
+
+
+# --- Varios procesos ---
+
+def _directorio():
+    return getattr(settings, "METRICAS_DIR", "")
+
+
+def _comprobar_proceso():
+    """Tras un fork el hijo empieza de cero y con su propio fichero (llamar con `_lock`)."""
+    if _proceso["pid"] != os.getpid():
+        if _proceso["pid"] is not None:
+            _valores.clear()
+        _proceso.update(pid=os.getpid(), fichero=f"{os.getpid()}-{uuid.uuid4().hex[:8]}.json", volcado=0.0)
+
+
+def _quizas_volcar():
+    if _directorio() and time.monotonic() - _proceso["volcado"] >= getattr(settings, "METRICAS_INTERVALO", 1.0):
+        volcar()
+
+
+def volcar():
+    """Escribe los valores del proceso en su fichero de `METRICAS_DIR`."""
+    directorio = _directorio()
+    if not directorio:
+        return
+    with _lock:
+        _comprobar_proceso()
+        datos = [[nombre, list(etiquetas), valor] for (nombre, etiquetas), valor in _valores.items()]
+        fichero = os.path.join(directorio, _proceso["fichero"])
+        _proceso["volcado"] = time.monotonic()
+    try:
+        os.makedirs(directorio, exist_ok=True)
+        temporal = f"{fichero}.tmp"
+        with open(temporal, "w") as f:
+            json.dump(datos, f)
+        os.replace(temporal, fichero)
+    except OSError as e:
+        print("⚠ No se pudieron volcar las métricas:", e)
+
+
+atexit.register(volcar)
+
+
+def _sumar(total, clave, valor):
+    if isinstance(valor, list):
+        actual = total.get(clave)
+        total[clave] = valor[:] if actual is None else [a + b for a, b in zip(actual, valor)]
+    else:
+        total[clave] = total.get(clave, 0) + valor
+
+
+def recoger():
+    """Valores de todos los procesos: los de este en memoria y los del resto de sus ficheros."""
+    total = {}
+    with _lock:
+        _comprobar_proceso()
+        propio = _proceso["fichero"]
+        for clave, valor in _valores.items():
+            _sumar(total, clave, valor)
+    directorio = _directorio()
+    if directorio:
+        for ruta in glob.glob(os.path.join(directorio, "*.json")):
+            if os.path.basename(ruta) == propio:
+                continue
+            try:
+                with open(ruta) as f:
+                    datos = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for nombre, etiquetas, valor in datos:
+                _sumar(total, (nombre, tuple(etiquetas)), valor)
+    return total
+
+
+# --- Formato de texto de Prometheus ---
+
+def _numero(valor):
+    if isinstance(valor, float) and valor.is_integer():
+        return str(int(valor))
+    return repr(valor) if isinstance(valor, float) else str(valor)
+
+
+def _escapar(valor):
+    return valor.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _etiquetas(nombres, valores, extra=()):
+    pares = [*zip(nombres, valores), *extra]
+    if not pares:
+        return ""
+    return "{" + ",".join(f'{n}="{_escapar(v)}"' for n, v in pares) + "}"
+
+
+def exponer():
+    """Todas las métricas, sumadas entre procesos, en formato de texto de Prometheus."""
+    valores = recoger()
+    lineas = []
+    for metrica in _registro.values():
+        lineas.append(f"# HELP {metrica.nombre} {metrica.ayuda}")
+        lineas.append(f"# TYPE {metrica.nombre} {metrica.tipo}")
+        series = sorted((et, v) for (nombre, et), v in valores.items() if nombre == metrica.nombre)
+        for etiquetas, valor in series:
+            if metrica.tipo == "counter":
+                lineas.append(f"{metrica.nombre}{_etiquetas(metrica.etiquetas, etiquetas)} {_numero(valor)}")
+                continue
+            acumulado = 0
+            for limite, cuenta in zip((*metrica.limites, "+Inf"), valor[:-1]):
+                acumulado += cuenta
+                le = limite if limite == "+Inf" else _numero(float(limite))
+                lineas.append(
+                    f"{metrica.nombre}_bucket{_etiquetas(metrica.etiquetas, etiquetas, [('le', le)])} {acumulado}"
+                )
+            lineas.append(f"{metrica.nombre}_sum{_etiquetas(metrica.etiquetas, etiquetas)} {_numero(valor[-1])}")
+            lineas.append(f"{metrica.nombre}_count{_etiquetas(metrica.etiquetas, etiquetas)} {acumulado}")
+    return "\n".join(lineas) + "\n"
+
+
+def reiniciar():
+    """Olvida los valores del proceso (pruebas)."""
+    with _lock:
+        _valores.clear()
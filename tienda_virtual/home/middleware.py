@@ -0,0 +1,111 @@
+"""
+Cliente de la petición.
+
+`ClienteMiddleware` deja en `request.cliente` el cliente de quien navega, que
+se resuelve la primera vez que se usa y como mucho una vez por petición:
+
+- Usuario autenticado: su `Cliente`, que llega con el propio usuario
+  (`home.backends.ClienteBackend` lo carga con `select_related`).
+- Invitado: el cliente sin usuario que el checkout guarda en la sesión
+  (`guest_cliente_id`), con una consulta por su clave primaria.
+- Si no hay ninguno, `None`.
+
+Como `request.user`, es un objeto perezoso: se comprueba con
+`if request.cliente`, no con `is None`. Va después de
+`AuthenticationMiddleware`.
+
+`LimitePeticionesMiddleware` aplica los límites de `home/limites.py` por
+nombre de URL: si se pasan, responde 429 con `Retry-After` sin llegar a la
+vista (en JSON a las peticiones AJAX del carrito).
+
+`TiemposMiddleware` mide una muestra de las peticiones (`home/tiempos.py`):
+va el primero para que el total incluya al resto de middlewares.
+
+`MetricasMiddleware` anota la duración de todas las peticiones por nombre de
+URL en `tienda_peticion_segundos` (`home/metricas.py`).
+"""
+import math
+import time
+
+from django.http import HttpResponse, JsonResponse
+from django.utils.functional import SimpleLazyObject
+
+from . import limites, metricas, tiempos
+
+CLAVE_INVITADO = "guest_cliente_id"
+
+
+def _resolver_cliente(request):
+    from .models import Cliente
+
+    if request.user.is_authenticated:
+        return getattr(request.user, "cliente", None)
+    cliente_id = request.session.get(CLAVE_INVITADO)
+    if not cliente_id:
+        return None
+    return Cliente.objects.filter(pk=cliente_id, user__isnull=True).first()
+
+
+class ClienteMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.cliente = SimpleLazyObject(lambda: _resolver_cliente(request))
+        return self.get_response(request)
+
+
+class LimitePeticionesMiddleware:
+    MENSAJE = "Demasiadas peticiones seguidas. Espera un momento y vuelve a intentarlo."
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.limites = limites.limites()
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        limite = self.limites.get(request.resolver_match.view_name)
+        if limite is None or not limite.aplica(request):
+            return None
+        espera = limites.espera(
+            request, request.resolver_match.view_name, limite, limites.coste(request, limite)
+        )
+        if not espera:
+            return None
+        if request.headers.get("X-Requested-With") == "XMLHttpRequest":
+            respuesta = JsonResponse({"success": False, "error": self.MENSAJE}, status=429)
+        else:
+            respuesta = HttpResponse(self.MENSAJE, status=429, content_type="text/plain; charset=utf-8")
+        respuesta["Retry-After"] = str(max(1, math.ceil(espera)))
+        return respuesta
+
+
+class TiemposMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not tiempos.muestrear():
+            return self.get_response(request)
+        return tiempos.medir_peticion(request, self.get_response)
+
+
+class MetricasMiddleware:
+    METODOS = {"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"}
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        inicio = time.perf_counter()
+        response = self.get_response(request)
+        coincidencia = getattr(request, "resolver_match", None)
+        metricas.peticiones.observar(
+            time.perf_counter() - inicio,
+            # Sin URL (404) o método raro se agrupan: las etiquetas no crecen sin límite
+            url=coincidencia.view_name if coincidencia else "sin_url",
+            metodo=request.method if request.method in self.METODOS else "otro",
+        )
+        return response
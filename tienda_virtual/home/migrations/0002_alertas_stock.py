@@ -0,0 +1,67 @@
+# Generated by Django 5.2.8 on 2026-10-19 02:07
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def crear_alertas_iniciales(apps, schema_editor):
+    """Genera las alertas del catálogo existente (mismo criterio que home.stock_alerts)."""
+    Producto = apps.get_model('home', 'Producto')
+    TallaProducto = apps.get_model('home', 'TallaProducto')
+    AlertaStock = apps.get_model('home', 'AlertaStock')
+
+    con_tallas = set(TallaProducto.objects.exclude(producto=None).values_list('producto_id', flat=True))
+    nuevas = []
+    for producto in Producto.objects.filter(esta_disponible=True).iterator():
+        if producto.id not in con_tallas and producto.stock < producto.umbral_stock_bajo:
+            nuevas.append(AlertaStock(producto_id=producto.id, stock=producto.stock, umbral=producto.umbral_stock_bajo))
+    for talla in TallaProducto.objects.filter(producto__esta_disponible=True).select_related('producto').iterator():
+        if talla.stock < talla.producto.umbral_stock_bajo:
+            nuevas.append(AlertaStock(
+                producto_id=talla.producto_id,
+                talla_id=talla.id,
+                stock=talla.stock,
+                umbral=talla.producto.umbral_stock_bajo,
+            ))
+    AlertaStock.objects.bulk_create(nuevas, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='producto',
+            name='umbral_stock_bajo',
+            field=models.PositiveIntegerField(default=10, help_text='Se genera una alerta cuando el stock baja de este valor.', verbose_name='Umbral de stock bajo'),
+        ),
+        migrations.AddField(
+            model_name='tallaproducto',
+            name='umbral_stock_bajo',
+            field=models.PositiveIntegerField(blank=True, help_text='Si se deja vacío se usa el umbral del producto.', null=True, verbose_name='Umbral de stock bajo'),
+        ),
+        migrations.CreateModel(
+            name='AlertaStock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stock', models.PositiveIntegerField()),
+                ('umbral', models.PositiveIntegerField()),
+                ('fecha_creacion', models.DateTimeField(default=django.utils.timezone.now)),
+                ('fecha_notificacion', models.DateTimeField(blank=True, null=True)),
+                ('producto', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='alertas_stock', to='home.producto')),
+                ('talla', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='alertas_stock', to='home.tallaproducto')),
+            ],
+            options={
+                'verbose_name': 'Alerta de stock',
+                'verbose_name_plural': 'Alertas de stock',
+                'ordering': ['stock', 'id'],
+                'indexes': [models.Index(fields=['stock', 'id'], name='alerta_stock_orden_idx'), models.Index(fields=['fecha_notificacion'], name='alerta_stock_notif_idx')],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('talla__isnull', True)), fields=('producto',), name='alerta_stock_producto_unica'), models.UniqueConstraint(condition=models.Q(('talla__isnull', False)), fields=('talla',), name='alerta_stock_talla_unica')],
+            },
+        ),
+        migrations.RunPython(crear_alertas_iniciales, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.8 on 2026-10-19 02:11
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def marcar_stock_descontado(apps, schema_editor):
+    """Los pedidos pagados y los contrareembolso ya restaron su stock."""
+    Pedido = apps.get_model('home', 'Pedido')
+    Pedido.objects.filter(estado__in=['pagado', 'en_proceso', 'enviado', 'entregado']).update(stock_descontado=True)
+    Pedido.objects.filter(estado='pendiente', metodo_pago='contrareembolso').update(stock_descontado=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0002_alertas_stock'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pedido',
+            name='stock_descontado',
+            field=models.BooleanField(default=False, help_text='Indica si las unidades del pedido ya se restaron del stock.'),
+        ),
+        migrations.CreateModel(
+            name='HistorialEstadoPedido',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('estado_anterior', models.CharField(choices=[('pendiente', 'Pendiente'), ('pagado', 'Pagado'), ('en_proceso', 'En proceso'), ('enviado', 'Enviado'), ('entregado', 'Entregado'), ('cancelado', 'Cancelado')], max_length=20)),
+                ('estado_nuevo', models.CharField(choices=[('pendiente', 'Pendiente'), ('pagado', 'Pagado'), ('en_proceso', 'En proceso'), ('enviado', 'Enviado'), ('entregado', 'Entregado'), ('cancelado', 'Cancelado')], max_length=20)),
+                ('fecha', models.DateTimeField(default=django.utils.timezone.now)),
+                ('nota', models.CharField(blank=True, max_length=255)),
+                ('pedido', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='historial_estados', to='home.pedido')),
+                ('usuario', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Cambio de estado de pedido',
+                'verbose_name_plural': 'Historial de estados de pedidos',
+                'ordering': ['fecha', 'id'],
+                'indexes': [models.Index(fields=['pedido', 'fecha'], name='historial_pedido_fecha_idx'), models.Index(fields=['estado_nuevo', 'fecha'], name='historial_estado_fecha_idx')],
+            },
+        ),
+        migrations.RunPython(marcar_stock_descontado, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,75 @@
+# Generated by Django 5.2.8 on 2026-10-19 02:19
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0003_estados_pedido'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CoocurrenciaProducto',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pedidos', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Co-ocurrencia de productos',
+                'verbose_name_plural': 'Co-ocurrencias de productos',
+            },
+        ),
+        migrations.CreateModel(
+            name='RecomendacionProducto',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('posicion', models.PositiveSmallIntegerField()),
+                ('puntuacion', models.FloatField()),
+            ],
+            options={
+                'verbose_name': 'Recomendación de producto',
+                'verbose_name_plural': 'Recomendaciones de productos',
+                'ordering': ['producto', 'posicion'],
+            },
+        ),
+        migrations.AddField(
+            model_name='pedido',
+            name='en_recomendaciones',
+            field=models.BooleanField(default=False, help_text='Indica si el pedido ya se sumó a las co-ocurrencias de productos.'),
+        ),
+        migrations.AddIndex(
+            model_name='pedido',
+            index=models.Index(condition=models.Q(('en_recomendaciones', False), ('stock_descontado', True)), fields=['id_pedido'], name='pedido_pend_recom_idx'),
+        ),
+        migrations.AddField(
+            model_name='coocurrenciaproducto',
+            name='producto',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='home.producto'),
+        ),
+        migrations.AddField(
+            model_name='coocurrenciaproducto',
+            name='relacionado',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='home.producto'),
+        ),
+        migrations.AddField(
+            model_name='recomendacionproducto',
+            name='producto',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recomendaciones', to='home.producto'),
+        ),
+        migrations.AddField(
+            model_name='recomendacionproducto',
+            name='recomendado',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='home.producto'),
+        ),
+        migrations.AddConstraint(
+            model_name='coocurrenciaproducto',
+            constraint=models.UniqueConstraint(fields=('producto', 'relacionado'), name='coocurrencia_producto_unica'),
+        ),
+        migrations.AddConstraint(
+            model_name='recomendacionproducto',
+            constraint=models.UniqueConstraint(fields=('producto', 'posicion'), name='recomendacion_producto_posicion_unica'),
+        ),
+    ]
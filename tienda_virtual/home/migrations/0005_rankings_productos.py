@@ -0,0 +1,31 @@
+# Generated by Django 5.2.8 on 2026-10-19 02:22
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0004_recomendaciones_productos'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RankingProducto',
+            fields=[
+                ('producto', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='ranking', serialize=False, to='home.producto')),
+                ('genero', models.CharField(choices=[('perro', 'Perro'), ('gato', 'Gato'), ('ave', 'Ave'), ('roedor', 'Roedor'), ('reptil', 'Reptil'), ('pez', 'Pez'), ('otro', 'Otro')], max_length=20)),
+                ('unidades_vendidas', models.PositiveIntegerField(default=0, help_text='Unidades vendidas en la ventana de los más vendidos.')),
+                ('tendencia', models.FloatField(default=0, help_text='Unidades vendidas con decaimiento exponencial por antigüedad.')),
+                ('fecha_calculo', models.DateTimeField(default=django.utils.timezone.now)),
+                ('categoria', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='home.categoria')),
+            ],
+            options={
+                'verbose_name': 'Ranking de producto',
+                'verbose_name_plural': 'Rankings de productos',
+                'indexes': [models.Index(fields=['-unidades_vendidas'], name='ranking_ventas_idx'), models.Index(fields=['-tendencia'], name='ranking_tendencia_idx'), models.Index(fields=['genero', '-unidades_vendidas'], name='ranking_especie_ventas_idx'), models.Index(fields=['genero', '-tendencia'], name='ranking_especie_tend_idx'), models.Index(fields=['categoria', '-unidades_vendidas'], name='ranking_cat_ventas_idx'), models.Index(fields=['categoria', '-tendencia'], name='ranking_cat_tend_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.8 on 2026-10-19 02:27
+
+import django.db.models.functions.comparison
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0005_rankings_productos'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='producto',
+            name='precio_efectivo',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.functions.comparison.Coalesce('precio_oferta', 'precio'), output_field=models.DecimalField(decimal_places=2, max_digits=10)),
+        ),
+        migrations.AddIndex(
+            model_name='producto',
+            index=models.Index(fields=['esta_disponible', 'precio_efectivo'], name='producto_precio_efectivo_idx'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.8 on 2026-10-19 02:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0007_fecha_actualizacion_catalogo'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='carrito',
+            name='clave_sesion',
+            field=models.CharField(blank=True, max_length=40, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='carrito',
+            name='version',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='carrito',
+            name='version_inicial',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='itemcarrito',
+            name='version',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='itemcarrito',
+            index=models.Index(fields=['carrito', 'version'], name='item_carrito_version_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='itemcarrito',
+            constraint=models.UniqueConstraint(fields=('carrito', 'producto', 'talla'), name='item_carrito_unico'),
+        ),
+    ]
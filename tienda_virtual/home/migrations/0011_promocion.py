@@ -0,0 +1,43 @@
+# Generated by Django 5.2.8 on 2026-10-19 03:04
+
+import django.db.models.deletion
+import django.utils.timezone
+from decimal import Decimal
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0010_pedido_estado_fecha'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Promocion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('nombre', models.CharField(max_length=100)),
+                ('codigo', models.CharField(blank=True, help_text='Código del cupón. Vacío para aplicarla automáticamente.', max_length=30)),
+                ('tipo', models.CharField(choices=[('porcentaje', 'Porcentaje'), ('importe', 'Importe fijo'), ('lleva_x_paga_y', 'Lleva X, paga Y'), ('envio_gratis', 'Envío gratis')], default='porcentaje', max_length=20)),
+                ('valor', models.DecimalField(decimal_places=2, default=Decimal('0.00'), help_text='Porcentaje (1-100) o importe en euros, según el tipo.', max_digits=10)),
+                ('cantidad_lleva', models.PositiveSmallIntegerField(default=0, help_text='X en «lleva X, paga Y».')),
+                ('cantidad_paga', models.PositiveSmallIntegerField(default=0, help_text='Y en «lleva X, paga Y».')),
+                ('especie', models.CharField(blank=True, choices=[('perro', 'Perro'), ('gato', 'Gato'), ('ave', 'Ave'), ('roedor', 'Roedor'), ('reptil', 'Reptil'), ('pez', 'Pez'), ('otro', 'Otro')], max_length=20)),
+                ('minimo_compra', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=10)),
+                ('activa', models.BooleanField(default=True)),
+                ('fecha_inicio', models.DateTimeField(default=django.utils.timezone.now)),
+                ('fecha_fin', models.DateTimeField(blank=True, null=True)),
+                ('fecha_actualizacion', models.DateTimeField(default=django.utils.timezone.now)),
+                ('categoria', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='promociones', to='home.categoria')),
+                ('marca', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='promociones', to='home.marca')),
+                ('producto', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='promociones', to='home.producto')),
+            ],
+            options={
+                'verbose_name': 'Promoción',
+                'verbose_name_plural': 'Promociones',
+                'indexes': [models.Index(fields=['activa', 'fecha_fin'], name='promocion_vigente_idx')],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('codigo', ''), _negated=True), fields=('codigo',), name='promocion_codigo_unico')],
+            },
+        ),
+    ]
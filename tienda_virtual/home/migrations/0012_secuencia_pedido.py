@@ -0,0 +1,25 @@
+# Generated by Django 5.2.8 on 2026-10-19 03:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0011_promocion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SecuenciaPedido',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('nombre', models.CharField(max_length=30, unique=True)),
+                ('siguiente', models.PositiveBigIntegerField(default=1)),
+            ],
+            options={
+                'verbose_name': 'Secuencia de pedidos',
+                'verbose_name_plural': 'Secuencias de pedidos',
+            },
+        ),
+    ]
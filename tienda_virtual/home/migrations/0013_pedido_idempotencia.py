@@ -0,0 +1,28 @@
+# Generated by Django 5.2.8 on 2026-10-19 03:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0012_secuencia_pedido'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pedido',
+            name='clave_idempotencia',
+            field=models.CharField(blank=True, default=None, help_text='Clave del formulario de pago que creó el pedido; un reenvío devuelve este pedido.', max_length=64, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='pedido',
+            name='sesion_stripe_id',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='pedido',
+            name='sesion_stripe_url',
+            field=models.TextField(blank=True),
+        ),
+    ]
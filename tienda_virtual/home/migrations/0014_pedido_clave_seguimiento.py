@@ -0,0 +1,26 @@
+# Generated by Django 5.2.8 on 2026-10-19 03:26
+
+from django.db import migrations, models
+from django.db.models.functions import Trim, Upper
+
+
+def rellenar_clave_seguimiento(apps, schema_editor):
+    """Los pedidos existentes se buscan por su número en mayúsculas."""
+    Pedido = apps.get_model('home', 'Pedido')
+    Pedido.objects.update(clave_seguimiento=Upper(Trim('numero_pedido')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0013_pedido_idempotencia'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pedido',
+            name='clave_seguimiento',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=50),
+        ),
+        migrations.RunPython(rellenar_clave_seguimiento, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.8 on 2026-10-19 03:30
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def copiar_nombre_producto(apps, schema_editor):
+    """Las líneas existentes guardan el nombre actual de su producto."""
+    ItemPedido = apps.get_model('home', 'ItemPedido')
+    Producto = apps.get_model('home', 'Producto')
+    ItemPedido.objects.update(
+        nombre_producto=Subquery(Producto.objects.filter(pk=OuterRef('producto_id')).values('nombre')[:1])
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0014_pedido_clave_seguimiento'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='itempedido',
+            name='nombre_producto',
+            field=models.CharField(blank=True, max_length=200),
+        ),
+        migrations.RunPython(copiar_nombre_producto, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='pedido',
+            index=models.Index(fields=['cliente', '-fecha_creacion', '-id_pedido'], name='pedido_cliente_fecha_idx'),
+        ),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 5.2.8 on 2026-10-19 03:37
+
+import django.db.models.functions.text
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import Lower, Trim
+
+CAMPOS_PERFIL = ('nombre', 'apellidos', 'telefono', 'direccion', 'ciudad', 'codigo_postal')
+
+
+def unificar_clientes(apps, schema_editor):
+    """
+    Antes de crear el índice único sobre LOWER(email) se unifican los clientes
+    cuyo email solo se diferencia en mayúsculas o espacios. Se queda el que
+    tiene usuario (o el más antiguo); los pedidos y carritos de los demás pasan
+    a él, completa con ellos los datos que le falten y se borran. Después se
+    guardan todos los emails normalizados.
+    """
+    Cliente = apps.get_model('home', 'Cliente')
+    Pedido = apps.get_model('home', 'Pedido')
+    Carrito = apps.get_model('home', 'Carrito')
+
+    repetidos = (
+        Cliente.objects.values(clave=Lower(Trim('email')))
+        .annotate(total=Count('id'))
+        .filter(total__gt=1)
+        .values_list('clave', flat=True)
+    )
+    for clave in list(repetidos):
+        clientes = list(
+            Cliente.objects.annotate(clave=Lower(Trim('email')))
+            .filter(clave=clave)
+            .order_by(models.F('user').asc(nulls_last=True), 'fecha_creacion', 'id')
+        )
+        principal, duplicados = clientes[0], clientes[1:]
+        ids = [c.pk for c in duplicados]
+        Pedido.objects.filter(cliente_id__in=ids).update(cliente=principal)
+        Carrito.objects.filter(cliente_id__in=ids).update(cliente=principal)
+        usuario = principal.user_id or next((c.user_id for c in duplicados if c.user_id), None)
+        for campo in CAMPOS_PERFIL:
+            if not getattr(principal, campo):
+                valor = next((getattr(c, campo) for c in duplicados if getattr(c, campo)), None)
+                if valor:
+                    setattr(principal, campo, valor)
+        principal.es_admin = any(c.es_admin for c in clientes)
+        Cliente.objects.filter(pk__in=ids).delete()
+        principal.user_id = usuario
+        principal.save()
+
+    Cliente.objects.update(email=Lower(Trim('email')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0015_historial_pedidos'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(unificar_clientes, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='cliente',
+            name='email',
+            field=models.EmailField(max_length=254),
+        ),
+        migrations.AddConstraint(
+            model_name='cliente',
+            constraint=models.UniqueConstraint(django.db.models.functions.text.Lower('email'), name='cliente_email_lower_unico', violation_error_message='Ya existe un cliente con este email.'),
+        ),
+    ]
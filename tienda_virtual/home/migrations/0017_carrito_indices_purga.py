@@ -0,0 +1,21 @@
+# Generated by Django 5.2.8 on 2026-10-19 04:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0016_cliente_email_normalizado'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='carrito',
+            index=models.Index(condition=models.Q(('cliente__isnull', True)), fields=['fecha_actualizacion'], name='carrito_anonimo_fecha_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='itemcarrito',
+            index=models.Index(condition=models.Q(('cantidad', 0)), fields=['carrito'], name='item_carrito_quitado_idx'),
+        ),
+    ]
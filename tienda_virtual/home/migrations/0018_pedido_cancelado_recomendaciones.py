@@ -0,0 +1,17 @@
+# Generated by Django 5.2.8 on 2026-10-19 04:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0017_carrito_indices_purga'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='pedido',
+            index=models.Index(condition=models.Q(('en_recomendaciones', True), ('stock_descontado', False)), fields=['id_pedido'], name='pedido_cancel_recom_idx'),
+        ),
+    ]
@@ -0,0 +1,77 @@
+# Generated by Django 5.2.8 on 2026-10-19 04:46
+
+from django.db import migrations, models
+
+
+def crear_rankings_pendientes(apps, schema_editor):
+    """Los listados por popularidad solo muestran productos con fila de ranking."""
+    Producto = apps.get_model('home', 'Producto')
+    RankingProducto = apps.get_model('home', 'RankingProducto')
+    RankingProducto.objects.bulk_create(
+        [
+            RankingProducto(producto_id=pk, genero=genero, categoria_id=categoria_id)
+            for pk, genero, categoria_id in Producto.objects.filter(ranking__isnull=True).values_list(
+                'id', 'genero', 'categoria_id'
+            )
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0018_pedido_cancelado_recomendaciones'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='rankingproducto',
+            name='ranking_ventas_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='rankingproducto',
+            name='ranking_tendencia_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='rankingproducto',
+            name='ranking_especie_ventas_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='rankingproducto',
+            name='ranking_especie_tend_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='rankingproducto',
+            name='ranking_cat_ventas_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='rankingproducto',
+            name='ranking_cat_tend_idx',
+        ),
+        migrations.AddIndex(
+            model_name='rankingproducto',
+            index=models.Index(fields=['-unidades_vendidas', '-producto'], name='ranking_ventas_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rankingproducto',
+            index=models.Index(fields=['-tendencia', '-producto'], name='ranking_tendencia_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rankingproducto',
+            index=models.Index(fields=['genero', '-unidades_vendidas', '-producto'], name='ranking_especie_ventas_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rankingproducto',
+            index=models.Index(fields=['genero', '-tendencia', '-producto'], name='ranking_especie_tend_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rankingproducto',
+            index=models.Index(fields=['categoria', '-unidades_vendidas', '-producto'], name='ranking_cat_ventas_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rankingproducto',
+            index=models.Index(fields=['categoria', '-tendencia', '-producto'], name='ranking_cat_tend_idx'),
+        ),
+        migrations.RunPython(crear_rankings_pendientes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,51 @@
+"""
+Miniaturas para las vistas de listado del admin.
+
+Las imágenes originales de productos, marcas y categorías pueden pesar varios MB;
+en un listado de 100 filas no tiene sentido descargarlas enteras. La primera vez
+que se pide la miniatura se genera con Pillow y se guarda en el mismo storage
+(`miniaturas/<tamaño>/<ruta original>`); las siguientes veces solo se devuelve
+su URL.
+"""
+import os
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, UnidentifiedImageError
+
+TAMANO_MINIATURA = 100
+
+
+def _ruta_miniatura(nombre, tamano):
+    base, _ = os.path.splitext(nombre)
+    return f"miniaturas/{tamano}/{base}.jpg"
+
+
+def miniatura_url(imagen, tamano=TAMANO_MINIATURA):
+    """
+    Devuelve la URL de la miniatura de un `ImageField`, generándola si no existe.
+    Devuelve None si el fichero no se puede leer como imagen.
+    """
+    if not imagen:
+        return None
+
+    storage = getattr(imagen, "storage", default_storage)
+    ruta = _ruta_miniatura(imagen.name, tamano)
+    if storage.exists(ruta):
+        return storage.url(ruta)
+
+    try:
+        with storage.open(imagen.name, "rb") as original:
+            img = Image.open(original)
+            img.thumbnail((tamano, tamano))
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            salida = BytesIO()
+            img.save(salida, format="JPEG", quality=80)
+    except (OSError, UnidentifiedImageError) as e:
+        print(f"Warning: no se pudo generar la miniatura de {imagen.name}: {e}")
+        return None
+
+    ruta = storage.save(ruta, ContentFile(salida.getvalue()))
+    return storage.url(ruta)
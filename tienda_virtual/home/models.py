@@ -1,11 +1,15 @@
 from decimal import Decimal, ROUND_HALF_UP
 
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Sum
+from django.db.models.functions import Coalesce, Lower
 from django.utils import timezone
 from django.core.validators import MinValueValidator
 from django.core.exceptions import ValidationError
 
+from . import metricas
+
 
 class Articulo(models.Model):
     nombre = models.CharField(max_length=30)
@@ -29,6 +33,12 @@ class Producto(models.Model):
                                  validators=[MinValueValidator(Decimal('0.00'))])
     precio_oferta = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True,
                                         validators=[MinValueValidator(Decimal('0.00'))])
+    # Precio que paga el cliente; columna generada para poder ordenar y filtrar en la BD
+    precio_efectivo = models.GeneratedField(
+        expression=Coalesce('precio_oferta', 'precio'),
+        output_field=models.DecimalField(max_digits=10, decimal_places=2),
+        db_persist=True,
+    )
 
     marca = models.ForeignKey('Marca', on_delete=models.PROTECT, related_name='productos')
     categoria = models.ForeignKey('Categoria', on_delete=models.PROTECT, blank=True, null=True, related_name='productos')
@@ -50,15 +60,44 @@ class Producto(models.Model):
     fecha_creacion = models.DateTimeField(default=timezone.now)
     fecha_actualizacion = models.DateTimeField(default=timezone.now)
     es_destacado = models.BooleanField(default=False)
+    umbral_stock_bajo = models.PositiveIntegerField(
+        default=10,
+        verbose_name="Umbral de stock bajo",
+        help_text="Se genera una alerta cuando el stock baja de este valor.",
+    )
 
     class Meta:
         verbose_name = "Producto"
         verbose_name_plural = "Productos"
+        indexes = [
+            models.Index(fields=["esta_disponible", "precio_efectivo"], name="producto_precio_efectivo_idx"),
+            # MAX(fecha_actualizacion) para los ETag del catálogo (home/condicional.py)
+            models.Index(fields=["fecha_actualizacion"], name="producto_fecha_act_idx"),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._valores_busqueda = (instance.__dict__.get("nombre"), instance.__dict__.get("esta_disponible"))
+        instance._valores_ranking = (instance.__dict__.get("genero"), instance.__dict__.get("categoria_id"))
+        return instance
+
+    @property
+    def cambia_busqueda(self):
+        """True si el guardado afecta al índice de búsqueda (nombre o disponibilidad)."""
+        return getattr(self, "_valores_busqueda", None) != (self.nombre, self.esta_disponible)
+
+    @property
+    def cambia_ranking(self):
+        """True si cambian la especie o la categoría, que se copian a `RankingProducto`."""
+        return getattr(self, "_valores_ranking", None) != (self.genero, self.categoria_id)
 
     def save(self, *args, **kwargs):
         self.fecha_actualizacion = timezone.now()
         self.full_clean()
         super().save(*args, **kwargs)
+        # La BD calcula precio_efectivo, pero Django no lo relee tras un UPDATE
+        self.precio_efectivo = self.precio_oferta if self.precio_oferta is not None else self.precio
         
 
     def clean(self):
@@ -86,10 +125,73 @@ class TallaProducto(models.Model):
     producto = models.ForeignKey(Producto, on_delete=models.CASCADE, related_name='tallas', null=True, blank=True)
     talla = models.CharField(max_length=50)
     stock = models.PositiveIntegerField(default=0)
+    umbral_stock_bajo = models.PositiveIntegerField(
+        blank=True,
+        null=True,
+        verbose_name="Umbral de stock bajo",
+        help_text="Si se deja vacío se usa el umbral del producto.",
+    )
+
+    @property
+    def umbral_efectivo(self) -> int:
+        """Umbral propio de la talla o, si no tiene, el del producto."""
+        if self.umbral_stock_bajo is not None:
+            return self.umbral_stock_bajo
+        if self.producto is not None:
+            return self.producto.umbral_stock_bajo
+        return 0
 
     def __str__(self):
         return f"{self.producto.nombre} - Talla: {self.talla}"
 
+
+class AlertaStock(models.Model):
+    """
+    Producto (sin tallas) o talla cuyo stock está por debajo de su umbral.
+
+    Las filas se mantienen de forma incremental desde las señales de `Producto`
+    y `TallaProducto` (ver `home/stock_alerts.py`): existen mientras dura la
+    falta de stock y se borran al reponerlo.
+    """
+    producto = models.ForeignKey(Producto, on_delete=models.CASCADE, related_name='alertas_stock')
+    talla = models.ForeignKey(
+        TallaProducto,
+        on_delete=models.CASCADE,
+        related_name='alertas_stock',
+        blank=True,
+        null=True,
+    )
+    stock = models.PositiveIntegerField()
+    umbral = models.PositiveIntegerField()
+    fecha_creacion = models.DateTimeField(default=timezone.now)
+    fecha_notificacion = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        verbose_name = "Alerta de stock"
+        verbose_name_plural = "Alertas de stock"
+        ordering = ["stock", "id"]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["producto"],
+                condition=models.Q(talla__isnull=True),
+                name="alerta_stock_producto_unica",
+            ),
+            models.UniqueConstraint(
+                fields=["talla"],
+                condition=models.Q(talla__isnull=False),
+                name="alerta_stock_talla_unica",
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["stock", "id"], name="alerta_stock_orden_idx"),
+            models.Index(fields=["fecha_notificacion"], name="alerta_stock_notif_idx"),
+        ]
+
+    def __str__(self):
+        if self.talla_id:
+            return f"{self.producto.nombre} (talla {self.talla.talla}): {self.stock}/{self.umbral}"
+        return f"{self.producto.nombre}: {self.stock}/{self.umbral}"
+
 class ImagenProducto(models.Model):
     producto = models.ForeignKey(Producto, on_delete=models.CASCADE, related_name='imagenes', null=True, blank=True)
     imagen = models.ImageField(upload_to='productos/imagenes/')
@@ -104,6 +206,11 @@ class ImagenProducto(models.Model):
 class Marca(models.Model):
     nombre = models.CharField(max_length=100, unique=True)
     imagen = models.ImageField(upload_to='marcas/imagenes/')
+    fecha_actualizacion = models.DateTimeField(default=timezone.now)
+
+    def save(self, *args, **kwargs):
+        self.fecha_actualizacion = timezone.now()
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return self.nombre
@@ -112,11 +219,21 @@ class Categoria(models.Model):
     nombre = models.CharField(max_length=100, unique=True)
     descripcion = models.TextField(blank=True)
     imagen = models.ImageField(upload_to='categorias/imagenes/')
+    fecha_actualizacion = models.DateTimeField(default=timezone.now)
+
+    def save(self, *args, **kwargs):
+        self.fecha_actualizacion = timezone.now()
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return self.nombre
 
 
+def normalizar_email(email):
+    """Emails de cliente sin espacios y en minúsculas: así se guardan y se buscan."""
+    return (email or "").strip().lower()
+
+
 class Cliente(models.Model):
     user = models.OneToOneField(
         settings.AUTH_USER_MODEL,
@@ -127,7 +244,8 @@ class Cliente(models.Model):
     )
     nombre = models.CharField(max_length=150)
     apellidos = models.CharField(max_length=150, blank=True, null=True)
-    email = models.EmailField(unique=True)
+    # Único sin distinguir mayúsculas: ver la restricción sobre LOWER(email)
+    email = models.EmailField()
     telefono = models.CharField(max_length=20, blank=True, null=True)
     fecha_creacion = models.DateTimeField(default=timezone.now)
     direccion = models.CharField(max_length=255, blank=True, null=True)
@@ -138,6 +256,28 @@ class Cliente(models.Model):
     class Meta:
         verbose_name = "Cliente"
         verbose_name_plural = "Clientes"
+        constraints = [
+            models.UniqueConstraint(
+                Lower("email"),
+                name="cliente_email_lower_unico",
+                violation_error_message="Ya existe un cliente con este email.",
+            ),
+        ]
+
+    @classmethod
+    def por_email(cls, email):
+        """
+        Clientes con ese email sin distinguir mayúsculas. Filtra por
+        LOWER(email), la misma expresión del índice único, así que la
+        consulta usa el índice (un `email__iexact` no puede).
+        """
+        return cls.objects.alias(email_normalizado=Lower("email")).filter(
+            email_normalizado=normalizar_email(email)
+        )
+
+    def save(self, *args, **kwargs):
+        self.email = normalizar_email(self.email)
+        super().save(*args, **kwargs)
 
     def __str__(self):
         nombre_completo = " ".join(
@@ -171,6 +311,8 @@ class Pedido(models.Model):
     )
     fecha_creacion = models.DateTimeField(default=timezone.now)
     numero_pedido = models.CharField(max_length=50, unique=True)
+    # numero_pedido en mayúsculas: el seguimiento busca por aquí (índice) y no con iexact
+    clave_seguimiento = models.CharField(max_length=50, db_index=True, editable=False, default="")
     estado = models.CharField(
         max_length=20,
         choices=Estados.choices,
@@ -204,39 +346,239 @@ class Pedido(models.Model):
     metodo_pago = models.CharField(max_length=100, blank=True)
     direccion_envio = models.CharField(max_length=255, blank=True)
     telefono = models.CharField(max_length=20, blank=True)
-
+    stock_descontado = models.BooleanField(
+        default=False,
+        help_text="Indica si las unidades del pedido ya se restaron del stock.",
+    )
+    en_recomendaciones = models.BooleanField(
+        default=False,
+        help_text="Indica si el pedido ya se sumó a las co-ocurrencias de productos.",
+    )
+    clave_idempotencia = models.CharField(
+        max_length=64,
+        unique=True,
+        null=True,
+        blank=True,
+        default=None,
+        help_text="Clave del formulario de pago que creó el pedido; un reenvío devuelve este pedido.",
+    )
+    sesion_stripe_id = models.CharField(max_length=255, blank=True)
+    sesion_stripe_url = models.TextField(blank=True)
+
+    # Máquina de estados: estado actual -> estados a los que puede pasar
+    TRANSICIONES = {
+        Estados.PENDIENTE: (Estados.PAGADO, Estados.CANCELADO),
+        Estados.PAGADO: (Estados.EN_PROCESO, Estados.CANCELADO),
+        Estados.EN_PROCESO: (Estados.ENVIADO, Estados.CANCELADO),
+        Estados.ENVIADO: (Estados.ENTREGADO,),
+        Estados.ENTREGADO: (),
+        Estados.CANCELADO: (),
+    }
 
     class Meta:
         verbose_name = "Pedido"
         verbose_name_plural = "Pedidos"
         ordering = ["-fecha_creacion"]
+        indexes = [
+            # pedidos confirmados pendientes de procesar por el job de recomendaciones
+            models.Index(
+                fields=["id_pedido"],
+                condition=models.Q(stock_descontado=True, en_recomendaciones=False),
+                name="pedido_pend_recom_idx",
+            ),
+            # pedidos ya contados y cancelados después, que el job tiene que restar
+            models.Index(
+                fields=["id_pedido"],
+                condition=models.Q(stock_descontado=False, en_recomendaciones=True),
+                name="pedido_cancel_recom_idx",
+            ),
+            # pedidos por estado y antigüedad (caducidad de pendientes, filtros del panel)
+            models.Index(fields=["estado", "fecha_creacion"], name="pedido_estado_fecha_idx"),
+            # historial de un cliente, del más reciente al más antiguo (paginación por cursor)
+            models.Index(fields=["cliente", "-fecha_creacion", "-id_pedido"], name="pedido_cliente_fecha_idx"),
+        ]
 
     def _quantize(self, value: Decimal) -> Decimal:
         return value.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
 
     def recalcular_totales(self):
-        items = self.items.all()
-        subtotal = sum((item.total for item in items), Decimal("0.00"))
+        subtotal = self.items.aggregate(total=Sum("total"))["total"] or Decimal("0.00")
         subtotal = self._quantize(subtotal)
 
         self.subtotal = subtotal
         total = subtotal + self.impuestos + self.coste_entrega - self.descuento
         self.total = self._quantize(total)
 
+    def actualizar_totales(self):
+        """Recalcula subtotal/total a partir de las líneas y guarda solo esas columnas."""
+        self.recalcular_totales()
+        Pedido.objects.filter(pk=self.pk).update(
+            subtotal=self.subtotal,
+            total=self.total,
+        )
+
     def save(self, *args, **kwargs):
-        is_new = self._state.adding
-        if not is_new:
-            self.recalcular_totales()
-        else:
+        # El total depende solo de columnas propias; las líneas actualizan el
+        # subtotal por su cuenta (ItemPedido.save/delete), así que aquí no se
+        # vuelven a leer. Un guardado parcial (update_fields) no toca totales.
+        update_fields = kwargs.get("update_fields")
+        self.clave_seguimiento = (self.numero_pedido or "").strip().upper()
+        if update_fields is not None and "numero_pedido" in update_fields:
+            kwargs["update_fields"] = update_fields = [*update_fields, "clave_seguimiento"]
+        if update_fields is None or "total" in update_fields:
             self.total = self._quantize(
                 self.subtotal + self.impuestos + self.coste_entrega - self.descuento
             )
         super().save(*args, **kwargs)
 
+    def estados_siguientes(self):
+        """Estados a los que puede pasar el pedido desde su estado actual."""
+        return list(self.TRANSICIONES.get(self.estado, ()))
+
+    def puede_cambiar_a(self, nuevo_estado) -> bool:
+        return nuevo_estado in self.TRANSICIONES.get(self.estado, ())
+
+    def cambiar_estado(self, nuevo_estado, usuario=None, nota=""):
+        """
+        Aplica una transición de la máquina de estados.
+
+        Bloquea la fila del pedido, valida la transición, guarda solo las
+        columnas que cambian y deja constancia en `HistorialEstadoPedido`.
+        Al cancelar un pedido cuyo stock ya se había restado, lo repone en la
+        misma transacción.
+        """
+        with transaction.atomic():
+            actual = (
+                Pedido.objects.select_for_update()
+                .only("estado", "stock_descontado")
+                .get(pk=self.pk)
+            )
+            self.estado = actual.estado
+            self.stock_descontado = actual.stock_descontado
+
+            if not self.puede_cambiar_a(nuevo_estado):
+                destino = dict(Pedido.Estados.choices).get(nuevo_estado, nuevo_estado)
+                raise ValidationError(
+                    f"No se puede pasar un pedido de '{self.get_estado_display()}' a '{destino}'."
+                )
+
+            estado_anterior = self.estado
+            campos = ["estado"]
+            if nuevo_estado == Pedido.Estados.CANCELADO and self.stock_descontado:
+                self._mover_stock(reponer=True)
+                self.stock_descontado = False
+                campos.append("stock_descontado")
+
+            self.estado = nuevo_estado
+            self.save(update_fields=campos)
+            HistorialEstadoPedido.objects.create(
+                pedido=self,
+                estado_anterior=estado_anterior,
+                estado_nuevo=nuevo_estado,
+                usuario=usuario,
+                nota=nota,
+            )
+
+    def descontar_stock(self):
+        """Resta del stock (talla o producto) las unidades del pedido, una sola vez."""
+        with transaction.atomic():
+            descontado = (
+                Pedido.objects.select_for_update()
+                .filter(pk=self.pk)
+                .values_list("stock_descontado", flat=True)
+                .first()
+            )
+            if descontado:
+                self.stock_descontado = True
+                return
+            self._mover_stock(reponer=False)
+            self.stock_descontado = True
+            self.save(update_fields=["stock_descontado"])
+
+    def _mover_stock(self, reponer):
+        """Suma (reponer=True) o resta las unidades de cada línea del stock."""
+        for item in self.items.select_related("producto"):
+            producto = item.producto
+            cantidad = item.cantidad
+            talla = item.talla or ''
+
+            if talla:
+                talla_obj = (
+                    TallaProducto.objects.select_for_update()
+                    .filter(producto=producto, talla=talla)
+                    .first()
+                )
+                if talla_obj is None:
+                    print(f"⚠ Error: No se encontró la talla '{talla}' para el producto {producto.nombre}")
+                    if not reponer:
+                        metricas.stock_fallos.inc(motivo="talla_no_encontrada")
+                    continue
+                if reponer:
+                    talla_obj.stock += cantidad
+                elif talla_obj.stock >= cantidad:
+                    talla_obj.stock -= cantidad
+                else:
+                    # Ajustar a 0 y avisar por consola (no romper el flujo)
+                    print(f"⚠ Advertencia: Stock insuficiente para {producto.nombre} talla {talla}. Stock actual: {talla_obj.stock}, solicitado: {cantidad}")
+                    metricas.stock_fallos.inc(motivo="stock_insuficiente")
+                    talla_obj.stock = 0
+                talla_obj.save()
+            else:
+                producto = Producto.objects.select_for_update().get(pk=producto.pk)
+                if reponer:
+                    producto.stock += cantidad
+                elif producto.stock >= cantidad:
+                    producto.stock -= cantidad
+                else:
+                    print(f"⚠ Advertencia: Stock insuficiente para {producto.nombre}. Stock actual: {producto.stock}, solicitado: {cantidad}")
+                    metricas.stock_fallos.inc(motivo="stock_insuficiente")
+                    producto.stock = 0
+                producto.save()
+
     def __str__(self):
         return f"Pedido #{self.numero_pedido}"
 
 
+class HistorialEstadoPedido(models.Model):
+    """Registro de solo inserción con cada cambio de estado de un pedido."""
+    pedido = models.ForeignKey(
+        Pedido,
+        on_delete=models.CASCADE,
+        related_name="historial_estados",
+    )
+    estado_anterior = models.CharField(max_length=20, choices=Pedido.Estados.choices)
+    estado_nuevo = models.CharField(max_length=20, choices=Pedido.Estados.choices)
+    fecha = models.DateTimeField(default=timezone.now)
+    usuario = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.SET_NULL,
+        related_name="+",
+        blank=True,
+        null=True,
+    )
+    nota = models.CharField(max_length=255, blank=True)
+
+    class Meta:
+        verbose_name = "Cambio de estado de pedido"
+        verbose_name_plural = "Historial de estados de pedidos"
+        ordering = ["fecha", "id"]
+        indexes = [
+            models.Index(fields=["pedido", "fecha"], name="historial_pedido_fecha_idx"),
+            models.Index(fields=["estado_nuevo", "fecha"], name="historial_estado_fecha_idx"),
+        ]
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValidationError("El historial de estados no se puede modificar.")
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise ValidationError("El historial de estados no se puede borrar.")
+
+    def __str__(self):
+        return f"{self.pedido.numero_pedido}: {self.estado_anterior} → {self.estado_nuevo}"
+
+
 class ItemPedido(models.Model):
     id_item_pedido = models.AutoField(primary_key=True)
     pedido = models.ForeignKey(
@@ -249,6 +591,8 @@ class ItemPedido(models.Model):
         on_delete=models.PROTECT,
         related_name="items_pedido",
     )
+    # Nombre del producto al comprarlo: el historial y el seguimiento no leen Producto
+    nombre_producto = models.CharField(max_length=200, blank=True)
     talla = models.CharField(max_length=50, blank=True, null=True)
     cantidad = models.PositiveIntegerField(default=1)
     precio_unitario = models.DecimalField(
@@ -266,26 +610,138 @@ class ItemPedido(models.Model):
         verbose_name = "Item de pedido"
         verbose_name_plural = "Items de pedido"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._valores_originales = (instance.cantidad, instance.precio_unitario)
+        return instance
+
     def save(self, *args, **kwargs):
         if not self.precio_unitario:
             self.precio_unitario = self.producto.precio or Decimal("0.00")
+        if not self.nombre_producto:
+            self.nombre_producto = self.producto.nombre
 
         self.total = Decimal(self.cantidad) * self.precio_unitario
         self.total = self.total.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
 
+        # Solo hace falta recalcular el pedido si la línea es nueva o cambió su importe
+        cambio = getattr(self, "_valores_originales", None) != (self.cantidad, self.precio_unitario)
+
         super().save(*args, **kwargs)
-        # Recalcular totales del pedido asociado
-        self.pedido.recalcular_totales()
-        Pedido.objects.filter(pk=self.pedido.pk).update(
-            subtotal=self.pedido.subtotal,
-            total=self.pedido.total,
-        )
+        self._valores_originales = (self.cantidad, self.precio_unitario)
+        if cambio:
+            self.pedido.actualizar_totales()
+
+    def delete(self, *args, **kwargs):
+        pedido = self.pedido
+        resultado = super().delete(*args, **kwargs)
+        pedido.actualizar_totales()
+        return resultado
 
     def __str__(self):
         return f"{self.producto.nombre} x{self.cantidad}"
 
 
+class RankingProducto(models.Model):
+    """
+    Puntuaciones de ventas de un producto, calculadas por `home/rankings.py`.
+
+    `genero` y `categoria` se copian del producto para poder sacar el ranking
+    de una especie o categoría recorriendo solo los índices de esta tabla.
+    """
+    producto = models.OneToOneField(
+        Producto, on_delete=models.CASCADE, primary_key=True, related_name="ranking"
+    )
+    genero = models.CharField(max_length=20, choices=Producto.Especie.choices)
+    categoria = models.ForeignKey(
+        "Categoria", on_delete=models.CASCADE, blank=True, null=True, related_name="+"
+    )
+    unidades_vendidas = models.PositiveIntegerField(
+        default=0, help_text="Unidades vendidas en la ventana de los más vendidos."
+    )
+    tendencia = models.FloatField(
+        default=0, help_text="Unidades vendidas con decaimiento exponencial por antigüedad."
+    )
+    fecha_calculo = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        verbose_name = "Ranking de producto"
+        verbose_name_plural = "Rankings de productos"
+        indexes = [
+            # `-producto` desempata igual que `catalogo.aplicar_orden`, así el
+            # ORDER BY completo sale del índice sin ordenar en memoria
+            models.Index(fields=["-unidades_vendidas", "-producto"], name="ranking_ventas_idx"),
+            models.Index(fields=["-tendencia", "-producto"], name="ranking_tendencia_idx"),
+            models.Index(
+                fields=["genero", "-unidades_vendidas", "-producto"], name="ranking_especie_ventas_idx"
+            ),
+            models.Index(fields=["genero", "-tendencia", "-producto"], name="ranking_especie_tend_idx"),
+            models.Index(
+                fields=["categoria", "-unidades_vendidas", "-producto"], name="ranking_cat_ventas_idx"
+            ),
+            models.Index(fields=["categoria", "-tendencia", "-producto"], name="ranking_cat_tend_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.producto.nombre}: {self.unidades_vendidas} uds, tendencia {self.tendencia:.2f}"
+
+
+class CoocurrenciaProducto(models.Model):
+    """
+    Número de pedidos en los que aparecen juntos dos productos.
+
+    Se guarda en ambos sentidos (A→B y B→A). La fila con `producto == relacionado`
+    es el número de pedidos que contienen el producto, que hace falta para
+    normalizar la similitud. Se mantiene desde `home/recomendaciones.py`.
+    """
+    producto = models.ForeignKey(Producto, on_delete=models.CASCADE, related_name="+")
+    relacionado = models.ForeignKey(Producto, on_delete=models.CASCADE, related_name="+")
+    pedidos = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = "Co-ocurrencia de productos"
+        verbose_name_plural = "Co-ocurrencias de productos"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["producto", "relacionado"],
+                name="coocurrencia_producto_unica",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.producto_id} ↔ {self.relacionado_id}: {self.pedidos}"
+
+
+class RecomendacionProducto(models.Model):
+    """Los K productos más comprados junto a `producto`, ya ordenados."""
+    producto = models.ForeignKey(Producto, on_delete=models.CASCADE, related_name="recomendaciones")
+    recomendado = models.ForeignKey(Producto, on_delete=models.CASCADE, related_name="+")
+    posicion = models.PositiveSmallIntegerField()
+    puntuacion = models.FloatField()
+
+    class Meta:
+        verbose_name = "Recomendación de producto"
+        verbose_name_plural = "Recomendaciones de productos"
+        ordering = ["producto", "posicion"]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["producto", "posicion"],
+                name="recomendacion_producto_posicion_unica",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.producto.nombre} → {self.recomendado.nombre} ({self.puntuacion:.2f})"
+
+
 class Carrito(models.Model):
+    """
+    Carrito de la tienda. El de la web va ligado a la sesión y se modifica
+    desde `home/carrito.py`: cada cambio sube `version` con un UPDATE
+    condicional (compare-and-swap), así que dos peticiones simultáneas no se
+    pisan.
+    """
     cliente = models.ForeignKey(
         Cliente,
         on_delete=models.CASCADE,
@@ -293,12 +749,23 @@ class Carrito(models.Model):
         blank=True,
         null=True,
     )
+    clave_sesion = models.CharField(max_length=40, unique=True, blank=True, null=True)
+    version = models.PositiveBigIntegerField(default=0)
+    version_inicial = models.PositiveBigIntegerField(default=0)
     fecha_creacion = models.DateTimeField(default=timezone.now)
     fecha_actualizacion = models.DateTimeField(default=timezone.now)
 
     class Meta:
         verbose_name = "Carrito"
         verbose_name_plural = "Carritos"
+        indexes = [
+            # Carritos sin cliente abandonados (ver `carrito.purgar()`)
+            models.Index(
+                fields=["fecha_actualizacion"],
+                condition=models.Q(cliente__isnull=True),
+                name="carrito_anonimo_fecha_idx",
+            ),
+        ]
 
     def save(self, *args, **kwargs):
         self.fecha_actualizacion = timezone.now()
@@ -352,7 +819,7 @@ class Carrito(models.Model):
         """Suma los subtotales (usa precio_oferta cuando exista)."""
         total = Decimal("0.00")
         for item in self.items.select_related("producto").all():
-            precio = item.producto.precio_oferta or item.producto.precio or Decimal("0.00")
+            precio = item.producto.precio_efectivo
             total += Decimal(item.cantidad) * precio
         return total.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
 
@@ -375,15 +842,32 @@ class ItemCarrito(models.Model):
     )
     talla = models.CharField(max_length=50, blank=True, null=True)
     cantidad = models.PositiveIntegerField(default=1)
+    # Versión del carrito en la que cambió la línea. Las líneas quitadas desde
+    # la web se quedan con cantidad 0 para poder avisar a cart.js del borrado.
+    version = models.PositiveBigIntegerField(default=0)
 
     class Meta:
         verbose_name = "Item de carrito"
         verbose_name_plural = "Items de carrito"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["carrito", "producto", "talla"],
+                name="item_carrito_unico",
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["carrito", "version"], name="item_carrito_version_idx"),
+            models.Index(
+                fields=["carrito"],
+                condition=models.Q(cantidad=0),
+                name="item_carrito_quitado_idx",
+            ),
+        ]
 
     @property
     def precio_unitario(self) -> Decimal:
         """Devuelve el precio unitario aplicable (oferta o normal)."""
-        return self.producto.precio_oferta or self.producto.precio or Decimal("0.00")
+        return self.producto.precio_efectivo
 
     @property
     def subtotal(self) -> Decimal:
@@ -394,6 +878,145 @@ class ItemCarrito(models.Model):
     def __str__(self):
         return f"{self.producto.nombre} x{self.cantidad} ({self.talla})"
 
+
+class ReservaStock(models.Model):
+    """
+    Unidades apartadas por un carrito hasta `expira` (modo de reserva, ver
+    `home/reservas.py`). El stock restante de los demás clientes es el stock
+    menos la suma de las reservas activas.
+    """
+    carrito = models.ForeignKey(
+        Carrito,
+        on_delete=models.CASCADE,
+        related_name="reservas",
+    )
+    producto = models.ForeignKey(
+        Producto,
+        on_delete=models.CASCADE,
+        related_name="reservas",
+    )
+    talla = models.CharField(max_length=50, blank=True, default="")
+    cantidad = models.PositiveIntegerField()
+    expira = models.DateTimeField()
+
+    class Meta:
+        verbose_name = "Reserva de stock"
+        verbose_name_plural = "Reservas de stock"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["carrito", "producto", "talla"],
+                name="reserva_stock_unica",
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["producto", "talla", "expira"], name="reserva_producto_idx"),
+            models.Index(fields=["expira"], name="reserva_expira_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.producto.nombre} x{self.cantidad} ({self.talla}) hasta {self.expira:%H:%M}"
+
+class Promocion(models.Model):
+    """
+    Regla de descuento. Sin código se aplica sola; con código es un cupón.
+    El ámbito (producto, categoría, marca, especie) limita las líneas del
+    carrito a las que se aplica; sin ámbito vale para todo el carrito. Se
+    evalúan con el índice en memoria de `home/promociones.py`.
+    """
+    class Tipos(models.TextChoices):
+        PORCENTAJE = "porcentaje", "Porcentaje"
+        IMPORTE = "importe", "Importe fijo"
+        LLEVA_X_PAGA_Y = "lleva_x_paga_y", "Lleva X, paga Y"
+        ENVIO_GRATIS = "envio_gratis", "Envío gratis"
+
+    nombre = models.CharField(max_length=100)
+    codigo = models.CharField(
+        max_length=30,
+        blank=True,
+        help_text="Código del cupón. Vacío para aplicarla automáticamente.",
+    )
+    tipo = models.CharField(max_length=20, choices=Tipos.choices, default=Tipos.PORCENTAJE)
+    valor = models.DecimalField(
+        max_digits=10,
+        decimal_places=2,
+        default=Decimal("0.00"),
+        help_text="Porcentaje (1-100) o importe en euros, según el tipo.",
+    )
+    cantidad_lleva = models.PositiveSmallIntegerField(default=0, help_text="X en «lleva X, paga Y».")
+    cantidad_paga = models.PositiveSmallIntegerField(default=0, help_text="Y en «lleva X, paga Y».")
+
+    producto = models.ForeignKey(
+        Producto, on_delete=models.CASCADE, blank=True, null=True, related_name="promociones"
+    )
+    categoria = models.ForeignKey(
+        Categoria, on_delete=models.CASCADE, blank=True, null=True, related_name="promociones"
+    )
+    marca = models.ForeignKey(
+        Marca, on_delete=models.CASCADE, blank=True, null=True, related_name="promociones"
+    )
+    especie = models.CharField(max_length=20, choices=Producto.Especie.choices, blank=True)
+
+    minimo_compra = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal("0.00"))
+    activa = models.BooleanField(default=True)
+    fecha_inicio = models.DateTimeField(default=timezone.now)
+    fecha_fin = models.DateTimeField(blank=True, null=True)
+    fecha_actualizacion = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        verbose_name = "Promoción"
+        verbose_name_plural = "Promociones"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["codigo"],
+                condition=~models.Q(codigo=""),
+                name="promocion_codigo_unico",
+            ),
+        ]
+        indexes = [
+            # promociones vigentes que carga el índice en memoria
+            models.Index(fields=["activa", "fecha_fin"], name="promocion_vigente_idx"),
+        ]
+
+    def clean(self):
+        errors = {}
+        if self.tipo == self.Tipos.PORCENTAJE and not (Decimal("0") < self.valor <= Decimal("100")):
+            errors["valor"] = "El porcentaje debe estar entre 0 y 100."
+        if self.tipo == self.Tipos.IMPORTE and self.valor <= Decimal("0"):
+            errors["valor"] = "El importe debe ser mayor que 0."
+        if self.tipo == self.Tipos.LLEVA_X_PAGA_Y and not (1 <= self.cantidad_paga < self.cantidad_lleva):
+            errors["cantidad_paga"] = "Debe pagarse al menos una unidad y menos de las que se llevan."
+        if self.fecha_fin and self.fecha_inicio and self.fecha_fin <= self.fecha_inicio:
+            errors["fecha_fin"] = "La fecha de fin debe ser posterior a la de inicio."
+        if errors:
+            raise ValidationError(errors)
+
+    def save(self, *args, **kwargs):
+        self.codigo = (self.codigo or "").strip().upper()
+        self.fecha_actualizacion = timezone.now()
+        self.full_clean()
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f"{self.nombre} ({self.codigo})" if self.codigo else self.nombre
+
+
+class SecuenciaPedido(models.Model):
+    """
+    Contador de números de pedido. Los procesos no lo leen por pedido: se
+    reservan bloques de números y los reparten en memoria (ver
+    `home/numeracion.py`).
+    """
+    nombre = models.CharField(max_length=30, unique=True)
+    siguiente = models.PositiveBigIntegerField(default=1)
+
+    class Meta:
+        verbose_name = "Secuencia de pedidos"
+        verbose_name_plural = "Secuencias de pedidos"
+
+    def __str__(self):
+        return f"{self.nombre}: {self.siguiente}"
+
+
 class MensajeContacto(models.Model):
     nombre = models.CharField(max_length=100)
     email = models.EmailField()
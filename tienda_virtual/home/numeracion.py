@@ -0,0 +1,93 @@
+"""
+Números de pedido sin colisiones: MP-<fecha>-<secuencia>-<código>.
+
+Antes el número era MP-<segundos>-<4 caracteres aleatorios>, que con varios
+checkouts en el mismo segundo podía repetirse y hacer fallar el `create` con
+`IntegrityError` (el campo es único). Ahora la secuencia sale de un contador
+global (`SecuenciaPedido`), así que nunca se repite.
+
+El número sirve para consultar el pedido en la página pública de seguimiento,
+así que no debe poder adivinarse a partir de otro: el código final son
+`LONGITUD_CODIGO` caracteres aleatorios (`get_random_string`, con
+`secrets`). La secuencia evita las colisiones; el código, que se recorran los
+pedidos del día.
+
+Para no ir a la base de datos en cada pedido, cada proceso reserva un bloque
+de `TAMANO_BLOQUE` números con un solo UPDATE (siguiente += tamaño) y los
+reparte desde memoria bajo un lock. Dos procesos nunca reciben el mismo bloque
+porque el UPDATE es atómico. Tras un `fork` el hijo descarta el bloque del
+padre (se comprueba el pid). Los números que quedan sin usar al terminar un
+proceso se pierden: habrá huecos en la secuencia, pero no repeticiones.
+
+Si hay que reservar dentro de una transacción, se reserva solo el número
+pedido: si la transacción se deshace, el contador vuelve atrás y el resto del
+bloque podría acabar en otro proceso. Los números de un bloque ya confirmado
+sí se reparten aunque haya una transacción abierta. Los checkouts crean el pedido en autocommit y
+usan bloques.
+"""
+import os
+import threading
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+
+from .models import SecuenciaPedido
+
+TAMANO_BLOQUE = 1000
+SECUENCIA = "pedido"
+LONGITUD_CODIGO = 6
+CARACTERES_CODIGO = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"  # sin 0/O ni 1/I
+
+
+def reservar_bloque(nombre, tamano):
+    """Reserva `tamano` números consecutivos. Devuelve (primero, fin) con fin excluido."""
+    while True:
+        with transaction.atomic():
+            # Se escribe antes de leer: el UPDATE bloquea la fila hasta el final
+            if SecuenciaPedido.objects.filter(nombre=nombre).update(siguiente=F("siguiente") + tamano):
+                fin = SecuenciaPedido.objects.filter(nombre=nombre).values_list("siguiente", flat=True).get()
+                return fin - tamano, fin
+        try:
+            with transaction.atomic():
+                SecuenciaPedido.objects.create(nombre=nombre)
+        except IntegrityError:
+            pass  # La ha creado otro proceso a la vez
+
+
+class AsignadorNumeros:
+    """Reparte números de la secuencia `nombre` desde bloques reservados por proceso."""
+
+    def __init__(self, nombre=SECUENCIA, tamano_bloque=TAMANO_BLOQUE):
+        self.nombre = nombre
+        self.tamano_bloque = tamano_bloque
+        self._lock = threading.Lock()
+        self._pid = None
+        self._siguiente = 0
+        self._fin = 0
+
+    def siguiente(self):
+        with self._lock:
+            if self._pid != os.getpid() or self._siguiente >= self._fin:
+                if connection.in_atomic_block:
+                    return reservar_bloque(self.nombre, 1)[0]
+                self._siguiente, self._fin = reservar_bloque(self.nombre, self.tamano_bloque)
+                self._pid = os.getpid()
+            numero = self._siguiente
+            self._siguiente += 1
+            return numero
+
+
+_asignador = AsignadorNumeros()
+
+
+def formatear(numero, fecha=None, codigo=None):
+    if codigo is None:
+        codigo = get_random_string(LONGITUD_CODIGO, CARACTERES_CODIGO)
+    return f"MP-{(fecha or timezone.localdate()):%Y%m%d}-{numero:06d}-{codigo}"
+
+
+def numero_pedido():
+    """Número nuevo para un `Pedido`, p. ej. MP-20261019-004213-K7QX2M."""
+    return formatear(_asignador.siguiente())
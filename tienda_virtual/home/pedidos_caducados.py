@@ -0,0 +1,101 @@
+"""
+Cancelación de pedidos pendientes abandonados.
+
+`checkout_stripe` crea el `Pedido` (pendiente) y sus líneas antes de mandar al
+cliente a Stripe. Si no llega a pagar, el pedido se queda pendiente para
+siempre e infla el listado del panel y sus contadores.
+
+El comando `manage.py cancelar_pedidos_caducados` (p. ej. cada hora desde
+cron) cancela los pedidos con pago online que llevan más de
+`PEDIDO_PENDIENTE_HORAS` pendientes. Trabaja por lotes recorriendo el índice
+(estado, fecha_creacion): cada lote bloquea sus pedidos, los pasa a cancelado
+con un solo UPDATE, deja el cambio en `HistorialEstadoPedido` con un solo
+INSERT y borra su seguimiento de la caché. Los contrareembolso no se tocan: se pagan al entregarlos.
+
+Un pedido pendiente nunca ha restado stock (eso lo hace `pago_ok`), así que no
+hay nada que reponer; si alguno lo tuviera marcado se deja para cancelarlo a
+mano con `Pedido.cambiar_estado`.
+"""
+import datetime
+import time
+from functools import partial
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import seguimiento
+from .models import HistorialEstadoPedido, ItemPedido, Pedido
+
+TAMANO_LOTE = 500
+METODOS_PAGO_ONLINE = ("stripe_test",)
+NOTA = "Cancelado automáticamente: pago no completado"
+
+
+def _caducados(limite):
+    return Pedido.objects.filter(
+        estado=Pedido.Estados.PENDIENTE,
+        fecha_creacion__lt=limite,
+        metodo_pago__in=METODOS_PAGO_ONLINE,
+        stock_descontado=False,
+    )
+
+
+def cancelar_caducados(horas=None, tamano_lote=TAMANO_LOTE, ahora=None):
+    """
+    Cancela por lotes los pedidos online pendientes desde hace más de `horas`.
+    Devuelve las métricas de la pasada: `pedidos`, `lineas`, `lotes`,
+    `segundos` y `pedidos_por_segundo`.
+    """
+    if horas is None:
+        horas = getattr(settings, "PEDIDO_PENDIENTE_HORAS", 25)
+    ahora = ahora or timezone.now()
+    limite = ahora - datetime.timedelta(hours=horas)
+    inicio = time.perf_counter()
+    metricas = {"pedidos": 0, "lineas": 0, "lotes": 0}
+
+    while True:
+        with transaction.atomic():
+            filas = list(
+                _caducados(limite)
+                .select_for_update(skip_locked=True)
+                .order_by("fecha_creacion", "id_pedido")
+                .values_list("id_pedido", "clave_seguimiento")[:tamano_lote]
+            )
+            if not filas:
+                break
+            # Se vuelve a leer el estado con las filas ya bloqueadas: un pago
+            # confirmado entretanto gana y no se cancela ni se anota en el historial
+            claves = dict(filas)
+            ids = list(
+                Pedido.objects.filter(id_pedido__in=claves, estado=Pedido.Estados.PENDIENTE)
+                .values_list("id_pedido", flat=True)
+            )
+            metricas["lotes"] += 1
+            if not ids:
+                continue
+            cancelados = Pedido.objects.filter(id_pedido__in=ids, estado=Pedido.Estados.PENDIENTE).update(
+                estado=Pedido.Estados.CANCELADO
+            )
+            HistorialEstadoPedido.objects.bulk_create(
+                HistorialEstadoPedido(
+                    pedido_id=pk,
+                    estado_anterior=Pedido.Estados.PENDIENTE,
+                    estado_nuevo=Pedido.Estados.CANCELADO,
+                    fecha=ahora,
+                    nota=NOTA,
+                )
+                for pk in ids
+            )
+            metricas["pedidos"] += cancelados
+            metricas["lineas"] += ItemPedido.objects.filter(pedido_id__in=ids).count()
+            # El UPDATE no dispara señales: se invalida aquí el seguimiento en caché.
+            # `partial` fija las claves de este lote (el callback puede correr al final
+            # de una transacción exterior, cuando el bucle ya va por otro lote)
+            transaction.on_commit(partial(seguimiento.invalidar, *(claves[pk] for pk in ids)))
+
+    metricas["segundos"] = round(time.perf_counter() - inicio, 3)
+    metricas["pedidos_por_segundo"] = (
+        round(metricas["pedidos"] / metricas["segundos"], 1) if metricas["segundos"] else 0.0
+    )
+    return metricas
@@ -0,0 +1,190 @@
+"""
+Presupuesto del checkout: precios, impuestos y gastos de envío en un solo sitio.
+
+`detalles_pago` calcula el presupuesto del carrito (una consulta de productos)
+y lo guarda firmado en la sesión junto con la huella del carrito (contenido y
+forma de envío). `checkout_stripe` y `checkout_contrareembolso` lo reutilizan
+si la huella coincide y no ha caducado, sin volver a leer los productos: el
+cliente paga exactamente lo que se le ha mostrado. Si el carrito ha cambiado,
+se calcula uno nuevo.
+
+Los descuentos y el envío gratis salen de `home/promociones.py`; el cupón que
+introduce el cliente se guarda en la sesión (`codigo_promocion`) y forma parte
+de la huella. Los impuestos se calculan sobre el subtotal ya descontado.
+
+El presupuesto es inmutable (`Presupuesto`, dataclass congelada) y se firma
+con `django.core.signing`, así que tampoco se puede alterar aunque la sesión
+se guarde en una cookie.
+"""
+import hashlib
+import json
+from dataclasses import dataclass
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.core import signing
+
+from . import promociones
+from .models import Producto
+
+IVA = Decimal("0.10")
+ENVIO_GRATIS_DESDE = Decimal("30.00")
+COSTE_ENTREGA = Decimal("2.99")
+
+ENVIO_DOMICILIO = "delivery"
+ENVIO_RECOGIDA = "pickup"
+
+CLAVE_SESION = "presupuesto"
+CLAVE_CODIGO = "codigo_promocion"
+CADUCIDAD = 30 * 60  # segundos
+_SAL = "home.precios.presupuesto"
+
+
+@dataclass(frozen=True)
+class LineaPresupuesto:
+    producto_id: int
+    nombre: str
+    talla: str
+    cantidad: int
+    precio_unitario: Decimal
+    total: Decimal
+
+
+@dataclass(frozen=True)
+class Presupuesto:
+    huella: str
+    envio: str
+    lineas: tuple
+    subtotal: Decimal
+    impuestos: Decimal
+    coste_entrega: Decimal
+    descuento: Decimal
+    total: Decimal
+    codigo: str = ""
+    promocion: str = ""
+
+    @property
+    def envio_gratis(self):
+        return self.envio == ENVIO_RECOGIDA or self.coste_entrega == 0
+
+    def firmar(self):
+        datos = {
+            "huella": self.huella,
+            "envio": self.envio,
+            "lineas": [
+                [l.producto_id, l.nombre, l.talla, l.cantidad, str(l.precio_unitario), str(l.total)]
+                for l in self.lineas
+            ],
+            "importes": [str(self.subtotal), str(self.impuestos), str(self.coste_entrega),
+                         str(self.descuento), str(self.total)],
+            "promocion": [self.codigo, self.promocion],
+        }
+        return signing.dumps(datos, salt=_SAL, compress=True)
+
+    @classmethod
+    def desde_firma(cls, firma, max_age=CADUCIDAD):
+        """Lanza `signing.BadSignature` si la firma no es válida o ha caducado."""
+        datos = signing.loads(firma, salt=_SAL, max_age=max_age)
+        lineas = tuple(
+            LineaPresupuesto(pid, nombre, talla, cantidad, Decimal(precio), Decimal(total))
+            for pid, nombre, talla, cantidad, precio, total in datos["lineas"]
+        )
+        subtotal, impuestos, coste_entrega, descuento, total = map(Decimal, datos["importes"])
+        codigo, promocion = datos["promocion"]
+        return cls(datos["huella"], datos["envio"], lineas, subtotal, impuestos,
+                   coste_entrega, descuento, total, codigo, promocion)
+
+
+def _centimos(valor):
+    return valor.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+
+
+def huella(cart, envio, codigo=""):
+    """Hash del contenido del carrito, la forma de envío y el cupón."""
+    datos = json.dumps([sorted((str(k), int(v)) for k, v in cart.items()), envio, codigo])
+    return hashlib.sha256(datos.encode()).hexdigest()
+
+
+def coste_entrega(subtotal, envio):
+    if envio == ENVIO_RECOGIDA or subtotal >= ENVIO_GRATIS_DESDE:
+        return Decimal("0.00")
+    return COSTE_ENTREGA
+
+
+def calcular(cart, envio=ENVIO_DOMICILIO, codigo=""):
+    """
+    Presupuesto de un carrito ({"<producto_id>:<talla>": cantidad}) con una
+    consulta, aplicando las promociones y el cupón `codigo`. Las líneas de
+    productos que ya no existen se omiten.
+    """
+    entradas = []
+    for clave, cantidad in cart.items():
+        pid, _, talla = str(clave).partition(":")
+        try:
+            entradas.append((int(pid), talla, int(cantidad)))
+        except (TypeError, ValueError):
+            continue
+    productos = Producto.objects.only(
+        "id", "nombre", "precio_efectivo", "categoria_id", "marca_id", "genero"
+    ).in_bulk({pid for pid, _, _ in entradas})
+
+    lineas = []
+    lineas_promocion = []
+    subtotal = Decimal("0.00")
+    for pid, talla, cantidad in entradas:
+        producto = productos.get(pid)
+        if producto is None:
+            print("⚠ Producto no encontrado, id =", pid)
+            continue
+        precio = producto.precio_efectivo
+        total_linea = precio * cantidad
+        lineas.append(LineaPresupuesto(pid, producto.nombre, talla, cantidad, precio, total_linea))
+        lineas_promocion.append(promociones.LineaPromocion(
+            pid, producto.categoria_id, producto.marca_id, producto.genero, cantidad, precio
+        ))
+        subtotal += total_linea
+
+    codigo = promociones.normalizar_codigo(codigo)
+    resultado = promociones.evaluar(lineas_promocion, codigo)
+    descuento = _centimos(resultado.descuento)
+    impuestos = _centimos((subtotal - descuento) * IVA)
+    entrega = Decimal("0.00") if resultado.envio_gratis else coste_entrega(subtotal, envio)
+    return Presupuesto(
+        huella=huella(cart, envio, codigo),
+        envio=envio,
+        lineas=tuple(lineas),
+        subtotal=subtotal,
+        impuestos=impuestos,
+        coste_entrega=entrega,
+        descuento=descuento,
+        total=subtotal + impuestos + entrega - descuento,
+        codigo=codigo,
+        promocion=resultado.promocion,
+    )
+
+
+def presupuesto(request, cart):
+    """
+    Presupuesto del carrito de la sesión: el guardado si sigue valiendo para
+    el mismo carrito y forma de envío, o uno nuevo (que se guarda).
+    """
+    envio = request.session.get("shipping_method", ENVIO_DOMICILIO)
+    codigo = request.session.get(CLAVE_CODIGO, "")
+    actual = huella(cart, envio, codigo)
+    firma = request.session.get(CLAVE_SESION)
+    if firma:
+        try:
+            guardado = Presupuesto.desde_firma(firma)
+        except (signing.BadSignature, KeyError, TypeError, ValueError):
+            guardado = None
+        if guardado is not None and guardado.huella == actual:
+            return guardado
+
+    nuevo = calcular(cart, envio, codigo)
+    request.session[CLAVE_SESION] = nuevo.firmar()
+    return nuevo
+
+
+def olvidar(request):
+    """Descarta el presupuesto guardado y el cupón (tras crear el pedido)."""
+    request.session.pop(CLAVE_SESION, None)
+    request.session.pop(CLAVE_CODIGO, None)
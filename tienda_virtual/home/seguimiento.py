@@ -0,0 +1,101 @@
+"""
+Seguimiento de pedidos por número (`/seguimiento/` y `/seguimiento/<número>/`).
+
+Tras los emails de envío llegan muchas consultas seguidas del mismo pedido.
+Para que salgan baratas:
+
+- Se busca por `Pedido.clave_seguimiento` (el número en mayúsculas, con
+  índice) en lugar de `numero_pedido__iexact`, que no usa el índice único y
+  recorre la tabla.
+- Lo que muestra la página (estado, importes, nombre del cliente y líneas)
+  se guarda en la caché como un dict `SEGUIMIENTO_CACHE_SEGUNDOS` segundos
+  por número, no el `Pedido` entero con su cliente; los números que no
+  existen también, para que no se repita la consulta. Las señales de
+  `Pedido` e `ItemPedido` (y la cancelación por lotes) borran la entrada al
+  confirmarse el cambio, así que un cambio de estado se ve al momento.
+  Eso solo vale en todos los workers si `CACHES` es compartida (ver
+  `settings.py`): con la caché en memoria por defecto cada proceso tiene la
+  suya, el borrado solo llega al que hizo el cambio y el resto puede mostrar
+  el estado anterior hasta que caduque su entrada.
+- Cada IP puede hacer `SEGUIMIENTO_CONSULTAS_POR_MINUTO` consultas por minuto
+  (con los cubos de `home/limites.py`; el formulario vacío no cuenta).
+"""
+import re
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import limites, metricas
+from .models import Pedido
+
+_NO_EXISTE = "-"
+_FORMATO = re.compile(r"^[A-Z0-9-]{1,50}$")
+
+
+def normalizar(numero):
+    return (numero or "").strip().upper()
+
+
+def _clave_cache(clave):
+    return f"seguimiento:{clave}"
+
+
+def _datos(pedido):
+    """Lo que pinta `tracking.html` de un pedido."""
+    return {
+        "numero_pedido": pedido.numero_pedido,
+        "estado": pedido.estado,
+        "estado_display": pedido.get_estado_display(),
+        "fecha_creacion": pedido.fecha_creacion,
+        "cliente": str(pedido.cliente) if pedido.cliente else "",
+        "subtotal": pedido.subtotal,
+        "impuestos": pedido.impuestos,
+        "coste_entrega": pedido.coste_entrega,
+        "descuento": pedido.descuento,
+        "total": pedido.total,
+        "items": [
+            {
+                "nombre_producto": item.nombre_producto,
+                "cantidad": item.cantidad,
+                "talla": item.talla,
+                "total": item.total,
+            }
+            for item in pedido.items.all()
+        ],
+    }
+
+
+def buscar(numero):
+    """Datos del pedido con ese número (sin distinguir mayúsculas), o None. Usa la caché."""
+    clave = normalizar(numero)
+    if not _FORMATO.match(clave):
+        return None
+    guardado = cache.get(_clave_cache(clave))
+    metricas.cache_consulta("seguimiento", guardado is not None)
+    if guardado is not None:
+        return None if guardado == _NO_EXISTE else guardado
+
+    pedido = (
+        Pedido.objects.select_related("cliente")
+        .prefetch_related("items")
+        .filter(clave_seguimiento=clave)
+        .first()
+    )
+    datos = _datos(pedido) if pedido is not None else None
+    cache.set(
+        _clave_cache(clave),
+        datos if datos is not None else _NO_EXISTE,
+        getattr(settings, "SEGUIMIENTO_CACHE_SEGUNDOS", 60),
+    )
+    return datos
+
+
+def invalidar(*claves):
+    """Borra de la caché el seguimiento de esos pedidos (por `clave_seguimiento`)."""
+    cache.delete_many([_clave_cache(clave) for clave in claves if clave])
+
+
+def permitido(request):
+    """Cuenta una consulta de la IP del cliente; False si ya ha pasado del límite por minuto."""
+    por_minuto = getattr(settings, "SEGUIMIENTO_CONSULTAS_POR_MINUTO", 30)
+    return not limites.espera(request, "seguimiento", limites.Limite(por_ip=f"{por_minuto}/m"))
@@ -0,0 +1,111 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import promociones, rankings, search_index, seguimiento, stock_alerts
+from .models import (
+    AlertaStock, Categoria, ImagenProducto, ItemPedido, Marca, Pedido, Producto, Promocion, TallaProducto,
+)
+
+
+@receiver(post_save, sender=Producto)
+def producto_guardado(sender, instance, raw=False, **kwargs):
+    """Reevalúa las alertas de stock del producto tras cada guardado."""
+    if raw:
+        return
+    stock_alerts.evaluar_producto(instance)
+
+
+@receiver(post_save, sender=Producto)
+def producto_guardado_ranking(sender, instance, created=False, raw=False, **kwargs):
+    """Da fila de ranking a los productos nuevos y le copia la especie y categoría."""
+    if raw:
+        return
+    if created or instance.cambia_ranking:
+        rankings.sincronizar_producto(instance)
+    instance._valores_ranking = (instance.genero, instance.categoria_id)
+
+
+@receiver(post_save, sender=TallaProducto)
+def talla_guardada(sender, instance, created=False, raw=False, **kwargs):
+    """Reevalúa la alerta de la talla; la primera talla anula la del producto."""
+    if raw or instance.producto_id is None:
+        return
+    if created:
+        AlertaStock.objects.filter(producto_id=instance.producto_id, talla__isnull=True).delete()
+    stock_alerts.evaluar_talla(instance)
+
+
+@receiver(post_delete, sender=TallaProducto)
+def talla_eliminada(sender, instance, **kwargs):
+    """Si el producto se queda sin tallas vuelve a contar su stock general."""
+    if instance.producto_id is not None:
+        stock_alerts.reevaluar_producto_tras_commit(instance.producto_id)
+
+
+@receiver(post_save, sender=Producto)
+def producto_guardado_busqueda(sender, instance, **kwargs):
+    """Refresca el índice de búsqueda si cambia el nombre o la disponibilidad."""
+    if instance.cambia_busqueda:
+        transaction.on_commit(search_index.invalidar)
+    instance._valores_busqueda = (instance.nombre, instance.esta_disponible)
+
+
+@receiver(post_delete, sender=Producto)
+@receiver(post_save, sender=Marca)
+@receiver(post_delete, sender=Marca)
+@receiver(post_save, sender=Categoria)
+@receiver(post_delete, sender=Categoria)
+def catalogo_modificado(sender, **kwargs):
+    """Refresca el índice de búsqueda cuando cambian marcas, categorías o se borra un producto."""
+    transaction.on_commit(search_index.invalidar)
+
+
+@receiver(post_save, sender=TallaProducto)
+@receiver(post_delete, sender=TallaProducto)
+@receiver(post_save, sender=ImagenProducto)
+@receiver(post_delete, sender=ImagenProducto)
+def marcar_producto_modificado(sender, instance, raw=False, **kwargs):
+    """Las tallas e imágenes forman parte de la ficha: actualizan la fecha del producto (ETag)."""
+    if raw or instance.producto_id is None:
+        return
+    # update() para no disparar las señales de Producto
+    Producto.objects.filter(pk=instance.producto_id).update(fecha_actualizacion=timezone.now())
+
+
+@receiver(post_delete, sender=Producto)
+def marcar_catalogo_modificado(sender, instance, **kwargs):
+    """Un producto borrado no deja fecha que comparar: se actualiza la de su marca y categoría."""
+    ahora = timezone.now()
+    Marca.objects.filter(pk=instance.marca_id).update(fecha_actualizacion=ahora)
+    if instance.categoria_id:
+        Categoria.objects.filter(pk=instance.categoria_id).update(fecha_actualizacion=ahora)
+
+
+@receiver(post_save, sender=Promocion)
+@receiver(post_delete, sender=Promocion)
+def promocion_modificada(sender, **kwargs):
+    """Recompila el índice de promociones en todos los procesos."""
+    transaction.on_commit(promociones.invalidar)
+
+
+@receiver(post_save, sender=Pedido)
+@receiver(post_delete, sender=Pedido)
+def pedido_modificado(sender, instance, raw=False, **kwargs):
+    """El seguimiento en caché deja de valer al cambiar el pedido (estado, importes...)."""
+    if raw:
+        return
+    clave = instance.clave_seguimiento
+    transaction.on_commit(lambda: seguimiento.invalidar(clave))
+
+
+@receiver(post_save, sender=ItemPedido)
+@receiver(post_delete, sender=ItemPedido)
+def linea_pedido_modificada(sender, instance, raw=False, **kwargs):
+    """Las líneas se muestran en el seguimiento: también lo invalidan."""
+    if raw:
+        return
+    clave = instance.pedido.clave_seguimiento
+    transaction.on_commit(lambda: seguimiento.invalidar(clave))
+
@@ -12,6 +12,184 @@ function escapeHtml(text) {
     return div.innerHTML;
 }
 
+// Estado local del carrito. El servidor numera cada cambio (cart_version) y,
+// si le mandamos la versión que tenemos (since_version), solo responde con las
+// líneas que han cambiado desde entonces; aquí se aplican sobre este estado.
+const cartState = {
+    version: null,
+    items: new Map(),
+    remaining: {},
+    count: 0,
+    total: 0
+};
+
+// Aplica una respuesta del servidor (completa o parcial) al estado local.
+// Las peticiones van en paralelo: una respuesta más antigua que el estado se ignora.
+function applyCartData(data) {
+    if (data.cart_version !== undefined && cartState.version !== null && data.cart_version < cartState.version) {
+        return currentCart();
+    }
+    if (data.cart_delta && cartState.version !== null) {
+        const affected = new Set();
+        (data.cart_removed || []).forEach(key => {
+            affected.add(String(key).split(':')[0]);
+            cartState.items.delete(key);
+        });
+        (data.cart_changes || []).forEach(item => {
+            affected.add(String(item.producto_id));
+            cartState.items.set(item.clave, item);
+        });
+        affected.forEach(productId => delete cartState.remaining[productId]);
+        Object.assign(cartState.remaining, data.remaining_by_product || {});
+    } else if (data.cart_items !== undefined) {
+        cartState.items = new Map(data.cart_items.map(item => [item.clave, item]));
+        cartState.remaining = Object.assign({}, data.remaining_by_product || {});
+    }
+    if (data.cart_version !== undefined) {
+        cartState.version = data.cart_version;
+    }
+    if (data.cart_count !== undefined) {
+        cartState.count = data.cart_count;
+        cartState.total = data.cart_total;
+    }
+    return currentCart();
+}
+
+// Pide el estado del carrito; si ya tenemos una versión, solo los cambios
+function fetchCartStatus() {
+    const baseUrl = window.location.origin;
+    const query = cartState.version !== null ? `?since_version=${cartState.version}` : '';
+    return fetch(`${baseUrl}/cart/status/${query}`, {
+        method: 'GET',
+        headers: {
+            'X-Requested-With': 'XMLHttpRequest',
+        },
+        credentials: 'same-origin'
+    })
+    .then(response => response.ok ? response.json() : null)
+    .then(data => (data && data.success) ? applyCartData(data) : null);
+}
+
+// Cola de clics en +/- del carrito: se agrupan y se mandan juntos a
+// /cart/batch/ cuando el usuario deja de pulsar durante CART_BATCH_DELAY ms.
+const CART_BATCH_DELAY = 400;
+const pendingCartOps = [];
+let cartBatchTimer = null;
+
+// Devuelve la operación de un formulario +/- del carrito, o null si no lo es
+function cartOperationFromForm(form) {
+    if (!form.closest('.mini-cart') && !form.matches('.cart-item-increment, .cart-item-decrement')) {
+        return null;
+    }
+    const match = (form.getAttribute('action') || '').match(/\/cart\/(add|decrement)\/(\d+)\/?$/);
+    if (!match) return null;
+    const sizeInput = form.querySelector('input[name="size"]');
+    return {
+        op: match[1],
+        product_id: parseInt(match[2], 10),
+        size: sizeInput ? sizeInput.value : '',
+        quantity: 1
+    };
+}
+
+// Refleja una operación pendiente en el estado local antes de que responda el servidor
+function applyOptimisticOperation(op) {
+    const step = op.op === 'add' ? op.quantity : -op.quantity;
+    const item = cartState.items.get(`${op.product_id}:${op.size}`);
+    if (item) {
+        const cantidad = Math.max(0, item.cantidad + step);
+        cartState.count = Math.max(0, cartState.count + cantidad - item.cantidad);
+        cartState.total = Math.max(0, cartState.total + (cantidad - item.cantidad) * item.precio);
+        if (cantidad === 0) {
+            cartState.items.delete(item.clave);
+        } else {
+            cartState.items.set(item.clave, Object.assign({}, item, {
+                cantidad: cantidad,
+                subtotal: cantidad * item.precio,
+                remaining: Math.max(0, item.remaining - step)
+            }));
+        }
+    } else if (step > 0) {
+        cartState.count += step;
+    }
+}
+
+function currentCart() {
+    return {
+        cart_items: Array.from(cartState.items.values()),
+        cart_total: cartState.total,
+        cart_count: cartState.count,
+        remaining_by_product: cartState.remaining
+    };
+}
+
+function refreshCartUi(cart) {
+    updateCartCount(cart.cart_count);
+    updateMiniCart(cart.cart_items, cart.cart_total, cart.cart_count);
+    updateSizeDropdowns(cart.cart_items, cart.remaining_by_product);
+}
+
+function queueCartOperation(op) {
+    const last = pendingCartOps[pendingCartOps.length - 1];
+    if (last && last.op === op.op && last.product_id === op.product_id && last.size === op.size) {
+        last.quantity += op.quantity;
+    } else {
+        pendingCartOps.push(op);
+    }
+    applyOptimisticOperation(op);
+    refreshCartUi(currentCart());
+
+    clearTimeout(cartBatchTimer);
+    cartBatchTimer = setTimeout(flushCartOperations, CART_BATCH_DELAY);
+}
+
+// Envía las operaciones pendientes en una sola petición
+function flushCartOperations() {
+    cartBatchTimer = null;
+    if (pendingCartOps.length === 0) return;
+    const operaciones = pendingCartOps.splice(0);
+    const baseUrl = window.location.origin;
+
+    fetch(`${baseUrl}/cart/batch/`, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'X-Requested-With': 'XMLHttpRequest',
+            'X-CSRFToken': getCsrfToken(),
+        },
+        credentials: 'same-origin',
+        body: JSON.stringify({ since_version: cartState.version, operaciones: operaciones })
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (!data.success) {
+            showNotification(data.error || 'Error al actualizar el carrito', 'error');
+            // No se ha aplicado nada: descartar lo optimista y pedir el carrito entero
+            cartState.version = null;
+            return fetchCartStatus().then(cart => {
+                if (cart) refreshCartUi(cart);
+            });
+        }
+        applyCartData(data);
+        // Los clics que han llegado mientras tanto siguen pendientes
+        pendingCartOps.forEach(applyOptimisticOperation);
+        refreshCartUi(currentCart());
+
+        const path = window.location.pathname;
+        if (pendingCartOps.length === 0 && path.includes('/cart') && !path.includes('/checkout')) {
+            // La página del carrito se renderiza en el servidor: recargar para ver cantidades y subtotales
+            window.location.reload();
+        }
+    })
+    .catch(error => {
+        console.error('Error en petición:', error);
+        showNotification('Error de conexión. Recargando...', 'error');
+        setTimeout(() => {
+            window.location.reload();
+        }, 1500);
+    });
+}
+
 // Función para actualizar el contador del carrito
 function updateCartCount(count) {
     console.log('Actualizando contador del carrito a:', count);
@@ -279,12 +457,14 @@ function clearCart() {
         },
         credentials: 'same-origin',
         body: new URLSearchParams({
-            'csrfmiddlewaretoken': csrfToken
+            'csrfmiddlewaretoken': csrfToken,
+            'since_version': cartState.version !== null ? cartState.version : ''
         })
     })
     .then(response => response.json())
     .then(data => {
         if (data.success) {
+            applyCartData(data);
             updateCartCount(0);
             updateMiniCart([], 0, 0);
             // Actualizar dropdowns con carrito vacío para que todos los productos vuelvan a estar disponibles
@@ -722,6 +902,13 @@ function setupCartForms() {
             // Guardar el evento para usar en updateCartPage
             window.cartFormEvent = e;
             
+            // Los +/- del carrito se agrupan en /cart/batch/
+            const batchOperation = cartOperationFromForm(form);
+            if (batchOperation) {
+                queueCartOperation(batchOperation);
+                return;
+            }
+            
             const action = form.getAttribute('action');
             
             // Validar si se puede añadir al carrito (para productos con tallas)
@@ -748,6 +935,9 @@ function setupCartForms() {
             
             const formData = new FormData(form);
             const method = form.getAttribute('method') || 'POST';
+            if (cartState.version !== null) {
+                formData.set('since_version', cartState.version);
+            }
             
             // Log para depuración
             const sizeValue = formData.get('size');
@@ -759,9 +949,8 @@ function setupCartForms() {
                 submitBtn.dataset.originalText = submitBtn.textContent;
             }
             
-            // Deshabilitar botón para evitar doble envío
+            // El servidor aplica bien los cambios simultáneos: no hace falta bloquear el botón
             if (submitBtn) {
-                submitBtn.disabled = true;
                 const buttonText = action.includes('cart_remove') ? 'Eliminando...' : 
                                   action.includes('cart_decrement') ? 'Actualizando...' :
                                   action.includes('cart_update') ? 'Actualizando...' :
@@ -798,8 +987,11 @@ function setupCartForms() {
                 console.log('Datos recibidos:', data);
                 
                 if (data.success) {
+                    // Aplicar los cambios al estado local del carrito
+                    const cart = applyCartData(data);
+
                     // Actualizar contador
-                    updateCartCount(data.cart_count);
+                    updateCartCount(cart.cart_count);
                     
                     // Si estamos en la página del carrito y es una acción de eliminar o actualizar
                     const isCartPage = window.location.pathname.includes('/cart') && !window.location.pathname.includes('/checkout');
@@ -808,47 +1000,24 @@ function setupCartForms() {
                     const isDecrementAction = action && action.includes('cart_decrement');
                     
                     if (isCartPage && (isRemoveAction || isUpdateAction || isDecrementAction)) {
-                        updateCartPage(data, form);
+                        updateCartPage(cart, form);
                     }
                     
-                    // Actualizar mini-carrito si hay datos
-                    if (data.cart_items !== undefined) {
-                        console.log('Actualizando mini-carrito con', data.cart_items.length, 'items');
-                        updateMiniCart(data.cart_items, data.cart_total, data.cart_count);
-                    }
+                    // Actualizar mini-carrito con el estado local ya parcheado
+                    console.log('Actualizando mini-carrito con', cart.cart_items.length, 'items');
+                    updateMiniCart(cart.cart_items, cart.cart_total, cart.cart_count);
                     
                     // SIEMPRE actualizar dropdowns, incluso si no hay items en el carrito
                     console.log('🔄 Actualizando dropdowns de tallas en la página de productos...');
-                    console.log('   Items en carrito:', data.cart_items ? data.cart_items.length : 0);
+                    console.log('   Items en carrito:', cart.cart_items.length);
                     // Ejecutar inmediatamente
-                    updateSizeDropdowns(data.cart_items || [], data.remaining_by_product || {});
+                    updateSizeDropdowns(cart.cart_items, cart.remaining_by_product);
                     // También ejecutar con un pequeño delay para asegurar que el DOM esté completamente actualizado
                     setTimeout(() => {
                         console.log('🔄 Re-ejecutando actualización de dropdowns (segunda pasada)...');
-                        updateSizeDropdowns(data.cart_items || [], data.remaining_by_product || {});
+                        updateSizeDropdowns(cart.cart_items, cart.remaining_by_product);
                     }, 150);
                     
-                    // También obtener el estado completo del carrito para asegurar sincronización
-                    // (esto se ejecuta en paralelo, no bloquea la actualización inmediata)
-                    const baseUrl = window.location.origin;
-                    fetch(`${baseUrl}/cart/status/`, {
-                        method: 'GET',
-                        headers: {
-                            'X-Requested-With': 'XMLHttpRequest',
-                        },
-                        credentials: 'same-origin'
-                    })
-                    .then(response => response.json())
-                    .then(statusData => {
-                        if (statusData && statusData.success) {
-                            console.log('Sincronizando dropdowns con estado completo del carrito:', statusData.cart_items.length, 'items');
-                            updateSizeDropdowns(statusData.cart_items || [], statusData.remaining_by_product || {});
-                        }
-                    })
-                    .catch(error => {
-                        console.log('Error al sincronizar estado del carrito (no crítico):', error);
-                    });
-                    
                     // Mostrar notificación
                     const message = data.message || 'Carrito actualizado';
                     showNotification(message, 'success');
@@ -859,7 +1028,6 @@ function setupCartForms() {
                         if (submitBtn) {
                             setTimeout(() => {
                                 submitBtn.textContent = submitBtn.dataset.originalText || 'Añadir al carrito';
-                                submitBtn.disabled = false;
                                 // Actualizar el botón según la validación actual (puede estar deshabilitado si la talla está agotada)
                                 updateAddToCartButton(form);
                             }, 1000);
@@ -903,22 +1071,9 @@ function initializeCart() {
     updateCartCount(initialCount);
     
     // Luego, obtener el estado actual del carrito desde el servidor para sincronizar
-    const baseUrl = window.location.origin;
-    fetch(`${baseUrl}/cart/status/`, {
-        method: 'GET',
-        headers: {
-            'X-Requested-With': 'XMLHttpRequest',
-        },
-        credentials: 'same-origin'
-    })
-    .then(response => {
-        if (response.ok) {
-            return response.json();
-        }
-        return null;
-    })
+    fetchCartStatus()
     .then(data => {
-        if (data && data.success) {
+        if (data) {
             console.log('Cart status recibido del servidor:', data);
             // Actualizar contador con el valor del servidor (más confiable)
             updateCartCount(data.cart_count);
@@ -979,6 +1134,24 @@ function initializeCart() {
     });
 }
 
+// Al volver a la pestaña, traer solo lo que haya cambiado en otra pestaña
+document.addEventListener('visibilitychange', function() {
+    if (document.visibilityState !== 'visible' || cartState.version === null) {
+        return;
+    }
+    const previousVersion = cartState.version;
+    fetchCartStatus()
+    .then(cart => {
+        if (!cart || cartState.version === previousVersion) return;
+        updateCartCount(cart.cart_count);
+        updateMiniCart(cart.cart_items, cart.cart_total, cart.cart_count);
+        updateSizeDropdowns(cart.cart_items, cart.remaining_by_product);
+    })
+    .catch(error => {
+        console.log('Error al sincronizar el carrito (no crítico):', error);
+    });
+});
+
 // Ejecutar cuando el DOM esté listo
 if (document.readyState === 'loading') {
     document.addEventListener('DOMContentLoaded', function() {
@@ -0,0 +1,186 @@
+"""
+Motor de alertas de stock bajo.
+
+Cada producto sin tallas y cada `TallaProducto` se comparan con su umbral en el
+momento en que cambia su stock (señales en `home/signals.py`). El resultado se
+guarda en `AlertaStock`, así que el panel de administración y el resumen por
+email solo leen las filas ya calculadas en lugar de recorrer el catálogo.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from sendgrid.helpers.mail import Mail
+
+from . import integraciones
+from .models import AlertaStock, Producto, TallaProducto
+
+
+def _sincronizar(producto, talla, stock, umbral):
+    """Crea, actualiza o elimina la alerta de un producto/talla concreto."""
+    if stock < umbral:
+        AlertaStock.objects.update_or_create(
+            producto=producto,
+            talla=talla,
+            defaults={"stock": stock, "umbral": umbral},
+        )
+    else:
+        AlertaStock.objects.filter(producto=producto, talla=talla).delete()
+
+
+def evaluar_talla(talla):
+    """Evalúa una talla concreta contra su umbral efectivo."""
+    producto = talla.producto
+    if producto is None or not talla.pk:
+        return
+    if not producto.esta_disponible:
+        AlertaStock.objects.filter(talla=talla).delete()
+        return
+    _sincronizar(producto, talla, talla.stock, talla.umbral_efectivo)
+
+
+def evaluar_producto(producto):
+    """
+    Evalúa un producto. Si tiene tallas, el stock que cuenta es el de cada
+    talla y no el campo `Producto.stock`.
+    """
+    if not producto.pk:
+        return
+    if not producto.esta_disponible:
+        AlertaStock.objects.filter(producto=producto).delete()
+        return
+
+    tallas = list(producto.tallas.all())
+    if tallas:
+        AlertaStock.objects.filter(producto=producto, talla__isnull=True).delete()
+        for talla in tallas:
+            # evitar una consulta extra por talla al leer el umbral del producto
+            talla.producto = producto
+            evaluar_talla(talla)
+        return
+
+    _sincronizar(producto, None, producto.stock, producto.umbral_stock_bajo)
+
+
+def reevaluar_producto_tras_commit(producto_id):
+    """
+    Reevalúa un producto cuando termine la transacción actual.
+
+    Se usa al borrar tallas: durante un borrado en cascada el producto todavía
+    existe pero va a desaparecer, así que no se puede crear su alerta ahí mismo.
+    """
+    def _reevaluar():
+        producto = Producto.objects.filter(pk=producto_id).first()
+        if producto:
+            evaluar_producto(producto)
+
+    transaction.on_commit(_reevaluar)
+
+
+@transaction.atomic
+def reconstruir_alertas():
+    """Recalcula todas las alertas desde cero. Devuelve cuántas hay activas."""
+    AlertaStock.objects.all().delete()
+    nuevas = []
+
+    productos = Producto.objects.filter(esta_disponible=True).only(
+        "id", "stock", "umbral_stock_bajo"
+    )
+    con_tallas = set(
+        TallaProducto.objects.filter(producto__in=productos).values_list("producto_id", flat=True)
+    )
+    for producto in productos.iterator(chunk_size=2000):
+        if producto.id not in con_tallas and producto.stock < producto.umbral_stock_bajo:
+            nuevas.append(AlertaStock(
+                producto_id=producto.id,
+                stock=producto.stock,
+                umbral=producto.umbral_stock_bajo,
+            ))
+
+    tallas = TallaProducto.objects.filter(producto__esta_disponible=True).values_list(
+        "id", "producto_id", "stock", "umbral_stock_bajo", "producto__umbral_stock_bajo"
+    )
+    for talla_id, producto_id, stock, umbral_talla, umbral_producto in tallas.iterator(chunk_size=2000):
+        umbral = umbral_talla if umbral_talla is not None else umbral_producto
+        if stock < umbral:
+            nuevas.append(AlertaStock(
+                producto_id=producto_id,
+                talla_id=talla_id,
+                stock=stock,
+                umbral=umbral,
+            ))
+
+    AlertaStock.objects.bulk_create(nuevas, batch_size=1000)
+    return len(nuevas)
+
+
+def enviar_resumen(email_destino=None):
+    """
+    Envía por email las alertas que todavía no se han notificado y las marca
+    como notificadas. Devuelve el número de alertas incluidas en el resumen.
+    """
+    alertas = list(
+        AlertaStock.objects.filter(fecha_notificacion__isnull=True)
+        .select_related("producto", "talla")
+        .order_by("stock", "id")
+    )
+    if not alertas:
+        return 0
+
+    filas = ""
+    for alerta in alertas:
+        talla = alerta.talla.talla if alerta.talla_id else "-"
+        filas += f"""
+        <tr>
+            <td>{alerta.producto.nombre}</td>
+            <td align="center">{talla}</td>
+            <td align="center">{alerta.stock}</td>
+            <td align="center">{alerta.umbral}</td>
+        </tr>
+        """
+
+    html = f"""
+    <table width="100%" cellpadding="0" cellspacing="0"
+           style="font-family:Arial, sans-serif; background:#f7f7f7; padding:20px;">
+      <tr>
+        <td align="center">
+          <table width="600" cellpadding="0" cellspacing="0"
+                 style="background:#ffffff; border-radius:12px; overflow:hidden;">
+            <tr>
+              <td style="background:#4a90e2; padding:20px; text-align:center; color:white;">
+                <h1 style="margin:0; font-size:24px;">🐾 My Pet Shop – Stock bajo</h1>
+              </td>
+            </tr>
+            <tr>
+              <td style="padding:24px; color:#333; font-size:15px; line-height:22px;">
+                <p style="margin-top:0;">
+                    Hay <strong>{len(alertas)}</strong> producto(s) o talla(s) nuevos por debajo de su umbral de stock.
+                </p>
+                <table width="100%" cellpadding="5" cellspacing="0"
+                       style="border-collapse:collapse; margin-top:10px;">
+                    <tr style="background:#f0f0f0;">
+                        <th align="left">Producto</th>
+                        <th align="center">Talla</th>
+                        <th align="center">Stock</th>
+                        <th align="center">Umbral</th>
+                    </tr>
+                    {filas}
+                </table>
+              </td>
+            </tr>
+          </table>
+        </td>
+      </tr>
+    </table>"""
+
+    mensaje = Mail(
+        from_email=settings.EMAIL_FROM,
+        to_emails=email_destino or settings.EMAIL_FROM,
+        subject=f"Resumen de stock bajo ({len(alertas)})",
+        html_content=html,
+    )
+    integraciones.enviar_email(mensaje)
+
+    AlertaStock.objects.filter(pk__in=[a.pk for a in alertas]).update(
+        fecha_notificacion=timezone.now()
+    )
+    return len(alertas)
@@ -0,0 +1,138 @@
+import time
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase, Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from .models import (
+    Cliente,
+    Pedido,
+    ItemPedido,
+    Marca,
+    Producto,
+    TallaProducto,
+)
+
+User = get_user_model()
+
+NUM_FILAS = 100_000
+MAX_CONSULTAS = 12
+MAX_SEGUNDOS = 5
+
+
+class AdminTablasGrandesTest(TestCase):
+    """
+    El admin de Django no debe degradarse con tablas grandes: número de
+    consultas acotado (sin N+1 ni COUNT(*) completos) y sin <select> con
+    todas las filas de la tabla relacionada.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.superuser = User.objects.create_superuser(
+            username="root", email="root@example.com", password="rootpass123"
+        )
+        marca = Marca.objects.create(nombre="Marca", imagen="marcas/imagenes/marca.jpg")
+        productos = Producto.objects.bulk_create([
+            Producto(nombre=f"Producto {i}", precio=Decimal("9.99"), stock=50, marca=marca)
+            for i in range(500)
+        ])
+        TallaProducto.objects.bulk_create([
+            TallaProducto(producto=p, talla="M", stock=5) for p in productos
+        ])
+        clientes = Cliente.objects.bulk_create([
+            Cliente(nombre=f"Cliente {i}", email=f"cliente{i}@example.com")
+            for i in range(1000)
+        ])
+        Pedido.objects.bulk_create(
+            (
+                Pedido(
+                    numero_pedido=f"MP-{i:06d}",
+                    cliente=clientes[i % len(clientes)],
+                    total=Decimal("12.98"),
+                )
+                for i in range(NUM_FILAS)
+            ),
+            batch_size=5000,
+        )
+        pedido_ids = list(Pedido.objects.values_list("id_pedido", flat=True))
+        ItemPedido.objects.bulk_create(
+            (
+                ItemPedido(
+                    pedido_id=pedido_id,
+                    producto=productos[i % len(productos)],
+                    cantidad=1,
+                    precio_unitario=Decimal("9.99"),
+                    total=Decimal("9.99"),
+                )
+                for i, pedido_id in enumerate(pedido_ids)
+            ),
+            batch_size=5000,
+        )
+        cls.pedido = Pedido.objects.order_by("id_pedido").first()
+        cls.item = ItemPedido.objects.order_by("id_item_pedido").first()
+
+    def setUp(self):
+        self.client = Client()
+        self.client.force_login(self.superuser)
+
+    def _get_acotado(self, url):
+        # assertNumQueries exige un número exacto; aquí solo interesa el máximo
+        inicio = time.perf_counter()
+        with CaptureQueriesContext(connection) as consultas:
+            response = self.client.get(url)
+        duracion = time.perf_counter() - inicio
+
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(
+            len(consultas), MAX_CONSULTAS,
+            "\n".join(q["sql"] for q in consultas.captured_queries),
+        )
+        self.assertLess(duracion, MAX_SEGUNDOS)
+        return response
+
+    def test_listado_pedidos(self):
+        response = self._get_acotado(reverse("admin:home_pedido_changelist"))
+        self.assertContains(response, "MP-")
+
+    def test_listado_items_pedido(self):
+        self._get_acotado(reverse("admin:home_itempedido_changelist"))
+
+    def test_listado_tallas(self):
+        self._get_acotado(reverse("admin:home_tallaproducto_changelist"))
+
+    def test_listado_con_busqueda(self):
+        self._get_acotado(reverse("admin:home_pedido_changelist") + "?q=MP-0000")
+
+    def test_formulario_item_sin_select_completo(self):
+        response = self._get_acotado(
+            reverse("admin:home_itempedido_change", args=[self.item.pk])
+        )
+        # Con autocompletado solo se renderiza la opción seleccionada
+        self.assertLess(response.content.decode().count("<option"), 20)
+
+    def test_formulario_pedido(self):
+        self._get_acotado(reverse("admin:home_pedido_change", args=[self.pedido.pk]))
+
+    def test_autocompletado_paginado(self):
+        url = reverse("admin:autocomplete") + (
+            "?app_label=home&model_name=itempedido&field_name=pedido&term=MP-00"
+        )
+        response = self._get_acotado(url)
+        self.assertLessEqual(len(response.json()["results"]), 20)
+
+    def test_paginas_mas_alla_del_limite_de_conteo(self):
+        url = reverse("admin:home_pedido_changelist")
+        # 100.000 pedidos / 50 por página: el conteo acotado da solo 200 páginas
+        response = self._get_acotado(url + "?p=201")
+        self.assertEqual(response.context["cl"].result_list.count(), 50)
+        response = self._get_acotado(url + f"?p={NUM_FILAS // 50}")
+        self.assertEqual(len(response.context["cl"].result_list), 50)
+        self.assertEqual(self.client.get(url + f"?p={NUM_FILAS // 50 + 1}").status_code, 302)
+
+    def test_ultima_pagina_estimada_enlaza_las_siguientes(self):
+        response = self._get_acotado(reverse("admin:home_pedido_changelist") + "?p=200")
+        self.assertContains(response, f"?p={NUM_FILAS // 50}")
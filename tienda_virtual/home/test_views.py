@@ -5,14 +5,23 @@ Estas pruebas verifican el flujo completo de interacción entre vistas, modelos,
 import tempfile
 import shutil
 from decimal import Decimal
-from django.test import TestCase, Client, override_settings
-from django.contrib.auth import get_user_model
+from django.test import TestCase, TransactionTestCase, Client, RequestFactory, override_settings
+from django.contrib.auth import BACKEND_SESSION_KEY, get_user_model
+from django.contrib.auth.models import AnonymousUser
 from django.urls import reverse
 from django.utils import timezone
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 import json
 import datetime
+import threading
+import time
+from unittest.mock import patch
+
+import stripe
 
 from .models import (
     Producto,
@@ -23,7 +32,17 @@ from .models import (
     ItemPedido,
     MensajeContacto,
     ImagenProducto,
+    TallaProducto,
+    RecomendacionProducto,
+    Carrito,
+    ItemCarrito,
+    ReservaStock,
+    Promocion,
 )
+from .backends import ClienteBackend
+from .middleware import ClienteMiddleware
+from .tests import BaseDatosEnFichero
+from . import carrito, integraciones, metricas, precios, promociones, rankings, reservas, search_index, seguimiento, tiempos
 
 User = get_user_model()
 
@@ -31,6 +50,14 @@ User = get_user_model()
 TEMP_MEDIA_ROOT = tempfile.mkdtemp()
 
 
+def carrito_de(client):
+    """Contenido del carrito de la sesión del cliente de pruebas."""
+    filas = ItemCarrito.objects.filter(
+        carrito_id=client.session.get('carrito_id'), cantidad__gt=0
+    ).values_list('producto_id', 'talla', 'cantidad')
+    return {f"{pid}:{talla}": cantidad for pid, talla, cantidad in filas}
+
+
 @override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
 class IndexViewTest(TestCase):
     @classmethod
@@ -178,12 +205,118 @@ class ProductosViewTest(TestCase):
         # El producto reciente debe estar en la lista
         self.assertIn(producto_reciente, productos)
 
+    def test_productos_orden_mas_vendidos(self):
+        """Test que ?orden=mas_vendidos ordena por el ranking precalculado."""
+        self.producto_normal.stock = 10
+        self.producto_normal.save()
+        pedido = Pedido.objects.create(numero_pedido="PED-RANK-1")
+        ItemPedido.objects.create(pedido=pedido, producto=self.producto_normal, cantidad=2)
+        pedido.descontar_stock()
+        otro = Producto.objects.create(
+            nombre="Otro", precio=Decimal("5.00"), marca=self.marca, esta_disponible=True
+        )
+        rankings.calcular_rankings()
+
+        response = self.client.get(reverse('productos'), {'orden': 'mas_vendidos'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context['productos'])[:2], [self.producto_normal, otro])
+        self.assertEqual(response.context['orden'], 'mas_vendidos')
+
+    def test_buscar_autocompletar(self):
+        """Test que el autocompletado responde desde el índice en memoria."""
+        search_index.invalidar()
+        response = self.client.get(reverse('buscar_autocompletar'), {'q': 'produc'})
+        self.assertEqual(response.status_code, 200)
+        nombres = [r['nombre'] for r in response.json()['resultados']]
+        self.assertEqual(sorted(nombres), ['Producto Destacado', 'Producto Normal'])
+
+        response = self.client.get(reverse('buscar_autocompletar'), {'q': 'royal'})
+        resultado = response.json()['resultados'][0]
+        self.assertEqual(resultado['tipo'], 'marca')
+        self.assertIn(f"marca={self.marca.id}", resultado['url'])
+
+    def test_buscar_autocompletar_refresca_al_cambiar_catalogo(self):
+        """Test que renombrar o retirar un producto refresca el índice."""
+        search_index.invalidar()
+        self.client.get(reverse('buscar_autocompletar'), {'q': 'produc'})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.producto_normal.nombre = "Arnés Normal"
+            self.producto_normal.save()
+            self.producto_destacado.esta_disponible = False
+            self.producto_destacado.save()
+
+        response = self.client.get(reverse('buscar_autocompletar'), {'q': 'arnes'})
+        self.assertEqual([r['id'] for r in response.json()['resultados']], [self.producto_normal.id])
+        response = self.client.get(reverse('buscar_autocompletar'), {'q': 'produc'})
+        self.assertEqual(response.json()['resultados'], [])
+
+    def test_buscar_autocompletar_sin_consultas(self):
+        """Test que un cambio de stock no invalida el índice y la búsqueda no consulta la BD."""
+        search_index.invalidar()
+        self.client.get(reverse('buscar_autocompletar'), {'q': 'produc'})
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.producto_normal.stock = 3
+            self.producto_normal.save()
+        self.assertEqual(callbacks, [])
+        with self.assertNumQueries(0):
+            self.client.get(reverse('buscar_autocompletar'), {'q': 'produc'})
+
+    def test_productos_orden_y_rango_de_precio(self):
+        """Test que se puede ordenar y filtrar por el precio que paga el cliente."""
+        self.producto_destacado.precio_oferta = Decimal("9.00")
+        self.producto_destacado.save()
+        barato = Producto.objects.create(
+            nombre="Barato", precio=Decimal("12.00"), marca=self.marca, esta_disponible=True
+        )
+
+        response = self.client.get(reverse('productos'), {'orden': 'precio_asc'})
+        self.assertEqual(list(response.context['productos']), [barato, self.producto_normal])
+
+        response = self.client.get(reverse('productos'), {'precio_min': '10', 'precio_max': '13'})
+        self.assertEqual(list(response.context['productos']), [barato])
+        self.assertEqual(list(response.context['destacados']), [])
+        # El histograma no aplica el propio filtro de precio
+        totales = [t['total'] for t in response.context['histograma']['tramos']]
+        self.assertEqual(totales, [1, 2, 0, 0, 0])
+        self.assertContains(response, 'precio_max=25')
+
     def test_product_detail_view(self):
         """Test que la vista de detalle muestra el producto correcto."""
         response = self.client.get(reverse('product_detail', args=[self.producto_destacado.id]))
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.context['producto'], self.producto_destacado)
 
+    def test_product_detail_recomendados(self):
+        """Test que la ficha muestra las recomendaciones precalculadas."""
+        RecomendacionProducto.objects.create(
+            producto=self.producto_destacado,
+            recomendado=self.producto_normal,
+            posicion=1,
+            puntuacion=0.5,
+        )
+        response = self.client.get(reverse('product_detail', args=[self.producto_destacado.id]))
+        self.assertEqual(response.context['recomendados'], [self.producto_normal])
+        self.assertContains(response, 'Los clientes también compraron')
+
+    def test_cart_recomendados_excluye_productos_del_carrito(self):
+        """Test que el carrito no recomienda productos que ya contiene."""
+        RecomendacionProducto.objects.create(
+            producto=self.producto_destacado,
+            recomendado=self.producto_normal,
+            posicion=1,
+            puntuacion=0.5,
+        )
+        session = self.client.session
+        session['cart'] = {f"{self.producto_destacado.id}:": 1}
+        session.save()
+        response = self.client.get(reverse('cart'))
+        self.assertEqual(response.context['recomendados'], [self.producto_normal])
+
+        session['cart'][f"{self.producto_normal.id}:"] = 1
+        session.save()
+        response = self.client.get(reverse('cart'))
+        self.assertEqual(response.context['recomendados'], [])
+
     def test_product_detail_404_no_disponible(self):
         """Test que productos no disponibles devuelven 404."""
         self.producto_destacado.esta_disponible = False
@@ -279,12 +412,12 @@ class CartViewTest(TestCase):
         response = self.client.post(reverse('add_to_cart', args=[self.producto.id]))
         self.assertEqual(response.status_code, 302)  # Redirect
         
-        # Verificar que el producto está en la sesión con composite key
+        # Verificar que el producto está en el carrito con composite key
         session = self.client.session
-        self.assertIn('cart', session)
+        self.assertIn('carrito_id', session)
         key = f"{self.producto.id}:"  # Composite key format: product_id:size
-        self.assertIn(key, session['cart'])
-        self.assertEqual(session['cart'][key], 1)
+        self.assertIn(key, carrito_de(self.client))
+        self.assertEqual(carrito_de(self.client)[key], 1)
 
     def test_add_to_cart_ajax(self):
         """Test que se puede añadir un producto al carrito vía AJAX."""
@@ -299,12 +432,12 @@ class CartViewTest(TestCase):
         self.assertIn('cart_items', data)
         self.assertIn('cart_total', data)
         
-        # Verificar que el producto está en la sesión con composite key
+        # Verificar que el producto está en el carrito con composite key
         session = self.client.session
-        self.assertIn('cart', session)
+        self.assertIn('carrito_id', session)
         key = f"{self.producto.id}:"  # Composite key format
-        self.assertIn(key, session['cart'])
-        self.assertEqual(session['cart'][key], 1)
+        self.assertIn(key, carrito_de(self.client))
+        self.assertEqual(carrito_de(self.client)[key], 1)
 
     def test_add_to_cart_con_talla(self):
         """Test que se puede añadir un producto con talla."""
@@ -314,9 +447,8 @@ class CartViewTest(TestCase):
         )
         self.assertEqual(response.status_code, 302)
         
-        session = self.client.session
         key = f"{self.producto.id}:M"
-        self.assertIn(key, session['cart'])
+        self.assertIn(key, carrito_de(self.client))
 
     def test_add_to_cart_con_talla_ajax(self):
         """Test que se puede añadir un producto con talla vía AJAX."""
@@ -329,18 +461,16 @@ class CartViewTest(TestCase):
         data = json.loads(response.content)
         self.assertTrue(data['success'])
         
-        session = self.client.session
         key = f"{self.producto.id}:M"
-        self.assertIn(key, session['cart'])
+        self.assertIn(key, carrito_de(self.client))
 
     def test_add_to_cart_incrementa_cantidad(self):
         """Test que añadir el mismo producto incrementa la cantidad."""
         self.client.post(reverse('add_to_cart', args=[self.producto.id]))
         self.client.post(reverse('add_to_cart', args=[self.producto.id]))
         
-        session = self.client.session
         key = f"{self.producto.id}:"  # Composite key format
-        self.assertEqual(session['cart'][key], 2)
+        self.assertEqual(carrito_de(self.client)[key], 2)
 
     def test_cart_view_con_productos(self):
         """Test que el carrito muestra los productos correctamente."""
@@ -366,9 +496,8 @@ class CartViewTest(TestCase):
         response = self.client.post(reverse('cart_decrement', args=[self.producto.id]))
         self.assertEqual(response.status_code, 302)
         
-        session = self.client.session
         key = f"{self.producto.id}:"  # Composite key format
-        self.assertEqual(session['cart'][key], 1)
+        self.assertEqual(carrito_de(self.client)[key], 1)
 
     def test_cart_decrement_ajax(self):
         """Test que se puede decrementar la cantidad vía AJAX."""
@@ -386,18 +515,16 @@ class CartViewTest(TestCase):
         self.assertTrue(data['success'])
         self.assertEqual(data['cart_count'], 1)
         
-        session = self.client.session
         key = f"{self.producto.id}:"  # Composite key format
-        self.assertEqual(session['cart'][key], 1)
+        self.assertEqual(carrito_de(self.client)[key], 1)
 
     def test_cart_decrement_elimina_si_cero(self):
         """Test que decrementar a 0 elimina el producto del carrito."""
         self.client.post(reverse('add_to_cart', args=[self.producto.id]))
         self.client.post(reverse('cart_decrement', args=[self.producto.id]))
         
-        session = self.client.session
         key = f"{self.producto.id}:"  # Composite key format
-        self.assertNotIn(key, session['cart'])
+        self.assertNotIn(key, carrito_de(self.client))
 
     def test_cart_remove(self):
         """Test que se puede eliminar un producto del carrito."""
@@ -405,9 +532,8 @@ class CartViewTest(TestCase):
         response = self.client.post(reverse('cart_remove', args=[self.producto.id]))
         self.assertEqual(response.status_code, 302)
         
-        session = self.client.session
         key = f"{self.producto.id}:"  # Composite key format
-        self.assertNotIn(key, session['cart'])
+        self.assertNotIn(key, carrito_de(self.client))
 
     def test_cart_remove_ajax(self):
         """Test que se puede eliminar un producto del carrito vía AJAX."""
@@ -421,9 +547,8 @@ class CartViewTest(TestCase):
         self.assertTrue(data['success'])
         self.assertEqual(data['cart_count'], 0)
         
-        session = self.client.session
         key = f"{self.producto.id}:"  # Composite key format
-        self.assertNotIn(key, session['cart'])
+        self.assertNotIn(key, carrito_de(self.client))
 
     def test_cart_update(self):
         """Test que se puede actualizar la cantidad de un producto."""
@@ -435,9 +560,8 @@ class CartViewTest(TestCase):
         )
         self.assertEqual(response.status_code, 302)
         
-        session = self.client.session
         key = f"{self.producto.id}:"  # Composite key format
-        self.assertEqual(session['cart'][key], 5)
+        self.assertEqual(carrito_de(self.client)[key], 5)
 
     def test_cart_update_ajax(self):
         """Test que se puede actualizar la cantidad vía AJAX."""
@@ -453,9 +577,8 @@ class CartViewTest(TestCase):
         self.assertTrue(data['success'])
         self.assertEqual(data['cart_count'], 5)
         
-        session = self.client.session
         key = f"{self.producto.id}:"  # Composite key format
-        self.assertEqual(session['cart'][key], 5)
+        self.assertEqual(carrito_de(self.client)[key], 5)
 
     def test_cart_update_elimina_si_cero(self):
         """Test que actualizar a 0 elimina el producto."""
@@ -466,9 +589,8 @@ class CartViewTest(TestCase):
             {'product_id': self.producto.id, 'quantity': '0', 'size': ''}
         )
         
-        session = self.client.session
         key = f"{self.producto.id}:"  # Composite key format
-        self.assertNotIn(key, session['cart'])
+        self.assertNotIn(key, carrito_de(self.client))
 
     def test_add_to_cart_solo_post(self):
         """Test que add_to_cart solo acepta POST."""
@@ -503,6 +625,463 @@ class CartViewTest(TestCase):
         self.assertEqual(data['cart_total'], float(self.producto.precio))
 
 
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class CartSincronizacionTest(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.client = Client()
+        imagen_marca = SimpleUploadedFile(
+            name="marca.jpg",
+            content=b"fake image content",
+            content_type="image/jpeg"
+        )
+        self.marca = Marca.objects.create(nombre="Royal Canin", imagen=imagen_marca)
+        self.producto = Producto.objects.create(
+            nombre="Producto Test", precio=Decimal("10.00"), marca=self.marca,
+            esta_disponible=True, stock=10
+        )
+        self.otro = Producto.objects.create(
+            nombre="Otro Producto", precio=Decimal("4.00"), marca=self.marca,
+            esta_disponible=True, stock=10
+        )
+
+    def _post(self, url, datos=None):
+        response = self.client.post(url, datos or {}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        return json.loads(response.content)
+
+    def test_mutacion_sin_version_devuelve_carrito_completo(self):
+        """Sin since_version se responde con el carrito entero y su versión."""
+        data = self._post(reverse('add_to_cart', args=[self.producto.id]))
+        self.assertFalse(data['cart_delta'])
+        self.assertEqual(len(data['cart_items']), 1)
+        self.assertEqual(data['cart_version'], Carrito.objects.get().version)
+
+    def test_mutacion_con_version_devuelve_solo_cambios(self):
+        """Con since_version solo vienen las líneas cambiadas y los totales."""
+        data = self._post(reverse('add_to_cart', args=[self.producto.id]))
+        data = self._post(reverse('add_to_cart', args=[self.otro.id]), {'since_version': data['cart_version']})
+
+        self.assertTrue(data['cart_delta'])
+        self.assertNotIn('cart_items', data)
+        self.assertEqual([linea['producto_id'] for linea in data['cart_changes']], [self.otro.id])
+        self.assertEqual(data['cart_changes'][0]['remaining'], 9)
+        self.assertEqual(data['cart_removed'], [])
+        self.assertEqual(data['cart_count'], 2)
+        self.assertEqual(data['cart_total'], 14.0)
+        self.assertEqual(data['remaining_by_product'], {str(self.otro.id): 9})
+
+    def test_eliminar_linea_aparece_en_removed(self):
+        data = self._post(reverse('add_to_cart', args=[self.producto.id]))
+        data = self._post(reverse('cart_remove', args=[self.producto.id]), {'since_version': data['cart_version']})
+        self.assertEqual(data['cart_changes'], [])
+        self.assertEqual(data['cart_removed'], [f"{self.producto.id}:"])
+        self.assertEqual(data['cart_count'], 0)
+
+    def test_status_since_version_acumula_cambios(self):
+        """Los cambios hechos desde otra pestaña llegan en un único delta."""
+        version = self._post(reverse('add_to_cart', args=[self.producto.id]))['cart_version']
+        self.client.post(reverse('add_to_cart', args=[self.otro.id]))
+        self.client.post(reverse('cart_remove', args=[self.producto.id]))
+
+        data = self.client.get(reverse('cart_status'), {'since_version': version}).json()
+        self.assertTrue(data['cart_delta'])
+        self.assertEqual([linea['producto_id'] for linea in data['cart_changes']], [self.otro.id])
+        self.assertEqual(data['cart_removed'], [f"{self.producto.id}:"])
+
+        data = self.client.get(reverse('cart_status'), {'since_version': data['cart_version']}).json()
+        self.assertEqual(data['cart_changes'], [])
+        self.assertEqual(data['cart_removed'], [])
+
+    def test_version_desconocida_devuelve_carrito_completo(self):
+        self._post(reverse('add_to_cart', args=[self.producto.id]))
+        data = self.client.get(reverse('cart_status'), {'since_version': 5}).json()
+        self.assertFalse(data['cart_delta'])
+        self.assertEqual(len(data['cart_items']), 1)
+
+    def test_status_responde_304_si_no_cambia(self):
+        self.client.post(reverse('add_to_cart', args=[self.producto.id]))
+        response = self.client.get(reverse('cart_status'))
+        etag = response['ETag']
+
+        response = self.client.get(reverse('cart_status'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self.client.post(reverse('add_to_cart', args=[self.producto.id]))
+        response = self.client.get(reverse('cart_status'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_status_cambia_etag_si_cambia_el_stock(self):
+        self.client.post(reverse('add_to_cart', args=[self.producto.id]))
+        etag = self.client.get(reverse('cart_status'))['ETag']
+        self.producto.stock = 3
+        self.producto.save()
+        response = self.client.get(reverse('cart_status'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['cart_items'][0]['remaining'], 2)
+
+    def test_carrito_se_conserva_al_iniciar_sesion(self):
+        self.client.post(reverse('add_to_cart', args=[self.producto.id]))
+        usuario = get_user_model().objects.create_user(username="ana", password="secreta123")
+        self.client.force_login(usuario)
+        self.assertEqual(carrito_de(self.client), {f"{self.producto.id}:": 1})
+
+    def test_carrito_antiguo_de_sesion_se_importa(self):
+        session = self.client.session
+        session['cart'] = {str(self.producto.id): 2, '999:': 1}
+        session.save()
+        data = self.client.get(reverse('cart_status')).json()
+        self.assertEqual(data['cart_count'], 2)
+        self.assertEqual(carrito_de(self.client), {f"{self.producto.id}:": 2})
+        self.assertNotIn('cart', self.client.session)
+
+    def test_vaciar_carrito_sube_version(self):
+        version = self._post(reverse('add_to_cart', args=[self.producto.id]))['cart_version']
+        data = self._post(reverse('cart_clear'), {'since_version': version})
+        self.assertGreater(data['cart_version'], version)
+        self.assertEqual(data['cart_removed'], [f"{self.producto.id}:"])
+        self.assertEqual(data['cart_count'], 0)
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class CartBatchTest(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.client = Client()
+        imagen_marca = SimpleUploadedFile(
+            name="marca.jpg",
+            content=b"fake image content",
+            content_type="image/jpeg"
+        )
+        self.marca = Marca.objects.create(nombre="Royal Canin", imagen=imagen_marca)
+        self.producto = Producto.objects.create(
+            nombre="Producto Test", precio=Decimal("10.00"), marca=self.marca,
+            esta_disponible=True, stock=5
+        )
+        self.con_tallas = Producto.objects.create(
+            nombre="Arnés", precio=Decimal("15.00"), marca=self.marca,
+            esta_disponible=True
+        )
+        TallaProducto.objects.create(producto=self.con_tallas, talla="M", stock=2)
+
+    def _batch(self, operaciones, since_version=None):
+        return self.client.post(
+            reverse('cart_batch'),
+            data=json.dumps({'operaciones': operaciones, 'since_version': since_version}),
+            content_type='application/json',
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+        )
+
+    def test_aplica_operaciones_en_orden(self):
+        """Las operaciones se aplican en orden y la sesión se guarda una vez."""
+        response = self._batch([
+            {'op': 'add', 'product_id': self.producto.id, 'quantity': 3},
+            {'op': 'decrement', 'product_id': self.producto.id},
+            {'op': 'add', 'product_id': self.con_tallas.id, 'size': 'M'},
+            {'op': 'update', 'product_id': self.con_tallas.id, 'size': 'M', 'quantity': 2},
+        ])
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertTrue(data['success'])
+        self.assertEqual(data['cart_count'], 4)
+        self.assertEqual(data['cart_total'], 50.0)
+        self.assertEqual(carrito_de(self.client), {f"{self.producto.id}:": 2, f"{self.con_tallas.id}:M": 2})
+        carrito_bd = Carrito.objects.get()
+        self.assertEqual(carrito_bd.version, carrito_bd.version_inicial + 1)
+
+    def test_sin_stock_no_aplica_ninguna(self):
+        """Si una operación supera el stock no se aplica ninguna."""
+        self.client.post(reverse('add_to_cart', args=[self.producto.id]))
+        version = Carrito.objects.get().version
+
+        response = self._batch([
+            {'op': 'add', 'product_id': self.producto.id},
+            {'op': 'add', 'product_id': self.con_tallas.id, 'size': 'M', 'quantity': 3},
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('talla "M"', response.json()['error'])
+        self.assertEqual(carrito_de(self.client), {f"{self.producto.id}:": 1})
+        self.assertEqual(Carrito.objects.get().version, version)
+
+    def test_talla_obligatoria(self):
+        response = self._batch([{'op': 'add', 'product_id': self.con_tallas.id}])
+        self.assertEqual(response.status_code, 400)
+
+    def test_bajar_no_comprueba_stock(self):
+        """Se puede decrementar aunque el carrito ya supere el stock actual."""
+        session = self.client.session
+        session['cart'] = {f"{self.producto.id}:": 8}
+        session.save()
+        response = self._batch([{'op': 'decrement', 'product_id': self.producto.id}])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(carrito_de(self.client), {f"{self.producto.id}:": 7})
+
+    def test_responde_delta_con_since_version(self):
+        version = self._batch([{'op': 'add', 'product_id': self.producto.id}]).json()['cart_version']
+        data = self._batch(
+            [{'op': 'add', 'product_id': self.producto.id}, {'op': 'add', 'product_id': self.producto.id}],
+            since_version=version,
+        ).json()
+        self.assertTrue(data['cart_delta'])
+        self.assertEqual(data['cart_changes'][0]['cantidad'], 3)
+        self.assertEqual(data['cart_changes'][0]['remaining'], 2)
+
+    def test_stock_en_una_consulta(self):
+        operaciones = [{'op': 'add', 'product_id': self.producto.id} for _ in range(5)]
+        operaciones.append({'op': 'add', 'product_id': self.con_tallas.id, 'size': 'M'})
+        with self.assertNumQueries(1):
+            carrito.aplicar_operaciones({}, operaciones)
+
+    def test_peticion_no_valida(self):
+        self.assertEqual(self.client.get(reverse('cart_batch')).status_code, 405)
+        self.assertEqual(self._batch([{'op': 'borrar', 'product_id': 1}]).status_code, 400)
+        response = self.client.post(reverse('cart_batch'), data='no es json', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT, RESERVA_STOCK_MINUTOS=15)
+class CartReservaTest(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.cliente_a = Client()
+        self.cliente_b = Client()
+        imagen_marca = SimpleUploadedFile(
+            name="marca.jpg",
+            content=b"fake image content",
+            content_type="image/jpeg"
+        )
+        self.marca = Marca.objects.create(nombre="Royal Canin", imagen=imagen_marca)
+        self.producto = Producto.objects.create(
+            nombre="Edición limitada", precio=Decimal("10.00"), marca=self.marca,
+            esta_disponible=True, stock=2
+        )
+        self.con_tallas = Producto.objects.create(
+            nombre="Arnés", precio=Decimal("15.00"), marca=self.marca,
+            esta_disponible=True
+        )
+        TallaProducto.objects.create(producto=self.con_tallas, talla="M", stock=2)
+
+    def _anadir(self, client, producto, size=''):
+        return client.post(
+            reverse('add_to_cart', args=[producto.id]),
+            {'size': size},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+        )
+
+    def test_reserva_al_anadir(self):
+        self._anadir(self.cliente_a, self.producto)
+        self._anadir(self.cliente_a, self.producto)
+        reserva = ReservaStock.objects.get()
+        self.assertEqual(reserva.cantidad, 2)
+        self.assertGreater(reserva.expira, timezone.now() + datetime.timedelta(minutes=14))
+
+    def test_stock_reservado_no_se_puede_anadir(self):
+        """Las últimas unidades en el carrito de otro cliente no se pueden añadir."""
+        self._anadir(self.cliente_a, self.producto)
+        self._anadir(self.cliente_a, self.producto)
+        response = self._anadir(self.cliente_b, self.producto)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('No hay suficiente stock', response.json()['error'])
+        self.assertEqual(carrito_de(self.cliente_b), {})
+
+    def test_restante_descuenta_reservas_de_otros(self):
+        self._anadir(self.cliente_a, self.con_tallas, 'M')
+        data = self._anadir(self.cliente_b, self.con_tallas, 'M').json()
+        self.assertEqual(data['cart_items'][0]['remaining'], 0)
+        self.assertEqual(self._anadir(self.cliente_b, self.con_tallas, 'M').status_code, 400)
+
+    def test_quitar_libera_la_reserva(self):
+        self._anadir(self.cliente_a, self.producto)
+        self._anadir(self.cliente_a, self.con_tallas, 'M')
+        self.cliente_a.post(reverse('cart_remove', args=[self.producto.id]))
+        self.assertEqual(
+            list(ReservaStock.objects.values_list('producto_id', flat=True)), [self.con_tallas.id]
+        )
+        self.cliente_a.post(reverse('cart_clear'))
+        self.assertFalse(ReservaStock.objects.exists())
+
+    def test_reservas_caducadas_no_cuentan(self):
+        self._anadir(self.cliente_a, self.producto)
+        self._anadir(self.cliente_a, self.producto)
+        ReservaStock.objects.update(expira=timezone.now() - datetime.timedelta(seconds=1))
+        self.assertEqual(self._anadir(self.cliente_b, self.producto).status_code, 200)
+
+        self.assertEqual(reservas.liberar_caducadas(tamano_lote=1), 1)
+        self.assertEqual(ReservaStock.objects.get().carrito.pk, self.cliente_b.session['carrito_id'])
+
+    def test_comando_liberar_reservas(self):
+        from django.core.management import call_command
+        from io import StringIO
+
+        self._anadir(self.cliente_a, self.producto)
+        self._anadir(self.cliente_b, self.con_tallas, 'M')
+        ReservaStock.objects.update(expira=timezone.now() - datetime.timedelta(minutes=1))
+        salida = StringIO()
+        call_command('liberar_reservas', '--lote', '1', stdout=salida)
+        self.assertIn('2', salida.getvalue())
+        self.assertFalse(ReservaStock.objects.exists())
+
+    def test_purgar_lineas_quitadas(self):
+        self._anadir(self.cliente_a, self.producto)
+        self._anadir(self.cliente_a, self.con_tallas, 'M')
+        carrito_bd = Carrito.objects.get()
+        antes = carrito_bd.version
+        self.cliente_a.post(reverse('cart_remove', args=[self.producto.id]))
+        self.assertEqual(ItemCarrito.objects.filter(cantidad=0).count(), 1)
+
+        self.assertEqual(carrito.purgar(), (0, 1))
+        self.assertFalse(ItemCarrito.objects.filter(cantidad=0).exists())
+        carrito_bd.refresh_from_db()
+        # Quien venía de antes del borrado ya no puede recibirlo como delta: carrito completo
+        self.assertIsNone(carrito.claves_cambiadas(carrito_bd, carrito_bd.version, antes))
+        self.assertEqual(carrito.claves_cambiadas(carrito_bd, carrito_bd.version, carrito_bd.version), set())
+        self.assertEqual(carrito_de(self.cliente_a), {f"{self.con_tallas.id}:M": 1})
+
+    def test_comando_borra_carritos_abandonados(self):
+        from django.core.management import call_command
+        from io import StringIO
+
+        self._anadir(self.cliente_a, self.producto)
+        self._anadir(self.cliente_b, self.con_tallas, 'M')
+        abandonado = Carrito.objects.get(pk=self.cliente_a.session['carrito_id'])
+        Carrito.objects.filter(pk=abandonado.pk).update(
+            fecha_actualizacion=timezone.now() - datetime.timedelta(days=31)
+        )
+        salida = StringIO()
+        call_command('liberar_reservas', stdout=salida)
+        self.assertIn('Carritos abandonados borrados: 1', salida.getvalue())
+        self.assertEqual(list(Carrito.objects.values_list('pk', flat=True)), [self.cliente_b.session['carrito_id']])
+        self.assertEqual(ReservaStock.objects.get().producto, self.con_tallas)
+
+    @override_settings(RESERVA_STOCK_MINUTOS=0)
+    def test_sin_reservas_por_defecto(self):
+        self._anadir(self.cliente_a, self.producto)
+        self._anadir(self.cliente_a, self.producto)
+        self.assertEqual(self._anadir(self.cliente_b, self.producto).status_code, 200)
+        self.assertFalse(ReservaStock.objects.exists())
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class CartConcurrenciaTest(BaseDatosEnFichero, TransactionTestCase):
+    """Peticiones de carrito simultáneas de la misma sesión (hilos con su propia conexión)."""
+    HILOS = 8
+    CLICS = 5
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.client = Client()
+        imagen_marca = SimpleUploadedFile(
+            name="marca.jpg",
+            content=b"fake image content",
+            content_type="image/jpeg"
+        )
+        self.marca = Marca.objects.create(nombre="Royal Canin", imagen=imagen_marca)
+        self.producto = Producto.objects.create(
+            nombre="Producto Test", precio=Decimal("10.00"), marca=self.marca,
+            esta_disponible=True, stock=1000
+        )
+        self.con_tallas = Producto.objects.create(
+            nombre="Arnés", precio=Decimal("15.00"), marca=self.marca,
+            esta_disponible=True
+        )
+        TallaProducto.objects.create(producto=self.con_tallas, talla="M", stock=1000)
+        # Primera petición normal: crea la sesión y el carrito
+        self.client.post(reverse('add_to_cart', args=[self.producto.id]))
+
+    def _en_paralelo(self, peticiones):
+        """Lanza cada petición (url, datos) desde un hilo con la cookie de sesión compartida."""
+        errores = []
+
+        def hilo(url, datos):
+            client = Client()
+            client.cookies = self.client.cookies
+            try:
+                for _ in range(self.CLICS):
+                    if isinstance(datos, str):
+                        response = client.post(url, datos, content_type='application/json',
+                                               HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+                    else:
+                        response = client.post(url, datos, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+                    if response.status_code != 200:
+                        errores.append(response.content)
+            except Exception as e:
+                errores.append(repr(e))
+            finally:
+                connection.close()
+
+        hilos = [threading.Thread(target=hilo, args=peticion) for peticion in peticiones]
+        for h in hilos:
+            h.start()
+        for h in hilos:
+            h.join()
+        self.assertEqual(errores, [])
+
+    def test_anadir_en_paralelo_no_pierde_unidades(self):
+        url = reverse('add_to_cart', args=[self.producto.id])
+        self._en_paralelo([(url, {})] * self.HILOS)
+        self.assertEqual(carrito_de(self.client), {f"{self.producto.id}:": 1 + self.HILOS * self.CLICS})
+
+    def test_endpoints_mezclados_en_paralelo(self):
+        """add, batch y decrement a la vez sobre dos líneas: el resultado es la suma exacta."""
+        add = (reverse('add_to_cart', args=[self.con_tallas.id]), {'size': 'M'})
+        batch = (reverse('cart_batch'), json.dumps({'operaciones': [
+            {'op': 'add', 'product_id': self.producto.id, 'quantity': 2},
+            {'op': 'add', 'product_id': self.con_tallas.id, 'size': 'M'},
+        ]}))
+        decrement = (reverse('cart_decrement', args=[self.producto.id]), {})
+        self.client.post(reverse('cart_update'), {'product_id': self.producto.id, 'quantity': 100})
+
+        self._en_paralelo([add, add, batch, batch, decrement, decrement])
+
+        n = self.CLICS
+        self.assertEqual(carrito_de(self.client), {
+            f"{self.producto.id}:": 100 + 2 * 2 * n - 2 * n,
+            f"{self.con_tallas.id}:M": 2 * n + 2 * n,
+        })
+        carrito_bd = Carrito.objects.get()
+        self.assertEqual(carrito_bd.version, carrito_bd.version_inicial + 2 + 6 * n)
+
+    @override_settings(RESERVA_STOCK_MINUTOS=15)
+    def test_reservas_en_paralelo_no_superan_el_stock(self):
+        """Varios clientes a la vez por las 3 últimas unidades: solo se reservan 3."""
+        Producto.objects.filter(pk=self.producto.pk).update(stock=3)
+        ReservaStock.objects.all().delete()
+        ItemCarrito.objects.all().delete()
+        url = reverse('add_to_cart', args=[self.producto.id])
+        resultados = []
+
+        def hilo():
+            client = Client()
+            try:
+                response = client.post(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+                resultados.append(response.status_code)
+            finally:
+                connection.close()
+
+        hilos = [threading.Thread(target=hilo) for _ in range(self.HILOS)]
+        for h in hilos:
+            h.start()
+        for h in hilos:
+            h.join()
+        self.assertEqual(sorted(resultados), [200] * 3 + [400] * (self.HILOS - 3))
+        self.assertEqual(sum(ReservaStock.objects.values_list('cantidad', flat=True)), 3)
+
+
 @override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
 class AuthenticationViewTest(TestCase):
     @classmethod
@@ -607,6 +1186,24 @@ class AuthenticationViewTest(TestCase):
         self.assertEqual(response.status_code, 200)  # Vuelve al formulario
         self.assertFalse(response.wsgi_request.user.is_authenticated)
 
+    def test_register_email_existente_con_otras_mayusculas(self):
+        response = self.client.post(
+            reverse('register'),
+            {
+                'nombre': 'Nuevo',
+                'apellidos': 'Usuario',
+                'email': 'Test@Example.com',
+                'telefono': '123456789',
+                'direccion': 'Calle 1',
+                'ciudad': 'Madrid',
+                'codigo_postal': '28001',
+                'password1': 'pass12345',
+                'password2': 'pass12345',
+            }
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('email', response.context['form'].errors)
+
     def test_register_redirect_si_autenticado(self):
         """Test que usuarios autenticados son redirigidos del registro."""
         self.client.login(username='test@example.com', password='testpass123')
@@ -731,6 +1328,31 @@ class CheckoutViewTest(TestCase):
         self.cliente.refresh_from_db()
         self.assertEqual(self.cliente.direccion, 'Calle Nueva 123')
 
+    def _datos_invitado(self, email):
+        return {
+            'form_type': 'guest',
+            'email': email,
+            'nombre': 'Invitado',
+            'direccion': 'Calle Invitado 1',
+            'ciudad': 'Sevilla',
+            'codigo_postal': '41001',
+        }
+
+    def test_invitado_reutiliza_cliente_sin_distinguir_mayusculas(self):
+        invitado = Cliente.objects.create(nombre="Invitado", email="invitado@example.com")
+        self.client.post(reverse('add_to_cart', args=[self.producto.id]))
+        response = self.client.post(reverse('checkout_datos'), self._datos_invitado(' Invitado@Example.COM'))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Cliente.por_email('invitado@example.com').count(), 1)
+        invitado.refresh_from_db()
+        self.assertEqual(invitado.ciudad, 'Sevilla')
+
+    def test_invitado_con_email_de_cuenta_debe_iniciar_sesion(self):
+        self.client.post(reverse('add_to_cart', args=[self.producto.id]))
+        response = self.client.post(reverse('checkout_datos'), self._datos_invitado('TEST@example.com'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Cliente.objects.count(), 1)
+
     def test_detalles_pago_requiere_login(self):
         """Test que detalles_pago requiere autenticación."""
         response = self.client.get(reverse('detalles_pago'))
@@ -787,6 +1409,171 @@ class CheckoutViewTest(TestCase):
         items = response.context['items']
         self.assertEqual(items[0]['subtotal'], Decimal("8.00"))
 
+    def _presupuestar(self, shipping_method='delivery'):
+        Cliente.objects.filter(pk=self.cliente.pk).update(direccion="Calle Mayor 1", telefono="600000000")
+        self.client.login(username='test@example.com', password='testpass123')
+        self.client.post(reverse('add_to_cart', args=[self.producto.id]))
+        session = self.client.session
+        session['shipping_method'] = shipping_method
+        session.save()
+        return self.client.get(reverse('detalles_pago'))
+
+    def test_detalles_pago_guarda_presupuesto_firmado(self):
+        self._presupuestar()
+        presupuesto = precios.Presupuesto.desde_firma(self.client.session[precios.CLAVE_SESION])
+        self.assertEqual(presupuesto.total, Decimal("13.99"))
+        self.assertEqual(presupuesto.lineas[0].producto_id, self.producto.id)
+
+    @patch('home.views.enviar_email_contrareembolso')
+    def test_contrareembolso_reutiliza_presupuesto(self, _):
+        """Si el carrito no cambia, se cobra lo presupuestado aunque cambie el precio."""
+        self._presupuestar()
+        Producto.objects.filter(pk=self.producto.pk).update(precio=Decimal("50.00"))
+
+        self.client.post(reverse('checkout_contrareembolso'))
+        pedido = Pedido.objects.get(metodo_pago="contrareembolso")
+        self.assertEqual(pedido.subtotal, Decimal("10.00"))
+        self.assertEqual(pedido.total, Decimal("13.99"))
+        self.assertEqual(pedido.items.get().precio_unitario, Decimal("10.00"))
+        self.assertNotIn(precios.CLAVE_SESION, self.client.session)
+
+    @patch('home.views.enviar_email_contrareembolso')
+    def test_contrareembolso_recalcula_si_cambia_el_carrito(self, _):
+        self._presupuestar()
+        self.client.post(reverse('add_to_cart', args=[self.producto.id]))
+
+        self.client.post(reverse('checkout_contrareembolso'))
+        pedido = Pedido.objects.get(metodo_pago="contrareembolso")
+        self.assertEqual(pedido.subtotal, Decimal("20.00"))
+        self.assertEqual(pedido.total, Decimal("24.99"))
+
+    @patch('home.views.enviar_email_contrareembolso')
+    def test_contrareembolso_recogida_sin_gastos_de_envio(self, _):
+        self._presupuestar('pickup')
+        self.client.post(reverse('checkout_contrareembolso'))
+        pedido = Pedido.objects.get(metodo_pago="contrareembolso")
+        self.assertEqual(pedido.coste_entrega, Decimal("0.00"))
+        self.assertEqual(pedido.total, Decimal("11.00"))
+
+    @patch('home.views.enviar_email_contrareembolso')
+    def test_cupon_se_aplica_al_pedido(self, _):
+        Promocion.objects.create(
+            nombre="Bienvenida", codigo="HOLA", tipo=Promocion.Tipos.IMPORTE, valor=Decimal("3.00")
+        )
+        promociones.invalidar()
+        self.addCleanup(promociones.invalidar)
+        self._presupuestar()
+
+        response = self.client.post(reverse('aplicar_codigo_promocion'), {'codigo': 'nada'})
+        self.assertTrue(any('no es válido' in str(m) for m in get_messages(response.wsgi_request)))
+        self.client.post(reverse('aplicar_codigo_promocion'), {'codigo': 'hola'})
+        response = self.client.get(reverse('detalles_pago'))
+        self.assertEqual(response.context['descuento'], Decimal("3.00"))
+        self.assertEqual(response.context['promocion'], "Bienvenida")
+
+        self.client.post(reverse('checkout_contrareembolso'))
+        pedido = Pedido.objects.get(metodo_pago="contrareembolso")
+        self.assertEqual(pedido.descuento, Decimal("3.00"))
+        # 10.00 - 3.00 de descuento + 0.70 de impuestos + 2.99 de envío
+        self.assertEqual(pedido.total, Decimal("10.69"))
+        self.assertNotIn(precios.CLAVE_CODIGO, self.client.session)
+
+    @patch('home.views.stripe.checkout.Session.create')
+    def test_stripe_usa_presupuesto(self, crear_sesion):
+        crear_sesion.return_value.id = 'cs_test_1'
+        crear_sesion.return_value.url = 'https://checkout.stripe.test/s'
+        self._presupuestar()
+        response = self.client.post(reverse('checkout_stripe'))
+        self.assertRedirects(response, 'https://checkout.stripe.test/s', fetch_redirect_response=False)
+        pedido = Pedido.objects.get(metodo_pago="stripe_test")
+        self.assertEqual(pedido.total, Decimal("13.99"))
+        linea = crear_sesion.call_args.kwargs['line_items'][0]
+        self.assertEqual(linea['price_data']['unit_amount'], 1399)
+
+    @patch('home.views.stripe.checkout.Session.create')
+    def test_stripe_reenvio_devuelve_el_mismo_pedido_y_sesion(self, crear_sesion):
+        crear_sesion.return_value.id = 'cs_test_1'
+        crear_sesion.return_value.url = 'https://checkout.stripe.test/s'
+        clave = self._presupuestar().context['clave_idempotencia']
+
+        self.client.post(reverse('checkout_stripe'), {'clave_idempotencia': clave})
+        with self.assertNumQueries(3):  # sesión, usuario y el pedido por su clave
+            response = self.client.post(reverse('checkout_stripe'), {'clave_idempotencia': clave})
+        self.assertRedirects(response, 'https://checkout.stripe.test/s', fetch_redirect_response=False)
+
+        pedido = Pedido.objects.get(metodo_pago="stripe_test")
+        self.assertEqual(pedido.clave_idempotencia, clave)
+        self.assertEqual(pedido.sesion_stripe_id, 'cs_test_1')
+        self.assertEqual(crear_sesion.call_count, 1)
+        self.assertEqual(crear_sesion.call_args.kwargs['idempotency_key'], f'checkout-{clave}')
+
+    @patch('home.views.stripe.checkout.Session.create')
+    def test_stripe_reenvio_sin_sesion_guardada_repite_la_clave(self, crear_sesion):
+        """Si la primera petición no llegó a guardar la sesión, se pide con la misma clave."""
+        crear_sesion.return_value.id = 'cs_test_1'
+        crear_sesion.return_value.url = 'https://checkout.stripe.test/s'
+        clave = self._presupuestar().context['clave_idempotencia']
+        self.client.post(reverse('checkout_stripe'), {'clave_idempotencia': clave})
+        Pedido.objects.update(sesion_stripe_id='', sesion_stripe_url='')
+
+        self.client.post(reverse('checkout_stripe'), {'clave_idempotencia': clave})
+        self.assertEqual(Pedido.objects.count(), 1)
+        claves = [c.kwargs['idempotency_key'] for c in crear_sesion.call_args_list]
+        self.assertEqual(claves, [f'checkout-{clave}'] * 2)
+
+    def test_stripe_con_interruptor_abierto_no_crea_pedido(self):
+        integraciones.reiniciar()
+        self.addCleanup(integraciones.reiniciar)
+        interruptor = integraciones.servicio("stripe").interruptor
+        for _ in range(interruptor.fallos_para_abrir):
+            interruptor.fallo()
+        self._presupuestar()
+
+        response = self.client.post(reverse('checkout_stripe'))
+        self.assertRedirects(response, reverse('detalles_pago'), fetch_redirect_response=False)
+        self.assertFalse(Pedido.objects.exists())
+        self.assertTrue(any('no está disponible' in str(m) for m in get_messages(response.wsgi_request)))
+
+    @patch('home.views.stripe.checkout.Session.create')
+    def test_stripe_sin_respuesta_vuelve_al_resumen(self, crear_sesion):
+        crear_sesion.side_effect = stripe.APIConnectionError("stripe: HTTP 503")
+        clave = self._presupuestar().context['clave_idempotencia']
+
+        response = self.client.post(reverse('checkout_stripe'), {'clave_idempotencia': clave})
+        self.assertRedirects(response, reverse('detalles_pago'), fetch_redirect_response=False)
+        # El pedido queda pendiente sin sesión: un reenvío vuelve a pedirla con la misma clave
+        self.assertEqual(Pedido.objects.get().sesion_stripe_url, '')
+
+    @patch('home.views.enviar_email_contrareembolso')
+    def test_contrareembolso_reenvio_no_duplica_pedido_ni_stock(self, enviar):
+        clave = self._presupuestar().context['clave_idempotencia']
+        Producto.objects.filter(pk=self.producto.pk).update(stock=10)
+        self.client.post(reverse('checkout_contrareembolso'), {'clave_idempotencia': clave})
+        response = self.client.post(reverse('checkout_contrareembolso'), {'clave_idempotencia': clave})
+
+        pedido = Pedido.objects.get()
+        self.assertEqual(response.context['pedido'], pedido)
+        self.assertEqual(pedido.items.count(), 1)
+        self.producto.refresh_from_db()
+        self.assertEqual(self.producto.stock, 9)
+        self.assertEqual(enviar.call_count, 1)
+
+    @patch('home.views.enviar_email_contrareembolso')
+    def test_contrareembolso_envio_simultaneo_devuelve_el_primero(self, _):
+        """La otra petición gana la carrera: el índice único impide el segundo pedido."""
+        clave = self._presupuestar().context['clave_idempotencia']
+        Producto.objects.filter(pk=self.producto.pk).update(stock=10)
+        primero = Pedido.objects.create(
+            cliente=self.cliente, numero_pedido="MP-PRIMERO", metodo_pago="contrareembolso",
+            clave_idempotencia=clave,
+        )
+        with patch('home.views._pedido_reenviado', side_effect=[None, primero]):
+            response = self.client.post(reverse('checkout_contrareembolso'), {'clave_idempotencia': clave})
+        self.assertEqual(response.context['pedido'], primero)
+        self.assertEqual(Pedido.objects.count(), 1)
+        self.producto.refresh_from_db()
+        self.assertEqual(self.producto.stock, 10)
+
 
 @override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
 class SeguimientoPedidoViewTest(TestCase):
@@ -806,6 +1593,7 @@ class SeguimientoPedidoViewTest(TestCase):
             numero_pedido="MP-20240101120000-ABCD",
             estado=Pedido.Estados.PAGADO
         )
+        cache.clear()
 
     def test_seguimiento_pedido_get(self):
         """Test que la vista de seguimiento se muestra correctamente."""
@@ -821,7 +1609,7 @@ class SeguimientoPedidoViewTest(TestCase):
         )
         self.assertEqual(response.status_code, 200)
         self.assertIsNotNone(response.context['pedido'])
-        self.assertEqual(response.context['pedido'], self.pedido)
+        self.assertEqual(response.context['pedido']['numero_pedido'], self.pedido.numero_pedido)
 
     def test_seguimiento_pedido_no_encontrado(self):
         """Test que se muestra error si el pedido no existe."""
@@ -844,6 +1632,152 @@ class SeguimientoPedidoViewTest(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIsNotNone(response.context['pedido'])
 
+    def test_seguimiento_por_enlace_get(self):
+        response = self.client.get(reverse('tracking_pedido', args=['mp-20240101120000-abcd']))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['pedido']['numero_pedido'], self.pedido.numero_pedido)
+        self.assertContains(response, reverse('tracking_pedido', args=['MP-20240101120000-ABCD']))
+
+    def test_seguimiento_usa_la_clave_indexada(self):
+        self.assertEqual(self.pedido.clave_seguimiento, "MP-20240101120000-ABCD")
+        with CaptureQueriesContext(connection) as consultas:
+            seguimiento.buscar(" mp-20240101120000-abcd ")
+        sql = consultas.captured_queries[0]['sql']
+        self.assertIn('"clave_seguimiento" =', sql)
+        self.assertNotIn('LIKE', sql)
+        self.assertNotIn('UPPER(', sql)
+
+    def test_seguimiento_en_cache_hasta_cambiar_el_estado(self):
+        url = reverse('tracking_pedido', args=['MP-20240101120000-ABCD'])
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            self.client.get(url)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.pedido.cambiar_estado(Pedido.Estados.EN_PROCESO)
+        response = self.client.get(url)
+        self.assertEqual(response.context['pedido']['estado'], Pedido.Estados.EN_PROCESO)
+
+    def test_seguimiento_guarda_en_cache_solo_lo_que_se_muestra(self):
+        self.client.get(reverse('tracking_pedido', args=['MP-20240101120000-ABCD']))
+        guardado = cache.get(seguimiento._clave_cache('MP-20240101120000-ABCD'))
+        self.assertIsInstance(guardado, dict)
+        self.assertEqual(guardado['cliente'], str(self.cliente))
+        self.assertNotIn(self.cliente.email, repr(guardado))
+        self.assertTrue(all(isinstance(item, dict) for item in guardado['items']))
+
+    def test_seguimiento_no_encontrado_tambien_en_cache(self):
+        url = reverse('tracking_pedido', args=['MP-NOEXISTE'])
+        self.client.get(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            Pedido.objects.create(cliente=self.cliente, numero_pedido="MP-noexiste")
+        self.assertIsNotNone(self.client.get(url).context['pedido'])
+
+    @override_settings(SEGUIMIENTO_CONSULTAS_POR_MINUTO=3)
+    def test_seguimiento_limitado_por_ip(self):
+        url = reverse('tracking_pedido', args=['MP-20240101120000-ABCD'])
+        for _ in range(3):
+            self.assertEqual(self.client.get(url).status_code, 200)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 429)
+        self.assertIsNone(response.context['pedido'])
+        # El formulario vacío no cuenta
+        self.assertEqual(self.client.get(reverse('tracking')).status_code, 200)
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class MisPedidosViewTest(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        imagen_marca = SimpleUploadedFile(
+            name="marca.jpg",
+            content=b"fake image content",
+            content_type="image/jpeg"
+        )
+        self.marca = Marca.objects.create(nombre="Royal Canin", imagen=imagen_marca)
+        self.producto = Producto.objects.create(
+            nombre="Pienso", precio=Decimal("10.00"), marca=self.marca, esta_disponible=True
+        )
+        self.user = User.objects.create_user(
+            username="test@example.com", email="test@example.com", password="testpass123"
+        )
+        self.cliente = Cliente.objects.create(nombre="Test", email="test@example.com", user=self.user)
+        self.ahora = timezone.now()
+
+    def _pedidos(self, cuantos, cliente=None, fecha=None):
+        pedidos = []
+        for _ in range(cuantos):
+            pedido = Pedido.objects.create(
+                cliente=cliente or self.cliente,
+                numero_pedido=f"MP-HIST-{Pedido.objects.count() + 1}",
+                fecha_creacion=fecha or self.ahora - datetime.timedelta(minutes=Pedido.objects.count()),
+            )
+            ItemPedido.objects.create(pedido=pedido, producto=self.producto, cantidad=2)
+            ItemPedido.objects.create(pedido=pedido, producto=self.producto, talla="M", cantidad=1)
+            pedidos.append(pedido)
+        return pedidos
+
+    def test_requiere_login(self):
+        response = self.client.get(reverse('mis_pedidos'))
+        self.assertRedirects(response, f"{reverse('login')}?next={reverse('mis_pedidos')}",
+                             fetch_redirect_response=False)
+
+    def test_lista_solo_los_pedidos_del_cliente(self):
+        propios = self._pedidos(3)
+        otro = Cliente.objects.create(nombre="Otro", email="otro@example.com")
+        self._pedidos(2, cliente=otro)
+        self.client.login(username='test@example.com', password='testpass123')
+
+        response = self.client.get(reverse('mis_pedidos'))
+        pedidos = response.context['pedidos']
+        self.assertEqual([p.pk for p in pedidos], [p.pk for p in propios])
+        self.assertEqual(pedidos[0].num_articulos, 3)
+        self.assertIsNone(response.context['siguiente'])
+
+    def test_muestra_el_nombre_del_producto_al_comprarlo(self):
+        self._pedidos(1)
+        Producto.objects.filter(pk=self.producto.pk).update(nombre="Pienso renovado")
+        self.client.login(username='test@example.com', password='testpass123')
+        response = self.client.get(reverse('mis_pedidos'))
+        self.assertContains(response, "Pienso — 2 ud.")
+        self.assertNotContains(response, "Pienso renovado")
+
+    def test_paginacion_por_cursor_sin_huecos_ni_repetidos(self):
+        # 45 pedidos, 10 de ellos con la misma fecha exacta (desempate por id)
+        esperados = self._pedidos(35) + self._pedidos(10, fecha=self.ahora - datetime.timedelta(days=1))
+        esperados.sort(key=lambda p: (p.fecha_creacion, p.pk), reverse=True)
+        self.client.login(username='test@example.com', password='testpass123')
+
+        vistos, tamanos, url = [], [], reverse('mis_pedidos')
+        while url:
+            response = self.client.get(url)
+            pagina = response.context['pedidos']
+            tamanos.append(len(pagina))
+            vistos.extend(p.pk for p in pagina)
+            siguiente = response.context['siguiente']
+            url = f"{reverse('mis_pedidos')}?antes={siguiente}" if siguiente else None
+        self.assertEqual(tamanos, [20, 20, 5])
+        self.assertEqual(vistos, [p.pk for p in esperados])
+
+    def test_consultas_constantes(self):
+        self._pedidos(25)
+        self.client.login(username='test@example.com', password='testpass123')
+        # sesión, usuario con su cliente, pedidos con sus artículos, líneas y el carrito de la cabecera
+        with self.assertNumQueries(6):
+            response = self.client.get(reverse('mis_pedidos'))
+        with self.assertNumQueries(6):
+            self.client.get(f"{reverse('mis_pedidos')}?antes={response.context['siguiente']}")
+
+    def test_cursor_invalido_muestra_la_primera_pagina(self):
+        self._pedidos(2)
+        self.client.login(username='test@example.com', password='testpass123')
+        response = self.client.get(f"{reverse('mis_pedidos')}?antes=basura")
+        self.assertEqual(len(response.context['pedidos']), 2)
+
 
 @override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
 class PagoViewsTest(TestCase):
@@ -898,6 +1832,44 @@ class PagoViewsTest(TestCase):
         
         session = self.client.session
         self.assertEqual(session.get('cart', {}), {})
+        self.assertEqual(carrito_de(self.client), {})
+
+    def test_pago_ok_descuenta_stock_una_vez(self):
+        """Test que recargar pago_ok no vuelve a restar stock."""
+        self.producto.stock = 10
+        self.producto.save()
+        ItemPedido.objects.create(pedido=self.pedido, producto=self.producto, cantidad=2)
+
+        self.client.get(reverse('pago_ok', args=[self.pedido.id_pedido]))
+        self.client.get(reverse('pago_ok', args=[self.pedido.id_pedido]))
+
+        self.producto.refresh_from_db()
+        self.assertEqual(self.producto.stock, 8)
+        self.assertEqual(self.pedido.historial_estados.count(), 1)
+
+    def test_pago_ok_concurrente_no_falla(self):
+        """Test que si otra petición paga el pedido tras la comprobación no hay error 500."""
+        self.producto.stock = 10
+        self.producto.save()
+        ItemPedido.objects.create(pedido=self.pedido, producto=self.producto, cantidad=2)
+        # La vista ve el pedido aún pendiente, pero en la base de datos ya está pagado
+        desfasado = Pedido.objects.get(pk=self.pedido.pk)
+        self.client.get(reverse('pago_ok', args=[self.pedido.id_pedido]))
+
+        with patch('home.views.get_object_or_404', return_value=desfasado):
+            response = self.client.get(reverse('pago_ok', args=[self.pedido.id_pedido]))
+
+        self.assertEqual(response.status_code, 200)
+        self.producto.refresh_from_db()
+        self.assertEqual(self.producto.stock, 8)
+        self.assertEqual(self.pedido.historial_estados.count(), 1)
+
+    def test_pago_cancelado_no_cancela_pedido_pagado(self):
+        """Test que pago_cancelado no cancela un pedido ya pagado."""
+        self.pedido.cambiar_estado(Pedido.Estados.PAGADO)
+        self.client.get(reverse('pago_cancelado', args=[self.pedido.id_pedido]))
+        self.pedido.refresh_from_db()
+        self.assertEqual(self.pedido.estado, Pedido.Estados.PAGADO)
 
     def test_pago_cancelado_cambia_estado(self):
         """Test que pago_cancelado cambia el estado a CANCELADO."""
@@ -923,3 +1895,510 @@ class AcercaDeViewTest(TestCase):
         response = self.client.get(reverse('acerca_de'))
         self.assertEqual(response.status_code, 200)
 
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class AdminStockBajoViewTest(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.client = Client()
+        imagen_marca = SimpleUploadedFile(
+            name="marca.jpg",
+            content=b"fake image content",
+            content_type="image/jpeg"
+        )
+        self.marca = Marca.objects.create(
+            nombre="Royal Canin",
+            imagen=imagen_marca
+        )
+        self.producto = Producto.objects.create(
+            nombre="Arnés",
+            precio=Decimal("25.00"),
+            marca=self.marca,
+            stock=0,
+        )
+        TallaProducto.objects.create(producto=self.producto, talla="S", stock=2)
+        TallaProducto.objects.create(producto=self.producto, talla="L", stock=30)
+        self.user = User.objects.create_user(
+            username="admin@example.com",
+            email="admin@example.com",
+            password="adminpass123"
+        )
+        Cliente.objects.create(
+            nombre="Admin",
+            email="admin@example.com",
+            user=self.user,
+            es_admin=True,
+        )
+        self.client.login(username='admin@example.com', password='adminpass123')
+
+    def test_stock_bajo_lista_tallas(self):
+        """Test que el listado de reposición muestra las tallas bajo umbral."""
+        response = self.client.get(reverse('admin_panel:stock_bajo'))
+        self.assertEqual(response.status_code, 200)
+        alertas = list(response.context['alertas'])
+        self.assertEqual(len(alertas), 1)
+        self.assertEqual(alertas[0].talla.talla, "S")
+
+    def test_dashboard_usa_alertas(self):
+        """Test que el dashboard muestra las alertas por talla."""
+        response = self.client.get(reverse('admin_panel:dashboard'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['total_alertas_stock'], 1)
+        self.assertContains(response, "Arnés")
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class AdminPedidoDetalleViewTest(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(
+            username="admin@example.com",
+            email="admin@example.com",
+            password="adminpass123"
+        )
+        Cliente.objects.create(
+            nombre="Admin",
+            email="admin@example.com",
+            user=self.user,
+            es_admin=True,
+        )
+        self.pedido = Pedido.objects.create(numero_pedido="MP-ADMIN-0001")
+        self.client.login(username='admin@example.com', password='adminpass123')
+        self.url = reverse('admin_panel:pedido_detalle', args=[self.pedido.id_pedido])
+
+    def test_transicion_valida(self):
+        """Test que el admin puede avanzar el pedido al siguiente estado."""
+        response = self.client.post(self.url, {'estado': 'pagado'})
+        self.assertEqual(response.status_code, 302)
+        self.pedido.refresh_from_db()
+        self.assertEqual(self.pedido.estado, Pedido.Estados.PAGADO)
+        cambio = self.pedido.historial_estados.get()
+        self.assertEqual(cambio.usuario, self.user)
+
+    def test_transicion_invalida(self):
+        """Test que no se puede saltar de pendiente a entregado."""
+        response = self.client.post(self.url, {'estado': 'entregado'})
+        self.assertEqual(response.status_code, 302)
+        self.pedido.refresh_from_db()
+        self.assertEqual(self.pedido.estado, Pedido.Estados.PENDIENTE)
+        messages = list(get_messages(response.wsgi_request))
+        self.assertTrue(any('No se puede pasar' in str(m) for m in messages))
+
+    def test_detalle_muestra_historial(self):
+        """Test que el detalle incluye el historial de estados."""
+        self.pedido.cambiar_estado(Pedido.Estados.PAGADO, usuario=self.user)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['historial']), 1)
+        self.assertIn('en_proceso', response.context['estados_siguientes'])
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class PeticionesCondicionalesTest(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.client = Client()
+        imagen = SimpleUploadedFile(
+            name="marca.jpg",
+            content=b"fake image content",
+            content_type="image/jpeg"
+        )
+        self.marca = Marca.objects.create(nombre="Royal Canin", imagen=imagen)
+        self.categoria = Categoria.objects.create(nombre="Juguetes", imagen=imagen)
+        self.producto = Producto.objects.create(
+            nombre="Pelota",
+            precio=Decimal("10.00"),
+            precio_oferta=Decimal("8.00"),
+            marca=self.marca,
+            categoria=self.categoria,
+            stock=10,
+        )
+        self.talla = TallaProducto.objects.create(producto=self.producto, talla="M", stock=4)
+        self.url = reverse('product_detail', args=[self.producto.id])
+
+    def _revalidar(self, url):
+        primera = self.client.get(url)
+        self.assertEqual(primera.status_code, 200)
+        return self.client.get(url, HTTP_IF_NONE_MATCH=primera['ETag'])
+
+    def test_cabeceras(self):
+        response = self.client.get(self.url)
+        self.assertIn('ETag', response)
+        self.assertNotIn('Last-Modified', response)
+        self.assertIn('private', response['Cache-Control'])
+        self.assertIn('no-cache', response['Cache-Control'])
+        self.assertIn('Cookie', response['Vary'])
+
+    def test_producto_sin_cambios_devuelve_304(self):
+        primera = self.client.get(self.url)
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=primera['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_cambio_de_talla_invalida(self):
+        primera = self.client.get(self.url)
+        self.talla.stock = 1
+        self.talla.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=primera['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+    def test_cambio_de_marca_invalida(self):
+        primera = self.client.get(self.url)
+        self.marca.nombre = "Otra marca"
+        self.marca.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=primera['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+    def test_carrito_forma_parte_del_etag(self):
+        primera = self.client.get(self.url)
+        session = self.client.session
+        session['cart'] = {f"{self.producto.id}:M": 1}
+        session.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=primera['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], primera['ETag'])
+
+    def test_usuario_forma_parte_del_etag(self):
+        primera = self.client.get(self.url)
+        user = User.objects.create_user(username="u@example.com", password="pass12345")
+        self.client.force_login(user)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=primera['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+    def test_ofertas_y_categoria(self):
+        for url in (reverse('ofertas'), reverse('categoria_detail', args=[self.categoria.id])):
+            self.assertEqual(self._revalidar(url).status_code, 304)
+
+        primera = self.client.get(reverse('ofertas'))
+        self.producto.precio_oferta = Decimal("7.00")
+        self.producto.save()
+        response = self.client.get(reverse('ofertas'), HTTP_IF_NONE_MATCH=primera['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+    def test_borrar_producto_invalida_listados(self):
+        otro = Producto.objects.create(nombre="Viejo", precio=Decimal("5.00"), marca=self.marca)
+        # que el borrado no coincida en el tiempo con la última modificación
+        Producto.objects.filter(pk=otro.pk).update(
+            fecha_actualizacion=timezone.now() - datetime.timedelta(days=1)
+        )
+        Marca.objects.filter(pk=self.marca.pk).update(
+            fecha_actualizacion=timezone.now() - datetime.timedelta(days=1)
+        )
+        primera = self.client.get(reverse('ofertas'))
+        otro.delete()
+        response = self.client.get(reverse('ofertas'), HTTP_IF_NONE_MATCH=primera['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+    def test_categorias(self):
+        self.assertEqual(self._revalidar(reverse('categorias')).status_code, 304)
+        primera = self.client.get(reverse('categorias'))
+        Categoria.objects.create(
+            nombre="Camas",
+            imagen=SimpleUploadedFile(name="c.jpg", content=b"x", content_type="image/jpeg"),
+        )
+        response = self.client.get(reverse('categorias'), HTTP_IF_NONE_MATCH=primera['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+
+
+class ClienteMiddlewareTest(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = User.objects.create_user(
+            username="test@example.com", email="test@example.com", password="testpass123"
+        )
+        self.cliente = Cliente.objects.create(nombre="Test", email="test@example.com", user=self.user)
+        self.invitado = Cliente.objects.create(nombre="Invitado", email="invitado@example.com")
+
+    def _peticion(self, user=None, sesion=None):
+        request = self.factory.get('/')
+        request.user = user or AnonymousUser()
+        request.session = sesion or {}
+        return ClienteMiddleware(lambda r: r)(request)
+
+    def test_usuario_llega_con_su_cliente(self):
+        with self.assertNumQueries(1):
+            user = ClienteBackend().get_user(self.user.pk)
+            request = self._peticion(user)
+            self.assertEqual(request.cliente, self.cliente)
+            self.assertEqual(request.cliente.email, "test@example.com")
+
+    def test_invitado_desde_la_sesion(self):
+        request = self._peticion(sesion={'guest_cliente_id': self.invitado.pk})
+        with self.assertNumQueries(1):
+            self.assertEqual(request.cliente, self.invitado)
+            self.assertEqual(request.cliente.nombre, "Invitado")
+
+    def test_sesion_de_invitado_no_da_acceso_a_una_cuenta(self):
+        request = self._peticion(sesion={'guest_cliente_id': self.cliente.pk})
+        self.assertFalse(request.cliente)
+
+    def test_no_consulta_si_no_se_usa(self):
+        with self.assertNumQueries(0):
+            self._peticion(sesion={'guest_cliente_id': self.invitado.pk})
+
+    def test_admin_required_sin_consulta_extra(self):
+        self.cliente.es_admin = True
+        self.cliente.save()
+        self.client.login(username='test@example.com', password='testpass123')
+        with CaptureQueriesContext(connection) as consultas:
+            response = self.client.get(reverse('admin_panel:dashboard'))
+        self.assertEqual(response.status_code, 200)
+        # El cliente llega en la consulta del usuario, no en otra aparte
+        self.assertFalse([
+            q['sql'] for q in consultas.captured_queries
+            if 'WHERE "home_cliente"."user_id"' in q['sql']
+        ])
+
+    def test_login_nuevo_usa_cliente_backend(self):
+        self.client.login(username='test@example.com', password='testpass123')
+        self.assertEqual(self.client.session[BACKEND_SESSION_KEY], 'home.backends.ClienteBackend')
+
+    def test_sesion_anterior_con_model_backend_sigue_valida(self):
+        self.client.force_login(self.user, backend='django.contrib.auth.backends.ModelBackend')
+        response = self.client.get(reverse('mis_pedidos'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['user'], self.user)
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT, LIMITES_PETICIONES={
+    "add_to_cart": {"por_ip": "10/m", "por_sesion": "2/m", "metodos": ["POST"]},
+    "cart_status": {"por_ip": "3/m"},
+    "contacto": {"por_ip": "1/h", "metodos": ["POST"]},
+    "login": {"por_ip": "2/m", "metodos": ["POST"]},
+    "cart_batch": {"por_ip": "6/m", "metodos": ["POST"], "por_operacion": True},
+    "cart_update": {"por_ip": "1/m", "metodos": ["POST"]},
+})
+class LimitePeticionesTest(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.marca = Marca.objects.create(
+            nombre="Royal Canin",
+            imagen=SimpleUploadedFile(name="marca.jpg", content=b"x", content_type="image/jpeg"),
+        )
+        self.producto = Producto.objects.create(
+            nombre="Producto Test", precio=Decimal("10.00"), marca=self.marca, esta_disponible=True, stock=50
+        )
+
+    def test_add_to_cart_por_sesion(self):
+        url = reverse('add_to_cart', args=[self.producto.id])
+        # La primera aún no tiene sesión: solo cuenta para la IP
+        for _ in range(3):
+            self.assertEqual(self.client.post(url).status_code, 302)
+        response = self.client.post(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 429)
+        self.assertGreaterEqual(int(response['Retry-After']), 1)
+        self.assertFalse(response.json()['success'])
+        self.assertEqual(carrito_de(self.client), {f"{self.producto.id}:": 3})
+        # Otra sesión desde la misma IP todavía puede
+        self.assertEqual(Client().post(url).status_code, 302)
+
+    def test_solo_cuentan_los_metodos_configurados(self):
+        for _ in range(5):
+            self.client.get(reverse('login'))
+        self.client.post(reverse('login'), {'username': 'a@example.com', 'password': 'x'})
+        self.client.post(reverse('login'), {'username': 'a@example.com', 'password': 'x'})
+        response = self.client.post(reverse('login'), {'username': 'a@example.com', 'password': 'x'})
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+
+    def test_cart_status_por_ip(self):
+        for _ in range(3):
+            self.assertEqual(self.client.get(reverse('cart_status')).status_code, 200)
+        self.assertEqual(Client().get(reverse('cart_status')).status_code, 429)
+
+    def test_contacto_no_envia_emails_al_pasarse(self):
+        datos = {'nombre': 'Juan', 'email': 'juan@example.com', 'mensaje': 'Hola'}
+        self.client.post(reverse('contacto'), datos)
+        response = self.client.post(reverse('contacto'), datos)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(MensajeContacto.objects.count(), 1)
+        # Una hora por mensaje
+        self.assertGreater(int(response['Retry-After']), 3000)
+
+    def _batch(self, cantidad):
+        operaciones = [{'op': 'add', 'product_id': self.producto.id}] * cantidad
+        return self.client.post(
+            reverse('cart_batch'),
+            data=json.dumps({'operaciones': operaciones}),
+            content_type='application/json',
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+        )
+
+    def test_cart_batch_gasta_un_token_por_operacion(self):
+        self.assertEqual(self._batch(4).status_code, 200)
+        # Quedan 2 tokens: un lote de 3 no cabe aunque sea una sola petición
+        response = self._batch(3)
+        self.assertEqual(response.status_code, 429)
+        self.assertGreaterEqual(int(response['Retry-After']), 1)
+        self.assertEqual(carrito_de(self.client), {f"{self.producto.id}:": 4})
+        self.assertEqual(self._batch(2).status_code, 200)
+        self.assertEqual(self._batch(1).status_code, 429)
+
+    def test_cart_update_limitado(self):
+        datos = {'product_id': self.producto.id, 'quantity': 2}
+        self.assertEqual(self.client.post(reverse('cart_update'), datos).status_code, 302)
+        self.assertEqual(self.client.post(reverse('cart_update'), datos).status_code, 429)
+
+    def test_urls_sin_limite(self):
+        for _ in range(5):
+            self.assertEqual(self.client.get(reverse('home')).status_code, 200)
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT, TIEMPOS_MUESTREO=1)
+class TiemposPeticionTest(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.client = Client()
+        self.marca = Marca.objects.create(
+            nombre="Royal Canin",
+            imagen=SimpleUploadedFile(name="marca.jpg", content=b"x", content_type="image/jpeg"),
+        )
+        Producto.objects.create(nombre="Pienso", precio=Decimal("10.00"), marca=self.marca, esta_disponible=True)
+        self.staff = User.objects.create_user(username='staff', password='x', is_staff=True)
+        self.client.force_login(self.staff)
+
+    def _entradas(self, response):
+        return {e.split(';')[0].strip(): e for e in response['Server-Timing'].split(',')}
+
+    def test_server_timing_y_log_por_url(self):
+        with self.assertLogs('home.tiempos', level='INFO') as logs:
+            with CaptureQueriesContext(connection) as consultas:
+                response = self.client.get(reverse('productos'))
+        entradas = self._entradas(response)
+        self.assertEqual(set(entradas), {'db', 'plantillas', 'total'})
+        self.assertIn(f'desc="{len(consultas.captured_queries)} consultas"', entradas['db'])
+        registro = json.loads(logs.records[0].getMessage())
+        self.assertEqual(registro['url'], 'productos')
+        self.assertEqual(registro['metodo'], 'GET')
+        self.assertEqual(registro['estado'], 200)
+        self.assertEqual(registro['db_consultas'], len(consultas.captured_queries))
+        self.assertGreaterEqual(registro['total_ms'], registro['plantillas_ms'])
+
+    @override_settings(SENDGRID_API_KEY='clave', EMAIL_FROM='tienda@example.com')
+    def test_tiempo_de_servicios_externos(self):
+        class Respuesta:
+            status_code = 202
+
+        def lenta(*args, **kwargs):
+            time.sleep(0.01)
+            return Respuesta()
+
+        with patch.object(integraciones.ServicioHTTP, '_peticion', lenta), self.assertLogs('home.tiempos', level='INFO'):
+            response = self.client.post(
+                reverse('contacto'), {'nombre': 'Juan', 'email': 'juan@example.com', 'mensaje': 'Hola'}
+            )
+        duracion = float(self._entradas(response)['sendgrid'].split('dur=')[1])
+        # Dos emails de 10 ms cada uno
+        self.assertGreaterEqual(duracion, 20)
+
+    def test_sin_server_timing_para_clientes(self):
+        self.client.logout()
+        with self.assertLogs('home.tiempos', level='INFO') as logs:
+            response = self.client.get(reverse('productos'))
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(json.loads(logs.records[0].getMessage())['url'], 'productos')
+
+        with override_settings(DEBUG=True), self.assertLogs('home.tiempos', level='INFO'):
+            self.assertIn('Server-Timing', self.client.get(reverse('productos')))
+
+    @override_settings(TIEMPOS_MUESTREO=0)
+    def test_sin_muestreo_no_se_mide(self):
+        response = self.client.get(reverse('productos'))
+        self.assertNotIn('Server-Timing', response)
+
+    def test_fuera_de_una_peticion_no_mide(self):
+        with tiempos.medir('plantillas'):
+            pass
+        self.assertIsNone(tiempos._actual.get())
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class MetricasViewTest(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        metricas.reiniciar()
+        self.addCleanup(metricas.reiniciar)
+        self.client = Client()
+        self.marca = Marca.objects.create(
+            nombre="Royal Canin",
+            imagen=SimpleUploadedFile(name="marca.jpg", content=b"x", content_type="image/jpeg"),
+        )
+        self.producto = Producto.objects.create(
+            nombre="Pienso", precio=Decimal("10.00"), marca=self.marca, esta_disponible=True, stock=1
+        )
+        self.cliente = Cliente.objects.create(nombre="Test", email="test@example.com")
+
+    def _metricas(self):
+        response = self.client.get(reverse('metricas'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        return response.content.decode()
+
+    def test_latencia_por_url(self):
+        self.client.get(reverse('productos'))
+        self.client.get('/no-existe/')
+        texto = self._metricas()
+        self.assertIn('tienda_peticion_segundos_count{url="productos",metodo="GET"} 1', texto)
+        self.assertIn('tienda_peticion_segundos_count{url="sin_url",metodo="GET"} 1', texto)
+
+    def test_operaciones_del_carrito(self):
+        self.client.post(reverse('add_to_cart', args=[self.producto.id]))
+        self.client.post(
+            reverse('cart_batch'),
+            json.dumps({'operaciones': [{'op': 'add', 'product_id': self.producto.id, 'quantity': 5}]}),
+            content_type='application/json',
+        )
+        texto = self._metricas()
+        self.assertIn('tienda_carrito_operaciones_total{operacion="add",resultado="ok"} 1', texto)
+        self.assertIn('tienda_carrito_operaciones_total{operacion="add",resultado="error"} 1', texto)
+
+    def test_pago_y_stock_insuficiente(self):
+        pedido = Pedido.objects.create(
+            cliente=self.cliente, numero_pedido="MP-1", metodo_pago="stripe_test", estado=Pedido.Estados.PENDIENTE
+        )
+        ItemPedido.objects.create(pedido=pedido, producto=self.producto, cantidad=3)
+        self.client.get(reverse('pago_ok', args=[pedido.id_pedido]))
+        texto = self._metricas()
+        self.assertIn('tienda_checkouts_total{metodo_pago="stripe_test",resultado="pagado"} 1', texto)
+        self.assertIn('tienda_stock_descuento_fallos_total{motivo="stock_insuficiente"} 1', texto)
+
+    def test_revalidacion_etag(self):
+        primera = self.client.get(reverse('ofertas'))
+        self.client.get(reverse('ofertas'), HTTP_IF_NONE_MATCH=primera['ETag'])
+        self.assertIn('tienda_cache_consultas_total{cache="etag",resultado="acierto"} 1', self._metricas())
+
+    @override_settings(METRICAS_TOKEN='secreto')
+    def test_token(self):
+        self.assertEqual(self.client.get(reverse('metricas')).status_code, 403)
+        response = self.client.get(reverse('metricas'), HTTP_AUTHORIZATION='Bearer secreto')
+        self.assertEqual(response.status_code, 200)
@@ -1,12 +1,30 @@
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
 import tempfile
 import shutil
+import time
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from decimal import Decimal
-from django.test import TestCase, override_settings
+from django.db import IntegrityError, connection, transaction
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings, tag
+from django.test.utils import CaptureQueriesContext
 from django.core.exceptions import ValidationError
 from django.contrib.auth import get_user_model
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache
 from django.utils import timezone
 from django.core.files.uploadedfile import SimpleUploadedFile
 from datetime import timedelta
+from unittest import skipUnless
+from unittest.mock import patch
+
+import stripe
+from sendgrid.helpers.mail import Mail
 
 from .models import (
     Articulo,
@@ -22,6 +40,28 @@ from .models import (
     Carrito,
     ItemCarrito,
     MensajeContacto,
+    AlertaStock,
+    HistorialEstadoPedido,
+    CoocurrenciaProducto,
+    RecomendacionProducto,
+    RankingProducto,
+    Promocion,
+    SecuenciaPedido,
+)
+from . import (
+    catalogo,
+    integraciones,
+    limites,
+    metricas,
+    numeracion,
+    pedidos_caducados,
+    precios,
+    promociones,
+    rankings,
+    recomendaciones,
+    search_index,
+    seguimiento,
+    stock_alerts,
 )
 
 User = get_user_model()
@@ -30,6 +70,43 @@ User = get_user_model()
 TEMP_MEDIA_ROOT = tempfile.mkdtemp()
 
 
+class BaseDatosEnFichero:
+    """
+    Mixin para `TransactionTestCase` con varios hilos o procesos.
+
+    La base de datos de pruebas de SQLite está en memoria: entre hilos falla con
+    "table is locked" en lugar de esperar y a un proceso hijo no le llega.
+    Durante la clase se copia a un fichero temporal y las conexiones nuevas
+    van a él; el resto de pruebas siguen en memoria.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls._memoria = None
+        if connection.vendor != "sqlite" or not connection.is_in_memory_db():
+            return
+        descriptor, cls._fichero = tempfile.mkstemp(suffix=".sqlite3")
+        os.close(descriptor)
+        connection.ensure_connection()
+        destino = sqlite3.connect(cls._fichero)
+        connection.connection.backup(destino)
+        destino.close()
+        # La conexión en memoria se guarda abierta: si se cerrase se perdería la base de datos
+        cls._memoria, cls._nombre = connection.connection, connection.settings_dict["NAME"]
+        connection.connection = None
+        connection.settings_dict["NAME"] = cls._fichero
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls._memoria is not None:
+            connection.close()
+            connection.settings_dict["NAME"] = cls._nombre
+            connection.connection = cls._memoria
+            os.remove(cls._fichero)
+        super().tearDownClass()
+
+
 class ArticuloModelTest(TestCase):
     def test_crear_articulo(self):
         articulo = Articulo.objects.create(
@@ -512,6 +589,27 @@ class ClienteModelTest(TestCase):
                 email="juan@example.com"
             )
 
+    def test_email_se_guarda_normalizado(self):
+        cliente = Cliente.objects.create(nombre="Juan", email="  Juan@Example.COM ")
+        cliente.refresh_from_db()
+        self.assertEqual(cliente.email, "juan@example.com")
+
+    def test_email_unico_sin_distinguir_mayusculas(self):
+        Cliente.objects.create(nombre="Juan", email="juan@example.com")
+        # update() no pasa por save(): lo frena el índice único sobre LOWER(email)
+        otro = Cliente.objects.create(nombre="Pedro", email="pedro@example.com")
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Cliente.objects.filter(pk=otro.pk).update(email="JUAN@example.com")
+
+    def test_por_email_ignora_mayusculas_y_espacios(self):
+        cliente = Cliente.objects.create(nombre="Juan", email="juan@example.com")
+        self.assertEqual(list(Cliente.por_email(" JUAN@example.com")), [cliente])
+        self.assertFalse(Cliente.por_email("otro@example.com").exists())
+
+    def test_por_email_usa_el_indice(self):
+        plan = Cliente.por_email("juan@example.com").explain()
+        self.assertIn("cliente_email_lower_unico", plan)
+
 
 @override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
 class PedidoModelTest(TestCase):
@@ -1081,3 +1179,1335 @@ class MensajeContactoModelTest(TestCase):
         )
         self.assertIsNotNone(mensaje.fecha)
         self.assertLessEqual(mensaje.fecha, timezone.now())
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class AlertaStockTest(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        imagen_marca = SimpleUploadedFile(
+            name="marca.jpg",
+            content=b"fake image content",
+            content_type="image/jpeg"
+        )
+        self.marca = Marca.objects.create(
+            nombre="Royal Canin",
+            imagen=imagen_marca
+        )
+        self.producto = Producto.objects.create(
+            nombre="Pienso",
+            precio=Decimal("20.00"),
+            marca=self.marca,
+            stock=50,
+            umbral_stock_bajo=10,
+        )
+
+    def test_sin_alerta_con_stock_suficiente(self):
+        self.assertFalse(AlertaStock.objects.exists())
+
+    def test_alerta_al_bajar_stock(self):
+        self.producto.stock = 3
+        self.producto.save()
+        alerta = AlertaStock.objects.get(producto=self.producto)
+        self.assertIsNone(alerta.talla)
+        self.assertEqual(alerta.stock, 3)
+        self.assertEqual(alerta.umbral, 10)
+
+    def test_alerta_se_elimina_al_reponer(self):
+        self.producto.stock = 3
+        self.producto.save()
+        self.producto.stock = 30
+        self.producto.save()
+        self.assertFalse(AlertaStock.objects.filter(producto=self.producto).exists())
+
+    def test_alerta_se_actualiza_sin_duplicar(self):
+        self.producto.stock = 5
+        self.producto.save()
+        self.producto.stock = 2
+        self.producto.save()
+        self.assertEqual(AlertaStock.objects.filter(producto=self.producto).count(), 1)
+        self.assertEqual(AlertaStock.objects.get(producto=self.producto).stock, 2)
+
+    def test_producto_no_disponible_sin_alerta(self):
+        self.producto.stock = 1
+        self.producto.esta_disponible = False
+        self.producto.save()
+        self.assertFalse(AlertaStock.objects.exists())
+
+    def test_alerta_por_talla_ignora_stock_producto(self):
+        self.producto.stock = 0
+        self.producto.save()
+        self.assertTrue(AlertaStock.objects.filter(producto=self.producto, talla__isnull=True).exists())
+
+        talla_m = TallaProducto.objects.create(producto=self.producto, talla="M", stock=2)
+        TallaProducto.objects.create(producto=self.producto, talla="L", stock=40)
+
+        alertas = AlertaStock.objects.filter(producto=self.producto)
+        self.assertEqual(alertas.count(), 1)
+        self.assertEqual(alertas.get().talla, talla_m)
+
+    def test_umbral_propio_de_talla(self):
+        talla = TallaProducto.objects.create(
+            producto=self.producto, talla="S", stock=15, umbral_stock_bajo=20
+        )
+        self.assertEqual(talla.umbral_efectivo, 20)
+        alerta = AlertaStock.objects.get(talla=talla)
+        self.assertEqual(alerta.umbral, 20)
+
+    def test_talla_eliminada_reevalua_producto(self):
+        self.producto.stock = 1
+        self.producto.save()
+        talla = TallaProducto.objects.create(producto=self.producto, talla="M", stock=40)
+        self.assertFalse(AlertaStock.objects.exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            talla.delete()
+        self.assertTrue(AlertaStock.objects.filter(producto=self.producto, talla__isnull=True).exists())
+
+    def test_reconstruir_alertas(self):
+        talla = TallaProducto.objects.create(producto=self.producto, talla="M", stock=1)
+        AlertaStock.objects.all().delete()
+        total = stock_alerts.reconstruir_alertas()
+        self.assertEqual(total, 1)
+        self.assertTrue(AlertaStock.objects.filter(talla=talla).exists())
+
+    @patch("home.integraciones.enviar_email")
+    def test_resumen_marca_alertas_notificadas(self, enviar_email):
+        self.producto.stock = 1
+        self.producto.save()
+        enviadas = stock_alerts.enviar_resumen("admin@example.com")
+        self.assertEqual(enviadas, 1)
+        enviar_email.assert_called_once()
+        self.assertIsNotNone(AlertaStock.objects.get(producto=self.producto).fecha_notificacion)
+
+        # Un segundo resumen no vuelve a enviar las mismas alertas
+        self.assertEqual(stock_alerts.enviar_resumen("admin@example.com"), 0)
+        enviar_email.assert_called_once()
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class PedidoEstadosTest(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        imagen_marca = SimpleUploadedFile(
+            name="marca.jpg",
+            content=b"fake image content",
+            content_type="image/jpeg"
+        )
+        self.marca = Marca.objects.create(
+            nombre="Royal Canin",
+            imagen=imagen_marca
+        )
+        self.producto = Producto.objects.create(
+            nombre="Pienso",
+            precio=Decimal("10.00"),
+            marca=self.marca,
+            stock=20,
+        )
+        self.camiseta = Producto.objects.create(
+            nombre="Camiseta",
+            precio=Decimal("15.00"),
+            marca=self.marca,
+        )
+        self.talla = TallaProducto.objects.create(producto=self.camiseta, talla="M", stock=5)
+        self.pedido = Pedido.objects.create(numero_pedido="PED-EST-1")
+        ItemPedido.objects.create(pedido=self.pedido, producto=self.producto, cantidad=3)
+        ItemPedido.objects.create(pedido=self.pedido, producto=self.camiseta, talla="M", cantidad=2)
+
+    def test_transicion_valida_registra_historial(self):
+        self.pedido.cambiar_estado(Pedido.Estados.PAGADO, nota="ok")
+        self.pedido.refresh_from_db()
+        self.assertEqual(self.pedido.estado, Pedido.Estados.PAGADO)
+        cambio = HistorialEstadoPedido.objects.get(pedido=self.pedido)
+        self.assertEqual(cambio.estado_anterior, Pedido.Estados.PENDIENTE)
+        self.assertEqual(cambio.estado_nuevo, Pedido.Estados.PAGADO)
+        self.assertEqual(cambio.nota, "ok")
+
+    def test_transicion_invalida(self):
+        with self.assertRaises(ValidationError):
+            self.pedido.cambiar_estado(Pedido.Estados.ENVIADO)
+        self.pedido.refresh_from_db()
+        self.assertEqual(self.pedido.estado, Pedido.Estados.PENDIENTE)
+        self.assertFalse(HistorialEstadoPedido.objects.exists())
+
+    def test_estado_final_sin_transiciones(self):
+        self.pedido.cambiar_estado(Pedido.Estados.CANCELADO)
+        self.assertEqual(self.pedido.estados_siguientes(), [])
+        with self.assertRaises(ValidationError):
+            self.pedido.cambiar_estado(Pedido.Estados.PAGADO)
+
+    def test_cambio_estado_no_relee_items(self):
+        # savepoint + select_for_update + update de estado + historial + release
+        with self.assertNumQueries(5):
+            self.pedido.cambiar_estado(Pedido.Estados.PAGADO)
+
+    def test_descontar_stock_una_sola_vez(self):
+        self.pedido.descontar_stock()
+        self.pedido.descontar_stock()
+        self.producto.refresh_from_db()
+        self.talla.refresh_from_db()
+        self.assertEqual(self.producto.stock, 17)
+        self.assertEqual(self.talla.stock, 3)
+
+    def test_cancelar_repone_stock(self):
+        self.pedido.cambiar_estado(Pedido.Estados.PAGADO)
+        self.pedido.descontar_stock()
+        self.pedido.cambiar_estado(Pedido.Estados.CANCELADO)
+        self.producto.refresh_from_db()
+        self.talla.refresh_from_db()
+        self.pedido.refresh_from_db()
+        self.assertEqual(self.producto.stock, 20)
+        self.assertEqual(self.talla.stock, 5)
+        self.assertFalse(self.pedido.stock_descontado)
+
+    def test_cancelar_sin_stock_descontado_no_repone(self):
+        self.pedido.cambiar_estado(Pedido.Estados.CANCELADO)
+        self.producto.refresh_from_db()
+        self.assertEqual(self.producto.stock, 20)
+
+    def test_historial_solo_insercion(self):
+        self.pedido.cambiar_estado(Pedido.Estados.PAGADO)
+        cambio = HistorialEstadoPedido.objects.get(pedido=self.pedido)
+        cambio.nota = "editado"
+        with self.assertRaises(ValidationError):
+            cambio.save()
+        with self.assertRaises(ValidationError):
+            cambio.delete()
+
+    def test_totales_solo_si_cambian_las_lineas(self):
+        item = self.pedido.items.get(producto=self.producto)
+        # Guardar la línea sin cambios no toca el pedido
+        with self.assertNumQueries(1):
+            item.save()
+        item.cantidad = 5
+        item.save()
+        self.pedido.refresh_from_db()
+        self.assertEqual(self.pedido.subtotal, Decimal("80.00"))
+
+    def test_borrar_linea_recalcula_totales(self):
+        self.pedido.items.get(producto=self.camiseta).delete()
+        self.pedido.refresh_from_db()
+        self.assertEqual(self.pedido.subtotal, Decimal("30.00"))
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class RecomendacionesTest(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        imagen_marca = SimpleUploadedFile(
+            name="marca.jpg",
+            content=b"fake image content",
+            content_type="image/jpeg"
+        )
+        self.marca = Marca.objects.create(
+            nombre="Royal Canin",
+            imagen=imagen_marca
+        )
+        self.pienso, self.correa, self.cama, self.juguete = [
+            Producto.objects.create(nombre=nombre, precio=Decimal("10.00"), marca=self.marca, stock=100)
+            for nombre in ("Pienso", "Correa", "Cama", "Juguete")
+        ]
+        self.num_pedido = 0
+
+    def _pedido(self, *productos, confirmado=True):
+        self.num_pedido += 1
+        pedido = Pedido.objects.create(numero_pedido=f"REC-{self.num_pedido}")
+        for producto in productos:
+            ItemPedido.objects.create(pedido=pedido, producto=producto, cantidad=1)
+        if confirmado:
+            pedido.descontar_stock()
+        return pedido
+
+    def _recomendados(self, producto):
+        return list(
+            RecomendacionProducto.objects.filter(producto=producto).values_list("recomendado_id", flat=True)
+        )
+
+    def test_coocurrencias_y_orden(self):
+        self._pedido(self.pienso, self.correa)
+        self._pedido(self.pienso, self.correa)
+        self._pedido(self.pienso, self.cama)
+
+        self.assertEqual(recomendaciones.actualizar_recomendaciones(), 3)
+        self.assertEqual(
+            CoocurrenciaProducto.objects.get(producto=self.pienso, relacionado=self.correa).pedidos, 2
+        )
+        self.assertEqual(
+            CoocurrenciaProducto.objects.get(producto=self.pienso, relacionado=self.pienso).pedidos, 3
+        )
+        self.assertEqual(self._recomendados(self.pienso), [self.correa.id, self.cama.id])
+        self.assertEqual(self._recomendados(self.cama), [self.pienso.id])
+
+    def test_ignora_pedidos_sin_confirmar(self):
+        self._pedido(self.pienso, self.correa, confirmado=False)
+        self.assertEqual(recomendaciones.actualizar_recomendaciones(), 0)
+        self.assertFalse(RecomendacionProducto.objects.exists())
+
+    def test_actualizacion_incremental(self):
+        self._pedido(self.pienso, self.correa)
+        recomendaciones.actualizar_recomendaciones()
+        # Volver a ejecutar no cuenta dos veces los mismos pedidos
+        self.assertEqual(recomendaciones.actualizar_recomendaciones(), 0)
+
+        self._pedido(self.correa, self.juguete)
+        self._pedido(self.correa, self.juguete)
+        self.assertEqual(recomendaciones.actualizar_recomendaciones(tamano_lote=1), 2)
+        self.assertEqual(
+            CoocurrenciaProducto.objects.get(producto=self.correa, relacionado=self.pienso).pedidos, 1
+        )
+        self.assertEqual(self._recomendados(self.correa), [self.juguete.id, self.pienso.id])
+
+    def test_incremental_igual_a_reconstruir(self):
+        self._pedido(self.pienso, self.correa, self.cama)
+        recomendaciones.actualizar_recomendaciones()
+        self._pedido(self.cama, self.juguete)
+        self._pedido(self.cama, self.juguete, self.correa)
+        recomendaciones.actualizar_recomendaciones()
+
+        incremental = list(
+            RecomendacionProducto.objects.values_list("producto_id", "recomendado_id", "posicion")
+        )
+        recomendaciones.reconstruir_recomendaciones()
+        completo = list(
+            RecomendacionProducto.objects.values_list("producto_id", "recomendado_id", "posicion")
+        )
+        self.assertEqual(incremental, completo)
+
+    def test_resta_pedidos_cancelados_despues_de_contarlos(self):
+        self._pedido(self.pienso, self.correa)
+        cancelado = self._pedido(self.pienso, self.cama)
+        recomendaciones.actualizar_recomendaciones()
+        self.assertEqual(self._recomendados(self.pienso), [self.correa.id, self.cama.id])
+
+        cancelado.cambiar_estado(Pedido.Estados.PAGADO)
+        cancelado.cambiar_estado(Pedido.Estados.CANCELADO)
+        self.assertEqual(recomendaciones.actualizar_recomendaciones(), 0)
+
+        self.assertFalse(CoocurrenciaProducto.objects.filter(producto=self.pienso, relacionado=self.cama).exists())
+        self.assertEqual(
+            CoocurrenciaProducto.objects.get(producto=self.pienso, relacionado=self.pienso).pedidos, 1
+        )
+        self.assertEqual(self._recomendados(self.pienso), [self.correa.id])
+        self.assertEqual(self._recomendados(self.cama), [])
+        cancelado.refresh_from_db()
+        self.assertFalse(cancelado.en_recomendaciones)
+        # Una segunda pasada no lo resta otra vez
+        recomendaciones.actualizar_recomendaciones()
+        self.assertEqual(CoocurrenciaProducto.objects.get(producto=self.pienso, relacionado=self.pienso).pedidos, 1)
+
+    def test_cancelacion_incremental_igual_a_reconstruir(self):
+        self._pedido(self.pienso, self.correa, self.cama)
+        self._pedido(self.cama, self.juguete)
+        cancelado = self._pedido(self.correa, self.juguete, self.cama)
+        recomendaciones.actualizar_recomendaciones(k=2)
+        cancelado.cambiar_estado(Pedido.Estados.PAGADO)
+        cancelado.cambiar_estado(Pedido.Estados.CANCELADO)
+        recomendaciones.actualizar_recomendaciones(k=2)
+
+        incremental = sorted(
+            RecomendacionProducto.objects.values_list("producto_id", "recomendado_id", "posicion")
+        )
+        recomendaciones.reconstruir_recomendaciones(k=2)
+        completo = sorted(
+            RecomendacionProducto.objects.values_list("producto_id", "recomendado_id", "posicion")
+        )
+        self.assertEqual(incremental, completo)
+
+    def test_top_k(self):
+        self._pedido(self.pienso, self.correa, self.cama, self.juguete)
+        recomendaciones.actualizar_recomendaciones(k=2)
+        self.assertEqual(len(self._recomendados(self.pienso)), 2)
+
+    def test_lectura_en_una_consulta(self):
+        self._pedido(self.pienso, self.correa)
+        recomendaciones.actualizar_recomendaciones()
+        # recomendaciones + imágenes precargadas
+        with self.assertNumQueries(2):
+            self.assertEqual(recomendaciones.recomendaciones_para(self.pienso), [self.correa])
+
+    def test_no_recomienda_productos_no_disponibles(self):
+        self._pedido(self.pienso, self.correa)
+        recomendaciones.actualizar_recomendaciones()
+        self.correa.esta_disponible = False
+        self.correa.save()
+        self.assertEqual(recomendaciones.recomendaciones_para(self.pienso), [])
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class PedidosCaducadosTest(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        imagen_marca = SimpleUploadedFile(
+            name="marca.jpg",
+            content=b"fake image content",
+            content_type="image/jpeg"
+        )
+        self.marca = Marca.objects.create(
+            nombre="Royal Canin",
+            imagen=imagen_marca
+        )
+        self.producto = Producto.objects.create(
+            nombre="Pienso", precio=Decimal("10.00"), marca=self.marca, stock=20,
+        )
+        self.ahora = timezone.now()
+        self.num_pedido = 0
+        cache.clear()  # el seguimiento en caché sobrevive al rollback de cada prueba
+
+    def _pedido(self, horas, metodo_pago="stripe_test", estado=Pedido.Estados.PENDIENTE):
+        self.num_pedido += 1
+        pedido = Pedido.objects.create(
+            numero_pedido=f"CAD-{self.num_pedido}",
+            fecha_creacion=self.ahora - timedelta(hours=horas),
+            metodo_pago=metodo_pago,
+            estado=estado,
+        )
+        ItemPedido.objects.create(pedido=pedido, producto=self.producto, cantidad=2)
+        return pedido
+
+    def test_cancela_solo_pendientes_online_caducados(self):
+        viejos = [self._pedido(30) for _ in range(5)]
+        reciente = self._pedido(2)
+        contrareembolso = self._pedido(30, metodo_pago="contrareembolso")
+        pagado = self._pedido(30, estado=Pedido.Estados.PAGADO)
+
+        metricas = pedidos_caducados.cancelar_caducados(horas=25, tamano_lote=2, ahora=self.ahora)
+
+        self.assertEqual(metricas["pedidos"], 5)
+        self.assertEqual(metricas["lineas"], 5)
+        self.assertEqual(metricas["lotes"], 3)
+        self.assertIn("pedidos_por_segundo", metricas)
+        cancelados = set(
+            Pedido.objects.filter(estado=Pedido.Estados.CANCELADO).values_list("pk", flat=True)
+        )
+        self.assertEqual(cancelados, {p.pk for p in viejos})
+        for pedido in (reciente, contrareembolso):
+            pedido.refresh_from_db()
+            self.assertEqual(pedido.estado, Pedido.Estados.PENDIENTE)
+        pagado.refresh_from_db()
+        self.assertEqual(pagado.estado, Pedido.Estados.PAGADO)
+
+    def test_registra_historial_y_no_toca_stock(self):
+        pedido = self._pedido(30)
+        pedidos_caducados.cancelar_caducados(horas=25, ahora=self.ahora)
+
+        cambio = HistorialEstadoPedido.objects.get(pedido=pedido)
+        self.assertEqual(cambio.estado_anterior, Pedido.Estados.PENDIENTE)
+        self.assertEqual(cambio.estado_nuevo, Pedido.Estados.CANCELADO)
+        self.assertEqual(cambio.nota, pedidos_caducados.NOTA)
+        self.producto.refresh_from_db()
+        self.assertEqual(self.producto.stock, 20)
+
+    def test_invalida_el_seguimiento_en_cache(self):
+        pedido = self._pedido(30)
+        self.assertEqual(seguimiento.buscar("cad-1")["estado"], Pedido.Estados.PENDIENTE)
+        with self.captureOnCommitCallbacks(execute=True):
+            pedidos_caducados.cancelar_caducados(horas=25, ahora=self.ahora)
+        self.assertEqual(seguimiento.buscar(pedido.numero_pedido)["estado"], Pedido.Estados.CANCELADO)
+
+    def test_invalida_el_seguimiento_de_cada_lote_en_transaccion_exterior(self):
+        pedidos = [self._pedido(30) for _ in range(3)]
+        for pedido in pedidos:
+            seguimiento.buscar(pedido.numero_pedido)
+        # Los callbacks corren al confirmar la transacción exterior, tras el último lote
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                pedidos_caducados.cancelar_caducados(horas=25, tamano_lote=1, ahora=self.ahora)
+        for pedido in pedidos:
+            self.assertEqual(seguimiento.buscar(pedido.numero_pedido)["estado"], Pedido.Estados.CANCELADO)
+
+    def test_pago_confirmado_entretanto_no_se_cancela(self):
+        pendiente = self._pedido(30)
+        pagado = self._pedido(30)
+        seleccion = Pedido.objects.filter(pk__in=[pendiente.pk, pagado.pk])
+        # El lote se eligió con los dos pendientes; antes de cancelar se paga uno
+        Pedido.objects.filter(pk=pagado.pk).update(estado=Pedido.Estados.PAGADO)
+        with patch.object(pedidos_caducados, "_caducados", side_effect=[seleccion, Pedido.objects.none()]):
+            metricas = pedidos_caducados.cancelar_caducados(horas=25, ahora=self.ahora)
+
+        self.assertEqual(metricas["pedidos"], 1)
+        self.assertEqual(metricas["lineas"], 1)
+        pagado.refresh_from_db()
+        self.assertEqual(pagado.estado, Pedido.Estados.PAGADO)
+        self.assertFalse(HistorialEstadoPedido.objects.filter(pedido=pagado).exists())
+        self.assertEqual(HistorialEstadoPedido.objects.filter(pedido=pendiente).count(), 1)
+
+    def test_segunda_pasada_no_hace_nada(self):
+        self._pedido(30)
+        pedidos_caducados.cancelar_caducados(horas=25, ahora=self.ahora)
+        metricas = pedidos_caducados.cancelar_caducados(horas=25, ahora=self.ahora)
+        self.assertEqual(metricas["pedidos"], 0)
+        self.assertEqual(metricas["lotes"], 0)
+        self.assertEqual(HistorialEstadoPedido.objects.count(), 1)
+
+    def test_comando(self):
+        from django.core.management import call_command
+        from io import StringIO
+
+        self._pedido(30)
+        salida = StringIO()
+        with override_settings(PEDIDO_PENDIENTE_HORAS=25):
+            call_command("cancelar_pedidos_caducados", stdout=salida)
+        self.assertIn("Pedidos cancelados: 1", salida.getvalue())
+        self.assertIn("pedidos/s", salida.getvalue())
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class RankingsTest(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        imagen_marca = SimpleUploadedFile(
+            name="marca.jpg",
+            content=b"fake image content",
+            content_type="image/jpeg"
+        )
+        self.marca = Marca.objects.create(
+            nombre="Royal Canin",
+            imagen=imagen_marca
+        )
+        self.categoria = Categoria.objects.create(nombre="Juguetes", imagen=imagen_marca)
+        self.pelota = Producto.objects.create(
+            nombre="Pelota", precio=Decimal("5.00"), marca=self.marca, stock=100,
+            categoria=self.categoria,
+        )
+        self.rascador = Producto.objects.create(
+            nombre="Rascador", precio=Decimal("25.00"), marca=self.marca, stock=100,
+            genero=Producto.Especie.GATO, categoria=self.categoria,
+        )
+        self.correa = Producto.objects.create(
+            nombre="Correa", precio=Decimal("12.00"), marca=self.marca, stock=100,
+        )
+        self.ahora = timezone.now()
+        self.num_pedido = 0
+
+    def _ordenados(self, orden=catalogo.ORDEN_MAS_VENDIDOS, especie=None, categoria=None):
+        productos = Producto.objects.all()
+        if especie:
+            productos = productos.filter(genero=especie)
+        if categoria:
+            productos = productos.filter(categoria=categoria)
+        return list(catalogo.aplicar_orden(productos, orden, especie=especie, categoria=categoria))
+
+    def _venta(self, producto, cantidad, dias, confirmado=True):
+        self.num_pedido += 1
+        pedido = Pedido.objects.create(
+            numero_pedido=f"RANK-{self.num_pedido}",
+            fecha_creacion=self.ahora - timedelta(days=dias),
+        )
+        ItemPedido.objects.create(pedido=pedido, producto=producto, cantidad=cantidad)
+        if confirmado:
+            pedido.descontar_stock()
+
+    def test_mas_vendidos_y_tendencia(self):
+        # La pelota vendió mucho hace semanas; el rascador, menos pero hoy
+        self._venta(self.pelota, 20, dias=40)
+        self._venta(self.rascador, 5, dias=0)
+
+        self.assertEqual(rankings.calcular_rankings(self.ahora), 3)
+        pelota = RankingProducto.objects.get(producto=self.pelota)
+        rascador = RankingProducto.objects.get(producto=self.rascador)
+        self.assertEqual(pelota.unidades_vendidas, 20)
+        self.assertEqual(rascador.unidades_vendidas, 5)
+        self.assertGreater(rascador.tendencia, pelota.tendencia)
+        self.assertAlmostEqual(rascador.tendencia, 5.0)
+
+        self.assertEqual(self._ordenados(), [self.pelota, self.rascador, self.correa])
+        self.assertEqual(self._ordenados(catalogo.ORDEN_TENDENCIA)[0], self.rascador)
+
+    def test_ventana_y_pedidos_no_confirmados(self):
+        self._venta(self.pelota, 10, dias=rankings.VENTANA_DIAS + 1)
+        self._venta(self.correa, 3, dias=1, confirmado=False)
+        rankings.calcular_rankings(self.ahora)
+        self.assertEqual(RankingProducto.objects.get(producto=self.pelota).unidades_vendidas, 0)
+        self.assertEqual(RankingProducto.objects.get(producto=self.correa).unidades_vendidas, 0)
+        # Sin ventas desempata el producto más nuevo
+        self.assertEqual(self._ordenados(), [self.correa, self.rascador, self.pelota])
+
+    def test_ranking_por_especie_y_categoria(self):
+        self._venta(self.pelota, 2, dias=1)
+        self._venta(self.rascador, 1, dias=1)
+        self._venta(self.correa, 9, dias=1)
+        rankings.calcular_rankings(self.ahora)
+        self.assertEqual(self._ordenados(especie=Producto.Especie.GATO), [self.rascador])
+        self.assertEqual(self._ordenados(categoria=self.categoria), [self.pelota, self.rascador])
+
+    def test_recalcular_actualiza_filas(self):
+        self._venta(self.pelota, 2, dias=1)
+        rankings.calcular_rankings(self.ahora)
+        self._venta(self.pelota, 3, dias=0)
+        rankings.calcular_rankings(self.ahora)
+        self.assertEqual(RankingProducto.objects.count(), 3)
+        self.assertEqual(RankingProducto.objects.get(producto=self.pelota).unidades_vendidas, 5)
+
+    def test_producto_nuevo_entra_en_el_ranking(self):
+        self._venta(self.correa, 1, dias=1)
+        rankings.calcular_rankings(self.ahora)
+        nuevo = Producto.objects.create(nombre="Nuevo", precio=Decimal("1.00"), marca=self.marca)
+        ranking = RankingProducto.objects.get(producto=nuevo)
+        self.assertEqual((ranking.unidades_vendidas, ranking.tendencia), (0, 0))
+        self.assertEqual(self._ordenados(), [self.correa, nuevo, self.rascador, self.pelota])
+
+    def test_cambio_de_especie_y_categoria_llega_al_ranking(self):
+        self._venta(self.rascador, 4, dias=1)
+        rankings.calcular_rankings(self.ahora)
+        self.rascador.genero = Producto.Especie.PERRO
+        self.rascador.categoria = None
+        self.rascador.save()
+        ranking = RankingProducto.objects.get(producto=self.rascador)
+        self.assertEqual((ranking.genero, ranking.categoria_id), (Producto.Especie.PERRO, None))
+        self.assertEqual(ranking.unidades_vendidas, 4)
+        self.assertEqual(self._ordenados(especie=Producto.Especie.GATO), [])
+
+    def test_orden_por_popularidad_usa_el_indice_del_ranking(self):
+        productos = Producto.objects.filter(esta_disponible=True, genero=Producto.Especie.GATO)
+        plan = catalogo.aplicar_orden(
+            productos, catalogo.ORDEN_MAS_VENDIDOS, especie=Producto.Especie.GATO
+        )[:12].explain()
+        self.assertIn("ranking_especie_ventas_idx", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+        plan = catalogo.aplicar_orden(
+            Producto.objects.filter(categoria=self.categoria), catalogo.ORDEN_TENDENCIA,
+            categoria=self.categoria,
+        )[:12].explain()
+        self.assertIn("ranking_cat_tend_idx", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+
+class IndicePrefijosTest(TestCase):
+    def setUp(self):
+        self.indice = search_index.IndicePrefijos([
+            (search_index.TIPO_PRODUCTO, 1, "Pienso Royal Canin Mini Adulto"),
+            (search_index.TIPO_PRODUCTO, 2, "Comedero Acero"),
+            (search_index.TIPO_PRODUCTO, 3, "Camión de juguete"),
+            (search_index.TIPO_MARCA, 4, "Royal Canin"),
+            (search_index.TIPO_CATEGORIA, 5, "Camas"),
+        ])
+
+    def test_normalizar(self):
+        self.assertEqual(search_index.normalizar("  Camión   ÑANDÚ "), "camion nandu")
+
+    def test_prefijo_sin_acentos(self):
+        ids = [pk for _, pk, _ in self.indice.buscar("camio")]
+        self.assertEqual(ids, [3])
+
+    def test_prefijo_en_medio_del_nombre(self):
+        ids = [pk for _, pk, _ in self.indice.buscar("canin mi")]
+        self.assertEqual(ids, [1])
+
+    def test_orden_resultados(self):
+        # Lo que empieza por el texto va primero; a igualdad, categorías y marcas antes que productos
+        ids = [pk for _, pk, _ in self.indice.buscar("royal")]
+        self.assertEqual(ids, [4, 1])
+        ids = [pk for _, pk, _ in self.indice.buscar("cam")]
+        self.assertEqual(ids, [5, 3])
+
+    def test_limite_y_vacio(self):
+        self.assertEqual(len(self.indice.buscar("c", limite=2)), 2)
+        self.assertEqual(self.indice.buscar("   "), [])
+        self.assertEqual(self.indice.buscar("zzz"), [])
+
+    def test_busqueda_rapida(self):
+        documentos = [
+            (search_index.TIPO_PRODUCTO, i, f"Producto {i} pienso cachorro")
+            for i in range(20000)
+        ]
+        indice = search_index.IndicePrefijos(documentos)
+        inicio = time.perf_counter()
+        for _ in range(200):
+            indice.buscar("pienso ca")
+        self.assertLess((time.perf_counter() - inicio) / 200, 0.001)
+
+    @override_settings(INDICES_COMPROBAR_VERSION=60)
+    def test_version_de_otro_worker_cada_intervalo(self):
+        estado = dict(search_index._indice.estado)
+        self.addCleanup(search_index._indice.estado.update, estado)
+        indice = search_index.precargar()
+        cache.incr(search_index.CLAVE_VERSION)  # invalidar() en otro worker
+        # Dentro del intervalo no se consulta la caché en cada búsqueda
+        with patch.object(cache, "get_or_set", wraps=cache.get_or_set) as consulta:
+            for _ in range(5):
+                self.assertIs(search_index.obtener_indice(), indice)
+        consulta.assert_not_called()
+        search_index._indice.estado["comprobado"] -= 60
+        self.assertIsNot(search_index.obtener_indice(), indice)
+
+    def test_una_reconstruccion_a_la_vez(self):
+        estado = dict(search_index._indice.estado)
+        self.addCleanup(search_index._indice.estado.update, estado)
+        anterior = search_index.IndicePrefijos([(search_index.TIPO_MARCA, 1, "Royal Canin")])
+        search_index._indice.estado.update(indice=anterior, version=search_index._indice.version_cache(),
+                                           construido=time.monotonic(), obsoleto=True)
+        construcciones = []
+        empezada = threading.Event()
+        seguir = threading.Event()
+
+        def cargar_lento():
+            construcciones.append(1)
+            empezada.set()
+            seguir.wait(5)
+            return [(search_index.TIPO_MARCA, 2, "Acana")]
+
+        resultados = []
+        with patch.object(search_index, "_cargar_documentos", cargar_lento):
+            hilo = threading.Thread(target=lambda: resultados.append(search_index.obtener_indice()))
+            hilo.start()
+            self.assertTrue(empezada.wait(5))
+            # Mientras se reconstruye, el resto de búsquedas usan el índice anterior
+            for _ in range(5):
+                self.assertIs(search_index.obtener_indice(), anterior)
+            seguir.set()
+            hilo.join(5)
+
+        self.assertEqual(len(construcciones), 1)
+        self.assertIsNot(resultados[0], anterior)
+        self.assertIs(search_index.obtener_indice(), resultados[0])
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class CatalogoPrecioTest(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        imagen_marca = SimpleUploadedFile(
+            name="marca.jpg",
+            content=b"fake image content",
+            content_type="image/jpeg"
+        )
+        self.marca = Marca.objects.create(
+            nombre="Royal Canin",
+            imagen=imagen_marca
+        )
+        self.barato = Producto.objects.create(nombre="Barato", precio=Decimal("8.00"), marca=self.marca)
+        # 40 € con oferta a 20 €: cuenta como 20 €
+        self.oferta = Producto.objects.create(
+            nombre="Oferta", precio=Decimal("40.00"), precio_oferta=Decimal("20.00"), marca=self.marca
+        )
+        self.caro = Producto.objects.create(nombre="Caro", precio=Decimal("150.00"), marca=self.marca)
+
+    def test_precio_efectivo(self):
+        self.oferta.refresh_from_db()
+        self.barato.refresh_from_db()
+        self.assertEqual(self.oferta.precio_efectivo, Decimal("20.00"))
+        self.assertEqual(self.barato.precio_efectivo, Decimal("8.00"))
+
+    def test_precio_efectivo_se_actualiza(self):
+        self.oferta.precio_oferta = None
+        self.oferta.save()
+        self.oferta.refresh_from_db()
+        self.assertEqual(self.oferta.precio_efectivo, Decimal("40.00"))
+
+    def test_orden_por_precio(self):
+        asc = list(catalogo.aplicar_orden(Producto.objects.all(), catalogo.ORDEN_PRECIO_ASC))
+        desc = list(catalogo.aplicar_orden(Producto.objects.all(), catalogo.ORDEN_PRECIO_DESC))
+        self.assertEqual(asc, [self.barato, self.oferta, self.caro])
+        self.assertEqual(desc, [self.caro, self.oferta, self.barato])
+
+    def test_filtrar_precio(self):
+        productos = catalogo.filtrar_precio(Producto.objects.all(), Decimal("10"), Decimal("25"))
+        self.assertEqual(list(productos), [self.oferta])
+
+    def test_leer_rango_precio_ignora_valores_no_validos(self):
+        self.assertEqual(
+            catalogo.leer_rango_precio({"precio_min": "abc", "precio_max": "-3"}), (None, None)
+        )
+        self.assertEqual(
+            catalogo.leer_rango_precio({"precio_min": "5", "precio_max": "NaN"}), (Decimal("5"), None)
+        )
+
+    def test_histograma_una_consulta(self):
+        with self.assertNumQueries(1):
+            histograma = catalogo.histograma_precios(Producto.objects.all())
+        self.assertEqual(histograma["min"], Decimal("8.00"))
+        self.assertEqual(histograma["max"], Decimal("150.00"))
+        self.assertEqual([t["total"] for t in histograma["tramos"]], [1, 1, 0, 0, 1])
+        self.assertIsNone(histograma["tramos"][-1]["hasta"])
+
+
+def _linea(producto_id, cantidad, precio, categoria_id=None, marca_id=1, especie="perro"):
+    return promociones.LineaPromocion(
+        producto_id, categoria_id, marca_id, especie, cantidad, Decimal(precio)
+    )
+
+
+def _regla(id, tipo, valor="0", **kwargs):
+    kwargs.setdefault("codigo", "")
+    return promociones.Regla(id=id, nombre=f"Promo {id}", tipo=tipo, valor=Decimal(valor), **kwargs)
+
+
+class IndicePromocionesTest(TestCase):
+    def test_porcentaje_por_categoria(self):
+        indice = promociones.IndicePromociones([
+            _regla(1, promociones.PORCENTAJE, "20", categoria_id=7),
+        ])
+        resultado = indice.evaluar([
+            _linea(1, 2, "10.00", categoria_id=7),
+            _linea(2, 1, "50.00", categoria_id=8),
+        ])
+        self.assertEqual(resultado.descuento, Decimal("4.00"))
+        self.assertEqual(resultado.promocion, "Promo 1")
+
+    def test_lleva_3_paga_2_regala_la_mas_barata(self):
+        indice = promociones.IndicePromociones([
+            _regla(1, promociones.LLEVA_X_PAGA_Y, lleva=3, paga=2, marca_id=1),
+        ])
+        resultado = indice.evaluar([_linea(1, 2, "10.00"), _linea(2, 2, "4.00")])
+        self.assertEqual(resultado.descuento, Decimal("4.00"))
+
+    def test_importe_fijo_no_supera_lo_elegible(self):
+        indice = promociones.IndicePromociones([
+            _regla(1, promociones.IMPORTE, "15", producto_id=1),
+        ])
+        resultado = indice.evaluar([_linea(1, 1, "9.00"), _linea(2, 1, "30.00")])
+        self.assertEqual(resultado.descuento, Decimal("9.00"))
+
+    def test_no_se_acumulan_y_envio_gratis_si(self):
+        indice = promociones.IndicePromociones([
+            _regla(1, promociones.PORCENTAJE, "10"),
+            _regla(2, promociones.PORCENTAJE, "25", especie="perro"),
+            _regla(3, promociones.ENVIO_GRATIS, especie="perro"),
+        ])
+        resultado = indice.evaluar([_linea(1, 1, "40.00"), _linea(2, 1, "40.00", especie="gato")])
+        self.assertEqual(resultado.descuento, Decimal("10.00"))
+        self.assertEqual(resultado.promocion, "Promo 2")
+        self.assertTrue(resultado.envio_gratis)
+
+    def test_cupon_solo_con_codigo(self):
+        indice = promociones.IndicePromociones([
+            _regla(1, promociones.IMPORTE, "5", codigo="BIENVENIDA"),
+        ])
+        lineas = [_linea(1, 1, "20.00")]
+        self.assertEqual(indice.evaluar(lineas).descuento, Decimal("0.00"))
+        self.assertEqual(indice.evaluar(lineas, " bienvenida ").descuento, Decimal("5.00"))
+        self.assertTrue(indice.existe_cupon("Bienvenida"))
+        self.assertFalse(indice.existe_cupon("OTRO"))
+
+    def test_minimo_de_compra_y_vigencia(self):
+        ahora = timezone.now()
+        indice = promociones.IndicePromociones([
+            _regla(1, promociones.IMPORTE, "5", minimo=Decimal("50.00")),
+            _regla(2, promociones.IMPORTE, "3", fin=ahora - timedelta(minutes=1)),
+            _regla(3, promociones.IMPORTE, "2", inicio=ahora + timedelta(days=1)),
+        ])
+        self.assertEqual(indice.evaluar([_linea(1, 1, "40.00")], ahora=ahora).descuento, Decimal("0.00"))
+        self.assertEqual(indice.evaluar([_linea(1, 2, "40.00")], ahora=ahora).descuento, Decimal("5.00"))
+
+    def test_ambito_combinado_exige_todos_los_campos(self):
+        indice = promociones.IndicePromociones([
+            _regla(1, promociones.PORCENTAJE, "50", categoria_id=7, especie="gato"),
+        ])
+        self.assertEqual(
+            indice.evaluar([_linea(1, 1, "10.00", categoria_id=7)]).descuento, Decimal("0.00")
+        )
+        self.assertEqual(
+            indice.evaluar([_linea(1, 1, "10.00", categoria_id=7, especie="gato")]).descuento,
+            Decimal("5.00"),
+        )
+
+    def test_solo_se_miran_las_reglas_del_carrito(self):
+        """Con miles de reglas de otros productos no se evalúa ninguna."""
+        reglas = [_regla(i, promociones.PORCENTAJE, "10", producto_id=1000 + i) for i in range(5000)]
+        reglas.append(_regla(99999, promociones.PORCENTAJE, "30", producto_id=1))
+        indice = promociones.IndicePromociones(reglas)
+        with patch.object(promociones, "_descuento", wraps=promociones._descuento) as descuento:
+            resultado = indice.evaluar([_linea(1, 1, "10.00"), _linea(2, 1, "10.00")])
+        self.assertEqual(descuento.call_count, 1)
+        self.assertEqual(resultado.descuento, Decimal("3.00"))
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class PromocionModelTest(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        imagen_marca = SimpleUploadedFile(
+            name="marca.jpg",
+            content=b"fake image content",
+            content_type="image/jpeg"
+        )
+        self.marca = Marca.objects.create(
+            nombre="Royal Canin",
+            imagen=imagen_marca
+        )
+        self.producto = Producto.objects.create(
+            nombre="Pienso", precio=Decimal("20.00"), marca=self.marca, stock=20,
+        )
+        promociones.invalidar()
+
+    def tearDown(self):
+        # El índice vive en memoria: que las promociones no pasen a otros tests
+        promociones.invalidar()
+
+    def test_validaciones(self):
+        with self.assertRaises(ValidationError):
+            Promocion.objects.create(nombre="Mal", tipo=Promocion.Tipos.PORCENTAJE, valor=Decimal("120"))
+        with self.assertRaises(ValidationError):
+            Promocion.objects.create(
+                nombre="Mal", tipo=Promocion.Tipos.LLEVA_X_PAGA_Y, cantidad_lleva=2, cantidad_paga=2
+            )
+        cupon = Promocion.objects.create(
+            nombre="Cupón", codigo=" verano ", tipo=Promocion.Tipos.IMPORTE, valor=Decimal("5")
+        )
+        self.assertEqual(cupon.codigo, "VERANO")
+
+    def test_guardar_invalida_el_indice(self):
+        self.assertEqual(len(promociones.obtener_indice()), 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            Promocion.objects.create(
+                nombre="Marca -10%", tipo=Promocion.Tipos.PORCENTAJE, valor=Decimal("10"), marca=self.marca
+            )
+        self.assertEqual(len(promociones.obtener_indice()), 1)
+
+    @override_settings(INDICES_COMPROBAR_VERSION=60)
+    def test_invalidacion_de_otro_worker_tras_el_intervalo(self):
+        self.assertEqual(len(promociones.obtener_indice()), 0)
+        # Una promoción creada en otro worker: llega solo la versión de la caché
+        Promocion.objects.bulk_create([
+            Promocion(nombre="Marca -10%", tipo=Promocion.Tipos.PORCENTAJE, valor=Decimal("10"), marca=self.marca)
+        ])
+        cache.incr(promociones.CLAVE_VERSION)
+        self.assertEqual(len(promociones.obtener_indice()), 0)
+        promociones._indice.estado["comprobado"] -= 60
+        self.assertEqual(len(promociones.obtener_indice()), 1)
+
+    def test_presupuesto_aplica_descuento_antes_de_impuestos(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Promocion.objects.create(
+                nombre="Pienso -25%", tipo=Promocion.Tipos.PORCENTAJE, valor=Decimal("25"),
+                producto=self.producto,
+            )
+            Promocion.objects.create(nombre="Envío gratis", tipo=Promocion.Tipos.ENVIO_GRATIS)
+        presupuesto = precios.calcular({f"{self.producto.id}:": 1})
+        self.assertEqual(presupuesto.subtotal, Decimal("20.00"))
+        self.assertEqual(presupuesto.descuento, Decimal("5.00"))
+        self.assertEqual(presupuesto.impuestos, Decimal("1.50"))
+        self.assertEqual(presupuesto.coste_entrega, Decimal("0.00"))
+        self.assertEqual(presupuesto.total, Decimal("16.50"))
+        self.assertEqual(presupuesto.promocion, "Pienso -25%")
+
+    def test_promocion_inactiva_no_se_carga(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Promocion.objects.create(
+                nombre="Apagada", tipo=Promocion.Tipos.IMPORTE, valor=Decimal("5"), activa=False
+            )
+        self.assertEqual(len(promociones.obtener_indice()), 0)
+
+    def test_benchmark(self):
+        from django.core.management import call_command
+        from io import StringIO
+
+        salida = StringIO()
+        call_command("benchmark_promociones", "--reglas", "2000", "--carritos", "20", stdout=salida)
+        self.assertIn("2000 reglas", salida.getvalue())
+
+
+def _repartir_numeros(asignador, cantidad, salida):
+    """
+    Proceso hijo: pide `cantidad` números y los manda empaquetados por
+    `salida`, seguidos de cuántas consultas ha hecho para ello.
+    """
+    connection.close()  # No usar la conexión heredada del padre
+    try:
+        with CaptureQueriesContext(connection) as consultas:
+            numeros = array("q", (asignador.siguiente() for _ in range(cantidad)))
+        salida.send_bytes(numeros.tobytes())
+        salida.send(len(consultas))
+    finally:
+        connection.close()
+        salida.close()
+
+
+class NumeracionPedidoTest(BaseDatosEnFichero, TransactionTestCase):
+    PROCESOS = 4
+    POR_PROCESO = 5_000
+    BLOQUE = 100
+
+    def test_formato_numero_pedido(self):
+        numero = numeracion.numero_pedido()
+        self.assertRegex(numero, r"^MP-\d{8}-\d{6,}-[A-Z2-9]{6}$")
+        self.assertEqual(
+            numeracion.formatear(42, timezone.datetime(2026, 1, 2), "ABC234"), "MP-20260102-000042-ABC234"
+        )
+
+    def test_numeros_consecutivos_no_se_deducen(self):
+        # La secuencia es correlativa, pero el código de cada número no
+        primero, segundo = numeracion.numero_pedido(), numeracion.numero_pedido()
+        self.assertEqual(int(segundo.split("-")[2]), int(primero.split("-")[2]) + 1)
+        self.assertNotEqual(primero.rsplit("-", 1)[1], segundo.rsplit("-", 1)[1])
+
+    def test_bloque_sin_consultas_por_numero(self):
+        asignador = numeracion.AsignadorNumeros("prueba", tamano_bloque=100)
+        primero = asignador.siguiente()
+        with self.assertNumQueries(0):
+            resto = [asignador.siguiente() for _ in range(99)]
+        self.assertEqual(resto, list(range(primero + 1, primero + 100)))
+        # Agotado el bloque se reserva otro
+        self.assertEqual(asignador.siguiente(), primero + 100)
+        self.assertEqual(SecuenciaPedido.objects.get(nombre="prueba").siguiente, primero + 200)
+
+    def test_dentro_de_transaccion_reserva_solo_un_numero(self):
+        asignador = numeracion.AsignadorNumeros("prueba", tamano_bloque=100)
+        with transaction.atomic():
+            primero = asignador.siguiente()
+            segundo = asignador.siguiente()
+        self.assertEqual(segundo, primero + 1)
+        self.assertEqual(SecuenciaPedido.objects.get(nombre="prueba").siguiente, segundo + 1)
+
+    def _sin_colisiones(self, procesos, por_proceso, bloque):
+        asignador = numeracion.AsignadorNumeros("prueba", tamano_bloque=bloque)
+        # El padre ya tiene un bloque: los hijos (fork) no deben reutilizarlo
+        del_padre = asignador.siguiente()
+        connection.close()
+
+        # Con fork los hijos heredan el asignador tal cual, con su bloque
+        contexto = multiprocessing.get_context("fork")
+        tuberias, hijos = [], []
+        for _ in range(procesos):
+            entrada, salida = contexto.Pipe(duplex=False)
+            proceso = contexto.Process(target=_repartir_numeros, args=(asignador, por_proceso, salida))
+            proceso.start()
+            salida.close()
+            tuberias.append(entrada)
+            hijos.append(proceso)
+
+        numeros, consultas = array("q"), []
+        for entrada in tuberias:
+            numeros.frombytes(entrada.recv_bytes())
+            consultas.append(entrada.recv())
+        for proceso in hijos:
+            proceso.join()
+            self.assertEqual(proceso.exitcode, 0)
+        numeros.append(del_padre)
+        self.assertEqual(len(numeros), procesos * por_proceso + 1)
+        self.assertEqual(len(set(numeros)), len(numeros))
+
+        # Una reserva por bloque (la del padre más las de los hijos), no por número
+        bloques_hijo = -(-por_proceso // bloque)
+        bloques = 1 + procesos * bloques_hijo
+        self.assertEqual(SecuenciaPedido.objects.get(nombre="prueba").siguiente, 1 + bloques * bloque)
+        # Cada reserva son unas pocas consultas (UPDATE y SELECT), nunca una por número
+        for total in consultas:
+            self.assertLessEqual(total, 4 * bloques_hijo)
+
+    def test_varios_procesos_sin_colisiones(self):
+        self._sin_colisiones(self.PROCESOS, self.POR_PROCESO, self.BLOQUE)
+
+    @tag("lento")
+    @skipUnless(os.getenv("PRUEBAS_LENTAS"), "PRUEBAS_LENTAS=1 para repartir millones de números")
+    def test_millones_de_numeros_sin_colisiones(self):
+        self._sin_colisiones(procesos=8, por_proceso=500_000, bloque=numeracion.TAMANO_BLOQUE)
+
+
+class ServidorFalso:
+    """
+    Servidor HTTP local para probar las integraciones. Responde por orden con
+    `respuestas` ((estado, cuerpo, segundos de retraso)); la última se repite.
+    """
+
+    def __init__(self, respuestas):
+        self.respuestas = list(respuestas)
+        self.peticiones = []
+        self.conexiones = set()
+        falso = self
+
+        class Manejador(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive
+
+            def responder(self):
+                cuerpo = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                falso.peticiones.append((self.command, self.path, dict(self.headers), cuerpo))
+                falso.conexiones.add(self.client_address)
+                estado, datos, retraso = falso.respuestas.pop(0) if len(falso.respuestas) > 1 else falso.respuestas[0]
+                time.sleep(retraso)
+                datos = datos.encode()
+                self.send_response(estado)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(datos)))
+                self.end_headers()
+                self.wfile.write(datos)
+
+            do_GET = do_POST = responder
+
+            def log_message(self, *args):
+                pass
+
+        class Servidor(ThreadingHTTPServer):
+            def handle_error(self, request, client_address):
+                pass  # el cliente cortó por timeout
+
+        self.servidor = Servidor(("127.0.0.1", 0), Manejador)
+        self.url = f"http://127.0.0.1:{self.servidor.server_port}"
+
+    def __enter__(self):
+        threading.Thread(target=self.servidor.serve_forever, args=(0.05,), daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.servidor.shutdown()
+        self.servidor.server_close()
+
+
+class IntegracionesTest(TestCase):
+    def setUp(self):
+        integraciones.reiniciar()
+        self.addCleanup(integraciones.reiniciar)
+
+    def _servicio(self, **cambios):
+        politica = dict(
+            timeout_conexion=1, timeout_lectura=1, reintentos=2, espera_base=0.001,
+            espera_maxima=0.001, fallos_para_abrir=2, segundos_abierto=60,
+        )
+        politica.update(cambios)
+        servicio = integraciones.ServicioHTTP("prueba", integraciones.Politica(**politica))
+        self.addCleanup(servicio.cerrar)
+        return servicio
+
+    def test_reutiliza_la_conexion(self):
+        servicio = self._servicio()
+        with ServidorFalso([(200, "{}", 0)]) as falso:
+            for _ in range(5):
+                self.assertEqual(servicio.peticion("GET", falso.url).status_code, 200)
+        self.assertEqual(len(falso.peticiones), 5)
+        self.assertEqual(len(falso.conexiones), 1)
+
+    def test_reintenta_errores_de_servidor_si_es_idempotente(self):
+        servicio = self._servicio()
+        with ServidorFalso([(503, "", 0), (200, "{}", 0)]) as falso:
+            self.assertEqual(servicio.peticion("GET", falso.url).status_code, 200)
+        self.assertEqual(len(falso.peticiones), 2)
+        metricas = servicio.metricas.resumen()
+        self.assertEqual((metricas["peticiones"], metricas["errores"], metricas["reintentos"]), (2, 1, 1))
+        self.assertEqual(metricas["fallidas"], 0)
+
+    def test_post_solo_se_reintenta_con_clave_de_idempotencia(self):
+        servicio = self._servicio(fallos_para_abrir=10)
+        with ServidorFalso([(500, "", 0)]) as falso:
+            with self.assertRaises(integraciones.IntegracionError):
+                servicio.peticion("POST", falso.url, json={})
+            self.assertEqual(len(falso.peticiones), 1)
+            with self.assertRaises(integraciones.IntegracionError):
+                servicio.peticion("POST", falso.url, json={}, headers={"Idempotency-Key": "k"})
+            self.assertEqual(len(falso.peticiones), 4)
+
+    def test_conexion_rechazada_se_reintenta_siempre(self):
+        with socket.socket() as libre:
+            libre.bind(("127.0.0.1", 0))
+            url = f"http://127.0.0.1:{libre.getsockname()[1]}"
+        servicio = self._servicio()
+        with self.assertRaises(integraciones.IntegracionError):
+            servicio.peticion("POST", url, json={})
+        self.assertEqual(servicio.metricas.resumen()["peticiones"], 3)
+
+    def test_timeout_de_lectura(self):
+        servicio = self._servicio(timeout_lectura=0.1, reintentos=0)
+        with ServidorFalso([(200, "{}", 0.5)]) as falso:
+            inicio = time.monotonic()
+            with self.assertRaises(integraciones.IntegracionError):
+                servicio.peticion("GET", falso.url)
+            self.assertLess(time.monotonic() - inicio, 0.4)
+
+    def test_interruptor_falla_rapido_y_se_recupera(self):
+        servicio = self._servicio(reintentos=0, segundos_abierto=0.2)
+        with ServidorFalso([(503, "", 0), (503, "", 0), (200, "{}", 0)]) as falso:
+            for _ in range(2):
+                with self.assertRaises(integraciones.IntegracionError):
+                    servicio.peticion("GET", falso.url)
+            with self.assertRaises(integraciones.CircuitoAbierto):
+                servicio.peticion("GET", falso.url)
+            self.assertEqual(len(falso.peticiones), 2)
+
+            time.sleep(0.25)
+            # Llamada de prueba: va bien y el interruptor se cierra
+            self.assertEqual(servicio.peticion("GET", falso.url).status_code, 200)
+        self.assertEqual(servicio.interruptor.estado, integraciones.Interruptor.CERRADO)
+        self.assertEqual(servicio.metricas.resumen()["rechazadas"], 1)
+
+    def test_errores_4xx_no_abren_el_interruptor(self):
+        servicio = self._servicio()
+        with ServidorFalso([(400, "{}", 0)]) as falso:
+            for _ in range(3):
+                self.assertEqual(servicio.peticion("POST", falso.url).status_code, 400)
+        self.assertEqual(servicio.interruptor.estado, integraciones.Interruptor.CERRADO)
+        self.assertEqual(len(falso.peticiones), 3)
+
+    @override_settings(SENDGRID_API_KEY="SG.prueba")
+    def test_enviar_email_por_sendgrid(self):
+        mensaje = Mail(
+            from_email="tienda@example.com", to_emails="cliente@example.com",
+            subject="Hola", html_content="<p>Hola</p>",
+        )
+        with ServidorFalso([(202, "", 0)]) as falso, override_settings(SENDGRID_API_URL=falso.url):
+            integraciones.enviar_email(mensaje)
+        metodo, ruta, cabeceras, cuerpo = falso.peticiones[0]
+        self.assertEqual((metodo, ruta), ("POST", "/v3/mail/send"))
+        self.assertEqual(cabeceras["Authorization"], "Bearer SG.prueba")
+        self.assertEqual(json.loads(cuerpo)["subject"], "Hola")
+        self.assertEqual(integraciones.metricas()["sendgrid"]["peticiones"], 1)
+
+    @override_settings(SENDGRID_API_KEY=None)
+    def test_enviar_email_sin_clave_no_llama(self):
+        with self.assertRaises(integraciones.IntegracionError):
+            integraciones.enviar_email(Mail(from_email="a@example.com", to_emails="b@example.com",
+                                            subject="x", html_content="x"))
+        self.assertNotIn("sendgrid", integraciones.metricas())
+
+    def test_stripe_pasa_por_el_servicio(self):
+        sesion = {"id": "cs_test_1", "object": "checkout.session", "url": "https://checkout.stripe.test/s"}
+        with ServidorFalso([(200, json.dumps(sesion), 0)]) as falso, \
+                patch.object(stripe, "api_base", falso.url), \
+                patch.object(stripe, "default_http_client", integraciones.ClienteStripe()):
+            creada = stripe.checkout.Session.create(
+                mode="payment", api_key="sk_test_prueba", idempotency_key="checkout-x"
+            )
+        self.assertEqual(creada.url, "https://checkout.stripe.test/s")
+        cabeceras = falso.peticiones[0][2]
+        self.assertEqual(cabeceras["Idempotency-Key"], "checkout-x")
+        self.assertEqual(integraciones.metricas()["stripe"]["peticiones"], 1)
+
+
+class LimitesTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        limites.olvidar()
+        self.factory = RequestFactory()
+
+    def test_tasa_desde_texto(self):
+        self.assertEqual(limites.Tasa.desde_texto("30/m"), limites.Tasa(30, 0.5))
+        self.assertEqual(limites.Tasa.desde_texto("5/h").capacidad, 5)
+        self.assertEqual(limites.Tasa.desde_texto("2/s").por_segundo, 2)
+
+    def test_cubo_se_vacia_y_se_rellena(self):
+        tasa = limites.Tasa(2, 1.0)
+        estado, espera = limites._gastar(None, tasa, 100.0)
+        self.assertEqual(espera, 0)
+        estado, espera = limites._gastar(estado, tasa, 100.0)
+        self.assertEqual(espera, 0)
+        estado, espera = limites._gastar(estado, tasa, 100.0)
+        self.assertAlmostEqual(espera, 1.0)
+        # Medio segundo después hay medio token: falta otro medio
+        estado, espera = limites._gastar(estado, tasa, 100.5)
+        self.assertAlmostEqual(espera, 0.5)
+        _, espera = limites._gastar(estado, tasa, 101.0)
+        self.assertEqual(espera, 0)
+
+    def test_el_cubo_no_pasa_de_su_capacidad(self):
+        tasa = limites.Tasa(2, 1.0)
+        estado, _ = limites._gastar(None, tasa, 0.0)
+        estado, _ = limites._gastar(estado, tasa, 1000.0)
+        self.assertEqual(estado[0], 1)
+
+    def test_ip_y_sesion_por_separado(self):
+        limite = limites.Limite(por_ip="3/m", por_sesion="1/m")
+        request = self.factory.post("/", REMOTE_ADDR="10.0.0.1")
+        request.session = SessionStore()
+        request.session.create()
+        self.assertEqual(limites.espera(request, "prueba", limite), 0)
+        self.assertGreater(limites.espera(request, "prueba", limite), 0)
+        # Otra sesión desde la misma IP gasta el cubo de la IP
+        otra = self.factory.post("/", REMOTE_ADDR="10.0.0.1")
+        self.assertEqual(limites.espera(otra, "prueba", limite), 0)
+        self.assertGreater(limites.espera(otra, "prueba", limite), 0)
+        # Otra IP tiene su propio cubo
+        self.assertEqual(limites.espera(self.factory.post("/", REMOTE_ADDR="10.0.0.2"), "prueba", limite), 0)
+
+    @override_settings(LIMITES_CABECERA_IP="HTTP_X_FORWARDED_FOR")
+    def test_ip_desde_la_cabecera_del_proxy(self):
+        request = self.factory.get("/", REMOTE_ADDR="10.0.0.1", HTTP_X_FORWARDED_FOR="1.1.1.1, 2.2.2.2")
+        self.assertEqual(limites.ip_cliente(request), "2.2.2.2")
+
+    def test_sin_cache_usa_la_memoria_del_proceso(self):
+        limite = limites.Limite(por_ip="2/m")
+        request = self.factory.post("/", REMOTE_ADDR="10.0.0.3")
+        with patch.object(limites.cache, "get", side_effect=ConnectionError("caída")):
+            esperas = [limites.espera(request, "prueba", limite) for _ in range(3)]
+        self.assertEqual(esperas[:2], [0, 0])
+        self.assertGreater(esperas[2], 0)
+
+    def test_limites_desde_settings(self):
+        with self.settings(LIMITES_PETICIONES={"login": {"por_ip": "5/m", "metodos": ["post"]}}):
+            limite = limites.limites()["login"]
+        self.assertEqual(limite, limites.Limite(por_ip="5/m", metodos=("POST",)))
+        self.assertFalse(limite.aplica(self.factory.get("/")))
+
+
+def _contar_en_hijo(veces):
+    for _ in range(veces):
+        metricas.checkouts.inc(metodo_pago="contrareembolso", resultado="creado")
+    metricas.volcar()
+
+
+class MetricasTest(TestCase):
+    def setUp(self):
+        metricas.reiniciar()
+        self.addCleanup(metricas.reiniciar)
+        self.directorio = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directorio, ignore_errors=True)
+
+    def test_contador_en_formato_prometheus(self):
+        metricas.checkouts.inc(metodo_pago="stripe_test", resultado="creado")
+        metricas.checkouts.inc(2, metodo_pago="stripe_test", resultado="creado")
+        texto = metricas.exponer()
+        self.assertIn("# TYPE tienda_checkouts_total counter", texto)
+        self.assertIn('tienda_checkouts_total{metodo_pago="stripe_test",resultado="creado"} 3', texto)
+
+    def test_histograma_acumula_cubetas(self):
+        metricas.email_segundos.observar(0.02, resultado="ok")
+        metricas.email_segundos.observar(3, resultado="ok")
+        texto = metricas.exponer()
+        self.assertIn('tienda_email_segundos_bucket{resultado="ok",le="0.01"} 0', texto)
+        self.assertIn('tienda_email_segundos_bucket{resultado="ok",le="0.025"} 1', texto)
+        self.assertIn('tienda_email_segundos_bucket{resultado="ok",le="5"} 2', texto)
+        self.assertIn('tienda_email_segundos_bucket{resultado="ok",le="+Inf"} 2', texto)
+        self.assertIn('tienda_email_segundos_sum{resultado="ok"} 3.02', texto)
+        self.assertIn('tienda_email_segundos_count{resultado="ok"} 2', texto)
+
+    def test_etiquetas_obligatorias_y_escapadas(self):
+        with self.assertRaises(ValueError):
+            metricas.checkouts.inc(metodo_pago="stripe_test")
+        metricas.cache_consultas.inc(cache='a"b', resultado="acierto")
+        self.assertIn('cache="a\\"b"', metricas.exponer())
+
+    def test_suma_los_procesos_por_ficheros(self):
+        with self.settings(METRICAS_DIR=self.directorio):
+            metricas.checkouts.inc(metodo_pago="contrareembolso", resultado="creado")
+            contexto = multiprocessing.get_context("fork")
+            hijos = [contexto.Process(target=_contar_en_hijo, args=(5,)) for _ in range(2)]
+            for hijo in hijos:
+                hijo.start()
+            for hijo in hijos:
+                hijo.join()
+            texto = metricas.exponer()
+        self.assertIn('tienda_checkouts_total{metodo_pago="contrareembolso",resultado="creado"} 11', texto)
+
+    def test_fichero_roto_se_ignora(self):
+        with open(os.path.join(self.directorio, "roto.json"), "w") as f:
+            f.write("{")
+        with self.settings(METRICAS_DIR=self.directorio):
+            metricas.checkouts.inc(metodo_pago="stripe_test", resultado="pagado")
+            self.assertIn('resultado="pagado"} 1', metricas.exponer())
+
@@ -0,0 +1,146 @@
+"""
+Dónde se va el tiempo de cada petición.
+
+`TiemposMiddleware` (`home/middleware.py`) mide una de cada
+`1 / TIEMPOS_MUESTREO` peticiones: las demás pasan sin ningún coste. De las
+medidas deja:
+
+- La cabecera `Server-Timing` (la muestran las herramientas de desarrollo del
+  navegador): `db` (tiempo y número de consultas), `plantillas`, una entrada
+  por servicio externo (`stripe`, `sendgrid`) y `total`. Solo se manda al
+  personal (`is_staff`) o con `DEBUG`: a cualquier otro le enseñaría cuántas
+  consultas hace cada página y cuánto tardan Stripe y SendGrid.
+- Una línea JSON en el logger `home.tiempos` con el nombre de la URL
+  (`add_to_cart`, `cart_status`, `productos`...), el método, el estado y los
+  mismos tiempos en milisegundos, para agregarlos por vista. Esta se deja
+  para todas las peticiones medidas.
+
+Cómo se mide:
+
+- Consultas: `connection.execute_wrapper` alrededor de la petición.
+- Plantillas: el backend `DjangoTemplatesMedidas` (en `TEMPLATES`) cronometra
+  cada `render()`. Incluye las consultas que se lanzan al pintar (querysets
+  perezosos), que también cuentan en `db`: las entradas no son exclusivas.
+- Servicios externos: `ServicioHTTP.peticion` (`home/integraciones.py`), con
+  reintentos y esperas incluidos.
+
+La medida en curso vive en una `ContextVar`, así que cada hilo (o tarea) ve la
+suya; fuera de una petición medida, `medir()` no hace nada.
+"""
+import contextvars
+import json
+import logging
+import random
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+from django.template.backends.django import DjangoTemplates, Template
+
+logger = logging.getLogger("home.tiempos")
+
+_actual = contextvars.ContextVar("tiempos", default=None)
+
+
+class Medicion:
+    def __init__(self):
+        self.inicio = time.perf_counter()
+        self.duraciones = defaultdict(float)
+        self.consultas = 0
+        self._activas = set()
+
+    def consulta(self, execute, sql, params, many, context):
+        inicio = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.consultas += 1
+            self.duraciones["db"] += time.perf_counter() - inicio
+
+    def total(self):
+        return time.perf_counter() - self.inicio
+
+    def server_timing(self, total):
+        entradas = [f'db;dur={self.duraciones["db"] * 1000:.1f};desc="{self.consultas} consultas"']
+        entradas += [
+            f"{nombre};dur={segundos * 1000:.1f}"
+            for nombre, segundos in self.duraciones.items()
+            if nombre != "db"
+        ]
+        entradas.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(entradas)
+
+    def registro(self, request, response, total):
+        coincidencia = getattr(request, "resolver_match", None)
+        return {
+            "url": coincidencia.view_name if coincidencia else None,
+            "metodo": request.method,
+            "estado": response.status_code,
+            "total_ms": round(total * 1000, 1),
+            "db_consultas": self.consultas,
+            **{f"{nombre}_ms": round(segundos * 1000, 1) for nombre, segundos in self.duraciones.items()},
+        }
+
+
+def muestrear():
+    """True si esta petición se mide (`TIEMPOS_MUESTREO`: de 0 a 1)."""
+    muestreo = getattr(settings, "TIEMPOS_MUESTREO", 0)
+    return muestreo >= 1 or (muestreo > 0 and random.random() < muestreo)
+
+
+@contextmanager
+def medir(nombre):
+    """Suma a `nombre` lo que tarde el bloque (una vez aunque se anide)."""
+    medicion = _actual.get()
+    if medicion is None or nombre in medicion._activas:
+        yield
+        return
+    medicion._activas.add(nombre)
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        medicion.duraciones[nombre] += time.perf_counter() - inicio
+        medicion._activas.discard(nombre)
+
+
+def ver_server_timing(request):
+    """True si a quien hace la petición se le puede mandar `Server-Timing`."""
+    if settings.DEBUG:
+        return True
+    user = getattr(request, "user", None)
+    return bool(user is not None and user.is_staff)
+
+
+def medir_peticion(request, get_response):
+    """Atiende la petición midiéndola; deja la línea en el log y, si se puede, añade `Server-Timing`."""
+    medicion = Medicion()
+    token = _actual.set(medicion)
+    try:
+        with connection.execute_wrapper(medicion.consulta):
+            response = get_response(request)
+    finally:
+        _actual.reset(token)
+    total = medicion.total()
+    if ver_server_timing(request):
+        response["Server-Timing"] = medicion.server_timing(total)
+    logger.info(json.dumps(medicion.registro(request, response, total)))
+    return response
+
+
+class _PlantillaMedida(Template):
+    def render(self, context=None, request=None):
+        with medir("plantillas"):
+            return super().render(context, request)
+
+
+class DjangoTemplatesMedidas(DjangoTemplates):
+    """Backend de plantillas de Django que cronometra cada `render()`."""
+
+    def from_string(self, template_code):
+        return _PlantillaMedida(super().from_string(template_code).template, self)
+
+    def get_template(self, template_name):
+        return _PlantillaMedida(super().get_template(template_name).template, self)
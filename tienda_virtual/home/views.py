@@ -1,4 +1,6 @@
 import datetime
+import json
+import secrets
 from decimal import Decimal, ROUND_HALF_UP
 
 import stripe
@@ -6,15 +8,16 @@ from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import login, logout
 from django.contrib.auth.decorators import login_required
+from django.core.exceptions import ValidationError
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
-from django.db.models import Q
-from django.http import JsonResponse
+from django.db import IntegrityError, transaction
+from django.db.models import OuterRef, Prefetch, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.http import HttpResponse, JsonResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse
 from django.utils import timezone
-from django.utils.crypto import get_random_string
 from django.utils.http import url_has_allowed_host_and_scheme
-from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
 
 from .forms import (
@@ -32,141 +35,19 @@ from .models import (
     MensajeContacto,
     Pedido,
     Producto,
-    TallaProducto,
+    normalizar_email,
 )
+from . import (
+    carrito, catalogo, integraciones, metricas, numeracion, precios, promociones, recomendaciones, search_index,
+    seguimiento,
+)
+from .condicional import pagina_condicional, version_catalogo, version_categorias, version_producto
 
 
 stripe.api_key = settings.STRIPE_SECRET_KEY
-
-
-def calculate_remaining_stock(cart, producto, size=''):
-    """
-    Calcula el stock restante para un producto/talla considerando lo que hay en el carrito.
-    Similar a la lógica en context_processors.py
-    """
-    if not isinstance(cart, dict):
-        cart = {}
-    
-    # Calcular cantidad total en el carrito para este producto
-    qty_by_product = {}
-    qty_by_item = {}
-    
-    for composite_key, qty in cart.items():
-        try:
-            if isinstance(composite_key, str) and ':' in composite_key:
-                pid_str, item_size = composite_key.split(':', 1)
-            else:
-                pid_str = str(composite_key)
-                item_size = ''
-            
-            if int(pid_str) == producto.id:
-                cantidad = int(qty)
-                pid_key = str(producto.id)
-                qty_by_product[pid_key] = qty_by_product.get(pid_key, 0) + cantidad
-                key = f"{pid_key}:{item_size}"
-                qty_by_item[key] = qty_by_item.get(key, 0) + cantidad
-        except Exception:
-            continue
-    
-    # Calcular stock restante
-    pid_key = str(producto.id)
-    key = f"{pid_key}:{size}"
-    
-    if size:
-        # Si tiene talla específica, usar el stock de esa talla
-        talla = producto.tallas.filter(talla=size).first()
-        stock = talla.stock if talla else 0
-        taken = qty_by_item.get(key, 0)
-        return max(0, stock - taken)
-    else:
-        # Sin talla específica
-        if producto.tallas.exists():
-            # Si el producto tiene tallas, sumar todos los stocks
-            total_stock = sum(t.stock for t in producto.tallas.all())
-            taken = qty_by_product.get(pid_key, 0)
-            return max(0, total_stock - taken)
-        else:
-            # Sin tallas, usar el stock del producto
-            taken = qty_by_product.get(pid_key, 0)
-            return max(0, producto.stock - taken)
-
-
-def _build_cart_json_response(cart, extra_data=None):
-    """
-    Helper function para construir la respuesta JSON del carrito.
-    Evita duplicación de código en las funciones de carrito.
-    
-    Args:
-        cart: Diccionario del carrito de sesión
-        extra_data: Diccionario opcional con datos adicionales para incluir en la respuesta
-    
-    Returns:
-        Dict con la estructura estándar de respuesta del carrito
-    """
-    if not isinstance(cart, dict):
-        cart = {}
-    
-    total_count = sum(int(qty) for qty in cart.values())
-    items = []
-    total_amount = Decimal('0.00')
-    remaining_by_product = {}
-    
-    for composite_key, qty in cart.items():
-        try:
-            if isinstance(composite_key, str) and ':' in composite_key:
-                pid_str, size = composite_key.split(':', 1)
-            else:
-                pid_str = str(composite_key)
-                size = ''
-            
-            prod = Producto.objects.filter(pk=int(pid_str)).first()
-            if not prod:
-                continue
-            
-            cantidad = int(qty)
-            precio = prod.precio_oferta or prod.precio or Decimal('0.00')
-            subtotal = precio * cantidad
-            total_amount += subtotal
-            
-            # Obtener imagen
-            imagen_url = None
-            imagen = prod.imagenes.first()
-            if imagen:
-                imagen_url = imagen.imagen.url
-            
-            # Calcular stock restante
-            remaining = calculate_remaining_stock(cart, prod, size)
-            
-            items.append({
-                'producto_id': prod.id,
-                'nombre': prod.nombre,
-                'cantidad': cantidad,
-                'subtotal': float(subtotal),
-                'size': size,
-                'imagen_url': imagen_url,
-                'precio': float(precio),
-                'remaining': remaining
-            })
-            
-            # Guardar remaining para productos sin tallas
-            if not size and not prod.tallas.exists():
-                remaining_by_product[prod.id] = remaining
-        except Exception:
-            continue
-    
-    response = {
-        'success': True,
-        'cart_count': total_count,
-        'cart_items': items,
-        'cart_total': float(total_amount),
-        'remaining_by_product': remaining_by_product
-    }
-    
-    # Agregar datos extra si se proporcionan
-    if extra_data:
-        response.update(extra_data)
-    
-    return response
+# Las llamadas a Stripe pasan por home/integraciones.py (timeouts, reintentos e interruptor)
+stripe.default_http_client = integraciones.ClienteStripe()
+stripe.max_network_retries = 0
 
 
 def index(request):
@@ -265,35 +146,24 @@ def add_to_cart(request, product_id):
             messages.error(request, error_msg)
             return redirect(request.META.get('HTTP_REFERER', reverse('home')))
 
-    # Asegurar que el carrito siempre sea un diccionario
-    cart = request.session.get('cart')
-    if not isinstance(cart, dict):
-        cart = {}
-        request.session['cart'] = cart
-
-    # use composite key productid:size (size may be empty string)
-    key = f"{product_id}:{size}"
-    
-    # Verificar stock disponible antes de añadir
-    if producto.tallas.exists() and size:
-        talla_obj = producto.tallas.filter(talla=size).first()
-        if talla_obj:
-            # Calcular cantidad actual en el carrito para esta talla
-            cantidad_en_carrito = int(cart.get(key, 0))
-            if cantidad_en_carrito >= talla_obj.stock:
-                error_msg = f'No hay suficiente stock disponible para la talla "{size}"'
-                if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-                    return JsonResponse({'success': False, 'error': error_msg}, status=400)
-                messages.error(request, error_msg)
-                return redirect(request.META.get('HTTP_REFERER', reverse('home')))
-    
-    cart[key] = int(cart.get(key, 0)) + 1
-    request.session['cart'] = cart
-    request.session.modified = True
+    # Se suma en la base de datos sin pisar otras peticiones; el stock de la talla
+    # se comprueba con el carrito ya actualizado
+    try:
+        carrito.modificar(
+            request,
+            [{'op': 'add', 'product_id': product_id, 'size': size}],
+            stock_sin_tallas=False,
+        )
+    except ValidationError as e:
+        error_msg = e.messages[0]
+        if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+            return JsonResponse({'success': False, 'error': error_msg}, status=400)
+        messages.error(request, error_msg)
+        return redirect(request.META.get('HTTP_REFERER', reverse('home')))
 
-    # Si es petición AJAX, devolver JSON con datos del carrito
+    # Si es petición AJAX, devolver JSON con las líneas cambiadas del carrito
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-        response = _build_cart_json_response(cart, {
+        response = carrito.respuesta(request, {
             'message': f'{producto.nombre} añadido al carrito',
             'product_name': producto.nombre
         })
@@ -302,22 +172,51 @@ def add_to_cart(request, product_id):
     return redirect(request.META.get('HTTP_REFERER', reverse('home')))
 
 
+def cart_batch(request):
+    """
+    Aplica en orden varias operaciones sobre el carrito (JSON con
+    `operaciones` y `since_version`) con una sola escritura. Si alguna no es
+    válida no se aplica ninguna.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'error': 'Método no permitido'}, status=405)
+
+    try:
+        datos = json.loads(request.body or b'{}')
+        operaciones = datos.get('operaciones')
+    except (ValueError, AttributeError):
+        return JsonResponse({'success': False, 'error': 'Petición no válida'}, status=400)
+
+    try:
+        carrito.modificar(request, operaciones)
+    except ValidationError as e:
+        return JsonResponse({'success': False, 'error': e.messages[0]}, status=400)
+
+    return JsonResponse(carrito.respuesta(request, desde=carrito.leer_version(datos.get('since_version'))))
+
+
+@pagina_condicional(carrito.version_estado)
 def cart_status(request):
-    """Devuelve el estado actual del carrito en formato JSON para AJAX."""
-    cart = request.session.get('cart')
-    if not isinstance(cart, dict):
-        cart = {}
-        request.session['cart'] = cart
-    response = _build_cart_json_response(cart)
-    return JsonResponse(response)
+    """
+    Devuelve el estado actual del carrito en formato JSON para AJAX. Con
+    `?since_version=` solo devuelve lo que ha cambiado desde esa versión.
+    """
+    return JsonResponse(carrito.respuesta(request))
+
+
+def buscar_autocompletar(request):
+    """Sugerencias del buscador en JSON, servidas desde el índice en memoria."""
+    q = request.GET.get('q', '')[:100]
+    try:
+        limite = max(1, min(int(request.GET.get('limite', 8)), 20))
+    except ValueError:
+        limite = 8
+    return JsonResponse({'q': q, 'resultados': search_index.autocompletar(q, limite)})
 
 
 def cart_view(request):
     """Muestra el contenido del carrito ."""
-    cart = request.session.get('cart')
-    if not isinstance(cart, dict):
-        cart = {}
-        request.session['cart'] = cart
+    cart = carrito.leer_carrito(request)
     items = []
     total = 0
     if isinstance(cart, dict):
@@ -335,17 +234,29 @@ def cart_view(request):
                 continue
 
             cantidad = int(qty)
-            precio_unitario = producto.precio_oferta or producto.precio
+            precio_unitario = producto.precio_efectivo
             subtotal = precio_unitario * cantidad
             items.append({'producto': producto, 'cantidad': cantidad, 'subtotal': subtotal, 'size': size})
             total += subtotal
 
-    contexto = {'items': items, 'total': total}
+    recomendados = recomendaciones.recomendaciones_para_carrito(
+        item['producto'].id for item in items
+    )
+    contexto = {'items': items, 'total': total, 'recomendados': recomendados}
     return render(request, 'cart.html', contexto)
 
 
+def _cambiar_carrito(request, operacion):
+    """Aplica una operación al carrito (ver `home/carrito.py`). Devuelve el error o None."""
+    try:
+        carrito.modificar(request, [operacion], stock_sin_tallas=False)
+    except ValidationError as e:
+        return e.messages[0]
+    return None
+
+
 def cart_decrement(request, product_id):
-    """Decrementa la cantidad de `product_id` en el carrito de sesión."""
+    """Decrementa la cantidad de `product_id` en el carrito."""
     if request.method != 'POST':
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
             return JsonResponse({'success': False, 'error': 'Método no permitido'}, status=405)
@@ -353,71 +264,29 @@ def cart_decrement(request, product_id):
 
     # Expect optional 'size' param from the form so we decrement the correct item
     size = (request.POST.get('size') or '').strip()
-    cart = request.session.get('cart', {})
-    if not isinstance(cart, dict):
-        cart = {}
-    
-    key = f"{product_id}:{size}"
-    # support legacy key without size
-    if key not in cart and str(product_id) in cart:
-        key = str(product_id)
-
-    if key in cart:
-        try:
-            current_qty = int(cart.get(key, 0))
-        except Exception:
-            current_qty = 0
-        
-        # Validar que la cantidad actual sea mayor que 0 antes de decrementar
-        if current_qty <= 0:
-            # Si la cantidad ya es 0 o menos, no hacer nada
-            if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-                response = _build_cart_json_response(cart)
-                return JsonResponse(response)
-            return redirect(request.META.get('HTTP_REFERER', reverse('home')))
-        
-        qty = current_qty - 1
-        if qty > 0:
-            cart[key] = qty
-        else:
-            cart.pop(key, None)
-        request.session['cart'] = cart
-        request.session.modified = True
+    # Si la línea no está o ya es 0 no cambia nada
+    _cambiar_carrito(request, {'op': 'decrement', 'product_id': product_id, 'size': size})
 
-    # Si es petición AJAX, devolver JSON con datos del carrito
+    # Si es petición AJAX, devolver JSON con las líneas cambiadas del carrito
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-        response = _build_cart_json_response(cart)
-        return JsonResponse(response)
+        return JsonResponse(carrito.respuesta(request))
 
     return redirect(request.META.get('HTTP_REFERER', reverse('home')))
 
 
 def cart_remove(request, product_id):
-    """Elimina completamente `product_id` del carrito de sesión."""
+    """Elimina completamente `product_id` del carrito."""
     if request.method != 'POST':
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
             return JsonResponse({'success': False, 'error': 'Método no permitido'}, status=405)
         return redirect(request.META.get('HTTP_REFERER', reverse('home')))
 
     size = (request.POST.get('size') or '').strip()
-    cart = request.session.get('cart')
-    if not isinstance(cart, dict):
-        cart = {}
-    
-    key = f"{product_id}:{size}"
-    if key in cart:
-        cart.pop(key, None)
-    else:
-        # fallback to legacy key
-        cart.pop(str(product_id), None)
-
-    request.session['cart'] = cart
-    request.session.modified = True
+    _cambiar_carrito(request, {'op': 'remove', 'product_id': product_id, 'size': size})
 
-    # Si es petición AJAX, devolver JSON con datos del carrito
+    # Si es petición AJAX, devolver JSON con las líneas cambiadas del carrito
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-        response = _build_cart_json_response(cart)
-        return JsonResponse(response)
+        return JsonResponse(carrito.respuesta(request))
 
     return redirect(request.META.get('HTTP_REFERER', reverse('home')))
 
@@ -438,32 +307,22 @@ def cart_update(request):
         return redirect(request.META.get('HTTP_REFERER', reverse('home')))
 
     try:
-        q = int(quantity)
+        q = max(0, int(quantity))
     except Exception:
         q = 0
 
-    cart = request.session.get('cart')
-    if not isinstance(cart, dict):
-        cart = {}
-        request.session['cart'] = cart
-
-    key = f"{product_id}:{size}"
-    # if key not present but legacy key exists, use legacy
-    if key not in cart and str(product_id) in cart and size == '':
-        key = str(product_id)
-
-    if q > 0:
-        cart[key] = q
-    else:
-        cart.pop(key, None)
-
-    request.session['cart'] = cart
-    request.session.modified = True
+    error_msg = _cambiar_carrito(
+        request, {'op': 'update', 'product_id': product_id, 'size': size, 'quantity': q}
+    )
+    if error_msg:
+        if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+            return JsonResponse({'success': False, 'error': error_msg}, status=400)
+        messages.error(request, error_msg)
+        return redirect(request.META.get('HTTP_REFERER', reverse('home')))
 
-    # Si es petición AJAX, devolver JSON con datos del carrito
+    # Si es petición AJAX, devolver JSON con las líneas cambiadas del carrito
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-        response = _build_cart_json_response(cart)
-        return JsonResponse(response)
+        return JsonResponse(carrito.respuesta(request))
 
     return redirect(request.META.get('HTTP_REFERER', reverse('home')))
 
@@ -475,18 +334,11 @@ def cart_clear(request):
             return JsonResponse({'success': False, 'error': 'Método no permitido'}, status=405)
         return redirect(request.META.get('HTTP_REFERER', reverse('home')))
 
-    request.session['cart'] = {}
-    request.session.modified = True
+    carrito.vaciar(request)
 
     # Si es petición AJAX, devolver JSON
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-        return JsonResponse({
-            'success': True,
-            'message': 'Carrito vaciado',
-            'cart_count': 0,
-            'cart_items': [],
-            'cart_total': 0.00
-        })
+        return JsonResponse(carrito.respuesta(request, {'message': 'Carrito vaciado'}))
 
     messages.success(request, "Carrito vaciado.")
     return redirect('cart')
@@ -502,6 +354,8 @@ def novedades(request):
     especie_filtro = request.GET.get('especie', '')
     color_filtro = request.GET.get('color', '')
     material_filtro = request.GET.get('material', '')
+    orden = request.GET.get('orden', '')
+    precio_min, precio_max = catalogo.leer_rango_precio(request.GET)
     
     if marca_filtro:
         productos_list = productos_list.filter(marca_id=marca_filtro)
@@ -512,7 +366,9 @@ def novedades(request):
     if material_filtro:
         productos_list = productos_list.filter(material__icontains=material_filtro)
     
-    productos_list = productos_list.order_by('-fecha_creacion')
+    histograma = catalogo.histograma_precios(productos_list)
+    productos_list = catalogo.filtrar_precio(productos_list, precio_min, precio_max)
+    productos_list = catalogo.aplicar_orden(productos_list, orden, especie=especie_filtro)
     
     # Paginación
     paginator = Paginator(productos_list, 12)
@@ -541,6 +397,11 @@ def novedades(request):
         'especie_filtro': especie_filtro,
         'color_filtro': color_filtro,
         'material_filtro': material_filtro,
+        'orden': orden,
+        'ordenes': catalogo.ORDENES,
+        'precio_min': precio_min,
+        'precio_max': precio_max,
+        'histograma': histograma,
     }
     return render(request, 'products.html', contexto)
 
@@ -552,6 +413,8 @@ def productos(request):
     especie_filtro = request.GET.get('especie', '')
     color_filtro = request.GET.get('color', '')
     material_filtro = request.GET.get('material', '')
+    orden = request.GET.get('orden', '')
+    precio_min, precio_max = catalogo.leer_rango_precio(request.GET)
     
     destacados_list = Producto.objects.filter(esta_disponible=True, es_destacado=True)
     productos_list = Producto.objects.filter(esta_disponible=True).exclude(es_destacado=True)
@@ -576,8 +439,11 @@ def productos(request):
     if material_filtro:
         productos_list = productos_list.filter(material__icontains=material_filtro)
     
-    destacados_list = destacados_list.order_by('-fecha_creacion')
-    productos_list = productos_list.order_by('-fecha_creacion')
+    histograma = catalogo.histograma_precios(destacados_list | productos_list)
+    destacados_list = catalogo.filtrar_precio(destacados_list, precio_min, precio_max)
+    productos_list = catalogo.filtrar_precio(productos_list, precio_min, precio_max)
+    destacados_list = catalogo.aplicar_orden(destacados_list, orden, especie=especie_filtro)
+    productos_list = catalogo.aplicar_orden(productos_list, orden, especie=especie_filtro)
     
     # Paginación para productos destacados
     paginator_destacados = Paginator(destacados_list, 12)
@@ -617,10 +483,16 @@ def productos(request):
         'especie_filtro': especie_filtro,
         'color_filtro': color_filtro,
         'material_filtro': material_filtro,
+        'orden': orden,
+        'ordenes': catalogo.ORDENES,
+        'precio_min': precio_min,
+        'precio_max': precio_max,
+        'histograma': histograma,
     }
     return render(request, 'products.html', contexto)
 
 
+@pagina_condicional(version_catalogo)
 def ofertas(request):
     """Muestra productos que tienen precio de oferta definido."""
     productos_list = Producto.objects.filter(esta_disponible=True, precio_oferta__isnull=False)
@@ -630,6 +502,8 @@ def ofertas(request):
     especie_filtro = request.GET.get('especie', '')
     color_filtro = request.GET.get('color', '')
     material_filtro = request.GET.get('material', '')
+    orden = request.GET.get('orden', '')
+    precio_min, precio_max = catalogo.leer_rango_precio(request.GET)
     
     if marca_filtro:
         productos_list = productos_list.filter(marca_id=marca_filtro)
@@ -640,7 +514,9 @@ def ofertas(request):
     if material_filtro:
         productos_list = productos_list.filter(material__icontains=material_filtro)
     
-    productos_list = productos_list.order_by('-fecha_creacion')
+    histograma = catalogo.histograma_precios(productos_list)
+    productos_list = catalogo.filtrar_precio(productos_list, precio_min, precio_max)
+    productos_list = catalogo.aplicar_orden(productos_list, orden, especie=especie_filtro)
     
     # Paginación
     paginator = Paginator(productos_list, 12)
@@ -669,10 +545,16 @@ def ofertas(request):
         'especie_filtro': especie_filtro,
         'color_filtro': color_filtro,
         'material_filtro': material_filtro,
+        'orden': orden,
+        'ordenes': catalogo.ORDENES,
+        'precio_min': precio_min,
+        'precio_max': precio_max,
+        'histograma': histograma,
     }
     return render(request, 'products.html', contexto)
 
 
+@pagina_condicional(version_producto)
 def product_detail(request, product_id):
     """Muestra la página de detalle de un producto."""
     producto = get_object_or_404(Producto, pk=product_id, esta_disponible=True)
@@ -681,6 +563,7 @@ def product_detail(request, product_id):
     contexto = {
         'producto': producto,
         'title': producto.nombre,
+        'recomendados': recomendaciones.recomendaciones_para(producto),
     }
     return render(request, 'product_detail.html', contexto)
 
@@ -699,11 +582,6 @@ def contacto(request):
             email=email,
             mensaje=mensaje
         )
-        enviar_email_respuesta_contacto_admin(
-            nombre=nombre,
-            email_destino="mypetshop.309@gmail.com",  # o un settings.CONTACT_EMAIL
-            mensaje_usuario=f"De: {nombre} ({email})\n\n{mensaje}",
-        )
         # 2. Enviar email de confirmación al usuario (SendGrid)
         try:
             enviar_email_respuesta_contacto(nombre, email, mensaje)
@@ -797,8 +675,7 @@ def enviar_email_respuesta_contacto(nombre, email_destino, mensaje_usuario):
         html_content=html,
     )
 
-    sg = SendGridAPIClient(settings.SENDGRID_API_KEY)
-    sg.send(mensaje)
+    integraciones.enviar_email(mensaje)
 
 
 def enviar_email_respuesta_contacto_admin(nombre, email_destino, mensaje_usuario):
@@ -856,21 +733,27 @@ def enviar_email_respuesta_contacto_admin(nombre, email_destino, mensaje_usuario
 
    
 
-    sg = SendGridAPIClient(settings.SENDGRID_API_KEY)
-    sg.send(message)
+    integraciones.enviar_email(message)
 
 
 
+@pagina_condicional(version_categorias)
 def categorias(request):
     # Mostrar las categorías reales definidas en el modelo `Categoria`.
     categorias = Categoria.objects.all().order_by('nombre')
     return render(request, "categorias.html", {"categorias": categorias})
 
 
+@pagina_condicional(version_catalogo)
 def categoria_detail(request, categoria_id):
     """Muestra los productos que pertenecen a la categoría indicada."""
     categoria = get_object_or_404(Categoria, pk=categoria_id)
-    productos_list = Producto.objects.filter(categoria=categoria, esta_disponible=True).order_by('-fecha_creacion')
+    orden = request.GET.get('orden', '')
+    precio_min, precio_max = catalogo.leer_rango_precio(request.GET)
+    productos_list = Producto.objects.filter(categoria=categoria, esta_disponible=True)
+    histograma = catalogo.histograma_precios(productos_list)
+    productos_list = catalogo.filtrar_precio(productos_list, precio_min, precio_max)
+    productos_list = catalogo.aplicar_orden(productos_list, orden, categoria=categoria)
     
     # Paginación
     paginator = Paginator(productos_list, 12)
@@ -887,6 +770,11 @@ def categoria_detail(request, categoria_id):
         'title': categoria.nombre,
         'categoria': categoria,
         'es_categoria': True,  # Flag para identificar que es vista de categoría
+        'orden': orden,
+        'ordenes': catalogo.ORDENES,
+        'precio_min': precio_min,
+        'precio_max': precio_max,
+        'histograma': histograma,
     }
     return render(request, 'products.html', contexto)
 
@@ -921,7 +809,7 @@ def register(request):
         form = RegistroForm(request.POST)
         if form.is_valid():
             cliente = form.save()
-            login(request, cliente.user)
+            login(request, cliente.user, backend="home.backends.ClienteBackend")
             messages.success(request, "Tu cuenta se creó correctamente.")
             if next_url and url_has_allowed_host_and_scheme(next_url, allowed_hosts={request.get_host()}):
                 return redirect(next_url)
@@ -932,19 +820,26 @@ def register(request):
     return render(request, 'register.html', {'form': form, 'next': next_url})
 
 
-def seguimiento_pedido(request):
+def seguimiento_pedido(request, numero_pedido=None):
+    """Formulario de seguimiento (POST) o enlace directo /seguimiento/<número>/ (GET)."""
     pedido = None
-    found = False
+    codigo = None
+    status = 200
     form = SeguimientoPedidoForm(request.POST or None)
     if request.method == "POST":
         if form.is_valid():
-            codigo = form.cleaned_data["numero_pedido"].strip()
-            pedido = Pedido.objects.select_related("cliente").prefetch_related("items__producto").filter(
-                numero_pedido__iexact=codigo
-            ).first()
-            if pedido:
-                found = True
-            else:
+            codigo = form.cleaned_data["numero_pedido"]
+    elif numero_pedido:
+        codigo = numero_pedido
+        form = SeguimientoPedidoForm(initial={"numero_pedido": numero_pedido})
+
+    if codigo is not None:
+        if not seguimiento.permitido(request):
+            messages.error(request, "Has hecho demasiadas consultas seguidas. Espera un minuto y vuelve a intentarlo.")
+            status = 429
+        else:
+            pedido = seguimiento.buscar(codigo)
+            if pedido is None:
                 messages.error(request, "No encontramos un pedido con ese código. Revisa el número y vuelve a intentarlo.")
 
     return render(
@@ -952,20 +847,93 @@ def seguimiento_pedido(request):
         "tracking.html",
         {
             "form": form,
-            "pedido": pedido if found else None,
+            "pedido": pedido,
+        },
+        status=status,
+    )
+
+PEDIDOS_POR_PAGINA = 20
+_EPOCA = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def _cursor_pedido(pedido):
+    """Posición de un pedido en el historial: microsegundos de su fecha y su id."""
+    return f"{(pedido.fecha_creacion - _EPOCA) // datetime.timedelta(microseconds=1)}-{pedido.id_pedido}"
+
+
+def _leer_cursor(texto):
+    try:
+        microsegundos, id_pedido = (int(parte) for parte in texto.split("-"))
+    except (AttributeError, ValueError):
+        return None
+    return _EPOCA + datetime.timedelta(microseconds=microsegundos), id_pedido
+
+
+@login_required(login_url="login")
+def mis_pedidos(request):
+    """
+    Historial de pedidos del cliente, del más reciente al más antiguo.
+    Se pagina por cursor (?antes=<fecha>-<id> del último pedido mostrado)
+    sobre el índice (cliente, fecha_creacion, id_pedido): cada página es una
+    consulta con el número de artículos ya sumado, más otra para las líneas,
+    tenga el cliente los pedidos que tenga.
+    """
+    cliente = request.cliente
+    pedidos = []
+    siguiente = None
+    if cliente:
+        articulos = (
+            ItemPedido.objects.filter(pedido=OuterRef("pk"))
+            .values("pedido")
+            .annotate(total=Sum("cantidad"))
+            .values("total")
+        )
+        consulta = (
+            Pedido.objects.filter(cliente=cliente)
+            .annotate(num_articulos=Coalesce(Subquery(articulos), 0))
+            .order_by("-fecha_creacion", "-id_pedido")
+            .prefetch_related(
+                Prefetch(
+                    "items",
+                    # precio_unitario lo lee ItemPedido.from_db
+                    queryset=ItemPedido.objects.only(
+                        "pedido_id", "nombre_producto", "talla", "cantidad", "precio_unitario", "total"
+                    ).order_by("id_item_pedido"),
+                )
+            )
+        )
+        cursor = _leer_cursor(request.GET.get("antes"))
+        if cursor:
+            fecha, id_pedido = cursor
+            consulta = consulta.filter(
+                Q(fecha_creacion__lt=fecha) | Q(fecha_creacion=fecha, id_pedido__lt=id_pedido)
+            )
+        pedidos = list(consulta[:PEDIDOS_POR_PAGINA + 1])
+        if len(pedidos) > PEDIDOS_POR_PAGINA:
+            pedidos = pedidos[:PEDIDOS_POR_PAGINA]
+            siguiente = _cursor_pedido(pedidos[-1])
+
+    return render(
+        request,
+        "mis_pedidos.html",
+        {
+            "pedidos": pedidos,
+            "siguiente": siguiente,
+            "es_primera_pagina": "antes" not in request.GET,
         },
     )
 
+
 def checkout_datos_cliente_envio(request):
-    cart = request.session.get("cart", {})
+    cart = carrito.leer_carrito(request)
     if not cart:
         messages.error(request, "Tu carrito está vacío.")
         return redirect("cart")
 
     # Si el usuario está autenticado, usar el flujo normal
     if request.user.is_authenticated:
-        cliente = getattr(request.user, "cliente", None)
-        email_real = (request.user.email or "").strip().lower()
+        cliente = request.cliente or None
+        email_real = normalizar_email(request.user.email)
         if email_real:
             lookup_email = email_real
         else:
@@ -973,7 +941,7 @@ def checkout_datos_cliente_envio(request):
             lookup_email = username_slug if "@" in username_slug else f"{username_slug}@local"
 
         if not cliente and lookup_email:
-            cliente = Cliente.objects.filter(email__iexact=lookup_email).first()
+            cliente = Cliente.por_email(lookup_email).first()
             if cliente and cliente.user is None:
                 cliente.user = request.user
                 cliente.save(update_fields=["user"])
@@ -1032,7 +1000,7 @@ def checkout_datos_cliente_envio(request):
         # Manejar registro
         if request.method == 'POST' and request.POST.get('form_type') == 'register' and register_form.is_valid():
             cliente = register_form.save()
-            login(request, cliente.user)
+            login(request, cliente.user, backend="home.backends.ClienteBackend")
             messages.success(request, "Tu cuenta se creó correctamente.")
             return redirect("checkout_datos")
         
@@ -1042,11 +1010,13 @@ def checkout_datos_cliente_envio(request):
             request.session["shipping_method"] = shipping_method
             request.session.modified = True
             
-            email = guest_form.cleaned_data['email'].strip().lower()
+            email = normalizar_email(guest_form.cleaned_data['email'])
             
-            # Verificar si ya existe un cliente con ese email que tiene usuario
-            existing_cliente_with_user = Cliente.objects.filter(email__iexact=email, user__isnull=False).first()
-            if existing_cliente_with_user:
+            # Una sola búsqueda por email: como mucho hay un cliente con él
+            cliente = Cliente.por_email(email).first()
+
+            # Si ese cliente tiene usuario, tiene que iniciar sesión
+            if cliente is not None and cliente.user_id is not None:
                 messages.error(request, f"Ya existe una cuenta con el email {email}. Por favor, inicia sesión para continuar.")
                 # Mostrar formulario de login
                 return render(
@@ -1061,9 +1031,6 @@ def checkout_datos_cliente_envio(request):
                     },
                 )
             
-            # Buscar si ya existe un cliente con ese email (sin usuario)
-            cliente = Cliente.objects.filter(email__iexact=email, user__isnull=True).first()
-            
             if not cliente:
                 # Crear nuevo cliente invitado (sin usuario)
                 try:
@@ -1121,84 +1088,38 @@ def checkout_datos_cliente_envio(request):
         )
 
 def detalles_pago(request):
-    # Obtener cliente: autenticado o invitado
-    if request.user.is_authenticated:
-        cliente = getattr(request.user, "cliente", None)
-    else:
-        # Cliente invitado desde sesión
-        guest_cliente_id = request.session.get('guest_cliente_id')
-        if guest_cliente_id:
-            try:
-                cliente = Cliente.objects.get(pk=guest_cliente_id, user__isnull=True)
-            except Cliente.DoesNotExist:
-                cliente = None
-        else:
-            cliente = None
-    
+    # Cliente autenticado o invitado (ClienteMiddleware)
+    cliente = request.cliente
     if not cliente:
         messages.error(request, "Primero debes completar tus datos de envío.")
         return redirect("checkout_datos")
 
-    cart = request.session.get("cart", {})
+    cart = carrito.leer_carrito(request)
     if not cart:
         messages.error(request, "Tu carrito está vacío.")
         return redirect("cart")
 
-    items = []
-    subtotal = Decimal("0.00")
-
-    for key, cantidad in cart.items():
-        # key debería ser "product_id:talla"
-        key_str = str(key)
-        if ":" in key_str:
-            pid_str, talla = key_str.split(":", 1)
-        else:
-            pid_str = key_str
-            talla = ""
-
-        try:
-            producto = Producto.objects.get(pk=int(pid_str))
-        except Producto.DoesNotExist:
-            # DEBUG: ver qué id está fallando
-            print("⚠ Producto no encontrado, id =", pid_str, "key completa =", key_str)
-            continue  # saltamos este item
-
-        cantidad = int(cantidad)
-        precio_unitario = producto.precio_oferta or producto.precio
-        total_item = precio_unitario * cantidad
-
-        items.append({
-            "producto": producto,
-            "cantidad": cantidad,
-            "talla": talla,
-            "subtotal": total_item,
-        })
-        subtotal += total_item
+    # Se calcula una vez y se guarda firmado en la sesión para el checkout
+    presupuesto = precios.presupuesto(request, cart)
 
     # Si después de limpiar no queda nada, vaciamos carrito
-    if not items:
-        request.session["cart"] = {}
-        request.session.modified = True
+    if not presupuesto.lineas:
+        carrito.vaciar(request)
         messages.error(
             request,
             "Tu carrito se ha vaciado porque algunos productos ya no están disponibles."
         )
         return redirect("cart")
 
-    impuestos = (subtotal * Decimal("0.10")).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-    
-    descuento = Decimal("0.00")
-
-    shipping_method = request.session.get('shipping_method', 'delivery')
-
-    if shipping_method == 'pickup':
-        coste_entrega = Decimal("0.00")
-        envio_gratis = True
-    else:
-        coste_entrega = Decimal("0.00") if subtotal >= Decimal("30.00") else Decimal("2.99")
-        envio_gratis = subtotal >= Decimal("30.00")
-
-    total = subtotal + impuestos + coste_entrega - descuento
+    items = [
+        {
+            "nombre": linea.nombre,
+            "cantidad": linea.cantidad,
+            "talla": linea.talla,
+            "subtotal": linea.total,
+        }
+        for linea in presupuesto.lineas
+    ]
 
     return render(
         request,
@@ -1206,137 +1127,120 @@ def detalles_pago(request):
         {
             "cliente": cliente,
             "items": items,
-            "subtotal": subtotal,
-            "impuestos": impuestos,
-            "coste_entrega": coste_entrega,
-            "descuento": descuento,
-            "total": total,
-            "shipping_method": shipping_method,
-            "envio_gratis": envio_gratis,
+            "subtotal": presupuesto.subtotal,
+            "impuestos": presupuesto.impuestos,
+            "coste_entrega": presupuesto.coste_entrega,
+            "descuento": presupuesto.descuento,
+            "total": presupuesto.total,
+            "shipping_method": presupuesto.envio,
+            "envio_gratis": presupuesto.envio_gratis,
+            "codigo_promocion": presupuesto.codigo,
+            "promocion": presupuesto.promocion,
+            # Una clave por resumen mostrado: reenviar el mismo formulario no duplica el pedido
+            "clave_idempotencia": secrets.token_urlsafe(32),
         },
     )
 
 
 
-def generar_numero_pedido():
-    return f"MP-{timezone.now().strftime('%Y%m%d%H%M%S')}-{get_random_string(4).upper()}"
-
-
-def checkout_stripe(request):
+def aplicar_codigo_promocion(request):
+    """Guarda (o quita, si viene vacío) el cupón del cliente y vuelve al resumen de pago."""
     if request.method != "POST":
         return redirect("detalles_pago")
 
-    cart = request.session.get("cart", {})
-    if not cart:
-        messages.error(request, "Tu carrito está vacío.")
-        return redirect("cart")
-
-    # Obtener cliente: autenticado o invitado
-    if request.user.is_authenticated:
-        cliente = getattr(request.user, "cliente", None)
+    codigo = promociones.normalizar_codigo(request.POST.get("codigo"))
+    if not codigo:
+        request.session.pop(precios.CLAVE_CODIGO, None)
+    elif promociones.existe_cupon(codigo):
+        request.session[precios.CLAVE_CODIGO] = codigo
+        messages.success(request, f"Código {codigo} aplicado.")
     else:
-        # Cliente invitado desde sesión
-        guest_cliente_id = request.session.get('guest_cliente_id')
-        if guest_cliente_id:
-            try:
-                cliente = Cliente.objects.get(pk=guest_cliente_id, user__isnull=True)
-            except Cliente.DoesNotExist:
-                cliente = None
-        else:
-            cliente = None
-    
-    if not cliente:
-        messages.error(request, "Primero debes completar tus datos de envío.")
-        return redirect("checkout_datos")
-
-    # Calcular totales y preparar items
-    subtotal = Decimal("0.00")
-    impuestos = Decimal("0.00")
-    coste_entrega = Decimal("0.00")
-    descuento = Decimal("0.00")
+        messages.error(request, "El código promocional no es válido.")
+    return redirect("detalles_pago")
 
-    line_items = []          # para Stripe
-    items_lista = []         # para crear ItemPedido
 
-    for key, cantidad in cart.items():
-        key_str = str(key)
-        if ":" in key_str:
-            pid_str, talla = key_str.split(":", 1)
-        else:
-            pid_str = key_str
-            talla = ""
-
-        try:
-            producto = Producto.objects.get(pk=int(pid_str))
-        except Producto.DoesNotExist:
-            # Debug opcional:
-            # print("⚠ Producto no encontrado en checkout_stripe, id =", pid_str)
-            continue
-
-        cantidad = int(cantidad)
-        precio_unitario = producto.precio_oferta or producto.precio or Decimal("0.00")
-        total_item = precio_unitario * cantidad
-
-        subtotal += total_item
-
-        items_lista.append((producto, talla, cantidad, precio_unitario, total_item))
+def crear_lineas_pedido(pedido, presupuesto):
+    """Crea las líneas del pedido con los precios del presupuesto."""
+    for linea in presupuesto.lineas:
+        ItemPedido.objects.create(
+            pedido=pedido,
+            producto_id=linea.producto_id,
+            nombre_producto=linea.nombre,
+            talla=linea.talla,
+            cantidad=linea.cantidad,
+            precio_unitario=linea.precio_unitario,
+            total=linea.total,
+        )
 
-        line_items.append({
-            "price_data": {
-                "currency": "eur",
-                "product_data": {"name": producto.nombre},
-                "unit_amount": int(precio_unitario * 100),  # en céntimos
-            },
-            "quantity": cantidad,
-        })
 
-    # Si no hay ningún producto válido, vaciamos carrito y salimos
-    if not items_lista:
-        request.session["cart"] = {}
-        request.session.modified = True
-        messages.error(
-            request,
-            "Tu carrito se ha vaciado porque los productos ya no están disponibles."
-        )
-        return redirect("cart")
+PAGO_TARJETA_NO_DISPONIBLE = (
+    "El pago con tarjeta no está disponible en este momento. "
+    "Inténtalo de nuevo en unos minutos o paga contrareembolso."
+)
 
-    impuestos = (subtotal * Decimal("0.10")).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
 
-    shipping_method = request.session.get('shipping_method', 'delivery')
-    
-    if shipping_method == 'pickup':
-        coste_entrega = Decimal("0.00")
+def _pedido_reenviado(request):
+    """
+    Pedido ya creado con la clave de idempotencia del formulario (doble clic,
+    reintento del navegador) si es del mismo cliente, o None. Una consulta
+    por el índice único.
+    """
+    clave = request.POST.get("clave_idempotencia", "").strip()
+    if not clave:
+        return None
+    pedido = Pedido.objects.select_related("cliente").filter(clave_idempotencia=clave).first()
+    if pedido is None or pedido.cliente is None:
+        return None
+    if request.user.is_authenticated:
+        propio = pedido.cliente.user_id == request.user.pk
     else:
-        coste_entrega = Decimal("0.00") if subtotal >= Decimal("30.00") else Decimal("2.99")
-
-    total = subtotal + impuestos + coste_entrega - descuento
-
-    # Crear Pedido
-    pedido = Pedido.objects.create(
-        cliente=cliente,
-        numero_pedido=generar_numero_pedido(),
-        subtotal=subtotal,
-        impuestos=impuestos,
-        coste_entrega=coste_entrega,
-        descuento=descuento,
-        total=total,
-        estado=Pedido.Estados.PENDIENTE,
-        metodo_pago="stripe_test",
-        direccion_envio=cliente.direccion,
-        telefono=cliente.telefono,
-    )
+        propio = pedido.cliente.user_id is None and pedido.cliente_id == request.session.get("guest_cliente_id")
+    return pedido if propio else None
 
-    # Crear Items de pedido
-    for producto, talla, cantidad, precio_unitario, total_item in items_lista:
-        ItemPedido.objects.create(
-            pedido=pedido,
-            producto=producto,
-            talla=talla,
-            cantidad=cantidad,
-            precio_unitario=precio_unitario,
-            total=total_item,
-        )
 
+def crear_pedido(request, cliente, presupuesto, metodo_pago, descontar_stock=False):
+    """
+    Crea el pedido con sus líneas (y resta el stock si `descontar_stock`) en
+    una transacción, guardando la clave de idempotencia del formulario.
+    Devuelve (pedido, creado): si otra petición con la misma clave se ha
+    adelantado, el índice único lo impide y se devuelve el suyo.
+    """
+    clave = request.POST.get("clave_idempotencia", "").strip()[:64] or None
+    numero = numeracion.numero_pedido()  # fuera de la transacción: usa el bloque del proceso
+    try:
+        with transaction.atomic():
+            pedido = Pedido.objects.create(
+                cliente=cliente,
+                numero_pedido=numero,
+                subtotal=presupuesto.subtotal,
+                impuestos=presupuesto.impuestos,
+                coste_entrega=presupuesto.coste_entrega,
+                descuento=presupuesto.descuento,
+                total=presupuesto.total,
+                estado=Pedido.Estados.PENDIENTE,
+                metodo_pago=metodo_pago,
+                direccion_envio=cliente.direccion,
+                telefono=cliente.telefono,
+                clave_idempotencia=clave,
+            )
+            crear_lineas_pedido(pedido, presupuesto)
+            if descontar_stock:
+                pedido.descontar_stock()
+    except IntegrityError:
+        existente = _pedido_reenviado(request)
+        if existente is None:
+            raise
+        return existente, False
+    metricas.checkouts.inc(metodo_pago=metodo_pago, resultado="creado")
+    return pedido, True
+
+
+def sesion_stripe(request, pedido):
+    """
+    Crea la sesión de Stripe Checkout del pedido y guarda su id y URL.
+    Lleva la clave de idempotencia del pedido: si se repite la llamada (un
+    reenvío antes de guardar la sesión), Stripe devuelve la misma sesión.
+    """
     # Enviar a Stripe un único `line_item` con el total final (incluye impuestos y envío)
     # para que la pantalla de Checkout muestre claramente el importe total.
     summary_line = [
@@ -1344,7 +1248,7 @@ def checkout_stripe(request):
             "price_data": {
                 "currency": "eur",
                 "product_data": {"name": f"Pedido {pedido.numero_pedido} (importe total)"},
-                "unit_amount": int(total * 100),
+                "unit_amount": int(pedido.total * 100),
             },
             "quantity": 1,
         }
@@ -1352,11 +1256,11 @@ def checkout_stripe(request):
 
     metadata = {
         "pedido_id": str(pedido.id_pedido),
-        "subtotal": str(subtotal),
-        "impuestos": str(impuestos),
-        "coste_entrega": str(coste_entrega),
-        "descuento": str(descuento),
-        "total": str(total),
+        "subtotal": str(pedido.subtotal),
+        "impuestos": str(pedido.impuestos),
+        "coste_entrega": str(pedido.coste_entrega),
+        "descuento": str(pedido.descuento),
+        "total": str(pedido.total),
     }
 
     session = stripe.checkout.Session.create(
@@ -1370,123 +1274,122 @@ def checkout_stripe(request):
         cancel_url=request.build_absolute_uri(
             reverse("pago_cancelado", args=[pedido.id_pedido])
         ),
+        idempotency_key=f"checkout-{pedido.clave_idempotencia or pedido.numero_pedido}",
     )
+    pedido.sesion_stripe_id = session.id
+    pedido.sesion_stripe_url = session.url
+    pedido.save(update_fields=["sesion_stripe_id", "sesion_stripe_url"])
+    return session.url
 
-    return redirect(session.url, code=303)
 
-def checkout_contrareembolso(request):
-    # 1) Comprobar carrito
-    cart = request.session.get("cart", {})
+def redirigir_a_stripe(request, pedido):
+    """Redirige a la sesión de Stripe del pedido; si Stripe no responde, vuelve al resumen de pago."""
+    try:
+        url = pedido.sesion_stripe_url or sesion_stripe(request, pedido)
+    except stripe.APIConnectionError as e:
+        print("❌ Stripe no disponible:", e)
+        metricas.checkouts.inc(metodo_pago=pedido.metodo_pago, resultado="stripe_no_disponible")
+        messages.error(request, PAGO_TARJETA_NO_DISPONIBLE)
+        return redirect("detalles_pago")
+    return redirect(url, code=303)
+
+
+def respuesta_pedido_reenviado(request, pedido):
+    """Respuesta a un checkout reenviado: la del pedido ya creado, sin repetir nada."""
+    metricas.checkouts.inc(metodo_pago=pedido.metodo_pago, resultado="reenviado")
+    if pedido.estado == Pedido.Estados.CANCELADO:
+        messages.error(request, f"El pedido {pedido.numero_pedido} está cancelado.")
+        return redirect("cart")
+    if pedido.metodo_pago == "stripe_test" and pedido.estado == Pedido.Estados.PENDIENTE:
+        return redirigir_a_stripe(request, pedido)
+    return render(request, "pago_ok.html", {"pedido": pedido})
+
+
+def checkout_stripe(request):
+    if request.method != "POST":
+        return redirect("detalles_pago")
+
+    # Reenvío del mismo formulario: el pedido y la sesión de Stripe ya existen
+    pedido = _pedido_reenviado(request)
+    if pedido is not None:
+        return respuesta_pedido_reenviado(request, pedido)
+
+    cart = carrito.leer_carrito(request)
     if not cart:
         messages.error(request, "Tu carrito está vacío.")
         return redirect("cart")
 
-    # 2) Obtener cliente: autenticado o invitado (usar guest_cliente_id usado en checkout_datos)
-    if request.user.is_authenticated:
-        cliente = getattr(request.user, "cliente", None)
-    else:
-        guest_cliente_id = request.session.get('guest_cliente_id')
-        if guest_cliente_id:
-            try:
-                cliente = Cliente.objects.get(pk=guest_cliente_id, user__isnull=True)
-            except Cliente.DoesNotExist:
-                cliente = None
-        else:
-            cliente = None
-
+    # Cliente autenticado o invitado (ClienteMiddleware)
+    cliente = request.cliente
     if not cliente:
         messages.error(request, "Primero debes completar tus datos de envío.")
         return redirect("checkout_datos")
 
-    # 3) Reconstruir items y totales igual que en detalles_pago / Stripe
-    items_lista = []
-    subtotal = Decimal("0.00")
+    # El presupuesto de detalles_pago si el carrito no ha cambiado
+    presupuesto = precios.presupuesto(request, cart)
 
-    for key, cantidad in cart.items():
-        key_str = str(key)
-        if ":" in key_str:
-            pid_str, talla = key_str.split(":", 1)
-        else:
-            pid_str = key_str
-            talla = ""
+    # Si no hay ningún producto válido, vaciamos carrito y salimos
+    if not presupuesto.lineas:
+        carrito.vaciar(request)
+        messages.error(
+            request,
+            "Tu carrito se ha vaciado porque los productos ya no están disponibles."
+        )
+        return redirect("cart")
+
+    # Con el interruptor de Stripe abierto no se crea un pedido que no se podría pagar
+    if not integraciones.disponible("stripe"):
+        metricas.checkouts.inc(metodo_pago="stripe_test", resultado="stripe_no_disponible")
+        messages.error(request, PAGO_TARJETA_NO_DISPONIBLE)
+        return redirect("detalles_pago")
 
-        producto = get_object_or_404(Producto, pk=int(pid_str))
-        cantidad = int(cantidad)
-        precio_unitario = producto.precio_oferta or producto.precio or Decimal("0.00")
-        total_item = precio_unitario * cantidad
+    pedido, creado = crear_pedido(request, cliente, presupuesto, "stripe_test")
+    if not creado:
+        return respuesta_pedido_reenviado(request, pedido)
 
-        subtotal += total_item
-        items_lista.append((producto, talla, cantidad, precio_unitario, total_item))
+    return redirigir_a_stripe(request, pedido)
 
-    impuestos = (subtotal * Decimal("0.10")).quantize(Decimal("0.01"))  # o tu regla
-    if subtotal >= Decimal("30.00"):
-        coste_entrega = Decimal("0.00")
-    else:
-        coste_entrega = Decimal("2.99")
+def checkout_contrareembolso(request):
+    # 0) Reenvío del mismo formulario: el pedido ya existe y el stock ya se restó
+    pedido = _pedido_reenviado(request)
+    if pedido is not None:
+        return respuesta_pedido_reenviado(request, pedido)
 
-    descuento = Decimal("0.00")
-    total = subtotal + impuestos + coste_entrega - descuento
+    # 1) Comprobar carrito
+    cart = carrito.leer_carrito(request)
+    if not cart:
+        messages.error(request, "Tu carrito está vacío.")
+        return redirect("cart")
 
-    shipping_method = request.session.get("shipping_method", "delivery")
-    # 4) Crear Pedido en BD con método contrareembolso
-    pedido = Pedido.objects.create(
-        cliente=cliente,
-        numero_pedido=generar_numero_pedido(),
-        subtotal=subtotal,
-        impuestos=impuestos,
-        coste_entrega=coste_entrega,
-        descuento=descuento,
-        total=total,
-        estado=Pedido.Estados.PENDIENTE,
-        metodo_pago="contrareembolso",
-        direccion_envio=cliente.direccion,
-        telefono=cliente.telefono,
-    )
+    # 2) Cliente autenticado o invitado (ClienteMiddleware)
+    cliente = request.cliente
+    if not cliente:
+        messages.error(request, "Primero debes completar tus datos de envío.")
+        return redirect("checkout_datos")
 
-    # 5) Crear líneas de pedido
-    for producto, talla, cantidad, precio_unitario, total_item in items_lista:
-        ItemPedido.objects.create(
-            pedido=pedido,
-            producto=producto,
-            talla=talla,
-            cantidad=cantidad,
-            precio_unitario=precio_unitario,
-            total=total_item,
+    # 3) Presupuesto de detalles_pago si el carrito no ha cambiado (misma regla que Stripe)
+    presupuesto = precios.presupuesto(request, cart)
+    if not presupuesto.lineas:
+        carrito.vaciar(request)
+        messages.error(
+            request,
+            "Tu carrito se ha vaciado porque los productos ya no están disponibles."
         )
+        return redirect("cart")
 
-    # 5b) Restar stock de los productos comprados (similar a pago_ok)
+    shipping_method = presupuesto.envio
+
+    # 4) Crear Pedido en BD con método contrareembolso, con sus líneas
+    # 5) Restar stock de los productos comprados (similar a pago_ok)
     # Es importante decrementar el stock aquí también para contrareembolso
     # para evitar sobreventa cuando el pedido queda pendiente de pago en entrega.
-    for item in pedido.items.all():
-        producto = item.producto
-        cantidad = item.cantidad
-        talla = item.talla or ''
-
-        if talla:
-            try:
-                talla_obj = TallaProducto.objects.get(producto=producto, talla=talla)
-                if talla_obj.stock >= cantidad:
-                    talla_obj.stock -= cantidad
-                    talla_obj.save()
-                else:
-                    # Ajustar a 0 y avisar por consola (no romper el flujo)
-                    print(f"⚠ Advertencia: Stock insuficiente para {producto.nombre} talla {talla}. Stock actual: {talla_obj.stock}, solicitado: {cantidad}")
-                    talla_obj.stock = 0
-                    talla_obj.save()
-            except TallaProducto.DoesNotExist:
-                print(f"⚠ Error: No se encontró la talla '{talla}' para el producto {producto.nombre}")
-        else:
-            if producto.stock >= cantidad:
-                producto.stock -= cantidad
-                producto.save()
-            else:
-                print(f"⚠ Advertencia: Stock insuficiente para {producto.nombre}. Stock actual: {producto.stock}, solicitado: {cantidad}")
-                producto.stock = 0
-                producto.save()
+    pedido, creado = crear_pedido(request, cliente, presupuesto, "contrareembolso", descontar_stock=True)
+    if not creado:
+        return respuesta_pedido_reenviado(request, pedido)
 
     # 6) Vaciar carrito
-    request.session["cart"] = {}
-    request.session.modified = True
+    carrito.vaciar(request)
+    precios.olvidar(request)
 
     # 7) Enviar email
     try:
@@ -1606,50 +1509,26 @@ def enviar_email_contrareembolso(pedido, shipping_method):
         html_content=html,
     )
 
-    sg = SendGridAPIClient(settings.SENDGRID_API_KEY)
-    sg.send(mensaje)
+    integraciones.enviar_email(mensaje)
 
 
 
 def pago_ok(request, pedido_id):
     pedido = get_object_or_404(Pedido, id_pedido=pedido_id)
     
-    # Solo procesar si el pedido aún no está pagado (evitar procesar dos veces)
-    if pedido.estado != Pedido.Estados.PAGADO:
-        pedido.estado = Pedido.Estados.PAGADO
-        pedido.save()
-        
-        # Restar stock de los productos comprados
-        items = pedido.items.all()
-        for item in items:
-            producto = item.producto
-            cantidad = item.cantidad
-            talla = item.talla or ''
-            
-            if talla:
-                # Si el producto tiene talla, restar del stock de la talla específica
-                try:
-                    talla_obj = TallaProducto.objects.get(producto=producto, talla=talla)
-                    if talla_obj.stock >= cantidad:
-                        talla_obj.stock -= cantidad
-                        talla_obj.save()
-                    else:
-                        # Si no hay suficiente stock, ajustar a 0 (no debería pasar si la validación es correcta)
-                        print(f"⚠ Advertencia: Stock insuficiente para {producto.nombre} talla {talla}. Stock actual: {talla_obj.stock}, solicitado: {cantidad}")
-                        talla_obj.stock = 0
-                        talla_obj.save()
-                except TallaProducto.DoesNotExist:
-                    print(f"⚠ Error: No se encontró la talla '{talla}' para el producto {producto.nombre}")
-            else:
-                # Si no tiene talla, restar del stock general del producto
-                if producto.stock >= cantidad:
-                    producto.stock -= cantidad
-                    producto.save()
-                else:
-                    # Si no hay suficiente stock, ajustar a 0
-                    print(f"⚠ Advertencia: Stock insuficiente para {producto.nombre}. Stock actual: {producto.stock}, solicitado: {cantidad}")
-                    producto.stock = 0
-                    producto.save()
+    # Solo procesar si el pedido sigue pendiente (evitar procesar dos veces)
+    if pedido.puede_cambiar_a(Pedido.Estados.PAGADO):
+        try:
+            with transaction.atomic():
+                pedido.cambiar_estado(Pedido.Estados.PAGADO, nota="Pago confirmado por Stripe")
+                # Restar stock de los productos comprados
+                pedido.descontar_stock()
+        except ValidationError:
+            # Otra petición (la redirección de Stripe y una recarga) lo ha pagado
+            # entre la comprobación y el bloqueo de la fila: ya está procesado
+            pedido.refresh_from_db()
+        else:
+            metricas.checkouts.inc(metodo_pago=pedido.metodo_pago, resultado="pagado")
     shipping_method = request.session.get("shipping_method", "delivery")
 
     if shipping_method == "pickup":
@@ -1673,7 +1552,7 @@ def pago_ok(request, pedido_id):
         try:
             precio_unitario = getattr(item, "precio_unitario", None)
             if precio_unitario is None:
-                precio_unitario = item.producto.precio_oferta or item.producto.precio or Decimal("0.00")
+                precio_unitario = item.producto.precio_efectivo
             total_item = (precio_unitario * (getattr(item, 'cantidad', 0) or 0)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
         except Exception:
             total_item = Decimal("0.00")
@@ -1792,23 +1671,32 @@ def pago_ok(request, pedido_id):
     )
 
     try:
-        sg = SendGridAPIClient(settings.SENDGRID_API_KEY)
-        sg.send(mensaje)
+        integraciones.enviar_email(mensaje)
         print("✔ Email enviado correctamente")
     except Exception as e:
         print("❌ Error enviando email:", e)
 
 
     # vaciar carrito
-    request.session["cart"] = {}
-    request.session.modified = True
+    carrito.vaciar(request)
+    precios.olvidar(request)
 
     return render(request, "pago_ok.html", {"pedido": pedido})
 
 
 def pago_cancelado(request, pedido_id):
     pedido = get_object_or_404(Pedido, id_pedido=pedido_id)
-    pedido.estado = Pedido.Estados.CANCELADO
-    pedido.save()
+    # Solo se cancela desde aquí un pedido que no llegó a pagarse
+    if pedido.estado == Pedido.Estados.PENDIENTE:
+        pedido.cambiar_estado(Pedido.Estados.CANCELADO, nota="Pago cancelado en Stripe")
+        metricas.checkouts.inc(metodo_pago=pedido.metodo_pago, resultado="cancelado")
 
     return render(request, "pago_cancelado.html", {"pedido": pedido})
+
+
+def metricas_prometheus(request):
+    """Métricas de la tienda en formato de texto de Prometheus (ver home/metricas.py)."""
+    token = getattr(settings, "METRICAS_TOKEN", "")
+    if token and not secrets.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return HttpResponse(status=403)
+    return HttpResponse(metricas.exponer(), content_type="text/plain; version=0.0.4; charset=utf-8")
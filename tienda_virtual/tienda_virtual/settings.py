@@ -47,21 +47,34 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'home.middleware.TiemposMiddleware',  # Server-Timing (TIEMPOS_MUESTREO)
+    'home.middleware.MetricasMiddleware',  # /metrics
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',  # ← añade esta línea aquí
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'home.middleware.ClienteMiddleware',  # request.cliente
+    'home.middleware.LimitePeticionesMiddleware',  # LIMITES_PETICIONES
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Carga el usuario de la sesión con su Cliente en una sola consulta. ModelBackend
+# sigue detrás para las sesiones abiertas antes del cambio (guardan su ruta):
+# los inicios de sesión nuevos pasan por ClienteBackend, que va primero
+AUTHENTICATION_BACKENDS = [
+    'home.backends.ClienteBackend',
+    'django.contrib.auth.backends.ModelBackend',
+]
+
 ROOT_URLCONF = 'tienda_virtual.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates que cronometra cada render para Server-Timing
+        'BACKEND': 'home.tiempos.DjangoTemplatesMedidas',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -85,6 +98,8 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Espera a que termine otra escritura en lugar de fallar con "database is locked"
+        'OPTIONS': {'timeout': 20},
     }
 }
 
@@ -142,6 +157,73 @@ STRIPE_PUBLISHABLE_KEY = os.getenv("STRIPE_PUBLISHABLE_KEY")
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY")
 # ==========================
 
+# Minutos que se aparta el stock al añadir al carrito (0 = sin reservas)
+RESERVA_STOCK_MINUTOS = int(os.getenv("RESERVA_STOCK_MINUTOS", "0"))
+
+# Días sin cambios tras los que `manage.py liberar_reservas` borra un carrito sin cliente
+CARRITO_ABANDONADO_DIAS = int(os.getenv("CARRITO_ABANDONADO_DIAS", "30"))
+
+# Horas tras las que se cancela un pedido con pago online que sigue pendiente
+# (una sesión de Stripe Checkout caduca a las 24 h)
+PEDIDO_PENDIENTE_HORAS = int(os.getenv("PEDIDO_PENDIENTE_HORAS", "25"))
+
+# Caché de Django. Por defecto en memoria de cada proceso: con varios workers
+# las invalidaciones (seguimiento, versión de promociones y del buscador) y los
+# cubos de límites de peticiones no se comparten entre ellos. En producción
+# conviene una compartida, p. ej. CACHE_BACKEND=django.core.cache.backends.db.DatabaseCache
+# con CACHE_LOCATION=cache_tienda (crear la tabla con `manage.py createcachetable`)
+CACHES = {
+    "default": {
+        "BACKEND": os.getenv("CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"),
+        "LOCATION": os.getenv("CACHE_LOCATION", ""),
+    }
+}
+
+# Seguimiento de pedidos: segundos en caché por número y consultas por minuto y IP
+SEGUIMIENTO_CACHE_SEGUNDOS = int(os.getenv("SEGUIMIENTO_CACHE_SEGUNDOS", "60"))
+SEGUIMIENTO_CONSULTAS_POR_MINUTO = int(os.getenv("SEGUIMIENTO_CONSULTAS_POR_MINUTO", "30"))
+
+# Límite de peticiones por nombre de URL (home/limites.py): "N/s", "N/m" o "N/h"
+# por IP y por sesión. Detrás de un proxy, cabecera con la IP real del cliente
+LIMITES_PETICIONES = {
+    "add_to_cart": {"por_ip": "120/m", "por_sesion": "60/m", "metodos": ["POST"]},
+    "cart_update": {"por_ip": "120/m", "por_sesion": "60/m", "metodos": ["POST"]},
+    "cart_decrement": {"por_ip": "120/m", "por_sesion": "60/m", "metodos": ["POST"]},
+    "cart_remove": {"por_ip": "120/m", "por_sesion": "60/m", "metodos": ["POST"]},
+    "cart_clear": {"por_ip": "30/m", "por_sesion": "10/m", "metodos": ["POST"]},
+    # Un token por operación del lote (hasta carrito.MAX_OPERACIONES por petición)
+    "cart_batch": {"por_ip": "240/m", "por_sesion": "120/m", "metodos": ["POST"], "por_operacion": True},
+    "cart_status": {"por_ip": "240/m", "por_sesion": "120/m"},
+    "contacto": {"por_ip": "10/h", "por_sesion": "5/h", "metodos": ["POST"]},
+    "login": {"por_ip": "30/m", "por_sesion": "10/m", "metodos": ["POST"]},
+}
+LIMITES_CABECERA_IP = os.getenv("LIMITES_CABECERA_IP", "")
+
+# Cada cuántos segundos miran los índices en memoria (búsqueda y promociones,
+# home/indice_local.py) si otro worker los ha invalidado a través de la caché
+INDICES_COMPROBAR_VERSION = float(os.getenv("INDICES_COMPROBAR_VERSION", "1"))
+
+# Fracción de peticiones (0 a 1) que se miden y se registran en el logger
+# home.tiempos (home/tiempos.py); Server-Timing solo para el personal o con DEBUG.
+# Desactivado salvo que se configure (en producción, p. ej. 0.05)
+TIEMPOS_MUESTREO = float(os.getenv("TIEMPOS_MUESTREO", "0"))
+
+# Métricas de /metrics (home/metricas.py): directorio compartido por los workers
+# (vaciarlo al desplegar), cada cuántos segundos vuelca cada uno y token opcional
+# que hay que mandar como "Authorization: Bearer <token>"
+METRICAS_DIR = os.getenv("METRICAS_DIR", "")
+METRICAS_INTERVALO = float(os.getenv("METRICAS_INTERVALO", "1"))
+METRICAS_TOKEN = os.getenv("METRICAS_TOKEN", "")
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {"consola": {"class": "logging.StreamHandler"}},
+    "loggers": {
+        "home.tiempos": {"handlers": ["consola"], "level": "INFO", "propagate": False},
+    },
+}
+
 # === Email settings (using SendGrid) ===
 import os
 from dotenv import load_dotenv
@@ -149,4 +231,13 @@ from dotenv import load_dotenv
 load_dotenv()
 
 SENDGRID_API_KEY = os.getenv("SENDGRID_API_KEY")
-EMAIL_FROM = os.getenv("EMAIL_FROM")
\ No newline at end of file
+EMAIL_FROM = os.getenv("EMAIL_FROM")
+SENDGRID_API_URL = os.getenv("SENDGRID_API_URL", "https://api.sendgrid.com")
+
+# Llamadas a Stripe y SendGrid (home/integraciones.py): timeouts en segundos,
+# reintentos por llamada y fallos seguidos que abren el interruptor (y cuánto dura abierto)
+INTEGRACIONES_TIMEOUT_CONEXION = float(os.getenv("INTEGRACIONES_TIMEOUT_CONEXION", "3"))
+INTEGRACIONES_TIMEOUT_LECTURA = float(os.getenv("INTEGRACIONES_TIMEOUT_LECTURA", "10"))
+INTEGRACIONES_REINTENTOS = int(os.getenv("INTEGRACIONES_REINTENTOS", "2"))
+INTEGRACIONES_FALLOS_CIRCUITO = int(os.getenv("INTEGRACIONES_FALLOS_CIRCUITO", "5"))
+INTEGRACIONES_SEGUNDOS_CIRCUITO = int(os.getenv("INTEGRACIONES_SEGUNDOS_CIRCUITO", "30"))
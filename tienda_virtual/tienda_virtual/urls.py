@@ -29,7 +29,9 @@ urlpatterns = [
     path('cart/update/', home_views.cart_update, name='cart_update'),
     path('cart/clear/', home_views.cart_clear, name='cart_clear'),
     path('cart/status/', home_views.cart_status, name='cart_status'),
+    path('cart/batch/', home_views.cart_batch, name='cart_batch'),
     path('cart/', home_views.cart_view, name='cart'),
+    path('buscar/autocompletar/', home_views.buscar_autocompletar, name='buscar_autocompletar'),
     path('novedades/', home_views.novedades, name='novedades'),
     path('productos/', home_views.productos, name='productos'),
     path('producto/<int:product_id>/', home_views.product_detail, name='product_detail'),
@@ -40,6 +42,7 @@ urlpatterns = [
     path('categorias/', home_views.categorias, name='categorias'),
     path("checkout/datos/", home_views.checkout_datos_cliente_envio, name="checkout_datos"),
     path("checkout/pago/", home_views.detalles_pago, name="detalles_pago"),
+    path("checkout/codigo/", home_views.aplicar_codigo_promocion, name="aplicar_codigo_promocion"),
     path("checkout/stripe/", home_views.checkout_stripe, name="checkout_stripe"),
     path("checkout/contrareembolso/", home_views.checkout_contrareembolso, name="checkout_contrareembolso"),
     path("pago/ok/<int:pedido_id>/", home_views.pago_ok, name="pago_ok"),
@@ -47,7 +50,10 @@ urlpatterns = [
     path("cuenta/registro/", home_views.register, name="register"),
     path("cuenta/login/", home_views.login_view, name="login"),
     path("cuenta/logout/", home_views.logout_view, name="logout"),
+    path("cuenta/pedidos/", home_views.mis_pedidos, name="mis_pedidos"),
     path("seguimiento/", home_views.seguimiento_pedido, name="tracking"),
+    path("seguimiento/<str:numero_pedido>/", home_views.seguimiento_pedido, name="tracking_pedido"),
+    path("metrics", home_views.metricas_prometheus, name="metricas"),
     path('', home_views.index, name='home'),
 
 ]
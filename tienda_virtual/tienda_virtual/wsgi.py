@@ -7,6 +7,7 @@ For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/wsgi/
 """
 
+import logging
 import os
 
 from django.core.wsgi import get_wsgi_application
@@ -14,3 +15,11 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tienda_virtual.settings')
 
 application = get_wsgi_application()
+
+# Construir el índice del autocompletado al arrancar el worker y no en la primera búsqueda
+try:
+    from home import search_index
+
+    search_index.precargar()
+except Exception:
+    logging.getLogger(__name__).warning("No se pudo precargar el índice de búsqueda", exc_info=True)